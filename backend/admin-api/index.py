@@ -4,127 +4,884 @@ Args: event with httpMethod, body, queryStringParameters; context with request_i
 Returns: HTTP response with admin data or operation results
 """
 
+import base64
+import gzip
+import hashlib
+import hmac
 import json
 import os
-from typing import Dict, Any
+import random
+import re
+import threading
+from bisect import bisect_left
+from contextvars import ContextVar
+from functools import lru_cache
+from itertools import groupby, repeat
+from operator import itemgetter
+import time
+from collections import OrderedDict
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Dict, Any, Iterator, List, Optional, Tuple, Callable
 import psycopg2
 from psycopg2.extras import RealDictCursor
 import requests
 from decimal import Decimal
-from datetime import datetime
+from datetime import date, datetime, timezone
+
+def connect_database(dsn: Optional[str] = None):
+    # Long-running hosts (server/) replace this with a pooled factory; close() hands the connection back.
+    return psycopg2.connect(dsn or os.environ['DATABASE_URL'])
 
 def get_db_connection():
-    return psycopg2.connect(os.environ['DATABASE_URL'])
+    started = time.perf_counter()
+    state = _request_state.get()
+    conn = None
+    if state is not None and state['replica']:
+        conn = connect_replica(state['read_after'])
+        state['read_from'] = 'primary' if conn is None else 'replica'
+    if conn is None:
+        conn = connect_database()
+    if state is None:
+        return conn
+    state['connect_seconds'] += time.perf_counter() - started
+    return TimedConnection(conn, state['queries']) if state['sampled'] else conn
+
+# Read replicas (streaming standbys of DATABASE_URL). Read-only GET actions go to the next replica
+# (round_robin) or the fastest one (least_latency) whose replay lag is within REPLICA_MAX_LAG_SECONDS,
+# and to the primary otherwise. Successful writes answer with X-Read-After, the primary's WAL position;
+# a GET that sends it back is only served by a replica that has replayed that far. Callers that do not
+# echo it read from the primary for READ_YOUR_WRITES_SECONDS after writing through this instance.
+REPLICA_DSNS = [dsn.strip() for dsn in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if dsn.strip()]
+REPLICA_SELECTION = os.environ.get('REPLICA_SELECTION', 'round_robin')
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get('REPLICA_MAX_LAG_SECONDS', '5'))
+REPLICA_CHECK_SECONDS = float(os.environ.get('REPLICA_CHECK_SECONDS', '1'))
+REPLICA_RETRY_SECONDS = 10.0
+READ_YOUR_WRITES_SECONDS = float(os.environ.get('READ_YOUR_WRITES_SECONDS', '10'))
+READ_AFTER_HEADER = 'X-Read-After'
+RECENT_WRITERS_LIMIT = 4096
+# Lag is zero while everything received is replayed, so an idle primary does not look like lag.
+REPLICA_STATUS_SQL = """
+    SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                ELSE COALESCE(EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - pg_last_xact_replay_timestamp())::float8, 'Infinity')
+           END,
+           (CASE WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn() ELSE pg_current_wal_lsn() END - '0/0'::pg_lsn)::bigint
+"""
+_replica_lock = threading.Lock()
+_replicas: List[Dict[str, Any]] = [
+    {'dsn': dsn, 'checked_at': float('-inf'), 'lag': 0.0, 'replayed': 0, 'latency': 0.0, 'down_until': 0.0}
+    for dsn in REPLICA_DSNS
+]
+_replica_turn = [0]
+_recent_writers: 'OrderedDict[str, float]' = OrderedDict()
+
+def parse_lsn(value: str) -> Optional[int]:
+    high, separator, low = value.strip().partition('/')
+    try:
+        return (int(high, 16) << 32) + int(low, 16) if separator else None
+    except ValueError:
+        return None
+
+def request_caller(event: Dict[str, Any]) -> str:
+    forwarded = get_request_header(event, 'x-forwarded-for').split(',')[0].strip()
+    return forwarded or ((event.get('requestContext') or {}).get('identity') or {}).get('sourceIp') or ''
+
+def route_read(event: Dict[str, Any]) -> bool:
+    """Sends this request's reads to a replica; False when its result is specific to the caller."""
+    state = _request_state.get()
+    if not REPLICA_DSNS or state is None:
+        return True
+    read_after = parse_lsn(get_request_header(event, 'x-read-after'))
+    if read_after is None:
+        caller = request_caller(event)
+        with _replica_lock:
+            recent = caller and _recent_writers.get(caller, 0.0) > time.monotonic()
+        if recent:
+            state['read_from'] = 'primary'
+            return False
+    state['replica'] = True
+    state['read_after'] = read_after
+    return read_after is None
+
+def remember_write(event: Dict[str, Any], conn, response: Dict[str, Any]) -> None:
+    cursor = conn.cursor()
+    cursor.execute('SELECT pg_current_wal_lsn()::text')
+    response['headers'] = {**response['headers'], READ_AFTER_HEADER: cursor.fetchone()[0],
+                           'Access-Control-Expose-Headers': READ_AFTER_HEADER}
+    caller = request_caller(event)
+    if caller:
+        with _replica_lock:
+            _recent_writers[caller] = time.monotonic() + READ_YOUR_WRITES_SECONDS
+            _recent_writers.move_to_end(caller)
+            if len(_recent_writers) > RECENT_WRITERS_LIMIT:
+                _recent_writers.popitem(last=False)
+
+def replica_candidates() -> List[Dict[str, Any]]:
+    now = time.monotonic()
+    with _replica_lock:
+        # A lagging replica stays a candidate once its status is stale, so it is checked again.
+        usable = [replica for replica in _replicas if replica['down_until'] <= now and (
+            replica['lag'] <= REPLICA_MAX_LAG_SECONDS or now - replica['checked_at'] >= REPLICA_CHECK_SECONDS)]
+        if REPLICA_SELECTION == 'least_latency':
+            return sorted(usable, key=lambda replica: replica['latency'])
+        _replica_turn[0] += 1
+        start = _replica_turn[0] % len(usable) if usable else 0
+        return usable[start:] + usable[:start]
+
+def check_replica(replica: Dict[str, Any], conn) -> None:
+    started = time.perf_counter()
+    cursor = conn.cursor()
+    cursor.execute(REPLICA_STATUS_SQL)
+    lag, replayed = cursor.fetchone()
+    elapsed = time.perf_counter() - started
+    with _replica_lock:
+        replica['lag'] = float(lag)
+        replica['replayed'] = replayed
+        replica['checked_at'] = time.monotonic()
+        replica['latency'] = 0.8 * replica['latency'] + 0.2 * elapsed if replica['latency'] else elapsed
+
+def connect_replica(read_after: Optional[int]):
+    """Connection to a replica that is fresh enough, or None to read from the primary."""
+    for replica in replica_candidates():
+        conn = None
+        try:
+            conn = connect_database(replica['dsn'])
+            if (time.monotonic() - replica['checked_at'] >= REPLICA_CHECK_SECONDS
+                    or (read_after is not None and replica['replayed'] < read_after)):
+                check_replica(replica, conn)
+        except psycopg2.Error:
+            if conn is not None:
+                conn.close()
+            with _replica_lock:
+                replica['down_until'] = time.monotonic() + REPLICA_RETRY_SECONDS
+            continue
+        if replica['lag'] <= REPLICA_MAX_LAG_SECONDS and (read_after is None or replica['replayed'] >= read_after):
+            return conn
+        conn.close()
+    return None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+class Rows:
+    # A result set as fetched: the driver's tuples plus the column names, read once per statement.
+    # Handlers that look at a row get it as a dict; the encoders turn the whole set into objects in
+    # one pass of C-level maps. Numeric columns are cast to text in SQL, so no value calls back.
+    __slots__ = ('keys', 'rows')
+
+    def __init__(self, keys: Tuple[str, ...], rows: List[Tuple]):
+        self.keys = keys
+        self.rows = rows
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __getitem__(self, index: int) -> Dict[str, Any]:
+        return dict(zip(self.keys, self.rows[index]))
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        return map(dict, map(zip, repeat(self.keys), self.rows))
+
+# Timestamps go out as ISO 8601 ('2025-01-02T03:04:05.123456'), as orjson writes them natively.
+JSON_ENCODERS = {
+    Rows: list,
+    Decimal: str,
+    datetime: datetime.isoformat,
+    date: date.isoformat,
+}
+
+def encode_json_value(value: Any) -> Any:
+    encoder = JSON_ENCODERS.get(type(value), str)
+    return encoder(value)
+
+if orjson is not None:
+    def dump_json(payload: Any) -> str:
+        return orjson.dumps(payload, default=encode_json_value).decode()
+else:
+    _json_encoder = json.JSONEncoder(default=encode_json_value, ensure_ascii=False, separators=(',', ':'))
+
+    def dump_json(payload: Any) -> str:
+        return _json_encoder.encode(payload)
+
+def fetch_rows(cursor) -> Rows:
+    return Rows(tuple(column[0] for column in cursor.description), cursor.fetchall())
+
+def enqueue_job(conn, kind: str, payload: Dict[str, Any], priority: int = 0, delay_seconds: float = 0,
+                dedupe_key: Optional[str] = None) -> Optional[int]:
+    # Inserted in the caller's transaction, so the job exists only if the request's writes commit;
+    # server/worker.py runs it. A dedupe_key that is already queued returns the existing job.
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO jobs (kind, payload, priority, run_at, dedupe_key)
+        VALUES (%s, %s, %s, CURRENT_TIMESTAMP + make_interval(secs => %s), %s)
+        ON CONFLICT (dedupe_key) WHERE status = 'queued' DO NOTHING
+        RETURNING id
+    """, (kind, dump_json(payload), priority, delay_seconds, dedupe_key))
+    row = cursor.fetchone()
+    if row is None:
+        cursor.execute("SELECT id FROM jobs WHERE dedupe_key = %s AND status = 'queued'", (dedupe_key,))
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+def transition_exchanges(conn, exchange_ids: List[int], status: str, performed_by: str,
+                         notes: str = '') -> Dict[int, Tuple[Optional[str], bool]]:
+    # Moves the exchanges to status where exchange_transitions (V0014) allows it from their current
+    # status, sets the matching timestamps and logs each move, in one statement and the caller's
+    # transaction. A transition that requires_deposit (V0024) also needs a confirmed deposit or a
+    # completed provider payment. Returns id -> (status before, moved); ids that do not exist map
+    # to (None, False).
+    cursor = conn.cursor()
+    cursor.execute("""
+        WITH current AS (
+            SELECT id, status FROM exchanges WHERE id = ANY(%(ids)s) ORDER BY id FOR UPDATE
+        ), moved AS (
+            UPDATE exchanges e
+            SET status = t.to_status,
+                deposit_confirmed_at = CASE WHEN t.to_status = 'processing'
+                                            THEN COALESCE(e.deposit_confirmed_at, CURRENT_TIMESTAMP)
+                                            ELSE e.deposit_confirmed_at END,
+                withdrawal_confirmed_at = CASE WHEN t.to_status = 'completed' AND e.withdrawal_tx_hash IS NOT NULL
+                                               THEN COALESCE(e.withdrawal_confirmed_at, CURRENT_TIMESTAMP)
+                                               ELSE e.withdrawal_confirmed_at END,
+                completed_at = CASE WHEN t.to_status = 'completed' THEN CURRENT_TIMESTAMP ELSE e.completed_at END
+            FROM current c
+            JOIN exchange_transitions t ON t.from_status = c.status AND t.to_status = %(status)s
+            WHERE e.id = c.id
+              AND (NOT t.requires_deposit
+                   OR EXISTS (SELECT 1 FROM blockchain_transactions b
+                              WHERE b.tx_hash = e.deposit_tx_hash AND b.status = 'confirmed')
+                   OR EXISTS (SELECT 1 FROM payment_provider_transactions p
+                              WHERE p.exchange_id = e.id AND p.status = 'completed'
+                                AND p.currency = e.from_currency))
+            RETURNING e.id, c.status AS status_from
+        ), logged AS (
+            INSERT INTO transaction_logs (exchange_id, action, status_from, status_to, performed_by, notes)
+            SELECT id, 'status_changed', status_from, %(status)s, %(performed_by)s, %(notes)s FROM moved
+        )
+        SELECT r.id, c.status, m.id IS NOT NULL
+        FROM unnest(%(ids)s::int[]) AS r(id)
+        LEFT JOIN current c ON c.id = r.id
+        LEFT JOIN moved m ON m.id = r.id
+    """, {'ids': exchange_ids, 'status': status, 'performed_by': performed_by, 'notes': notes})
+    return {exchange_id: (status_from, moved) for exchange_id, status_from, moved in cursor.fetchall()}
+
+FUNCTION_NAME = 'admin-api'
+# Request instrumentation. Latency histograms (per action, connection acquire,
+# serialization) are always recorded; per-statement timing and the structured log
+# line are kept for a sampled fraction of requests, plus a log line for slow ones.
+METRICS_SAMPLE_RATE = float(os.environ.get('METRICS_SAMPLE_RATE', '0.05'))
+SLOW_REQUEST_SECONDS = float(os.environ.get('SLOW_REQUEST_MS', '500')) / 1000
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+QUERY_TEXT_LIMIT = 200
+_metrics_lock = threading.Lock()
+_histograms: Dict[Tuple[str, Tuple], List[float]] = {}
+_request_counts: Dict[Tuple, int] = {}
+_query_stats: Dict[str, List[Any]] = {}
+_routed_reads: Dict[str, int] = {}
+_request_state: ContextVar[Optional[Dict[str, Any]]] = ContextVar('request_state', default=None)
+_literal_pattern = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_space_pattern = re.compile(r'\s+')
+
+@lru_cache(maxsize=512)
+def query_fingerprint(query: str) -> Tuple[str, str]:
+    normalized = _space_pattern.sub(' ', _literal_pattern.sub('?', query)).strip()
+    return hashlib.blake2b(normalized.encode('utf-8'), digest_size=6).hexdigest(), normalized
+
+class TimedCursor:
+    def __init__(self, cursor, queries: List[Tuple[Any, float, int]]):
+        self._cursor = cursor
+        self._queries = queries
+    
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._cursor, name)
+    
+    def __iter__(self):
+        return iter(self._cursor)
+    
+    def execute(self, query, params=None):
+        started = time.perf_counter()
+        try:
+            return self._cursor.execute(query, params)
+        finally:
+            self._queries.append((query, time.perf_counter() - started, self._cursor.rowcount))
+
+class TimedConnection:
+    def __init__(self, conn, queries: List[Tuple[Any, float, int]]):
+        self._conn = conn
+        self._queries = queries
+    
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._conn, name)
+    
+    def cursor(self, *args, **kwargs) -> TimedCursor:
+        return TimedCursor(self._conn.cursor(*args, **kwargs), self._queries)
+
+def begin_request(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    request_id = getattr(context, 'request_id', None) or get_request_header(event, 'x-request-id')[:128]
+    return {
+        'request_id': request_id or None,
+        'action': None,
+        'sampled': random.random() < METRICS_SAMPLE_RATE,
+        'connect_seconds': 0.0,
+        'serialize_seconds': 0.0,
+        'queries': [],
+        'replica': False,
+        'read_after': None,
+        'read_from': None
+    }
+
+def tag_request(action: str) -> None:
+    state = _request_state.get()
+    if state is not None:
+        state['action'] = action
+
+def observe(name: str, labels: Tuple, seconds: float) -> None:
+    histogram = _histograms.get((name, labels))
+    if histogram is None:
+        histogram = _histograms[(name, labels)] = [0.0] * (len(LATENCY_BUCKETS) + 2)
+    histogram[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+    histogram[-1] += seconds
+
+def finish_request(state: Dict[str, Any], method: str, status_code: int, seconds: float) -> None:
+    action = state['action'] or 'unknown'
+    queries = [(query_fingerprint(query if isinstance(query, str) else str(query)), elapsed, rows)
+               for query, elapsed, rows in state['queries']]
+    
+    with _metrics_lock:
+        observe('request_duration_seconds', (('method', method), ('action', action)), seconds)
+        if state['connect_seconds']:
+            observe('db_connect_duration_seconds', (), state['connect_seconds'])
+        if state['serialize_seconds']:
+            observe('serialization_duration_seconds', (), state['serialize_seconds'])
+        count_key = (('action', action), ('status', str(status_code)))
+        _request_counts[count_key] = _request_counts.get(count_key, 0) + 1
+        if state['read_from']:
+            _routed_reads[state['read_from']] = _routed_reads.get(state['read_from'], 0) + 1
+        for (fingerprint, text), elapsed, rows in queries:
+            stats = _query_stats.get(fingerprint)
+            if stats is None:
+                stats = _query_stats[fingerprint] = [text[:QUERY_TEXT_LIMIT], 0, 0.0, 0]
+            stats[1] += 1
+            stats[2] += elapsed
+            stats[3] += max(rows, 0)
+    
+    if state['sampled'] or seconds >= SLOW_REQUEST_SECONDS:
+        print(dump_json({
+            'level': 'warning' if seconds >= SLOW_REQUEST_SECONDS else 'info',
+            'event': 'request',
+            'function': FUNCTION_NAME,
+            'request_id': state['request_id'],
+            'method': method,
+            'action': action,
+            'status': status_code,
+            'duration_ms': round(seconds * 1000, 3),
+            'db_connect_ms': round(state['connect_seconds'] * 1000, 3),
+            'serialize_ms': round(state['serialize_seconds'] * 1000, 3),
+            'queries': [
+                {'fingerprint': fingerprint, 'ms': round(elapsed * 1000, 3), 'rows': rows}
+                for (fingerprint, _), elapsed, rows in queries
+            ]
+        }), flush=True)
+
+def escape_label(value: Any) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+
+def prometheus_labels(labels: Tuple) -> str:
+    pairs = (('function', FUNCTION_NAME),) + labels
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in pairs) + '}'
+
+def render_metrics() -> str:
+    lines = []
+    with _metrics_lock:
+        histograms = sorted((key, list(values)) for key, values in _histograms.items())
+        request_counts = sorted(_request_counts.items())
+        routed_reads = sorted(_routed_reads.items())
+        query_stats = sorted((fingerprint, list(stats)) for fingerprint, stats in _query_stats.items())
+    
+    declared = set()
+    for (name, labels), values in histograms:
+        metric = f'backend_{name}'
+        if metric not in declared:
+            declared.add(metric)
+            lines.append(f'# TYPE {metric} histogram')
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), values[:-1]):
+            cumulative += count
+            lines.append(f"{metric}_bucket{prometheus_labels(labels + (('le', bound),))} {int(cumulative)}")
+        lines.append(f'{metric}_sum{prometheus_labels(labels)} {values[-1]:.6f}')
+        lines.append(f'{metric}_count{prometheus_labels(labels)} {int(cumulative)}')
+    
+    lines.append('# TYPE backend_requests_total counter')
+    for labels, count in request_counts:
+        lines.append(f'backend_requests_total{prometheus_labels(labels)} {count}')
+    
+    if routed_reads:
+        lines.append('# TYPE backend_replica_eligible_reads_total counter')
+    for database, count in routed_reads:
+        lines.append(f"backend_replica_eligible_reads_total{prometheus_labels((('database', database),))} {count}")
+    
+    lines.append('# TYPE backend_sampled_query_calls_total counter')
+    lines.append('# TYPE backend_sampled_query_seconds_total counter')
+    lines.append('# TYPE backend_sampled_query_rows_total counter')
+    lines.append('# TYPE backend_query_info gauge')
+    for fingerprint, (text, calls, seconds, rows) in query_stats:
+        labels = (('fingerprint', fingerprint),)
+        lines.append(f'backend_sampled_query_calls_total{prometheus_labels(labels)} {calls}')
+        lines.append(f'backend_sampled_query_seconds_total{prometheus_labels(labels)} {seconds:.6f}')
+        lines.append(f'backend_sampled_query_rows_total{prometheus_labels(labels)} {rows}')
+        lines.append(f"backend_query_info{prometheus_labels(labels + (('statement', text),))} 1")
+    return '\n'.join(lines) + '\n'
+
+def metrics_response(event: Dict[str, Any]) -> Dict[str, Any]:
+    token = os.environ.get('METRICS_TOKEN')
+    if token and not hmac.compare_digest(get_request_header(event, 'x-metrics-token'), token):
+        return json_response(403, {'error': 'Forbidden'})
+    return {'statusCode': 200, 'headers': METRICS_HEADERS, 'body': render_metrics(), 'isBase64Encoded': False}
+
+# Shared by every response of a kind; code that adds headers builds a new dict.
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+METRICS_HEADERS = {'Content-Type': 'text/plain; version=0.0.4', 'Access-Control-Allow-Origin': '*'}
+
+def json_response(status_code: int, payload: Any) -> Dict[str, Any]:
+    started = time.perf_counter()
+    body = dump_json(payload)
+    state = _request_state.get()
+    if state is not None:
+        state['serialize_seconds'] += time.perf_counter() - started
+    return {
+        'statusCode': status_code,
+        'headers': JSON_HEADERS,
+        'body': body,
+        'isBase64Encoded': False
+    }
+
+MAX_BODY_BYTES = 64 * 1024
+
+class RequestError(Exception):
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+
+def parse_body(event: Dict[str, Any]) -> Dict[str, Any]:
+    body = event.get('body') or '{}'
+    try:
+        if event.get('isBase64Encoded'):
+            body = base64.b64decode(body)
+        if len(body) > MAX_BODY_BYTES:
+            raise RequestError(413, 'Request body too large')
+        data = json.loads(body)
+    except ValueError:
+        raise RequestError(400, 'Invalid JSON body')
+    if not isinstance(data, dict):
+        raise RequestError(400, 'JSON body must be an object')
+    return data
+
+def is_number(value: Any) -> bool:
+    if isinstance(value, str):
+        try:
+            float(value)
+        except ValueError:
+            return False
+        return True
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def is_integer(value: Any) -> bool:
+    if isinstance(value, str):
+        return value.lstrip('-').isdigit()
+    return isinstance(value, int) and not isinstance(value, bool)
+
+FIELD_TYPES: Dict[str, Callable[[Any], bool]] = {
+    'str': lambda value: isinstance(value, str),
+    'number': is_number,
+    'int': is_integer,
+    'bool': lambda value: isinstance(value, bool),
+    'dict': lambda value: isinstance(value, dict),
+    'any': lambda value: True
+}
+
+def compile_schema(schema: Dict[str, str]) -> Callable[[Dict[str, Any]], None]:
+    # 'type' marks a required field, 'type?' an optional one (None counts as absent).
+    fields = tuple(
+        (name, not spec.endswith('?'), spec.rstrip('?'), FIELD_TYPES[spec.rstrip('?')])
+        for name, spec in schema.items()
+    )
+    
+    def validate(data: Dict[str, Any]) -> None:
+        for name, required, type_name, check in fields:
+            value = data.get(name)
+            if value is None:
+                if required:
+                    raise RequestError(400, f'Missing required field: {name}')
+            elif not check(value):
+                raise RequestError(400, f'Invalid field {name}: expected {type_name}')
+    return validate
+
+COMPRESSION_MIN_BYTES = 1024
+COMPRESSED_BODY_CACHE_SIZE = 64
+_compressed_bodies: 'OrderedDict[Tuple[str, str], str]' = OrderedDict()
+
+def get_request_header(event: Dict[str, Any], name: str) -> str:
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name:
+            return value or ''
+    return ''
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    weights = {}
+    for part in accept_encoding.lower().split(','):
+        token, _, param = part.partition(';')
+        param = param.strip()
+        try:
+            weight = float(param[2:]) if param.startswith('q=') else 1.0
+        except ValueError:
+            weight = 0.0
+        weights[token.strip()] = weight
+    for encoding in ('br', 'gzip'):
+        if encoding == 'br' and brotli is None:
+            continue
+        if weights.get(encoding, weights.get('*', 0.0)) > 0:
+            return encoding
+    return None
+
+def compress_body(raw: bytes, encoding: str) -> str:
+    if encoding == 'br':
+        compressed = brotli.compress(raw, quality=5)
+    else:
+        compressed = gzip.compress(raw, compresslevel=6)
+    return base64.b64encode(compressed).decode('ascii')
+
+def opaque_tag(etag: str) -> str:
+    # Weak comparison (RFC 7232 section 2.3.2); '-br'/'-gzip' are the variant suffixes older
+    # responses carried.
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    for encoding in ('br', 'gzip'):
+        etag = etag.replace(f'-{encoding}"', '"')
+    return etag
+
+def etag_matches(if_none_match: str, etag: Optional[str]) -> bool:
+    if not if_none_match or etag is None:
+        return False
+    opaque = opaque_tag(etag)
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*' or opaque_tag(candidate) == opaque:
+            return True
+    return False
+
+def finalize_response(event: Dict[str, Any], response: Dict[str, Any]) -> Dict[str, Any]:
+    body = response.get('body')
+    if not body or response.get('isBase64Encoded'):
+        return response
+    
+    headers = response['headers']
+    raw = body.encode('utf-8')
+    if len(raw) >= COMPRESSION_MIN_BYTES:
+        headers = response['headers'] = {**headers, 'Vary': 'Accept-Encoding'}
+    
+    # ETags are weak and name the body whatever its encoding, so a 304 carries the tag the 200 had.
+    # Cacheable reads bring one derived from their version probe (validator_etag); other GETs are
+    # tagged by a hash of the body and can only be answered with 304 after the handler ran.
+    etag = headers.get('ETag')
+    if etag is None and event.get('httpMethod') == 'GET' and response['statusCode'] == 200:
+        etag = 'W/"' + hashlib.blake2b(raw, digest_size=16).hexdigest() + '"'
+        headers = response['headers'] = {**headers, 'ETag': etag}
+        if etag_matches(get_request_header(event, 'if-none-match'), etag):
+            return {'statusCode': 304, 'headers': headers, 'body': '', 'isBase64Encoded': False}
+    
+    if len(raw) < COMPRESSION_MIN_BYTES:
+        return response
+    
+    encoding = choose_encoding(get_request_header(event, 'accept-encoding'))
+    if encoding is None:
+        return response
+    
+    cache_key = (etag, encoding)
+    encoded = _compressed_bodies.get(cache_key) if etag else None
+    if encoded is None:
+        encoded = compress_body(raw, encoding)
+        if etag:
+            _compressed_bodies[cache_key] = encoded
+            if len(_compressed_bodies) > COMPRESSED_BODY_CACHE_SIZE:
+                _compressed_bodies.popitem(last=False)
+    else:
+        _compressed_bodies.move_to_end(cache_key)
+    
+    headers['Content-Encoding'] = encoding
+    response['body'] = encoded
+    response['isBase64Encoded'] = True
+    return response
+
+# Public reads that a CDN/proxy may cache. last_modified_sql is a cheap probe of the
+# underlying tables; actions without one must not need a database connection.
+CACHE_POLICIES: Dict[str, Dict[str, Any]] = {
+    'site_content': {
+        'max_age': 60,
+        'stale_while_revalidate': 600,
+        'last_modified_sql': "SELECT MAX(updated_at) FROM site_content"
+    }
+}
+_last_modified: Dict[str, Tuple[float, Optional[datetime]]] = {}
+
+def parse_http_date(value: str) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        parsed = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+def validator_etag(event: Dict[str, Any], key: str, last_modified: Optional[datetime]) -> str:
+    # The body follows from the action, its query and the probed version, so the tag is built from
+    # those and a revalidation is answered before the handler, its SQL or any serialization runs.
+    params = sorted((event.get('queryStringParameters') or {}).items())
+    return 'W/"' + hashlib.blake2b(repr((key, params, last_modified)).encode(), digest_size=16).hexdigest() + '"'
+
+def cache_headers(policy: Dict[str, Any], last_modified: Optional[datetime], etag: Optional[str]) -> Dict[str, str]:
+    headers = {
+        'Cache-Control': f"public, max-age={policy['max_age']}, stale-while-revalidate={policy['stale_while_revalidate']}",
+        'Vary': 'Accept-Encoding'
+    }
+    if last_modified is not None:
+        headers['Last-Modified'] = format_datetime(last_modified.replace(microsecond=0, tzinfo=timezone.utc), usegmt=True)
+    if etag is not None:
+        headers['ETag'] = etag
+    return headers
+
+def is_not_modified(etag: Optional[str], last_modified: Optional[datetime], if_none_match: str,
+                    if_modified_since: Optional[datetime]) -> bool:
+    # If-Modified-Since is ignored when the request also carries If-None-Match (RFC 7232 section 6).
+    if if_none_match:
+        return etag_matches(if_none_match, etag)
+    return last_modified is not None and if_modified_since is not None and last_modified.replace(microsecond=0) <= if_modified_since
+
+def not_modified_response(policy: Dict[str, Any], last_modified: Optional[datetime], etag: Optional[str]) -> Dict[str, Any]:
+    return {
+        'statusCode': 304,
+        'headers': {'Access-Control-Allow-Origin': '*', **cache_headers(policy, last_modified, etag)},
+        'body': '',
+        'isBase64Encoded': False
+    }
+
+def serve_cacheable(event: Dict[str, Any], key: str, policy: Dict[str, Any], run: Callable[[Any], Dict[str, Any]]) -> Dict[str, Any]:
+    if_none_match = get_request_header(event, 'if-none-match')
+    if_modified_since = parse_http_date(get_request_header(event, 'if-modified-since'))
+    
+    known = _last_modified.get(key)
+    if known and time.monotonic() - known[0] < policy['max_age']:
+        etag = validator_etag(event, key, known[1])
+        if is_not_modified(etag, known[1], if_none_match, if_modified_since):
+            return not_modified_response(policy, known[1], etag)
+    
+    last_modified = etag = None
+    if policy['last_modified_sql'] is None:
+        response = run(None)
+    else:
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(policy['last_modified_sql'])
+            last_modified = cursor.fetchone()[0]
+            _last_modified[key] = (time.monotonic(), last_modified)
+            etag = validator_etag(event, key, last_modified)
+            if is_not_modified(etag, last_modified, if_none_match, if_modified_since):
+                return not_modified_response(policy, last_modified, etag)
+            response = run(conn)
+        finally:
+            conn.close()
+    
+    if response['statusCode'] == 200:
+        response['headers'] = {**response['headers'], **cache_headers(policy, last_modified, etag)}
+    return response
+
+OPTIONS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, X-Admin-Token, X-Read-After',
+    'Access-Control-Max-Age': '86400'
+}
+
+# Resource table per method: each route takes (conn, data, event) where data is the
+# query string for GET/DELETE and the parsed JSON body otherwise.
+ROUTE_KEY = 'resource'
+QUERY_METHODS = ('GET', 'DELETE')
+# GET resources that write, so they never read from a replica.
+PRIMARY_GET_ACTIONS = frozenset()
+DEFAULT_ACTIONS = {'GET': 'dashboard'}
+ROUTES: Dict[str, Dict[str, Callable[[Any, Dict[str, Any], Dict[str, Any]], Dict[str, Any]]]] = {
+    'GET': {
+        'dashboard': lambda conn, params, event: get_dashboard_stats(conn),
+        'rate_sources': lambda conn, params, event: list_rate_sources(conn),
+        'sponsors': lambda conn, params, event: list_sponsors(conn),
+        'settings': lambda conn, params, event: list_settings(conn),
+        'currencies': lambda conn, params, event: list_all_currencies(conn),
+        'commissions': lambda conn, params, event: get_commission_settings(conn),
+        'site_content': lambda conn, params, event: get_site_content(conn, params.get('category')),
+        'payment_providers': lambda conn, params, event: get_payment_providers(conn),
+        'system_settings': lambda conn, params, event: get_system_settings(conn),
+        'payment_transaction': lambda conn, params, event: get_transaction_status(conn, params.get('id')),
+        'reconciliation': lambda conn, params, event: get_reconciliation_report(conn, params),
+        'ledger': lambda conn, params, event: get_ledger(conn, params)
+    },
+    'POST': {
+        'rate_source': lambda conn, body, event: create_rate_source(conn, body),
+        'sponsor': lambda conn, body, event: create_sponsor(conn, body),
+        'currency': lambda conn, body, event: create_currency(conn, body),
+        'setting': lambda conn, body, event: update_setting(conn, body),
+        'commission': lambda conn, body, event: create_commission_setting(conn, body),
+        'site_content': lambda conn, body, event: create_site_content(conn, body),
+        'payment': lambda conn, body, event: create_payment(conn, body),
+        'webhook': lambda conn, body, event: handle_webhook(conn, body.get('provider'), body, event.get('headers', {}))
+    },
+    'PUT': {
+        'rate_source': lambda conn, body, event: update_rate_source(conn, body),
+        'sponsor': lambda conn, body, event: update_sponsor(conn, body),
+        'currency': lambda conn, body, event: update_currency(conn, body),
+        'commission': lambda conn, body, event: update_commission_setting(conn, body),
+        'site_content': lambda conn, body, event: update_site_content(conn, body),
+        'system_setting': lambda conn, body, event: update_system_setting(conn, body),
+        'payment_provider': lambda conn, body, event: update_provider_config(conn, body)
+    },
+    'DELETE': {
+        'sponsor': lambda conn, params, event: delete_sponsor(conn, params.get('id')),
+        'rate_source': lambda conn, params, event: delete_rate_source(conn, params.get('id'))
+    }
+}
+SCHEMAS: Dict[Tuple[str, str], Dict[str, str]] = {
+    ('POST', 'rate_source'): {'name': 'str', 'api_url': 'str', 'api_key_required': 'bool?', 'is_active': 'bool?', 'priority': 'int?'},
+    ('POST', 'sponsor'): {'name': 'str', 'is_active': 'bool?', 'display_order': 'int?'},
+    ('POST', 'currency'): {'symbol': 'str', 'name': 'str', 'type': 'str', 'decimals': 'int?', 'is_active': 'bool?'},
+    ('POST', 'setting'): {'setting_key': 'str', 'setting_value': 'any'},
+    ('POST', 'commission'): {'from_currency': 'str', 'to_currency': 'str', 'commission_percent': 'number',
+                             'min_commission': 'number?', 'max_commission': 'number?'},
+    ('POST', 'site_content'): {'key': 'str', 'value': 'any'},
+    ('POST', 'payment'): {'provider_id': 'int', 'amount': 'number', 'exchange_id': 'int?', 'currency': 'str?'},
+    ('PUT', 'rate_source'): {'id': 'int', 'name': 'str', 'api_url': 'str', 'api_key_required': 'bool',
+                             'is_active': 'bool', 'priority': 'int'},
+    ('PUT', 'sponsor'): {'id': 'int', 'name': 'str', 'is_active': 'bool', 'display_order': 'int'},
+    ('PUT', 'currency'): {'symbol': 'str', 'name': 'str', 'type': 'str', 'decimals': 'int', 'is_active': 'bool'},
+    ('PUT', 'commission'): {'id': 'int', 'commission_percent': 'number?', 'min_commission': 'number?', 'max_commission': 'number?'},
+    ('PUT', 'site_content'): {'id': 'int'},
+    ('PUT', 'system_setting'): {'key': 'str', 'value': 'any'},
+    ('PUT', 'payment_provider'): {'provider_id': 'int', 'config': 'dict?'},
+    ('GET', 'reconciliation'): {'kind': 'str?', 'limit': 'int?', 'before_id': 'int?'},
+    ('GET', 'ledger'): {'account': 'str?', 'kind': 'str?', 'limit': 'int?', 'before_seq': 'int?'},
+    ('DELETE', 'sponsor'): {'id': 'int'},
+    ('DELETE', 'rate_source'): {'id': 'int'}
+}
+VALIDATORS = {route: compile_schema(schema) for route, schema in SCHEMAS.items()}
+
+# Reconciliation (V0016): the reconcile job re-checks each exchange whose row, blockchain
+# transactions or provider payments changed since the watermark, RECONCILE_BATCH exchanges per run
+# in id order, queuing itself again until the pass is through. The three sources are streamed
+# sorted by exchange id and merge-joined, so a run holds one exchange's rows at a time besides the
+# batch's ids and findings. What it finds is kept in reconciliation_issues.
+RECONCILE_SECONDS = float(os.environ.get('RECONCILE_SECONDS', '60'))
+RECONCILE_BATCH = 2000
+RECONCILE_FETCH_ROWS = 500
+# Recorded amounts may differ from the exchange's by this much (network fees, rounding).
+AMOUNT_DRIFT_PERCENT = Decimal(os.environ.get('AMOUNT_DRIFT_PERCENT', '0.5'))
+RECONCILIATION_KINDS = ('completed_without_deposit', 'duplicate_tx_hash', 'amount_drift')
+DEFAULT_ISSUES = 100
+MAX_ISSUES = 1000
+# Ledger (V0017): accounts cache their balances; ledger_checkpoint re-derives each one that has
+# new lines from its last verified checkpoint and the lines since, and checks that every currency
+# sums to zero across accounts.
+LEDGER_CHECKPOINT_SECONDS = float(os.environ.get('LEDGER_CHECKPOINT_SECONDS', '300'))
+DEFAULT_LEDGER_LINES = 100
+MAX_LEDGER_LINES = 1000
+
+# Background jobs owned by this function: server/worker.py runs them as (conn, payload) -> result
+# inside its own transaction, so they must not commit.
+JOBS: Dict[str, Callable[[Any, Dict[str, Any]], Optional[Dict[str, Any]]]] = {
+    'reconcile': lambda conn, payload: run_reconciliation(conn, payload),
+    'ledger_checkpoint': lambda conn, payload: run_ledger_checkpoint(conn, payload)
+}
+# Recurring jobs (kind -> interval in seconds) that server/worker.py keeps queued.
+SCHEDULES: Dict[str, float] = {
+    'reconcile': RECONCILE_SECONDS,
+    'ledger_checkpoint': LEDGER_CHECKPOINT_SECONDS
+}
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    started = time.perf_counter()
+    state = begin_request(event, context)
+    token = _request_state.set(state)
+    status_code = 500
+    try:
+        response = finalize_response(event, dispatch(event, context))
+        status_code = response['statusCode']
+        if state['request_id']:
+            response['headers'] = {**response['headers'], 'X-Request-Id': state['request_id']}
+        return response
+    finally:
+        _request_state.reset(token)
+        method = event.get('httpMethod', 'GET')
+        finish_request(state, method if method in ROUTES or method == 'OPTIONS' else 'OTHER', status_code,
+                       time.perf_counter() - started)
+
+def dispatch(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Admin-Token',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
+        return {'statusCode': 200, 'headers': OPTIONS_HEADERS, 'body': '', 'isBase64Encoded': False}
     
-    conn = get_db_connection()
+    if method == 'GET' and (event.get('queryStringParameters') or {}).get(ROUTE_KEY) == 'metrics':
+        tag_request('metrics')
+        return metrics_response(event)
     
     try:
-        if method == 'GET':
-            params = event.get('queryStringParameters') or {}
-            resource = params.get('resource', 'dashboard')
-            
-            if resource == 'dashboard':
-                return get_dashboard_stats(conn)
-            elif resource == 'rate_sources':
-                return list_rate_sources(conn)
-            elif resource == 'sponsors':
-                return list_sponsors(conn)
-            elif resource == 'settings':
-                return list_settings(conn)
-            elif resource == 'currencies':
-                return list_all_currencies(conn)
-            elif resource == 'commissions':
-                return get_commission_settings(conn)
-            elif resource == 'site_content':
-                category = params.get('category')
-                return get_site_content(conn, category)
-            elif resource == 'payment_providers':
-                return get_payment_providers(conn)
-            elif resource == 'system_settings':
-                return get_system_settings(conn)
-            elif resource == 'payment_transaction':
-                tx_id = params.get('id')
-                return get_transaction_status(conn, tx_id)
-            
-        elif method == 'POST':
-            body = json.loads(event.get('body', '{}'))
-            resource = body.get('resource')
-            
-            if resource == 'rate_source':
-                return create_rate_source(conn, body)
-            elif resource == 'sponsor':
-                return create_sponsor(conn, body)
-            elif resource == 'currency':
-                return create_currency(conn, body)
-            elif resource == 'setting':
-                return update_setting(conn, body)
-            elif resource == 'commission':
-                return create_commission_setting(conn, body)
-            elif resource == 'site_content':
-                return create_site_content(conn, body)
-            elif resource == 'payment':
-                return create_payment(conn, body)
-            elif resource == 'webhook':
-                provider_name = body.get('provider')
-                return handle_webhook(conn, provider_name, body, event.get('headers', {}))
-            
-        elif method == 'PUT':
-            body = json.loads(event.get('body', '{}'))
-            resource = body.get('resource')
-            
-            if resource == 'rate_source':
-                return update_rate_source(conn, body)
-            elif resource == 'sponsor':
-                return update_sponsor(conn, body)
-            elif resource == 'currency':
-                return update_currency(conn, body)
-            elif resource == 'commission':
-                return update_commission_setting(conn, body)
-            elif resource == 'site_content':
-                return update_site_content(conn, body)
-            elif resource == 'system_setting':
-                return update_system_setting(conn, body)
-            elif resource == 'payment_provider':
-                return update_provider_config(conn, body)
-            
-        elif method == 'DELETE':
-            params = event.get('queryStringParameters') or {}
-            resource = params.get('resource')
-            item_id = params.get('id')
-            
-            if resource == 'sponsor':
-                return delete_sponsor(conn, item_id)
-            elif resource == 'rate_source':
-                return delete_rate_source(conn, item_id)
-        
-        return {
-            'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Invalid resource or action'}),
-            'isBase64Encoded': False
-        }
-        
+        return route_request(event, method)
+    except RequestError as error:
+        return json_response(error.status_code, {'error': error.message})
+
+def route_request(event: Dict[str, Any], method: str) -> Dict[str, Any]:
+    routes = ROUTES.get(method, {})
+    if method in QUERY_METHODS:
+        data = event.get('queryStringParameters') or {}
+    else:
+        data = parse_body(event) if routes else {}
+    resource = data.get(ROUTE_KEY) or DEFAULT_ACTIONS.get(method)
+    route = routes.get(resource)
+    if route is None:
+        raise RequestError(400, 'Invalid resource or action')
+    tag_request(resource)
+    validate = VALIDATORS.get((method, resource))
+    if validate is not None:
+        validate(data)
+    run = lambda conn: route(conn, data, event)
+    readonly = method == 'GET' and resource not in PRIMARY_GET_ACTIONS
+    
+    if method == 'GET':
+        if readonly:
+            route_read(event)
+        policy = CACHE_POLICIES.get(resource)
+        if policy:
+            return serve_cacheable(event, resource, policy, run)
+    else:
+        _last_modified.clear()
+    
+    conn = get_db_connection()
+    try:
+        response = run(conn)
+        if not readonly and REPLICA_DSNS and response['statusCode'] < 400:
+            remember_write(event, conn, response)
+        return response
     finally:
         conn.close()
 
 def get_dashboard_stats(conn) -> Dict:
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor = conn.cursor()
     
     cursor.execute("""
         SELECT 
@@ -132,13 +889,13 @@ def get_dashboard_stats(conn) -> Dict:
             COUNT(CASE WHEN status = 'completed' THEN 1 END) as completed_exchanges,
             COUNT(CASE WHEN status = 'pending' THEN 1 END) as pending_exchanges,
             COUNT(CASE WHEN status = 'failed' THEN 1 END) as failed_exchanges,
-            SUM(CASE WHEN status = 'completed' THEN from_amount ELSE 0 END) as total_volume
+            SUM(CASE WHEN status = 'completed' THEN from_amount ELSE 0 END)::text as total_volume
         FROM exchanges
     """)
-    exchange_stats = cursor.fetchone()
+    exchange_stats = fetch_rows(cursor)[0]
     
     cursor.execute("SELECT COUNT(*) as total_clients FROM clients WHERE is_active = true")
-    client_stats = cursor.fetchone()
+    total_clients = cursor.fetchone()[0]
     
     cursor.execute("""
         SELECT from_currency, to_currency, COUNT(*) as count
@@ -148,7 +905,7 @@ def get_dashboard_stats(conn) -> Dict:
         ORDER BY count DESC
         LIMIT 5
     """)
-    popular_pairs = cursor.fetchall()
+    popular_pairs = fetch_rows(cursor)
     
     cursor.execute("""
         SELECT DATE(created_at) as date, COUNT(*) as count
@@ -157,31 +914,21 @@ def get_dashboard_stats(conn) -> Dict:
         GROUP BY DATE(created_at)
         ORDER BY date DESC
     """)
-    daily_exchanges = cursor.fetchall()
-    
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({
-            'exchange_stats': dict(exchange_stats),
-            'total_clients': client_stats['total_clients'],
-            'popular_pairs': [dict(p) for p in popular_pairs],
-            'daily_exchanges': [dict(d) for d in daily_exchanges]
-        }, default=str),
-        'isBase64Encoded': False
-    }
+    daily_exchanges = fetch_rows(cursor)
+    
+    return json_response(200, {
+        'exchange_stats': exchange_stats,
+        'total_clients': total_clients,
+        'popular_pairs': popular_pairs,
+        'daily_exchanges': daily_exchanges
+    })
 
 def list_rate_sources(conn) -> Dict:
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor = conn.cursor()
     cursor.execute("SELECT * FROM rate_sources ORDER BY priority, name")
-    sources = cursor.fetchall()
+    sources = fetch_rows(cursor)
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'rate_sources': [dict(s) for s in sources]}, default=str),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {'rate_sources': sources})
 
 def create_rate_source(conn, data: Dict) -> Dict:
     cursor = conn.cursor(cursor_factory=RealDictCursor)
@@ -201,12 +948,7 @@ def create_rate_source(conn, data: Dict) -> Dict:
     result = cursor.fetchone()
     conn.commit()
     
-    return {
-        'statusCode': 201,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'success': True, 'id': result['id']}),
-        'isBase64Encoded': False
-    }
+    return json_response(201, {'success': True, 'id': result['id']})
 
 def update_rate_source(conn, data: Dict) -> Dict:
     cursor = conn.cursor()
@@ -226,36 +968,21 @@ def update_rate_source(conn, data: Dict) -> Dict:
     
     conn.commit()
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'success': True, 'message': 'Rate source updated'}),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {'success': True, 'message': 'Rate source updated'})
 
 def delete_rate_source(conn, source_id: str) -> Dict:
     cursor = conn.cursor()
     cursor.execute("DELETE FROM rate_sources WHERE id = %s", (source_id,))
     conn.commit()
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'success': True, 'message': 'Rate source deleted'}),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {'success': True, 'message': 'Rate source deleted'})
 
 def list_sponsors(conn) -> Dict:
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor = conn.cursor()
     cursor.execute("SELECT * FROM sponsors ORDER BY display_order, name")
-    sponsors = cursor.fetchall()
+    sponsors = fetch_rows(cursor)
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'sponsors': [dict(s) for s in sponsors]}, default=str),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {'sponsors': sponsors})
 
 def create_sponsor(conn, data: Dict) -> Dict:
     cursor = conn.cursor(cursor_factory=RealDictCursor)
@@ -276,12 +1003,7 @@ def create_sponsor(conn, data: Dict) -> Dict:
     result = cursor.fetchone()
     conn.commit()
     
-    return {
-        'statusCode': 201,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'success': True, 'id': result['id']}),
-        'isBase64Encoded': False
-    }
+    return json_response(201, {'success': True, 'id': result['id']})
 
 def update_sponsor(conn, data: Dict) -> Dict:
     cursor = conn.cursor()
@@ -303,36 +1025,21 @@ def update_sponsor(conn, data: Dict) -> Dict:
     
     conn.commit()
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'success': True, 'message': 'Sponsor updated'}),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {'success': True, 'message': 'Sponsor updated'})
 
 def delete_sponsor(conn, sponsor_id: str) -> Dict:
     cursor = conn.cursor()
     cursor.execute("DELETE FROM sponsors WHERE id = %s", (sponsor_id,))
     conn.commit()
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'success': True, 'message': 'Sponsor deleted'}),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {'success': True, 'message': 'Sponsor deleted'})
 
 def list_settings(conn) -> Dict:
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor = conn.cursor()
     cursor.execute("SELECT * FROM admin_settings ORDER BY setting_key")
-    settings = cursor.fetchall()
+    settings = fetch_rows(cursor)
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'settings': [dict(s) for s in settings]}, default=str),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {'settings': settings})
 
 def update_setting(conn, data: Dict) -> Dict:
     cursor = conn.cursor()
@@ -350,24 +1057,14 @@ def update_setting(conn, data: Dict) -> Dict:
     
     conn.commit()
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'success': True, 'message': 'Setting updated'}),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {'success': True, 'message': 'Setting updated'})
 
 def list_all_currencies(conn) -> Dict:
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor = conn.cursor()
     cursor.execute("SELECT * FROM currencies ORDER BY type, symbol")
-    currencies = cursor.fetchall()
+    currencies = fetch_rows(cursor)
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'currencies': [dict(c) for c in currencies]}, default=str),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {'currencies': currencies})
 
 def create_currency(conn, data: Dict) -> Dict:
     cursor = conn.cursor(cursor_factory=RealDictCursor)
@@ -388,19 +1085,15 @@ def create_currency(conn, data: Dict) -> Dict:
     result = cursor.fetchone()
     conn.commit()
     
-    return {
-        'statusCode': 201,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'success': True, 'id': result['id']}),
-        'isBase64Encoded': False
-    }
+    return json_response(201, {'success': True, 'id': result['id']})
 
 def update_currency(conn, data: Dict) -> Dict:
     cursor = conn.cursor()
     
     cursor.execute("""
         UPDATE currencies 
-        SET name = %s, type = %s, icon_emoji = %s, decimals = %s, is_active = %s
+        SET name = %s, type = %s, icon_emoji = %s, decimals = %s, is_active = %s,
+            updated_at = CURRENT_TIMESTAMP
         WHERE symbol = %s
     """, (
         data['name'],
@@ -413,29 +1106,19 @@ def update_currency(conn, data: Dict) -> Dict:
     
     conn.commit()
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'success': True, 'message': 'Currency updated'}),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {'success': True, 'message': 'Currency updated'})
 
 def get_commission_settings(conn) -> Dict:
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor = conn.cursor()
     cursor.execute("""
-        SELECT id, from_currency, to_currency, commission_percent, 
-               min_commission, max_commission, is_active
+        SELECT id, from_currency, to_currency, commission_percent::text, 
+               min_commission::text, max_commission::text, is_active
         FROM commission_settings
         ORDER BY from_currency, to_currency
     """)
-    commissions = cursor.fetchall()
+    commissions = fetch_rows(cursor)
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'commissions': [dict(c) for c in commissions]}, default=str),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {'commissions': commissions})
 
 def create_commission_setting(conn, data: Dict) -> Dict:
     cursor = conn.cursor(cursor_factory=RealDictCursor)
@@ -451,12 +1134,7 @@ def create_commission_setting(conn, data: Dict) -> Dict:
     result = cursor.fetchone()
     conn.commit()
     
-    return {
-        'statusCode': 201,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'success': True, 'id': result['id']}),
-        'isBase64Encoded': False
-    }
+    return json_response(201, {'success': True, 'id': result['id']})
 
 def update_commission_setting(conn, data: Dict) -> Dict:
     cursor = conn.cursor()
@@ -474,15 +1152,10 @@ def update_commission_setting(conn, data: Dict) -> Dict:
     
     conn.commit()
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'success': True, 'message': 'Commission updated'}),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {'success': True, 'message': 'Commission updated'})
 
 def get_site_content(conn, category=None) -> Dict:
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor = conn.cursor()
     
     if category:
         cursor.execute("""
@@ -495,14 +1168,9 @@ def get_site_content(conn, category=None) -> Dict:
             FROM site_content ORDER BY category, key
         """)
     
-    content_items = cursor.fetchall()
+    content_items = fetch_rows(cursor)
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'content': [dict(c) for c in content_items]}, default=str),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {'content': content_items})
 
 def create_site_content(conn, data: Dict) -> Dict:
     cursor = conn.cursor(cursor_factory=RealDictCursor)
@@ -517,12 +1185,7 @@ def create_site_content(conn, data: Dict) -> Dict:
     result = cursor.fetchone()
     conn.commit()
     
-    return {
-        'statusCode': 201,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'success': True, 'id': result['id']}),
-        'isBase64Encoded': False
-    }
+    return json_response(201, {'success': True, 'id': result['id']})
 
 def update_site_content(conn, data: Dict) -> Dict:
     cursor = conn.cursor()
@@ -537,23 +1200,17 @@ def update_site_content(conn, data: Dict) -> Dict:
     
     conn.commit()
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'success': True, 'message': 'Content updated'}),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {'success': True, 'message': 'Content updated'})
 
 def get_system_settings(conn) -> Dict:
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor = conn.cursor()
     cursor.execute("""
         SELECT id, key, value, value_type, category, description, is_editable
         FROM system_settings ORDER BY category, key
     """)
     
-    settings = []
-    for row in cursor.fetchall():
-        setting = dict(row)
+    settings = list(fetch_rows(cursor))
+    for setting in settings:
         value = setting['value']
         if setting['value_type'] == 'number':
             value = float(value) if '.' in value else int(value)
@@ -562,14 +1219,8 @@ def get_system_settings(conn) -> Dict:
         elif setting['value_type'] == 'json':
             value = json.loads(value)
         setting['value'] = value
-        settings.append(setting)
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'settings': settings}, default=str),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {'settings': settings})
 
 def update_system_setting(conn, data: Dict) -> Dict:
     cursor = conn.cursor()
@@ -590,27 +1241,17 @@ def update_system_setting(conn, data: Dict) -> Dict:
     
     conn.commit()
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'success': True, 'message': 'Setting updated'}),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {'success': True, 'message': 'Setting updated'})
 
 def get_payment_providers(conn) -> Dict:
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor = conn.cursor()
     cursor.execute("""
         SELECT id, name, type, is_active, supported_currencies, config
         FROM payment_providers ORDER BY name
     """)
-    providers = cursor.fetchall()
+    providers = fetch_rows(cursor)
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'providers': [dict(p) for p in providers]}, default=str),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {'providers': providers})
 
 def update_provider_config(conn, data: Dict) -> Dict:
     cursor = conn.cursor()
@@ -625,12 +1266,7 @@ def update_provider_config(conn, data: Dict) -> Dict:
     
     conn.commit()
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'success': True, 'message': 'Provider updated'}),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {'success': True, 'message': 'Provider updated'})
 
 def create_payment(conn, data: Dict) -> Dict:
     exchange_id = data.get('exchange_id')
@@ -647,12 +1283,7 @@ def create_payment(conn, data: Dict) -> Dict:
     
     provider = cursor.fetchone()
     if not provider:
-        return {
-            'statusCode': 404,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Provider not found or inactive'}),
-            'isBase64Encoded': False
-        }
+        return json_response(404, {'error': 'Provider not found or inactive'})
     
     provider_type = provider['type']
     api_key_secret = os.environ.get(f'{provider_type.upper()}_API_KEY', '')
@@ -673,19 +1304,14 @@ def create_payment(conn, data: Dict) -> Dict:
     tx_id = cursor.fetchone()['id']
     conn.commit()
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({
-            'transaction_id': tx_id,
-            'payment_url': payment_url,
-            'payment_address': payment_address,
-            'amount': str(amount),
-            'currency': currency,
-            'provider': provider['name']
-        }),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {
+        'transaction_id': tx_id,
+        'payment_url': payment_url,
+        'payment_address': payment_address,
+        'amount': str(amount),
+        'currency': currency,
+        'provider': provider['name']
+    })
 
 def handle_webhook(conn, provider_name: str, data: Dict, headers: Dict) -> Dict:
     cursor = conn.cursor(cursor_factory=RealDictCursor)
@@ -716,29 +1342,19 @@ def handle_webhook(conn, provider_name: str, data: Dict, headers: Dict) -> Dict:
     
     result = cursor.fetchone()
     
-    if result and mapped_status == 'completed':
-        cursor.execute("""
-            UPDATE exchanges SET status = 'completed', completed_at = CURRENT_TIMESTAMP
-            WHERE id = %s
-        """, (result['exchange_id'],))
+    # The provider collected the client's payment: that is the exchange's deposit, and the payout
+    # completes it later.
+    if result and result['exchange_id'] and mapped_status == 'completed':
+        transition_exchanges(conn, [result['exchange_id']], 'processing', 'payment_webhook',
+                             f'{provider_name} payment {external_tx_id} completed')
     
     conn.commit()
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'status': 'webhook_received'}),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {'status': 'webhook_received'})
 
 def get_transaction_status(conn, tx_id: str) -> Dict:
     if not tx_id:
-        return {
-            'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Transaction ID required'}),
-            'isBase64Encoded': False
-        }
+        return json_response(400, {'error': 'Transaction ID required'})
     
     cursor = conn.cursor(cursor_factory=RealDictCursor)
     cursor.execute("""
@@ -753,16 +1369,358 @@ def get_transaction_status(conn, tx_id: str) -> Dict:
     row = cursor.fetchone()
     
     if not row:
-        return {
-            'statusCode': 404,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Transaction not found'}),
-            'isBase64Encoded': False
-        }
+        return json_response(404, {'error': 'Transaction not found'})
+    
+    return json_response(200, dict(row))
+
+def get_reconciliation_report(conn, params: Dict) -> Dict:
+    kind = params.get('kind')
+    if kind is not None and kind not in RECONCILIATION_KINDS:
+        raise RequestError(400, f"Invalid field kind: expected one of {', '.join(RECONCILIATION_KINDS)}")
+    limit = max(1, min(int(params.get('limit') or DEFAULT_ISSUES), MAX_ISSUES))
+    
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT watermark, pass_horizon IS NOT NULL AS pass_running, pass_cursor, pass_started_at, last_pass_at
+        FROM reconciliation_state
+    """)
+    state = fetch_rows(cursor)[0]
+    
+    cursor.execute("SELECT kind, COUNT(*) FROM reconciliation_issues WHERE resolved_at IS NULL GROUP BY kind")
+    open_issues = {name: 0 for name in RECONCILIATION_KINDS}
+    open_issues.update(cursor.fetchall())
+    
+    filters = ""
+    args: List[Any] = []
+    if kind:
+        filters += " AND i.kind = %s"
+        args.append(kind)
+    if params.get('before_id'):
+        filters += " AND i.id < %s"
+        args.append(int(params['before_id']))
+    
+    cursor.execute(f"""
+        SELECT i.id, i.exchange_id, e.order_number, e.status, i.kind, i.details, i.first_seen_at, i.last_seen_at
+        FROM reconciliation_issues i
+        JOIN exchanges e ON e.id = i.exchange_id
+        WHERE i.resolved_at IS NULL{filters}
+        ORDER BY i.id DESC
+        LIMIT %s
+    """, (*args, limit))
+    issues = fetch_rows(cursor)
+    
+    return json_response(200, {
+        'state': state,
+        'open_issues': open_issues,
+        'issues': issues,
+        'next_before_id': issues[-1]['id'] if len(issues) == limit else None
+    })
+
+def stream_rows(conn, name: str, query: str, params: Any) -> Iterator[Tuple]:
+    # Server-side cursor: rows arrive RECONCILE_FETCH_ROWS at a time however many match.
+    cursor = conn.cursor(name)
+    cursor.execute(query, params)
+    while True:
+        rows = cursor.fetchmany(RECONCILE_FETCH_ROWS)
+        if not rows:
+            break
+        yield from rows
+    cursor.close()
+
+def merge_by_exchange(exchanges: Iterator[Tuple], *sources: Iterator[Tuple]) -> Iterator[Tuple[Tuple, List[List[Tuple]]]]:
+    # Merge join on exchange id, the first column of every input, which each is sorted by. Yields
+    # every exchange with its rows from each source.
+    groups = [groupby(source, key=itemgetter(0)) for source in sources]
+    heads = [next(group, None) for group in groups]
+    for exchange in exchanges:
+        matched = []
+        for index, group in enumerate(groups):
+            rows: List[Tuple] = []
+            while heads[index] is not None and heads[index][0] <= exchange[0]:
+                if heads[index][0] == exchange[0]:
+                    rows = list(heads[index][1])
+                heads[index] = next(group, None)
+            matched.append(rows)
+        yield exchange, matched
+
+def amount_drifted(actual: Decimal, expected: Decimal) -> bool:
+    return abs(actual - expected) > abs(expected) * AMOUNT_DRIFT_PERCENT / 100
+
+def check_exchange(exchange: Tuple, transactions: List[Tuple], payments: List[Tuple]) -> Dict[str, List[Dict[str, Any]]]:
+    # Findings for one exchange from its own rows; duplicate hashes need the other exchanges and
+    # are added by check_exchanges.
+    exchange_id, status, from_currency, to_currency, from_amount, to_amount, deposit_hash, withdrawal_hash = exchange
+    by_hash = {tx_hash: (amount, currency, tx_status) for _, tx_hash, amount, currency, tx_status in transactions}
+    deposit = by_hash.get(deposit_hash)
+    withdrawal = by_hash.get(withdrawal_hash)
+    paid = [(payment_id, amount) for _, payment_id, amount, currency, payment_status in payments
+            if payment_status == 'completed' and currency == from_currency]
+    found: Dict[str, List[Dict[str, Any]]] = {}
+    
+    # A provider payment counts as the deposit (see handle_webhook).
+    if status == 'completed' and not paid and (deposit is None or deposit[2] != 'confirmed'):
+        found['completed_without_deposit'] = [{
+            'deposit_tx_hash': deposit_hash,
+            'deposit_status': deposit[2] if deposit else None
+        }]
+    
+    drift = []
+    for source, tx_hash, recorded, expected, currency in (('deposit', deposit_hash, deposit, from_amount, from_currency),
+                                                           ('withdrawal', withdrawal_hash, withdrawal, to_amount, to_currency)):
+        if recorded is not None and recorded[0] is not None and recorded[1] in (None, currency) \
+                and amount_drifted(recorded[0], expected):
+            drift.append({'source': source, 'tx_hash': tx_hash, 'currency': currency,
+                          'expected': expected, 'actual': recorded[0]})
+    if paid and amount_drifted(sum(amount for _, amount in paid), from_amount):
+        drift.append({'source': 'payment', 'payment_ids': [payment_id for payment_id, _ in paid],
+                      'currency': from_currency, 'expected': from_amount, 'actual': sum(amount for _, amount in paid)})
+    if drift:
+        found['amount_drift'] = drift
+    return found
+
+def check_exchanges(conn, exchange_ids: List[int]) -> Dict[int, Dict[str, List[Dict[str, Any]]]]:
+    exchanges = stream_rows(conn, 'reconcile_exchanges', """
+        SELECT id, status, from_currency, to_currency, from_amount, to_amount, deposit_tx_hash, withdrawal_tx_hash
+        FROM exchanges
+        WHERE id = ANY(%s)
+        ORDER BY id
+    """, (exchange_ids,))
+    transactions = stream_rows(conn, 'reconcile_transactions', """
+        SELECT exchange_id, tx_hash, amount, currency, status
+        FROM blockchain_transactions
+        WHERE exchange_id = ANY(%s)
+        ORDER BY exchange_id
+    """, (exchange_ids,))
+    payments = stream_rows(conn, 'reconcile_payments', """
+        SELECT exchange_id, id, amount, currency, status
+        FROM payment_provider_transactions
+        WHERE exchange_id = ANY(%s)
+        ORDER BY exchange_id
+    """, (exchange_ids,))
+    
+    issues: Dict[int, Dict[str, List[Dict[str, Any]]]] = {}
+    hashes: Dict[str, List[int]] = {}
+    for exchange, (exchange_transactions, exchange_payments) in merge_by_exchange(exchanges, transactions, payments):
+        found = check_exchange(exchange, exchange_transactions, exchange_payments)
+        if found:
+            issues[exchange[0]] = found
+        for tx_hash in {exchange[6], exchange[7], *(row[1] for row in exchange_transactions)} - {None}:
+            hashes.setdefault(tx_hash, []).append(exchange[0])
+    
+    if not hashes:
+        return issues
+    # A hash is duplicated when more than one exchange refers to it, or one exchange uses it as both
+    # its deposit and its withdrawal. Probed hash by hash: against a few thousand hashes, = ANY()
+    # turns into sequential scans.
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT h.tx_hash, array_agg(DISTINCT r.exchange_id ORDER BY r.exchange_id), array_agg(DISTINCT r.used_as ORDER BY r.used_as)
+        FROM unnest(%s::text[]) AS h(tx_hash)
+        CROSS JOIN LATERAL (
+            SELECT id, 'deposit' FROM exchanges WHERE deposit_tx_hash = h.tx_hash
+            UNION ALL
+            SELECT id, 'withdrawal' FROM exchanges WHERE withdrawal_tx_hash = h.tx_hash
+            UNION ALL
+            SELECT exchange_id, 'transaction' FROM blockchain_transactions WHERE tx_hash = h.tx_hash
+        ) AS r(exchange_id, used_as)
+        GROUP BY h.tx_hash
+        HAVING COUNT(DISTINCT r.exchange_id) > 1 OR COUNT(DISTINCT r.used_as) FILTER (WHERE r.used_as <> 'transaction') > 1
+    """, (list(hashes),))
+    for tx_hash, referenced_by, used_as in cursor.fetchall():
+        for exchange_id in hashes[tx_hash]:
+            issues.setdefault(exchange_id, {}).setdefault('duplicate_tx_hash', []).append(
+                {'tx_hash': tx_hash, 'exchange_ids': referenced_by, 'used_as': used_as})
+    return issues
+
+def changed_exchange_ids(cursor, watermark: str, after: int, batch: int) -> List[int]:
+    cursor.execute("""
+        SELECT exchange_id FROM reconciliation_changes
+        WHERE change_xid >= %s AND exchange_id > %s
+        ORDER BY exchange_id
+        LIMIT %s
+    """, (watermark, after, batch))
+    return [row[0] for row in cursor.fetchall()]
+
+def record_issues(cursor, exchange_ids: List[int], issues: Dict[int, Dict[str, List[Dict[str, Any]]]]) -> int:
+    # Replaces the open report rows of the checked exchanges: findings are inserted or refreshed,
+    # open rows no longer found are resolved. Returns how many were resolved.
+    found = dump_json([
+        {'exchange_id': exchange_id, 'kind': kind, 'details': details}
+        for exchange_id, kinds in issues.items() for kind, details in kinds.items()
+    ])
+    cursor.execute("""
+        UPDATE reconciliation_issues i SET resolved_at = CURRENT_TIMESTAMP
+        WHERE i.exchange_id = ANY(%s) AND i.resolved_at IS NULL
+          AND NOT EXISTS (
+              SELECT 1 FROM jsonb_to_recordset(%s::jsonb) AS f(exchange_id INTEGER, kind TEXT)
+              WHERE f.exchange_id = i.exchange_id AND f.kind = i.kind
+          )
+    """, (exchange_ids, found))
+    resolved = cursor.rowcount
+    cursor.execute("""
+        INSERT INTO reconciliation_issues (exchange_id, kind, details)
+        SELECT exchange_id, kind, details
+        FROM jsonb_to_recordset(%s::jsonb) AS f(exchange_id INTEGER, kind TEXT, details JSONB)
+        ON CONFLICT (exchange_id, kind) WHERE resolved_at IS NULL DO UPDATE
+        SET details = EXCLUDED.details, last_seen_at = CURRENT_TIMESTAMP
+    """, (found,))
+    return resolved
+
+def run_reconciliation(conn, payload: Dict) -> Dict:
+    cursor = conn.cursor()
+    batch = int(payload.get('batch', RECONCILE_BATCH))
+    
+    # The state row lock serializes runs: one that finds it taken leaves the pass to the holder. A
+    # pass's horizon is the oldest transaction running when it starts, and becomes the watermark
+    # when it ends.
+    cursor.execute("""
+        SELECT watermark, COALESCE(pass_horizon, pg_snapshot_xmin(pg_current_snapshot())), pass_cursor
+        FROM reconciliation_state
+        FOR UPDATE SKIP LOCKED
+    """)
+    state = cursor.fetchone()
+    if state is None:
+        return {'skipped': True}
+    watermark, horizon, after = state
+    
+    exchange_ids = changed_exchange_ids(cursor, watermark, after, batch)
+    issues = check_exchanges(conn, exchange_ids) if exchange_ids else {}
+    resolved = record_issues(cursor, exchange_ids, issues) if exchange_ids else 0
+    
+    finished = len(exchange_ids) < batch
+    if finished:
+        cursor.execute("""
+            UPDATE reconciliation_state
+            SET watermark = %s, pass_horizon = NULL, pass_cursor = 0, pass_started_at = NULL,
+                last_pass_at = CURRENT_TIMESTAMP
+        """, (horizon,))
+    else:
+        cursor.execute("""
+            UPDATE reconciliation_state
+            SET pass_horizon = %s, pass_cursor = %s, pass_started_at = COALESCE(pass_started_at, CURRENT_TIMESTAMP)
+        """, (horizon, exchange_ids[-1]))
+        # The next batch starts as soon as this one commits. The dedupe key alternates because this
+        # job's own row still counts as queued until then.
+        round_number = int(payload.get('round', 0)) + 1
+        enqueue_job(conn, 'reconcile', {**payload, 'round': round_number},
+                    dedupe_key=f'reconcile:pass:{round_number % 2}')
+    
+    found: Dict[str, int] = {}
+    for kinds in issues.values():
+        for kind in kinds:
+            found[kind] = found.get(kind, 0) + 1
+    return {'checked': len(exchange_ids), 'found': found, 'resolved': resolved, 'finished': finished,
+            'watermark': horizon if finished else watermark}
+
+def get_ledger(conn, params: Dict) -> Dict:
+    cursor = conn.cursor()
+    
+    account = params.get('account')
+    if account is None:
+        filters = ""
+        args: List[Any] = []
+        if params.get('kind'):
+            filters += " WHERE a.kind = %s"
+            args.append(params['kind'])
+        cursor.execute(f"""
+            SELECT a.code, a.kind, a.currency, a.balance::text, a.line_count, a.updated_at,
+                   c.account_seq AS checkpoint_seq, c.verified AS checkpoint_verified, c.created_at AS checkpoint_at
+            FROM ledger_accounts a
+            LEFT JOIN LATERAL (
+                SELECT account_seq, verified, created_at FROM ledger_checkpoints
+                WHERE account_id = a.id
+                ORDER BY account_seq DESC, id DESC
+                LIMIT 1
+            ) c ON true{filters}
+            ORDER BY a.kind, a.code
+        """, args)
+        accounts = fetch_rows(cursor)
+        # Every entry balances, so each currency's balances sum to zero across all accounts.
+        cursor.execute("SELECT currency, SUM(balance)::text FROM ledger_accounts GROUP BY currency HAVING SUM(balance) <> 0")
+        return json_response(200, {'accounts': accounts, 'unbalanced_currencies': dict(cursor.fetchall())})
+    
+    cursor.execute("""
+        SELECT id, code, kind, currency, balance::text, line_count, created_at, updated_at
+        FROM ledger_accounts WHERE code = %s
+    """, (account,))
+    rows = fetch_rows(cursor)
+    if not rows:
+        return json_response(404, {'error': 'Account not found'})
+    account_row = rows[0]
+    limit = max(1, min(int(params.get('limit') or DEFAULT_LEDGER_LINES), MAX_LEDGER_LINES))
+    
+    filters = ""
+    args = [account_row.pop('id')]
+    if params.get('before_seq'):
+        filters += " AND l.account_seq < %s"
+        args.append(int(params['before_seq']))
+    
+    cursor.execute(f"""
+        SELECT l.account_seq, l.amount::text, l.balance_after::text, e.id AS entry_id, e.kind, e.reference, e.exchange_id, e.created_at
+        FROM ledger_lines l
+        JOIN ledger_entries e ON e.id = l.entry_id
+        WHERE l.account_id = %s{filters}
+        ORDER BY l.account_seq DESC
+        LIMIT %s
+    """, (*args, limit))
+    lines = fetch_rows(cursor)
+    
+    return json_response(200, {
+        'account': account_row,
+        'lines': lines,
+        'next_before_seq': lines[-1]['account_seq'] if len(lines) == limit else None
+    })
+
+def run_ledger_checkpoint(conn, payload: Dict) -> Dict:
+    cursor = conn.cursor()
+    
+    # One statement, so one snapshot: postings update an account and add its lines in the same
+    # transaction, and either both or neither are seen here. An account is due once it has lines
+    # past its latest checkpoint; it is re-derived from its latest verified one, so a mismatch is
+    # reported again on every run until it is dealt with.
+    cursor.execute("""
+        WITH due AS (
+            SELECT a.id, a.code, a.balance, a.line_count,
+                   COALESCE(v.account_seq, 0) AS base_seq, COALESCE(v.balance, 0) AS base_balance
+            FROM ledger_accounts a
+            LEFT JOIN LATERAL (
+                SELECT account_seq FROM ledger_checkpoints WHERE account_id = a.id
+                ORDER BY account_seq DESC LIMIT 1
+            ) c ON true
+            LEFT JOIN LATERAL (
+                SELECT account_seq, balance FROM ledger_checkpoints WHERE account_id = a.id AND verified
+                ORDER BY account_seq DESC LIMIT 1
+            ) v ON true
+            WHERE a.line_count > COALESCE(c.account_seq, 0)
+        ), derived AS (
+            SELECT d.id, d.code, d.balance, d.line_count, d.base_balance + COALESCE(s.total, 0) AS computed_balance,
+                   COALESCE(s.lines, 0) = d.line_count - d.base_seq AND s.last_balance = d.balance AS lines_match
+            FROM due d
+            LEFT JOIN LATERAL (
+                SELECT SUM(amount) AS total, COUNT(*) AS lines,
+                       (array_agg(balance_after ORDER BY account_seq DESC))[1] AS last_balance
+                FROM ledger_lines
+                WHERE account_id = d.id AND account_seq > d.base_seq AND account_seq <= d.line_count
+            ) s ON true
+        ), checkpoints AS (
+            INSERT INTO ledger_checkpoints (account_id, account_seq, balance, computed_balance, verified)
+            SELECT id, line_count, balance, computed_balance, computed_balance = balance AND COALESCE(lines_match, false)
+            FROM derived
+            RETURNING account_id, verified
+        )
+        SELECT d.code, d.balance, d.computed_balance, c.verified
+        FROM checkpoints c
+        JOIN derived d ON d.id = c.account_id
+        ORDER BY d.code
+    """)
+    checked = cursor.fetchall()
+    
+    cursor.execute("SELECT currency, SUM(balance) FROM ledger_accounts GROUP BY currency HAVING SUM(balance) <> 0")
+    unbalanced = dict(cursor.fetchall())
     
     return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps(dict(row), default=str),
-        'isBase64Encoded': False
-    }
\ No newline at end of file
+        'accounts_checked': len(checked),
+        'mismatched': [{'account': code, 'balance': balance, 'computed_balance': computed}
+                       for code, balance, computed, verified in checked if not verified],
+        'unbalanced_currencies': unbalanced
+    }
@@ -4,65 +4,894 @@ Args: event with httpMethod, body, queryStringParameters; context with request_i
 Returns: HTTP response with transaction status, confirmations, or blockchain data
 """
 
+import base64
+import gzip
+import hashlib
+import hmac
 import json
 import os
-from typing import Dict, Any
+import random
+import re
+import threading
+from bisect import bisect_left
+from contextvars import ContextVar
+from functools import lru_cache
+from itertools import repeat
+import time
+import weakref
+from datetime import date, datetime, timezone
+from decimal import Decimal
+from collections import OrderedDict
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Dict, Any, Iterator, List, Optional, Tuple, Callable
 import psycopg2
 from psycopg2.extras import RealDictCursor
 
+def connect_database(dsn: Optional[str] = None):
+    # Long-running hosts (server/) replace this with a pooled factory; close() hands the connection back.
+    return psycopg2.connect(dsn or os.environ['DATABASE_URL'])
+
 def get_db_connection():
-    return psycopg2.connect(os.environ['DATABASE_URL'])
+    started = time.perf_counter()
+    state = _request_state.get()
+    conn = None
+    if state is not None and state['replica']:
+        conn = connect_replica(state['read_after'])
+        state['read_from'] = 'primary' if conn is None else 'replica'
+    if conn is None:
+        conn = connect_database()
+    if state is None:
+        return conn
+    state['connect_seconds'] += time.perf_counter() - started
+    return TimedConnection(conn, state['queries']) if state['sampled'] else conn
+
+# Read replicas (streaming standbys of DATABASE_URL). Read-only GET actions go to the next replica
+# (round_robin) or the fastest one (least_latency) whose replay lag is within REPLICA_MAX_LAG_SECONDS,
+# and to the primary otherwise. Successful writes answer with X-Read-After, the primary's WAL position;
+# a GET that sends it back is only served by a replica that has replayed that far. Callers that do not
+# echo it read from the primary for READ_YOUR_WRITES_SECONDS after writing through this instance.
+REPLICA_DSNS = [dsn.strip() for dsn in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if dsn.strip()]
+REPLICA_SELECTION = os.environ.get('REPLICA_SELECTION', 'round_robin')
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get('REPLICA_MAX_LAG_SECONDS', '5'))
+REPLICA_CHECK_SECONDS = float(os.environ.get('REPLICA_CHECK_SECONDS', '1'))
+REPLICA_RETRY_SECONDS = 10.0
+READ_YOUR_WRITES_SECONDS = float(os.environ.get('READ_YOUR_WRITES_SECONDS', '10'))
+READ_AFTER_HEADER = 'X-Read-After'
+RECENT_WRITERS_LIMIT = 4096
+# Lag is zero while everything received is replayed, so an idle primary does not look like lag.
+REPLICA_STATUS_SQL = """
+    SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                ELSE COALESCE(EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - pg_last_xact_replay_timestamp())::float8, 'Infinity')
+           END,
+           (CASE WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn() ELSE pg_current_wal_lsn() END - '0/0'::pg_lsn)::bigint
+"""
+_replica_lock = threading.Lock()
+_replicas: List[Dict[str, Any]] = [
+    {'dsn': dsn, 'checked_at': float('-inf'), 'lag': 0.0, 'replayed': 0, 'latency': 0.0, 'down_until': 0.0}
+    for dsn in REPLICA_DSNS
+]
+_replica_turn = [0]
+_recent_writers: 'OrderedDict[str, float]' = OrderedDict()
+
+def parse_lsn(value: str) -> Optional[int]:
+    high, separator, low = value.strip().partition('/')
+    try:
+        return (int(high, 16) << 32) + int(low, 16) if separator else None
+    except ValueError:
+        return None
+
+def request_caller(event: Dict[str, Any]) -> str:
+    forwarded = get_request_header(event, 'x-forwarded-for').split(',')[0].strip()
+    return forwarded or ((event.get('requestContext') or {}).get('identity') or {}).get('sourceIp') or ''
+
+def route_read(event: Dict[str, Any]) -> bool:
+    """Sends this request's reads to a replica; False when its result is specific to the caller."""
+    state = _request_state.get()
+    if not REPLICA_DSNS or state is None:
+        return True
+    read_after = parse_lsn(get_request_header(event, 'x-read-after'))
+    if read_after is None:
+        caller = request_caller(event)
+        with _replica_lock:
+            recent = caller and _recent_writers.get(caller, 0.0) > time.monotonic()
+        if recent:
+            state['read_from'] = 'primary'
+            return False
+    state['replica'] = True
+    state['read_after'] = read_after
+    return read_after is None
+
+def remember_write(event: Dict[str, Any], conn, response: Dict[str, Any]) -> None:
+    cursor = conn.cursor()
+    cursor.execute('SELECT pg_current_wal_lsn()::text')
+    response['headers'] = {**response['headers'], READ_AFTER_HEADER: cursor.fetchone()[0],
+                           'Access-Control-Expose-Headers': READ_AFTER_HEADER}
+    caller = request_caller(event)
+    if caller:
+        with _replica_lock:
+            _recent_writers[caller] = time.monotonic() + READ_YOUR_WRITES_SECONDS
+            _recent_writers.move_to_end(caller)
+            if len(_recent_writers) > RECENT_WRITERS_LIMIT:
+                _recent_writers.popitem(last=False)
+
+def replica_candidates() -> List[Dict[str, Any]]:
+    now = time.monotonic()
+    with _replica_lock:
+        # A lagging replica stays a candidate once its status is stale, so it is checked again.
+        usable = [replica for replica in _replicas if replica['down_until'] <= now and (
+            replica['lag'] <= REPLICA_MAX_LAG_SECONDS or now - replica['checked_at'] >= REPLICA_CHECK_SECONDS)]
+        if REPLICA_SELECTION == 'least_latency':
+            return sorted(usable, key=lambda replica: replica['latency'])
+        _replica_turn[0] += 1
+        start = _replica_turn[0] % len(usable) if usable else 0
+        return usable[start:] + usable[:start]
+
+def check_replica(replica: Dict[str, Any], conn) -> None:
+    started = time.perf_counter()
+    cursor = conn.cursor()
+    cursor.execute(REPLICA_STATUS_SQL)
+    lag, replayed = cursor.fetchone()
+    elapsed = time.perf_counter() - started
+    with _replica_lock:
+        replica['lag'] = float(lag)
+        replica['replayed'] = replayed
+        replica['checked_at'] = time.monotonic()
+        replica['latency'] = 0.8 * replica['latency'] + 0.2 * elapsed if replica['latency'] else elapsed
+
+def connect_replica(read_after: Optional[int]):
+    """Connection to a replica that is fresh enough, or None to read from the primary."""
+    for replica in replica_candidates():
+        conn = None
+        try:
+            conn = connect_database(replica['dsn'])
+            if (time.monotonic() - replica['checked_at'] >= REPLICA_CHECK_SECONDS
+                    or (read_after is not None and replica['replayed'] < read_after)):
+                check_replica(replica, conn)
+        except psycopg2.Error:
+            if conn is not None:
+                conn.close()
+            with _replica_lock:
+                replica['down_until'] = time.monotonic() + REPLICA_RETRY_SECONDS
+            continue
+        if replica['lag'] <= REPLICA_MAX_LAG_SECONDS and (read_after is None or replica['replayed'] >= read_after):
+            return conn
+        conn.close()
+    return None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+class Rows:
+    # A result set as fetched: the driver's tuples plus the column names, read once per statement.
+    # Handlers that look at a row get it as a dict; the encoders turn the whole set into objects in
+    # one pass of C-level maps. Numeric columns are cast to text in SQL, so no value calls back.
+    __slots__ = ('keys', 'rows')
+
+    def __init__(self, keys: Tuple[str, ...], rows: List[Tuple]):
+        self.keys = keys
+        self.rows = rows
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __getitem__(self, index: int) -> Dict[str, Any]:
+        return dict(zip(self.keys, self.rows[index]))
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        return map(dict, map(zip, repeat(self.keys), self.rows))
+
+# Timestamps go out as ISO 8601 ('2025-01-02T03:04:05.123456'), as orjson writes them natively.
+JSON_ENCODERS = {
+    Rows: list,
+    Decimal: str,
+    datetime: datetime.isoformat,
+    date: date.isoformat,
+}
+
+def encode_json_value(value: Any) -> Any:
+    encoder = JSON_ENCODERS.get(type(value), str)
+    return encoder(value)
+
+if orjson is not None:
+    def dump_json(payload: Any) -> str:
+        return orjson.dumps(payload, default=encode_json_value).decode()
+else:
+    _json_encoder = json.JSONEncoder(default=encode_json_value, ensure_ascii=False, separators=(',', ':'))
+
+    def dump_json(payload: Any) -> str:
+        return _json_encoder.encode(payload)
+
+def fetch_rows(cursor) -> Rows:
+    return Rows(tuple(column[0] for column in cursor.description), cursor.fetchall())
+
+def enqueue_job(conn, kind: str, payload: Dict[str, Any], priority: int = 0, delay_seconds: float = 0,
+                dedupe_key: Optional[str] = None) -> Optional[int]:
+    # Inserted in the caller's transaction, so the job exists only if the request's writes commit;
+    # server/worker.py runs it. A dedupe_key that is already queued returns the existing job.
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO jobs (kind, payload, priority, run_at, dedupe_key)
+        VALUES (%s, %s, %s, CURRENT_TIMESTAMP + make_interval(secs => %s), %s)
+        ON CONFLICT (dedupe_key) WHERE status = 'queued' DO NOTHING
+        RETURNING id
+    """, (kind, dump_json(payload), priority, delay_seconds, dedupe_key))
+    row = cursor.fetchone()
+    if row is None:
+        cursor.execute("SELECT id FROM jobs WHERE dedupe_key = %s AND status = 'queued'", (dedupe_key,))
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+def transition_exchanges(conn, exchange_ids: List[int], status: str, performed_by: str,
+                         notes: str = '') -> Dict[int, Tuple[Optional[str], bool]]:
+    # Moves the exchanges to status where exchange_transitions (V0014) allows it from their current
+    # status, sets the matching timestamps and logs each move, in one statement and the caller's
+    # transaction. A transition that requires_deposit (V0024) also needs a confirmed deposit or a
+    # completed provider payment. Returns id -> (status before, moved); ids that do not exist map
+    # to (None, False).
+    cursor = conn.cursor()
+    cursor.execute("""
+        WITH current AS (
+            SELECT id, status FROM exchanges WHERE id = ANY(%(ids)s) ORDER BY id FOR UPDATE
+        ), moved AS (
+            UPDATE exchanges e
+            SET status = t.to_status,
+                deposit_confirmed_at = CASE WHEN t.to_status = 'processing'
+                                            THEN COALESCE(e.deposit_confirmed_at, CURRENT_TIMESTAMP)
+                                            ELSE e.deposit_confirmed_at END,
+                withdrawal_confirmed_at = CASE WHEN t.to_status = 'completed' AND e.withdrawal_tx_hash IS NOT NULL
+                                               THEN COALESCE(e.withdrawal_confirmed_at, CURRENT_TIMESTAMP)
+                                               ELSE e.withdrawal_confirmed_at END,
+                completed_at = CASE WHEN t.to_status = 'completed' THEN CURRENT_TIMESTAMP ELSE e.completed_at END
+            FROM current c
+            JOIN exchange_transitions t ON t.from_status = c.status AND t.to_status = %(status)s
+            WHERE e.id = c.id
+              AND (NOT t.requires_deposit
+                   OR EXISTS (SELECT 1 FROM blockchain_transactions b
+                              WHERE b.tx_hash = e.deposit_tx_hash AND b.status = 'confirmed')
+                   OR EXISTS (SELECT 1 FROM payment_provider_transactions p
+                              WHERE p.exchange_id = e.id AND p.status = 'completed'
+                                AND p.currency = e.from_currency))
+            RETURNING e.id, c.status AS status_from
+        ), logged AS (
+            INSERT INTO transaction_logs (exchange_id, action, status_from, status_to, performed_by, notes)
+            SELECT id, 'status_changed', status_from, %(status)s, %(performed_by)s, %(notes)s FROM moved
+        )
+        SELECT r.id, c.status, m.id IS NOT NULL
+        FROM unnest(%(ids)s::int[]) AS r(id)
+        LEFT JOIN current c ON c.id = r.id
+        LEFT JOIN moved m ON m.id = r.id
+    """, {'ids': exchange_ids, 'status': status, 'performed_by': performed_by, 'notes': notes})
+    return {exchange_id: (status_from, moved) for exchange_id, status_from, moved in cursor.fetchall()}
+
+FUNCTION_NAME = 'blockchain-api'
+# Request instrumentation. Latency histograms (per action, connection acquire,
+# serialization) are always recorded; per-statement timing and the structured log
+# line are kept for a sampled fraction of requests, plus a log line for slow ones.
+METRICS_SAMPLE_RATE = float(os.environ.get('METRICS_SAMPLE_RATE', '0.05'))
+SLOW_REQUEST_SECONDS = float(os.environ.get('SLOW_REQUEST_MS', '500')) / 1000
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+QUERY_TEXT_LIMIT = 200
+_metrics_lock = threading.Lock()
+_histograms: Dict[Tuple[str, Tuple], List[float]] = {}
+_request_counts: Dict[Tuple, int] = {}
+_query_stats: Dict[str, List[Any]] = {}
+_routed_reads: Dict[str, int] = {}
+_request_state: ContextVar[Optional[Dict[str, Any]]] = ContextVar('request_state', default=None)
+_literal_pattern = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_space_pattern = re.compile(r'\s+')
+
+@lru_cache(maxsize=512)
+def query_fingerprint(query: str) -> Tuple[str, str]:
+    normalized = _space_pattern.sub(' ', _literal_pattern.sub('?', query)).strip()
+    return hashlib.blake2b(normalized.encode('utf-8'), digest_size=6).hexdigest(), normalized
+
+class TimedCursor:
+    def __init__(self, cursor, queries: List[Tuple[Any, float, int]]):
+        self._cursor = cursor
+        self._queries = queries
+    
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._cursor, name)
+    
+    def __iter__(self):
+        return iter(self._cursor)
+    
+    def execute(self, query, params=None):
+        started = time.perf_counter()
+        try:
+            return self._cursor.execute(query, params)
+        finally:
+            self._queries.append((query, time.perf_counter() - started, self._cursor.rowcount))
+
+class TimedConnection:
+    def __init__(self, conn, queries: List[Tuple[Any, float, int]]):
+        self._conn = conn
+        self._queries = queries
+    
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._conn, name)
+    
+    def cursor(self, *args, **kwargs) -> TimedCursor:
+        return TimedCursor(self._conn.cursor(*args, **kwargs), self._queries)
+
+def begin_request(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    request_id = getattr(context, 'request_id', None) or get_request_header(event, 'x-request-id')[:128]
+    return {
+        'request_id': request_id or None,
+        'action': None,
+        'sampled': random.random() < METRICS_SAMPLE_RATE,
+        'connect_seconds': 0.0,
+        'serialize_seconds': 0.0,
+        'queries': [],
+        'replica': False,
+        'read_after': None,
+        'read_from': None
+    }
+
+def tag_request(action: str) -> None:
+    state = _request_state.get()
+    if state is not None:
+        state['action'] = action
+
+def observe(name: str, labels: Tuple, seconds: float) -> None:
+    histogram = _histograms.get((name, labels))
+    if histogram is None:
+        histogram = _histograms[(name, labels)] = [0.0] * (len(LATENCY_BUCKETS) + 2)
+    histogram[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+    histogram[-1] += seconds
+
+def finish_request(state: Dict[str, Any], method: str, status_code: int, seconds: float) -> None:
+    action = state['action'] or 'unknown'
+    queries = [(query_fingerprint(query if isinstance(query, str) else str(query)), elapsed, rows)
+               for query, elapsed, rows in state['queries']]
+    
+    with _metrics_lock:
+        observe('request_duration_seconds', (('method', method), ('action', action)), seconds)
+        if state['connect_seconds']:
+            observe('db_connect_duration_seconds', (), state['connect_seconds'])
+        if state['serialize_seconds']:
+            observe('serialization_duration_seconds', (), state['serialize_seconds'])
+        count_key = (('action', action), ('status', str(status_code)))
+        _request_counts[count_key] = _request_counts.get(count_key, 0) + 1
+        if state['read_from']:
+            _routed_reads[state['read_from']] = _routed_reads.get(state['read_from'], 0) + 1
+        for (fingerprint, text), elapsed, rows in queries:
+            stats = _query_stats.get(fingerprint)
+            if stats is None:
+                stats = _query_stats[fingerprint] = [text[:QUERY_TEXT_LIMIT], 0, 0.0, 0]
+            stats[1] += 1
+            stats[2] += elapsed
+            stats[3] += max(rows, 0)
+    
+    if state['sampled'] or seconds >= SLOW_REQUEST_SECONDS:
+        print(dump_json({
+            'level': 'warning' if seconds >= SLOW_REQUEST_SECONDS else 'info',
+            'event': 'request',
+            'function': FUNCTION_NAME,
+            'request_id': state['request_id'],
+            'method': method,
+            'action': action,
+            'status': status_code,
+            'duration_ms': round(seconds * 1000, 3),
+            'db_connect_ms': round(state['connect_seconds'] * 1000, 3),
+            'serialize_ms': round(state['serialize_seconds'] * 1000, 3),
+            'queries': [
+                {'fingerprint': fingerprint, 'ms': round(elapsed * 1000, 3), 'rows': rows}
+                for (fingerprint, _), elapsed, rows in queries
+            ]
+        }), flush=True)
+
+def escape_label(value: Any) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+
+def prometheus_labels(labels: Tuple) -> str:
+    pairs = (('function', FUNCTION_NAME),) + labels
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in pairs) + '}'
+
+def render_metrics() -> str:
+    lines = []
+    with _metrics_lock:
+        histograms = sorted((key, list(values)) for key, values in _histograms.items())
+        request_counts = sorted(_request_counts.items())
+        routed_reads = sorted(_routed_reads.items())
+        query_stats = sorted((fingerprint, list(stats)) for fingerprint, stats in _query_stats.items())
+    
+    declared = set()
+    for (name, labels), values in histograms:
+        metric = f'backend_{name}'
+        if metric not in declared:
+            declared.add(metric)
+            lines.append(f'# TYPE {metric} histogram')
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), values[:-1]):
+            cumulative += count
+            lines.append(f"{metric}_bucket{prometheus_labels(labels + (('le', bound),))} {int(cumulative)}")
+        lines.append(f'{metric}_sum{prometheus_labels(labels)} {values[-1]:.6f}')
+        lines.append(f'{metric}_count{prometheus_labels(labels)} {int(cumulative)}')
+    
+    lines.append('# TYPE backend_requests_total counter')
+    for labels, count in request_counts:
+        lines.append(f'backend_requests_total{prometheus_labels(labels)} {count}')
+    
+    if routed_reads:
+        lines.append('# TYPE backend_replica_eligible_reads_total counter')
+    for database, count in routed_reads:
+        lines.append(f"backend_replica_eligible_reads_total{prometheus_labels((('database', database),))} {count}")
+    
+    lines.append('# TYPE backend_sampled_query_calls_total counter')
+    lines.append('# TYPE backend_sampled_query_seconds_total counter')
+    lines.append('# TYPE backend_sampled_query_rows_total counter')
+    lines.append('# TYPE backend_query_info gauge')
+    for fingerprint, (text, calls, seconds, rows) in query_stats:
+        labels = (('fingerprint', fingerprint),)
+        lines.append(f'backend_sampled_query_calls_total{prometheus_labels(labels)} {calls}')
+        lines.append(f'backend_sampled_query_seconds_total{prometheus_labels(labels)} {seconds:.6f}')
+        lines.append(f'backend_sampled_query_rows_total{prometheus_labels(labels)} {rows}')
+        lines.append(f"backend_query_info{prometheus_labels(labels + (('statement', text),))} 1")
+    return '\n'.join(lines) + '\n'
+
+def metrics_response(event: Dict[str, Any]) -> Dict[str, Any]:
+    token = os.environ.get('METRICS_TOKEN')
+    if token and not hmac.compare_digest(get_request_header(event, 'x-metrics-token'), token):
+        return json_response(403, {'error': 'Forbidden'})
+    return {'statusCode': 200, 'headers': METRICS_HEADERS, 'body': render_metrics(), 'isBase64Encoded': False}
+
+# Shared by every response of a kind; code that adds headers builds a new dict.
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+METRICS_HEADERS = {'Content-Type': 'text/plain; version=0.0.4', 'Access-Control-Allow-Origin': '*'}
+
+def json_response(status_code: int, payload: Any) -> Dict[str, Any]:
+    started = time.perf_counter()
+    body = dump_json(payload)
+    state = _request_state.get()
+    if state is not None:
+        state['serialize_seconds'] += time.perf_counter() - started
+    return {
+        'statusCode': status_code,
+        'headers': JSON_HEADERS,
+        'body': body,
+        'isBase64Encoded': False
+    }
+
+MAX_BODY_BYTES = 64 * 1024
+
+class RequestError(Exception):
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+
+def parse_body(event: Dict[str, Any]) -> Dict[str, Any]:
+    body = event.get('body') or '{}'
+    try:
+        if event.get('isBase64Encoded'):
+            body = base64.b64decode(body)
+        if len(body) > MAX_BODY_BYTES:
+            raise RequestError(413, 'Request body too large')
+        data = json.loads(body)
+    except ValueError:
+        raise RequestError(400, 'Invalid JSON body')
+    if not isinstance(data, dict):
+        raise RequestError(400, 'JSON body must be an object')
+    return data
+
+def is_number(value: Any) -> bool:
+    if isinstance(value, str):
+        try:
+            float(value)
+        except ValueError:
+            return False
+        return True
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def is_integer(value: Any) -> bool:
+    if isinstance(value, str):
+        return value.lstrip('-').isdigit()
+    return isinstance(value, int) and not isinstance(value, bool)
+
+FIELD_TYPES: Dict[str, Callable[[Any], bool]] = {
+    'str': lambda value: isinstance(value, str),
+    'number': is_number,
+    'int': is_integer,
+    'bool': lambda value: isinstance(value, bool),
+    'dict': lambda value: isinstance(value, dict),
+    'any': lambda value: True
+}
+
+def compile_schema(schema: Dict[str, str]) -> Callable[[Dict[str, Any]], None]:
+    # 'type' marks a required field, 'type?' an optional one (None counts as absent).
+    fields = tuple(
+        (name, not spec.endswith('?'), spec.rstrip('?'), FIELD_TYPES[spec.rstrip('?')])
+        for name, spec in schema.items()
+    )
+    
+    def validate(data: Dict[str, Any]) -> None:
+        for name, required, type_name, check in fields:
+            value = data.get(name)
+            if value is None:
+                if required:
+                    raise RequestError(400, f'Missing required field: {name}')
+            elif not check(value):
+                raise RequestError(400, f'Invalid field {name}: expected {type_name}')
+    return validate
+
+COMPRESSION_MIN_BYTES = 1024
+COMPRESSED_BODY_CACHE_SIZE = 64
+_compressed_bodies: 'OrderedDict[Tuple[str, str], str]' = OrderedDict()
+
+def get_request_header(event: Dict[str, Any], name: str) -> str:
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name:
+            return value or ''
+    return ''
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    weights = {}
+    for part in accept_encoding.lower().split(','):
+        token, _, param = part.partition(';')
+        param = param.strip()
+        try:
+            weight = float(param[2:]) if param.startswith('q=') else 1.0
+        except ValueError:
+            weight = 0.0
+        weights[token.strip()] = weight
+    for encoding in ('br', 'gzip'):
+        if encoding == 'br' and brotli is None:
+            continue
+        if weights.get(encoding, weights.get('*', 0.0)) > 0:
+            return encoding
+    return None
+
+def compress_body(raw: bytes, encoding: str) -> str:
+    if encoding == 'br':
+        compressed = brotli.compress(raw, quality=5)
+    else:
+        compressed = gzip.compress(raw, compresslevel=6)
+    return base64.b64encode(compressed).decode('ascii')
+
+def opaque_tag(etag: str) -> str:
+    # Weak comparison (RFC 7232 section 2.3.2); '-br'/'-gzip' are the variant suffixes older
+    # responses carried.
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    for encoding in ('br', 'gzip'):
+        etag = etag.replace(f'-{encoding}"', '"')
+    return etag
+
+def etag_matches(if_none_match: str, etag: Optional[str]) -> bool:
+    if not if_none_match or etag is None:
+        return False
+    opaque = opaque_tag(etag)
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*' or opaque_tag(candidate) == opaque:
+            return True
+    return False
+
+def finalize_response(event: Dict[str, Any], response: Dict[str, Any]) -> Dict[str, Any]:
+    body = response.get('body')
+    if not body or response.get('isBase64Encoded'):
+        return response
+    
+    headers = response['headers']
+    raw = body.encode('utf-8')
+    if len(raw) >= COMPRESSION_MIN_BYTES:
+        headers = response['headers'] = {**headers, 'Vary': 'Accept-Encoding'}
+    
+    # ETags are weak and name the body whatever its encoding, so a 304 carries the tag the 200 had.
+    # Cacheable reads bring one derived from their version probe (validator_etag); other GETs are
+    # tagged by a hash of the body and can only be answered with 304 after the handler ran.
+    etag = headers.get('ETag')
+    if etag is None and event.get('httpMethod') == 'GET' and response['statusCode'] == 200:
+        etag = 'W/"' + hashlib.blake2b(raw, digest_size=16).hexdigest() + '"'
+        headers = response['headers'] = {**headers, 'ETag': etag}
+        if etag_matches(get_request_header(event, 'if-none-match'), etag):
+            return {'statusCode': 304, 'headers': headers, 'body': '', 'isBase64Encoded': False}
+    
+    if len(raw) < COMPRESSION_MIN_BYTES:
+        return response
+    
+    encoding = choose_encoding(get_request_header(event, 'accept-encoding'))
+    if encoding is None:
+        return response
+    
+    cache_key = (etag, encoding)
+    encoded = _compressed_bodies.get(cache_key) if etag else None
+    if encoded is None:
+        encoded = compress_body(raw, encoding)
+        if etag:
+            _compressed_bodies[cache_key] = encoded
+            if len(_compressed_bodies) > COMPRESSED_BODY_CACHE_SIZE:
+                _compressed_bodies.popitem(last=False)
+    else:
+        _compressed_bodies.move_to_end(cache_key)
+    
+    headers['Content-Encoding'] = encoding
+    response['body'] = encoded
+    response['isBase64Encoded'] = True
+    return response
+
+# Public reads that a CDN/proxy may cache. last_modified_sql is a cheap probe of the
+# underlying tables; actions without one must not need a database connection.
+CACHE_POLICIES: Dict[str, Dict[str, Any]] = {
+    'get_blockchain_info': {
+        'max_age': 3600,
+        'stale_while_revalidate': 86400,
+        'last_modified_sql': None
+    }
+}
+_last_modified: Dict[str, Tuple[float, Optional[datetime]]] = {}
+
+def parse_http_date(value: str) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        parsed = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+def validator_etag(event: Dict[str, Any], key: str, last_modified: Optional[datetime]) -> str:
+    # The body follows from the action, its query and the probed version, so the tag is built from
+    # those and a revalidation is answered before the handler, its SQL or any serialization runs.
+    params = sorted((event.get('queryStringParameters') or {}).items())
+    return 'W/"' + hashlib.blake2b(repr((key, params, last_modified)).encode(), digest_size=16).hexdigest() + '"'
+
+def cache_headers(policy: Dict[str, Any], last_modified: Optional[datetime], etag: Optional[str]) -> Dict[str, str]:
+    headers = {
+        'Cache-Control': f"public, max-age={policy['max_age']}, stale-while-revalidate={policy['stale_while_revalidate']}",
+        'Vary': 'Accept-Encoding'
+    }
+    if last_modified is not None:
+        headers['Last-Modified'] = format_datetime(last_modified.replace(microsecond=0, tzinfo=timezone.utc), usegmt=True)
+    if etag is not None:
+        headers['ETag'] = etag
+    return headers
+
+def is_not_modified(etag: Optional[str], last_modified: Optional[datetime], if_none_match: str,
+                    if_modified_since: Optional[datetime]) -> bool:
+    # If-Modified-Since is ignored when the request also carries If-None-Match (RFC 7232 section 6).
+    if if_none_match:
+        return etag_matches(if_none_match, etag)
+    return last_modified is not None and if_modified_since is not None and last_modified.replace(microsecond=0) <= if_modified_since
+
+def not_modified_response(policy: Dict[str, Any], last_modified: Optional[datetime], etag: Optional[str]) -> Dict[str, Any]:
+    return {
+        'statusCode': 304,
+        'headers': {'Access-Control-Allow-Origin': '*', **cache_headers(policy, last_modified, etag)},
+        'body': '',
+        'isBase64Encoded': False
+    }
+
+def serve_cacheable(event: Dict[str, Any], key: str, policy: Dict[str, Any], run: Callable[[Any], Dict[str, Any]]) -> Dict[str, Any]:
+    if_none_match = get_request_header(event, 'if-none-match')
+    if_modified_since = parse_http_date(get_request_header(event, 'if-modified-since'))
+    
+    known = _last_modified.get(key)
+    if known and time.monotonic() - known[0] < policy['max_age']:
+        etag = validator_etag(event, key, known[1])
+        if is_not_modified(etag, known[1], if_none_match, if_modified_since):
+            return not_modified_response(policy, known[1], etag)
+    
+    last_modified = etag = None
+    if policy['last_modified_sql'] is None:
+        response = run(None)
+    else:
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(policy['last_modified_sql'])
+            last_modified = cursor.fetchone()[0]
+            _last_modified[key] = (time.monotonic(), last_modified)
+            etag = validator_etag(event, key, last_modified)
+            if is_not_modified(etag, last_modified, if_none_match, if_modified_since):
+                return not_modified_response(policy, last_modified, etag)
+            response = run(conn)
+        finally:
+            conn.close()
+    
+    if response['statusCode'] == 200:
+        response['headers'] = {**response['headers'], **cache_headers(policy, last_modified, etag)}
+    return response
+
+# Hot statements by name. With PREPARE_STATEMENTS=1 each runs as a server-side prepared statement:
+# PREPARE once per connection (sent with the first EXECUTE, so it costs no extra round trip), then
+# EXECUTE, which skips parsing and, once Postgres settles on a generic plan, planning. Off by default:
+# a serverless invocation's connection serves one request, and transaction-mode poolers do not keep
+# sessions; server/app.py turns it on for its pooled connections. After five executions Postgres may
+# switch to a generic plan, so statements whose best plan depends on the parameter (a per-client
+# ORDER BY ... LIMIT over skewed data) stay plain; tools/bench/prepared.py shows the effect.
+PREPARE_STATEMENTS = os.environ.get('PREPARE_STATEMENTS', '0') == '1'
+PREPARED_QUERIES: Dict[str, str] = {
+    'check_transaction': """
+        SELECT bt.*, e.id as exchange_id, e.status as exchange_status
+        FROM blockchain_transactions bt
+        LEFT JOIN exchanges e ON bt.exchange_id = e.id
+        WHERE bt.tx_hash = %s
+    """,
+    'transaction_history': """
+        SELECT id, exchange_id, blockchain, tx_hash, from_address, to_address, amount::text, currency,
+               confirmations, status, block_number, gas_used::text, gas_price_gwei::text, created_at, confirmed_at
+        FROM blockchain_transactions
+        WHERE exchange_id = %s
+        ORDER BY created_at DESC
+    """
+}
+PREPARED_PREFIX = FUNCTION_NAME.replace('-', '_') + '_'
+FEATURE_NOT_SUPPORTED = '0A000'
+INVALID_SQL_STATEMENT_NAME = '26000'
+_prepared_lock = threading.Lock()
+# connection -> {name: 'ready' | 'stale'}; weak, so entries leave with their connections
+_prepared_sessions: 'weakref.WeakKeyDictionary' = weakref.WeakKeyDictionary()
+_prepared_unknown: 'weakref.WeakSet' = weakref.WeakSet()
+
+def server_placeholders(query: str) -> str:
+    parts = query.split('%s')
+    return parts[0] + ''.join(f'${index}{part}' for index, part in enumerate(parts[1:], 1))
+
+PREPARE_SQL = {name: f'PREPARE {PREPARED_PREFIX}{name} AS {server_placeholders(query)}' for name, query in PREPARED_QUERIES.items()}
+
+def prepared_session(conn) -> Dict[str, str]:
+    with _prepared_lock:
+        session = _prepared_sessions.get(conn)
+        unknown = conn in _prepared_unknown
+    if session is not None and not unknown:
+        return session
+    session = {}
+    if unknown:
+        # A PREPARE went out with a statement that failed, so ask the session what it holds.
+        cursor = conn.cursor()
+        cursor.execute("SELECT name FROM pg_prepared_statements WHERE starts_with(name, %s)", (PREPARED_PREFIX,))
+        session = {row[0][len(PREPARED_PREFIX):]: 'ready' for row in cursor.fetchall()}
+    with _prepared_lock:
+        _prepared_sessions[conn] = session
+        _prepared_unknown.discard(conn)
+    return session
+
+def execute_prepared(cursor, name: str, params: Tuple = ()) -> None:
+    if not PREPARE_STATEMENTS:
+        cursor.execute(PREPARED_QUERIES[name], params)
+        return
+    conn = cursor.connection
+    session = prepared_session(conn)
+    status = session.get(name)
+    statement = PREPARED_PREFIX + name
+    execute = f"EXECUTE {statement}({', '.join(['%s'] * len(params))})" if params else f'EXECUTE {statement}'
+    if status == 'ready':
+        query = execute
+    elif status == 'stale':
+        query = f'DEALLOCATE {statement}; {PREPARE_SQL[name]}; {execute}'
+    else:
+        query = f'{PREPARE_SQL[name]}; {execute}'
+    try:
+        cursor.execute(query, params)
+    except psycopg2.Error as error:
+        with _prepared_lock:
+            if status == 'ready' and error.pgcode == FEATURE_NOT_SUPPORTED:
+                # "cached plan must not change result type": a migration changed a table under SELECT *,
+                # so every connection re-prepares the statement rather than failing once each.
+                for other in _prepared_sessions.values():
+                    if other.get(name) == 'ready':
+                        other[name] = 'stale'
+            elif status != 'ready' or error.pgcode == INVALID_SQL_STATEMENT_NAME:
+                _prepared_unknown.add(conn)
+        raise
+    session[name] = 'ready'
+
+OPTIONS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, POST, PUT, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, X-Read-After',
+    'Access-Control-Max-Age': '86400'
+}
+
+# Action table per method: each route takes (conn, data, event) where data is the
+# query string for GET and the parsed JSON body otherwise.
+ROUTE_KEY = 'action'
+QUERY_METHODS = ('GET', 'DELETE')
+# GET actions that write, so they never read from a replica.
+PRIMARY_GET_ACTIONS = frozenset()
+DEFAULT_ACTIONS: Dict[str, str] = {}
+ROUTES: Dict[str, Dict[str, Callable[[Any, Dict[str, Any], Dict[str, Any]], Dict[str, Any]]]] = {
+    'GET': {
+        'check_transaction': lambda conn, params, event: check_transaction_status(conn, params),
+        'get_wallet_balance': lambda conn, params, event: get_wallet_balance(conn, params),
+        'get_transaction_history': lambda conn, params, event: get_transaction_history(conn, params),
+        'get_blockchain_info': lambda conn, params, event: get_blockchain_info(params.get('blockchain'))
+    },
+    'POST': {
+        'track_deposit': lambda conn, body, event: track_deposit_transaction(conn, body),
+        'initiate_withdrawal': lambda conn, body, event: initiate_withdrawal(conn, body),
+        'verify_transaction': lambda conn, body, event: verify_transaction(conn, body)
+    }
+}
+SCHEMAS: Dict[Tuple[str, str], Dict[str, str]] = {
+    ('GET', 'get_blockchain_info'): {'blockchain': 'str'},
+    ('POST', 'track_deposit'): {'exchange_id': 'int', 'tx_hash': 'str', 'blockchain': 'str', 'amount': 'number', 'currency': 'str'},
+    ('POST', 'initiate_withdrawal'): {'exchange_id': 'int', 'to_address': 'str', 'amount': 'number', 'currency': 'str', 'blockchain': 'str'},
+    ('POST', 'verify_transaction'): {'tx_hash': 'str', 'confirmations': 'int?', 'block_number': 'int?'}
+}
+VALIDATORS = {route: compile_schema(schema) for route, schema in SCHEMAS.items()}
+
+# Background jobs owned by this function: server/worker.py runs them as (conn, payload) -> result
+# inside its own transaction, so they must not commit.
+JOBS: Dict[str, Callable[[Any, Dict[str, Any]], Optional[Dict[str, Any]]]] = {
+    'withdrawal': lambda conn, payload: run_withdrawal(conn, payload)
+}
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    started = time.perf_counter()
+    state = begin_request(event, context)
+    token = _request_state.set(state)
+    status_code = 500
+    try:
+        response = finalize_response(event, dispatch(event, context))
+        status_code = response['statusCode']
+        if state['request_id']:
+            response['headers'] = {**response['headers'], 'X-Request-Id': state['request_id']}
+        return response
+    finally:
+        _request_state.reset(token)
+        method = event.get('httpMethod', 'GET')
+        finish_request(state, method if method in ROUTES or method == 'OPTIONS' else 'OTHER', status_code,
+                       time.perf_counter() - started)
+
+def dispatch(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, PUT, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
+        return {'statusCode': 200, 'headers': OPTIONS_HEADERS, 'body': '', 'isBase64Encoded': False}
     
-    conn = get_db_connection()
+    if method == 'GET' and (event.get('queryStringParameters') or {}).get(ROUTE_KEY) == 'metrics':
+        tag_request('metrics')
+        return metrics_response(event)
     
     try:
-        if method == 'GET':
-            params = event.get('queryStringParameters') or {}
-            action = params.get('action')
-            
-            if action == 'check_transaction':
-                return check_transaction_status(conn, params)
-            elif action == 'get_wallet_balance':
-                return get_wallet_balance(params)
-            elif action == 'get_transaction_history':
-                return get_transaction_history(conn, params)
-            elif action == 'get_blockchain_info':
-                return get_blockchain_info(params.get('blockchain'))
-            
-        elif method == 'POST':
-            body = json.loads(event.get('body', '{}'))
-            action = body.get('action')
-            
-            if action == 'track_deposit':
-                return track_deposit_transaction(conn, body)
-            elif action == 'initiate_withdrawal':
-                return initiate_withdrawal(conn, body)
-            elif action == 'verify_transaction':
-                return verify_transaction(conn, body)
-        
-        return {
-            'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Invalid action'}),
-            'isBase64Encoded': False
-        }
-        
+        return route_request(event, method)
+    except RequestError as error:
+        return json_response(error.status_code, {'error': error.message})
+
+def route_request(event: Dict[str, Any], method: str) -> Dict[str, Any]:
+    routes = ROUTES.get(method, {})
+    if method in QUERY_METHODS:
+        data = event.get('queryStringParameters') or {}
+    else:
+        data = parse_body(event) if routes else {}
+    action = data.get(ROUTE_KEY) or DEFAULT_ACTIONS.get(method)
+    route = routes.get(action)
+    if route is None:
+        raise RequestError(400, 'Invalid action')
+    tag_request(action)
+    validate = VALIDATORS.get((method, action))
+    if validate is not None:
+        validate(data)
+    run = lambda conn: route(conn, data, event)
+    readonly = method == 'GET' and action not in PRIMARY_GET_ACTIONS
+    
+    if method == 'GET':
+        if readonly:
+            route_read(event)
+        policy = CACHE_POLICIES.get(action)
+        if policy:
+            return serve_cacheable(event, action, policy, run)
+    else:
+        _last_modified.clear()
+    
+    conn = get_db_connection()
+    try:
+        response = run(conn)
+        if not readonly and REPLICA_DSNS and response['statusCode'] < 400:
+            remember_write(event, conn, response)
+        return response
     finally:
         conn.close()
 
@@ -71,33 +900,18 @@ def check_transaction_status(conn, params: Dict) -> Dict:
     
     tx_hash = params.get('tx_hash')
     
-    cursor.execute("""
-        SELECT bt.*, e.id as exchange_id, e.status as exchange_status
-        FROM blockchain_transactions bt
-        LEFT JOIN exchanges e ON bt.exchange_id = e.id
-        WHERE bt.tx_hash = %s
-    """, (tx_hash,))
+    execute_prepared(cursor, 'check_transaction', (tx_hash,))
     
     transaction = cursor.fetchone()
     
     if not transaction:
-        return {
-            'statusCode': 404,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Transaction not found'}),
-            'isBase64Encoded': False
-        }
+        return json_response(404, {'error': 'Transaction not found'})
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({
-            'transaction': dict(transaction),
-            'confirmations': transaction['confirmations'],
-            'is_confirmed': transaction['confirmations'] >= get_required_confirmations(transaction['blockchain'])
-        }, default=str),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {
+        'transaction': dict(transaction),
+        'confirmations': transaction['confirmations'],
+        'is_confirmed': transaction['confirmations'] >= get_required_confirmations(transaction['blockchain'])
+    })
 
 def get_required_confirmations(blockchain: str) -> int:
     confirmations_map = {
@@ -141,61 +955,66 @@ def track_deposit_transaction(conn, data: Dict) -> Dict:
     result = cursor.fetchone()
     
     cursor.execute("""
-        UPDATE exchanges 
-        SET deposit_tx_hash = %s, 
-            status = CASE 
-                WHEN %s = 'confirmed' THEN 'processing'
-                ELSE 'pending'
-            END,
-            deposit_confirmed_at = CASE 
-                WHEN %s = 'confirmed' THEN CURRENT_TIMESTAMP
-                ELSE deposit_confirmed_at
-            END
-        WHERE id = %s
-    """, (tx_hash, result['status'], result['status'], exchange_id))
-    
-    cursor.execute("""
-        INSERT INTO transaction_logs (exchange_id, action, status_to, notes, performed_by)
-        VALUES (%s, 'deposit_tracked', %s, %s, 'blockchain_monitor')
-    """, (exchange_id, result['status'], f'TX: {tx_hash}, Confirmations: {result["confirmations"]}'))
+        UPDATE exchanges SET deposit_tx_hash = %s WHERE id = %s
+    """, (tx_hash, exchange_id))
+    if result['status'] == 'confirmed':
+        # transition_exchanges writes the transaction_logs row for the move.
+        transition_exchanges(conn, [exchange_id], 'processing', 'blockchain_monitor',
+                             f'Deposit {tx_hash} confirmed, confirmations: {result["confirmations"]}')
     
     conn.commit()
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({
-            'success': True,
-            'transaction_id': result['id'],
-            'status': result['status'],
-            'confirmations': result['confirmations'],
-            'required_confirmations': get_required_confirmations(blockchain)
-        }),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {
+        'success': True,
+        'transaction_id': result['id'],
+        'status': result['status'],
+        'confirmations': result['confirmations'],
+        'required_confirmations': get_required_confirmations(blockchain)
+    })
 
 def initiate_withdrawal(conn, data: Dict) -> Dict:
     cursor = conn.cursor(cursor_factory=RealDictCursor)
     
     exchange_id = data['exchange_id']
-    to_address = data['to_address']
-    amount = data['amount']
-    currency = data['currency']
-    blockchain = data['blockchain']
     
     cursor.execute("""
-        SELECT * FROM exchanges WHERE id = %s AND status = 'processing'
+        SELECT id FROM exchanges WHERE id = %s AND status = 'processing' AND withdrawal_tx_hash IS NULL
     """, (exchange_id,))
     
+    if not cursor.fetchone():
+        return json_response(400, {'error': 'Exchange not ready for withdrawal'})
+    
+    job_id = enqueue_job(conn, 'withdrawal', {
+        'exchange_id': exchange_id,
+        'to_address': data['to_address'],
+        'amount': data['amount'],
+        'currency': data['currency'],
+        'blockchain': data['blockchain']
+    }, priority=10, dedupe_key=f'withdrawal:{exchange_id}')
+    
+    conn.commit()
+    
+    return json_response(202, {
+        'success': True,
+        'job_id': job_id,
+        'status': 'queued',
+        'blockchain': data['blockchain'],
+        'message': 'Withdrawal queued. The transaction hash appears on the exchange once submitted.'
+    })
+
+def run_withdrawal(conn, payload: Dict) -> Dict:
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    
+    exchange_id = payload['exchange_id']
+    
+    # Locked until the worker commits, so a retried or duplicate job cannot submit twice.
+    cursor.execute("""
+        SELECT status, withdrawal_tx_hash FROM exchanges WHERE id = %s FOR UPDATE
+    """, (exchange_id,))
     exchange = cursor.fetchone()
     
-    if not exchange:
-        return {
-            'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Exchange not ready for withdrawal'}),
-            'isBase64Encoded': False
-        }
+    if not exchange or exchange['status'] != 'processing' or exchange['withdrawal_tx_hash']:
+        return {'exchange_id': exchange_id, 'skipped': True}
     
     simulated_tx_hash = f"0x{''.join([format(i, '02x') for i in os.urandom(32)])}"
     
@@ -204,29 +1023,18 @@ def initiate_withdrawal(conn, data: Dict) -> Dict:
         (exchange_id, blockchain, tx_hash, to_address, amount, currency, status)
         VALUES (%s, %s, %s, %s, %s, %s, 'pending')
         RETURNING id
-    """, (exchange_id, blockchain, simulated_tx_hash, to_address, amount, currency))
+    """, (exchange_id, payload['blockchain'], simulated_tx_hash, payload['to_address'],
+          payload['amount'], payload['currency']))
     
     result = cursor.fetchone()
     
     cursor.execute("""
         UPDATE exchanges 
-        SET withdrawal_tx_hash = %s, status = 'processing'
+        SET withdrawal_tx_hash = %s
         WHERE id = %s
     """, (simulated_tx_hash, exchange_id))
     
-    conn.commit()
-    
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({
-            'success': True,
-            'tx_hash': simulated_tx_hash,
-            'blockchain': blockchain,
-            'message': 'Withdrawal initiated. Transaction submitted to blockchain.'
-        }),
-        'isBase64Encoded': False
-    }
+    return {'transaction_id': result['id'], 'tx_hash': simulated_tx_hash, 'blockchain': payload['blockchain']}
 
 def verify_transaction(conn, data: Dict) -> Dict:
     cursor = conn.cursor()
@@ -265,65 +1073,60 @@ def verify_transaction(conn, data: Dict) -> Dict:
     
     result = cursor.fetchone()
     
+    # A confirmed deposit moves the exchange on to processing; a confirmed payout completes it.
     if result and result[1] == 'confirmed':
         cursor.execute("""
-            UPDATE exchanges 
-            SET status = 'completed',
-                completed_at = CURRENT_TIMESTAMP
-            WHERE id = %s
-        """, (result[0],))
+            SELECT withdrawal_tx_hash IS NOT DISTINCT FROM %s FROM exchanges WHERE id = %s
+        """, (tx_hash, result[0]))
+        row = cursor.fetchone()
+        if row is not None:
+            transition_exchanges(conn, [result[0]], 'completed' if row[0] else 'processing', 'blockchain_monitor',
+                                 f'TX {tx_hash} confirmed')
     
     conn.commit()
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'success': True, 'status': result[1] if result else 'unknown'}),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {'success': True, 'status': result[1] if result else 'unknown'})
 
-def get_wallet_balance(params: Dict) -> Dict:
+def get_wallet_balance(conn, params: Dict) -> Dict:
+    cursor = conn.cursor()
+    
     address = params.get('address')
     blockchain = params.get('blockchain', 'ethereum')
     
-    simulated_balance = {
+    # The hot wallet's ledger accounts (V0017) cache their balances, so this is one row per
+    # currency; usd_value is null for a currency without a USD rate.
+    cursor.execute("""
+        SELECT a.currency, a.balance::text,
+               ROUND(a.balance * CASE WHEN a.currency IN ('USD', 'USDT', 'USDC') THEN 1 ELSE r.rate END, 2)::text AS usd_value
+        FROM ledger_accounts a
+        LEFT JOIN LATERAL (
+            SELECT rate FROM exchange_rates
+            WHERE from_currency = a.currency AND to_currency IN ('USD', 'USDT', 'USDC')
+            ORDER BY updated_at DESC
+            LIMIT 1
+        ) r ON true
+        WHERE a.kind = 'hot_wallet'
+        ORDER BY a.currency
+    """)
+    
+    return json_response(200, {
         'address': address,
         'blockchain': blockchain,
-        'balances': [
-            {'currency': 'ETH', 'balance': '1.5423', 'usd_value': '4520.50'},
-            {'currency': 'USDT', 'balance': '1000.00', 'usd_value': '1000.00'},
-            {'currency': 'BTC', 'balance': '0.0542', 'usd_value': '3500.00'}
-        ]
-    }
-    
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps(simulated_balance),
-        'isBase64Encoded': False
-    }
+        'balances': fetch_rows(cursor)
+    })
 
 def get_transaction_history(conn, params: Dict) -> Dict:
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor = conn.cursor()
     
     exchange_id = params.get('exchange_id')
     
-    cursor.execute("""
-        SELECT * FROM blockchain_transactions 
-        WHERE exchange_id = %s
-        ORDER BY created_at DESC
-    """, (exchange_id,))
+    execute_prepared(cursor, 'transaction_history', (exchange_id,))
     
-    transactions = cursor.fetchall()
+    transactions = fetch_rows(cursor)
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({
-            'transactions': [dict(tx) for tx in transactions]
-        }, default=str),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {
+        'transactions': transactions
+    })
 
 def get_blockchain_info(blockchain: str) -> Dict:
     blockchain_info = {
@@ -363,9 +1166,4 @@ def get_blockchain_info(blockchain: str) -> Dict:
     
     info = blockchain_info.get(blockchain.lower(), blockchain_info['ethereum'])
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'blockchain_info': info}),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {'blockchain_info': info})
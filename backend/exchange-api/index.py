@@ -4,79 +4,1452 @@ Args: event with httpMethod, body, queryStringParameters; context with request_i
 Returns: HTTP response with exchange data, client info, or rates
 """
 
+import base64
+import gzip
+import hashlib
+import hmac
 import json
 import os
-from datetime import datetime
-from typing import Dict, Any, List, Optional
-from decimal import Decimal
+import random
+import re
+import secrets
+from bisect import bisect_left
+from contextvars import ContextVar
+from functools import lru_cache
+from itertools import repeat
+import threading
+import time
+import urllib.parse
+import urllib.request
+import weakref
+from datetime import date, datetime, timezone
+from collections import OrderedDict
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Dict, Any, Iterator, List, Optional, Tuple, Callable
+from decimal import Decimal, InvalidOperation, ROUND_DOWN, ROUND_UP
 import psycopg2
 from psycopg2.extras import RealDictCursor
 
+def connect_database(dsn: Optional[str] = None):
+    # Long-running hosts (server/) replace this with a pooled factory; close() hands the connection back.
+    return psycopg2.connect(dsn or os.environ['DATABASE_URL'])
+
 def get_db_connection():
-    return psycopg2.connect(os.environ['DATABASE_URL'])
+    started = time.perf_counter()
+    state = _request_state.get()
+    conn = None
+    if state is not None and state['replica']:
+        conn = connect_replica(state['read_after'])
+        state['read_from'] = 'primary' if conn is None else 'replica'
+    if conn is None:
+        conn = connect_database()
+    if state is None:
+        return conn
+    state['connect_seconds'] += time.perf_counter() - started
+    return TimedConnection(conn, state['queries']) if state['sampled'] else conn
+
+# Read replicas (streaming standbys of DATABASE_URL). Read-only GET actions go to the next replica
+# (round_robin) or the fastest one (least_latency) whose replay lag is within REPLICA_MAX_LAG_SECONDS,
+# and to the primary otherwise. Successful writes answer with X-Read-After, the primary's WAL position;
+# a GET that sends it back is only served by a replica that has replayed that far. Callers that do not
+# echo it read from the primary for READ_YOUR_WRITES_SECONDS after writing through this instance.
+REPLICA_DSNS = [dsn.strip() for dsn in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if dsn.strip()]
+REPLICA_SELECTION = os.environ.get('REPLICA_SELECTION', 'round_robin')
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get('REPLICA_MAX_LAG_SECONDS', '5'))
+REPLICA_CHECK_SECONDS = float(os.environ.get('REPLICA_CHECK_SECONDS', '1'))
+REPLICA_RETRY_SECONDS = 10.0
+READ_YOUR_WRITES_SECONDS = float(os.environ.get('READ_YOUR_WRITES_SECONDS', '10'))
+READ_AFTER_HEADER = 'X-Read-After'
+RECENT_WRITERS_LIMIT = 4096
+# Lag is zero while everything received is replayed, so an idle primary does not look like lag.
+REPLICA_STATUS_SQL = """
+    SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                ELSE COALESCE(EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - pg_last_xact_replay_timestamp())::float8, 'Infinity')
+           END,
+           (CASE WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn() ELSE pg_current_wal_lsn() END - '0/0'::pg_lsn)::bigint
+"""
+_replica_lock = threading.Lock()
+_replicas: List[Dict[str, Any]] = [
+    {'dsn': dsn, 'checked_at': float('-inf'), 'lag': 0.0, 'replayed': 0, 'latency': 0.0, 'down_until': 0.0}
+    for dsn in REPLICA_DSNS
+]
+_replica_turn = [0]
+_recent_writers: 'OrderedDict[str, float]' = OrderedDict()
+
+def parse_lsn(value: str) -> Optional[int]:
+    high, separator, low = value.strip().partition('/')
+    try:
+        return (int(high, 16) << 32) + int(low, 16) if separator else None
+    except ValueError:
+        return None
+
+def request_caller(event: Dict[str, Any]) -> str:
+    forwarded = get_request_header(event, 'x-forwarded-for').split(',')[0].strip()
+    return forwarded or ((event.get('requestContext') or {}).get('identity') or {}).get('sourceIp') or ''
+
+def route_read(event: Dict[str, Any]) -> bool:
+    """Sends this request's reads to a replica; False when its result is specific to the caller."""
+    state = _request_state.get()
+    if not REPLICA_DSNS or state is None:
+        return True
+    read_after = parse_lsn(get_request_header(event, 'x-read-after'))
+    if read_after is None:
+        caller = request_caller(event)
+        with _replica_lock:
+            recent = caller and _recent_writers.get(caller, 0.0) > time.monotonic()
+        if recent:
+            state['read_from'] = 'primary'
+            return False
+    state['replica'] = True
+    state['read_after'] = read_after
+    return read_after is None
+
+def remember_write(event: Dict[str, Any], conn, response: Dict[str, Any]) -> None:
+    cursor = conn.cursor()
+    cursor.execute('SELECT pg_current_wal_lsn()::text')
+    response['headers'] = {**response['headers'], READ_AFTER_HEADER: cursor.fetchone()[0],
+                           'Access-Control-Expose-Headers': READ_AFTER_HEADER}
+    caller = request_caller(event)
+    if caller:
+        with _replica_lock:
+            _recent_writers[caller] = time.monotonic() + READ_YOUR_WRITES_SECONDS
+            _recent_writers.move_to_end(caller)
+            if len(_recent_writers) > RECENT_WRITERS_LIMIT:
+                _recent_writers.popitem(last=False)
+
+def replica_candidates() -> List[Dict[str, Any]]:
+    now = time.monotonic()
+    with _replica_lock:
+        # A lagging replica stays a candidate once its status is stale, so it is checked again.
+        usable = [replica for replica in _replicas if replica['down_until'] <= now and (
+            replica['lag'] <= REPLICA_MAX_LAG_SECONDS or now - replica['checked_at'] >= REPLICA_CHECK_SECONDS)]
+        if REPLICA_SELECTION == 'least_latency':
+            return sorted(usable, key=lambda replica: replica['latency'])
+        _replica_turn[0] += 1
+        start = _replica_turn[0] % len(usable) if usable else 0
+        return usable[start:] + usable[:start]
+
+def check_replica(replica: Dict[str, Any], conn) -> None:
+    started = time.perf_counter()
+    cursor = conn.cursor()
+    cursor.execute(REPLICA_STATUS_SQL)
+    lag, replayed = cursor.fetchone()
+    elapsed = time.perf_counter() - started
+    with _replica_lock:
+        replica['lag'] = float(lag)
+        replica['replayed'] = replayed
+        replica['checked_at'] = time.monotonic()
+        replica['latency'] = 0.8 * replica['latency'] + 0.2 * elapsed if replica['latency'] else elapsed
+
+def connect_replica(read_after: Optional[int]):
+    """Connection to a replica that is fresh enough, or None to read from the primary."""
+    for replica in replica_candidates():
+        conn = None
+        try:
+            conn = connect_database(replica['dsn'])
+            if (time.monotonic() - replica['checked_at'] >= REPLICA_CHECK_SECONDS
+                    or (read_after is not None and replica['replayed'] < read_after)):
+                check_replica(replica, conn)
+        except psycopg2.Error:
+            if conn is not None:
+                conn.close()
+            with _replica_lock:
+                replica['down_until'] = time.monotonic() + REPLICA_RETRY_SECONDS
+            continue
+        if replica['lag'] <= REPLICA_MAX_LAG_SECONDS and (read_after is None or replica['replayed'] >= read_after):
+            return conn
+        conn.close()
+    return None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+class Rows:
+    # A result set as fetched: the driver's tuples plus the column names, read once per statement.
+    # Handlers that look at a row get it as a dict; the encoders turn the whole set into objects in
+    # one pass of C-level maps. Numeric columns are cast to text in SQL, so no value calls back.
+    __slots__ = ('keys', 'rows')
+
+    def __init__(self, keys: Tuple[str, ...], rows: List[Tuple]):
+        self.keys = keys
+        self.rows = rows
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __getitem__(self, index: int) -> Dict[str, Any]:
+        return dict(zip(self.keys, self.rows[index]))
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        return map(dict, map(zip, repeat(self.keys), self.rows))
+
+# Timestamps go out as ISO 8601 ('2025-01-02T03:04:05.123456'), as orjson writes them natively.
+JSON_ENCODERS = {
+    Rows: list,
+    Decimal: str,
+    datetime: datetime.isoformat,
+    date: date.isoformat,
+}
+
+def encode_json_value(value: Any) -> Any:
+    encoder = JSON_ENCODERS.get(type(value), str)
+    return encoder(value)
+
+if orjson is not None:
+    def dump_json(payload: Any) -> str:
+        return orjson.dumps(payload, default=encode_json_value).decode()
+else:
+    _json_encoder = json.JSONEncoder(default=encode_json_value, ensure_ascii=False, separators=(',', ':'))
+
+    def dump_json(payload: Any) -> str:
+        return _json_encoder.encode(payload)
+
+def fetch_rows(cursor) -> Rows:
+    return Rows(tuple(column[0] for column in cursor.description), cursor.fetchall())
+
+def enqueue_job(conn, kind: str, payload: Dict[str, Any], priority: int = 0, delay_seconds: float = 0,
+                dedupe_key: Optional[str] = None) -> Optional[int]:
+    # Inserted in the caller's transaction, so the job exists only if the request's writes commit;
+    # server/worker.py runs it. A dedupe_key that is already queued returns the existing job.
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO jobs (kind, payload, priority, run_at, dedupe_key)
+        VALUES (%s, %s, %s, CURRENT_TIMESTAMP + make_interval(secs => %s), %s)
+        ON CONFLICT (dedupe_key) WHERE status = 'queued' DO NOTHING
+        RETURNING id
+    """, (kind, dump_json(payload), priority, delay_seconds, dedupe_key))
+    row = cursor.fetchone()
+    if row is None:
+        cursor.execute("SELECT id FROM jobs WHERE dedupe_key = %s AND status = 'queued'", (dedupe_key,))
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+def transition_exchanges(conn, exchange_ids: List[int], status: str, performed_by: str,
+                         notes: str = '') -> Dict[int, Tuple[Optional[str], bool]]:
+    # Moves the exchanges to status where exchange_transitions (V0014) allows it from their current
+    # status, sets the matching timestamps and logs each move, in one statement and the caller's
+    # transaction. A transition that requires_deposit (V0024) also needs a confirmed deposit or a
+    # completed provider payment. Returns id -> (status before, moved); ids that do not exist map
+    # to (None, False).
+    cursor = conn.cursor()
+    cursor.execute("""
+        WITH current AS (
+            SELECT id, status FROM exchanges WHERE id = ANY(%(ids)s) ORDER BY id FOR UPDATE
+        ), moved AS (
+            UPDATE exchanges e
+            SET status = t.to_status,
+                deposit_confirmed_at = CASE WHEN t.to_status = 'processing'
+                                            THEN COALESCE(e.deposit_confirmed_at, CURRENT_TIMESTAMP)
+                                            ELSE e.deposit_confirmed_at END,
+                withdrawal_confirmed_at = CASE WHEN t.to_status = 'completed' AND e.withdrawal_tx_hash IS NOT NULL
+                                               THEN COALESCE(e.withdrawal_confirmed_at, CURRENT_TIMESTAMP)
+                                               ELSE e.withdrawal_confirmed_at END,
+                completed_at = CASE WHEN t.to_status = 'completed' THEN CURRENT_TIMESTAMP ELSE e.completed_at END
+            FROM current c
+            JOIN exchange_transitions t ON t.from_status = c.status AND t.to_status = %(status)s
+            WHERE e.id = c.id
+              AND (NOT t.requires_deposit
+                   OR EXISTS (SELECT 1 FROM blockchain_transactions b
+                              WHERE b.tx_hash = e.deposit_tx_hash AND b.status = 'confirmed')
+                   OR EXISTS (SELECT 1 FROM payment_provider_transactions p
+                              WHERE p.exchange_id = e.id AND p.status = 'completed'
+                                AND p.currency = e.from_currency))
+            RETURNING e.id, c.status AS status_from
+        ), logged AS (
+            INSERT INTO transaction_logs (exchange_id, action, status_from, status_to, performed_by, notes)
+            SELECT id, 'status_changed', status_from, %(status)s, %(performed_by)s, %(notes)s FROM moved
+        )
+        SELECT r.id, c.status, m.id IS NOT NULL
+        FROM unnest(%(ids)s::int[]) AS r(id)
+        LEFT JOIN current c ON c.id = r.id
+        LEFT JOIN moved m ON m.id = r.id
+    """, {'ids': exchange_ids, 'status': status, 'performed_by': performed_by, 'notes': notes})
+    return {exchange_id: (status_from, moved) for exchange_id, status_from, moved in cursor.fetchall()}
+
+FUNCTION_NAME = 'exchange-api'
+# Request instrumentation. Latency histograms (per action, connection acquire,
+# serialization) are always recorded; per-statement timing and the structured log
+# line are kept for a sampled fraction of requests, plus a log line for slow ones.
+METRICS_SAMPLE_RATE = float(os.environ.get('METRICS_SAMPLE_RATE', '0.05'))
+SLOW_REQUEST_SECONDS = float(os.environ.get('SLOW_REQUEST_MS', '500')) / 1000
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+QUERY_TEXT_LIMIT = 200
+_metrics_lock = threading.Lock()
+_histograms: Dict[Tuple[str, Tuple], List[float]] = {}
+_request_counts: Dict[Tuple, int] = {}
+_query_stats: Dict[str, List[Any]] = {}
+_routed_reads: Dict[str, int] = {}
+_request_state: ContextVar[Optional[Dict[str, Any]]] = ContextVar('request_state', default=None)
+_literal_pattern = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_space_pattern = re.compile(r'\s+')
+
+@lru_cache(maxsize=512)
+def query_fingerprint(query: str) -> Tuple[str, str]:
+    normalized = _space_pattern.sub(' ', _literal_pattern.sub('?', query)).strip()
+    return hashlib.blake2b(normalized.encode('utf-8'), digest_size=6).hexdigest(), normalized
+
+class TimedCursor:
+    def __init__(self, cursor, queries: List[Tuple[Any, float, int]]):
+        self._cursor = cursor
+        self._queries = queries
+    
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._cursor, name)
+    
+    def __iter__(self):
+        return iter(self._cursor)
+    
+    def execute(self, query, params=None):
+        started = time.perf_counter()
+        try:
+            return self._cursor.execute(query, params)
+        finally:
+            self._queries.append((query, time.perf_counter() - started, self._cursor.rowcount))
+
+class TimedConnection:
+    def __init__(self, conn, queries: List[Tuple[Any, float, int]]):
+        self._conn = conn
+        self._queries = queries
+    
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._conn, name)
+    
+    def cursor(self, *args, **kwargs) -> TimedCursor:
+        return TimedCursor(self._conn.cursor(*args, **kwargs), self._queries)
+
+def begin_request(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    request_id = getattr(context, 'request_id', None) or get_request_header(event, 'x-request-id')[:128]
+    return {
+        'request_id': request_id or None,
+        'action': None,
+        'sampled': random.random() < METRICS_SAMPLE_RATE,
+        'connect_seconds': 0.0,
+        'serialize_seconds': 0.0,
+        'queries': [],
+        'replica': False,
+        'read_after': None,
+        'read_from': None
+    }
+
+def tag_request(action: str) -> None:
+    state = _request_state.get()
+    if state is not None:
+        state['action'] = action
+
+def observe(name: str, labels: Tuple, seconds: float) -> None:
+    histogram = _histograms.get((name, labels))
+    if histogram is None:
+        histogram = _histograms[(name, labels)] = [0.0] * (len(LATENCY_BUCKETS) + 2)
+    histogram[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+    histogram[-1] += seconds
+
+def finish_request(state: Dict[str, Any], method: str, status_code: int, seconds: float) -> None:
+    action = state['action'] or 'unknown'
+    queries = [(query_fingerprint(query if isinstance(query, str) else str(query)), elapsed, rows)
+               for query, elapsed, rows in state['queries']]
+    
+    with _metrics_lock:
+        observe('request_duration_seconds', (('method', method), ('action', action)), seconds)
+        if state['connect_seconds']:
+            observe('db_connect_duration_seconds', (), state['connect_seconds'])
+        if state['serialize_seconds']:
+            observe('serialization_duration_seconds', (), state['serialize_seconds'])
+        count_key = (('action', action), ('status', str(status_code)))
+        _request_counts[count_key] = _request_counts.get(count_key, 0) + 1
+        if state['read_from']:
+            _routed_reads[state['read_from']] = _routed_reads.get(state['read_from'], 0) + 1
+        for (fingerprint, text), elapsed, rows in queries:
+            stats = _query_stats.get(fingerprint)
+            if stats is None:
+                stats = _query_stats[fingerprint] = [text[:QUERY_TEXT_LIMIT], 0, 0.0, 0]
+            stats[1] += 1
+            stats[2] += elapsed
+            stats[3] += max(rows, 0)
+    
+    if state['sampled'] or seconds >= SLOW_REQUEST_SECONDS:
+        print(dump_json({
+            'level': 'warning' if seconds >= SLOW_REQUEST_SECONDS else 'info',
+            'event': 'request',
+            'function': FUNCTION_NAME,
+            'request_id': state['request_id'],
+            'method': method,
+            'action': action,
+            'status': status_code,
+            'duration_ms': round(seconds * 1000, 3),
+            'db_connect_ms': round(state['connect_seconds'] * 1000, 3),
+            'serialize_ms': round(state['serialize_seconds'] * 1000, 3),
+            'queries': [
+                {'fingerprint': fingerprint, 'ms': round(elapsed * 1000, 3), 'rows': rows}
+                for (fingerprint, _), elapsed, rows in queries
+            ]
+        }), flush=True)
+
+def escape_label(value: Any) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+
+def prometheus_labels(labels: Tuple) -> str:
+    pairs = (('function', FUNCTION_NAME),) + labels
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in pairs) + '}'
+
+COALESCING_METRICS = {
+    'leader': 'backend_coalescing_leader_requests_total',
+    'coalesced': 'backend_coalesced_requests_total',
+    'micro_cached': 'backend_micro_cached_requests_total'
+}
+
+def render_metrics() -> str:
+    lines = []
+    with _metrics_lock:
+        histograms = sorted((key, list(values)) for key, values in _histograms.items())
+        request_counts = sorted(_request_counts.items())
+        routed_reads = sorted(_routed_reads.items())
+        query_stats = sorted((fingerprint, list(stats)) for fingerprint, stats in _query_stats.items())
+    with _flight_lock:
+        coalescing = sorted(coalescing_stats.items())
+    
+    declared = set()
+    for (name, labels), values in histograms:
+        metric = f'backend_{name}'
+        if metric not in declared:
+            declared.add(metric)
+            lines.append(f'# TYPE {metric} histogram')
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), values[:-1]):
+            cumulative += count
+            lines.append(f"{metric}_bucket{prometheus_labels(labels + (('le', bound),))} {int(cumulative)}")
+        lines.append(f'{metric}_sum{prometheus_labels(labels)} {values[-1]:.6f}')
+        lines.append(f'{metric}_count{prometheus_labels(labels)} {int(cumulative)}')
+    
+    lines.append('# TYPE backend_requests_total counter')
+    for labels, count in request_counts:
+        lines.append(f'backend_requests_total{prometheus_labels(labels)} {count}')
+    
+    if routed_reads:
+        lines.append('# TYPE backend_replica_eligible_reads_total counter')
+    for database, count in routed_reads:
+        lines.append(f"backend_replica_eligible_reads_total{prometheus_labels((('database', database),))} {count}")
+    
+    for outcome in ('leader', 'coalesced', 'micro_cached'):
+        metric = COALESCING_METRICS[outcome]
+        lines.append(f'# TYPE {metric} counter')
+        for (route, counted), count in coalescing:
+            if counted == outcome:
+                lines.append(f"{metric}{prometheus_labels((('route', route),))} {count}")
+    
+    lines.append('# TYPE backend_sampled_query_calls_total counter')
+    lines.append('# TYPE backend_sampled_query_seconds_total counter')
+    lines.append('# TYPE backend_sampled_query_rows_total counter')
+    lines.append('# TYPE backend_query_info gauge')
+    for fingerprint, (text, calls, seconds, rows) in query_stats:
+        labels = (('fingerprint', fingerprint),)
+        lines.append(f'backend_sampled_query_calls_total{prometheus_labels(labels)} {calls}')
+        lines.append(f'backend_sampled_query_seconds_total{prometheus_labels(labels)} {seconds:.6f}')
+        lines.append(f'backend_sampled_query_rows_total{prometheus_labels(labels)} {rows}')
+        lines.append(f"backend_query_info{prometheus_labels(labels + (('statement', text),))} 1")
+    return '\n'.join(lines) + '\n'
+
+def metrics_response(event: Dict[str, Any]) -> Dict[str, Any]:
+    token = os.environ.get('METRICS_TOKEN')
+    if token and not hmac.compare_digest(get_request_header(event, 'x-metrics-token'), token):
+        return json_response(403, {'error': 'Forbidden'})
+    return {'statusCode': 200, 'headers': METRICS_HEADERS, 'body': render_metrics(), 'isBase64Encoded': False}
+
+# Shared by every response of a kind; code that adds headers builds a new dict.
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+METRICS_HEADERS = {'Content-Type': 'text/plain; version=0.0.4', 'Access-Control-Allow-Origin': '*'}
+
+def json_response(status_code: int, payload: Any) -> Dict[str, Any]:
+    started = time.perf_counter()
+    body = dump_json(payload)
+    state = _request_state.get()
+    if state is not None:
+        state['serialize_seconds'] += time.perf_counter() - started
+    return {
+        'statusCode': status_code,
+        'headers': JSON_HEADERS,
+        'body': body,
+        'isBase64Encoded': False
+    }
+
+MAX_BODY_BYTES = 64 * 1024
+
+class RequestError(Exception):
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+
+def parse_body(event: Dict[str, Any]) -> Dict[str, Any]:
+    body = event.get('body') or '{}'
+    try:
+        if event.get('isBase64Encoded'):
+            body = base64.b64decode(body)
+        if len(body) > MAX_BODY_BYTES:
+            raise RequestError(413, 'Request body too large')
+        data = json.loads(body)
+    except ValueError:
+        raise RequestError(400, 'Invalid JSON body')
+    if not isinstance(data, dict):
+        raise RequestError(400, 'JSON body must be an object')
+    return data
+
+def is_number(value: Any) -> bool:
+    if isinstance(value, str):
+        try:
+            float(value)
+        except ValueError:
+            return False
+        return True
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def is_integer(value: Any) -> bool:
+    if isinstance(value, str):
+        return value.lstrip('-').isdigit()
+    return isinstance(value, int) and not isinstance(value, bool)
+
+FIELD_TYPES: Dict[str, Callable[[Any], bool]] = {
+    'str': lambda value: isinstance(value, str),
+    'number': is_number,
+    'int': is_integer,
+    'bool': lambda value: isinstance(value, bool),
+    'dict': lambda value: isinstance(value, dict),
+    'list': lambda value: isinstance(value, list),
+    'any': lambda value: True
+}
+
+def compile_schema(schema: Dict[str, str]) -> Callable[[Dict[str, Any]], None]:
+    # 'type' marks a required field, 'type?' an optional one (None counts as absent).
+    fields = tuple(
+        (name, not spec.endswith('?'), spec.rstrip('?'), FIELD_TYPES[spec.rstrip('?')])
+        for name, spec in schema.items()
+    )
+    
+    def validate(data: Dict[str, Any]) -> None:
+        for name, required, type_name, check in fields:
+            value = data.get(name)
+            if value is None:
+                if required:
+                    raise RequestError(400, f'Missing required field: {name}')
+            elif not check(value):
+                raise RequestError(400, f'Invalid field {name}: expected {type_name}')
+    return validate
+
+COMPRESSION_MIN_BYTES = 1024
+COMPRESSED_BODY_CACHE_SIZE = 64
+_compressed_bodies: 'OrderedDict[Tuple[str, str], str]' = OrderedDict()
+
+def get_request_header(event: Dict[str, Any], name: str) -> str:
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name:
+            return value or ''
+    return ''
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    weights = {}
+    for part in accept_encoding.lower().split(','):
+        token, _, param = part.partition(';')
+        param = param.strip()
+        try:
+            weight = float(param[2:]) if param.startswith('q=') else 1.0
+        except ValueError:
+            weight = 0.0
+        weights[token.strip()] = weight
+    for encoding in ('br', 'gzip'):
+        if encoding == 'br' and brotli is None:
+            continue
+        if weights.get(encoding, weights.get('*', 0.0)) > 0:
+            return encoding
+    return None
+
+def compress_body(raw: bytes, encoding: str) -> str:
+    if encoding == 'br':
+        compressed = brotli.compress(raw, quality=5)
+    else:
+        compressed = gzip.compress(raw, compresslevel=6)
+    return base64.b64encode(compressed).decode('ascii')
+
+def opaque_tag(etag: str) -> str:
+    # Weak comparison (RFC 7232 section 2.3.2); '-br'/'-gzip' are the variant suffixes older
+    # responses carried.
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    for encoding in ('br', 'gzip'):
+        etag = etag.replace(f'-{encoding}"', '"')
+    return etag
+
+def etag_matches(if_none_match: str, etag: Optional[str]) -> bool:
+    if not if_none_match or etag is None:
+        return False
+    opaque = opaque_tag(etag)
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*' or opaque_tag(candidate) == opaque:
+            return True
+    return False
+
+def finalize_response(event: Dict[str, Any], response: Dict[str, Any]) -> Dict[str, Any]:
+    body = response.get('body')
+    if not body or response.get('isBase64Encoded'):
+        return response
+    
+    headers = response['headers']
+    raw = body.encode('utf-8')
+    if len(raw) >= COMPRESSION_MIN_BYTES:
+        headers = response['headers'] = {**headers, 'Vary': 'Accept-Encoding'}
+    
+    # ETags are weak and name the body whatever its encoding, so a 304 carries the tag the 200 had.
+    # Cacheable reads bring one derived from their version probe (validator_etag); other GETs are
+    # tagged by a hash of the body and can only be answered with 304 after the handler ran.
+    etag = headers.get('ETag')
+    if etag is None and event.get('httpMethod') == 'GET' and response['statusCode'] == 200:
+        etag = 'W/"' + hashlib.blake2b(raw, digest_size=16).hexdigest() + '"'
+        headers = response['headers'] = {**headers, 'ETag': etag}
+        if etag_matches(get_request_header(event, 'if-none-match'), etag):
+            return {'statusCode': 304, 'headers': headers, 'body': '', 'isBase64Encoded': False}
+    
+    if len(raw) < COMPRESSION_MIN_BYTES:
+        return response
+    
+    encoding = choose_encoding(get_request_header(event, 'accept-encoding'))
+    if encoding is None:
+        return response
+    
+    cache_key = (etag, encoding)
+    encoded = _compressed_bodies.get(cache_key) if etag else None
+    if encoded is None:
+        encoded = compress_body(raw, encoding)
+        if etag:
+            _compressed_bodies[cache_key] = encoded
+            if len(_compressed_bodies) > COMPRESSED_BODY_CACHE_SIZE:
+                _compressed_bodies.popitem(last=False)
+    else:
+        _compressed_bodies.move_to_end(cache_key)
+    
+    headers['Content-Encoding'] = encoding
+    response['body'] = encoded
+    response['isBase64Encoded'] = True
+    return response
+
+# Public reads that a CDN/proxy may cache. last_modified_sql is a cheap probe of the
+# underlying tables; actions without one must not need a database connection.
+CACHE_POLICIES: Dict[str, Dict[str, Any]] = {
+    'get_rates': {
+        'max_age': 10,
+        'stale_while_revalidate': 30,
+        # get_rates shows the last hour of rates, so its body also changes when a rate leaves that
+        # window: the newest update or the moment the last rate aged out, whichever is later.
+        'last_modified_sql': """
+            SELECT GREATEST(
+                (SELECT MAX(updated_at) FROM exchange_rates),
+                (SELECT MAX(updated_at) FROM exchange_rates WHERE updated_at <= NOW() - INTERVAL '1 hour')
+                    + INTERVAL '1 hour'
+            )
+        """
+    },
+    'get_candles': {
+        'max_age': 10,
+        'stale_while_revalidate': 30,
+        'last_modified_sql': "SELECT MAX(updated_at) FROM exchange_rates"
+    },
+    'list_currencies': {
+        'max_age': 300,
+        'stale_while_revalidate': 3600,
+        'last_modified_sql': "SELECT MAX(updated_at) FROM currencies"
+    }
+}
+_last_modified: Dict[str, Tuple[float, Optional[datetime]]] = {}
+
+def parse_http_date(value: str) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        parsed = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+def validator_etag(event: Dict[str, Any], key: str, last_modified: Optional[datetime]) -> str:
+    # The body follows from the action, its query and the probed version, so the tag is built from
+    # those and a revalidation is answered before the handler, its SQL or any serialization runs.
+    params = sorted((event.get('queryStringParameters') or {}).items())
+    return 'W/"' + hashlib.blake2b(repr((key, params, last_modified)).encode(), digest_size=16).hexdigest() + '"'
+
+def cache_headers(policy: Dict[str, Any], last_modified: Optional[datetime], etag: Optional[str]) -> Dict[str, str]:
+    headers = {
+        'Cache-Control': f"public, max-age={policy['max_age']}, stale-while-revalidate={policy['stale_while_revalidate']}",
+        'Vary': 'Accept-Encoding'
+    }
+    if last_modified is not None:
+        headers['Last-Modified'] = format_datetime(last_modified.replace(microsecond=0, tzinfo=timezone.utc), usegmt=True)
+    if etag is not None:
+        headers['ETag'] = etag
+    return headers
+
+def is_not_modified(etag: Optional[str], last_modified: Optional[datetime], if_none_match: str,
+                    if_modified_since: Optional[datetime]) -> bool:
+    # If-Modified-Since is ignored when the request also carries If-None-Match (RFC 7232 section 6).
+    if if_none_match:
+        return etag_matches(if_none_match, etag)
+    return last_modified is not None and if_modified_since is not None and last_modified.replace(microsecond=0) <= if_modified_since
+
+def not_modified_response(policy: Dict[str, Any], last_modified: Optional[datetime], etag: Optional[str]) -> Dict[str, Any]:
+    return {
+        'statusCode': 304,
+        'headers': {'Access-Control-Allow-Origin': '*', **cache_headers(policy, last_modified, etag)},
+        'body': '',
+        'isBase64Encoded': False
+    }
+
+def load_cacheable(policy: Dict[str, Any], run: Callable[[Any], Dict[str, Any]]) -> Tuple[Optional[datetime], Dict[str, Any]]:
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(policy['last_modified_sql'])
+        return cursor.fetchone()[0], run(conn)
+    finally:
+        conn.close()
+
+def serve_cacheable(event: Dict[str, Any], key: str, policy: Dict[str, Any], run: Callable[[Any], Dict[str, Any]],
+                    flight_key: Optional[Tuple] = None) -> Dict[str, Any]:
+    if_none_match = get_request_header(event, 'if-none-match')
+    if_modified_since = parse_http_date(get_request_header(event, 'if-modified-since'))
+    
+    known = _last_modified.get(key)
+    if known and time.monotonic() - known[0] < policy['max_age']:
+        etag = validator_etag(event, key, known[1])
+        if is_not_modified(etag, known[1], if_none_match, if_modified_since):
+            return not_modified_response(policy, known[1], etag)
+    
+    last_modified = etag = None
+    if policy['last_modified_sql'] is None:
+        response = run(None)
+    elif flight_key is not None and not (if_none_match or if_modified_since):
+        # Conditional requests take the probe below, which answers them without running the read.
+        last_modified, response = single_flight(flight_key, COALESCED_READS[key], lambda: load_cacheable(policy, run))
+        _last_modified[key] = (time.monotonic(), last_modified)
+        etag = validator_etag(event, key, last_modified)
+        response = copy_response(response)
+    else:
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(policy['last_modified_sql'])
+            last_modified = cursor.fetchone()[0]
+            _last_modified[key] = (time.monotonic(), last_modified)
+            etag = validator_etag(event, key, last_modified)
+            if is_not_modified(etag, last_modified, if_none_match, if_modified_since):
+                return not_modified_response(policy, last_modified, etag)
+            response = run(conn)
+        finally:
+            conn.close()
+    
+    if response['statusCode'] == 200:
+        response['headers'] = {**response['headers'], **cache_headers(policy, last_modified, etag)}
+    return response
+
+# Hot reads whose concurrent identical requests share one query, with the result
+# reused for a short micro-cache window (seconds) after it completes.
+COALESCED_READS: Dict[str, float] = {
+    'get_rates': 1.0,
+    'get_candles': 1.0,
+    'get_exchange': 0.5
+}
+FLIGHT_TABLE_LIMIT = 1024
+# (route, outcome) -> requests; outcome is 'leader' (ran the query), 'coalesced' (waited for a
+# leader's query) or 'micro_cached' (took a finished result within the window).
+coalescing_stats: Dict[Tuple[str, str], int] = {}
+_flight_lock = threading.Lock()
+_flights: Dict[Tuple, Dict[str, Any]] = {}
+
+def coalesce_key(action: str, params: Dict) -> Optional[Tuple]:
+    if action not in COALESCED_READS:
+        return None
+    return (action, tuple(sorted(params.items())))
+
+def copy_response(response: Dict[str, Any]) -> Dict[str, Any]:
+    return {**response, 'headers': dict(response['headers'])}
+
+def forget_finished_flights(expired_only: bool) -> None:
+    now = time.monotonic()
+    for key, flight in list(_flights.items()):
+        if flight['done'].is_set() and (not expired_only or now - flight['finished_at'] >= COALESCED_READS[key[0]]):
+            del _flights[key]
+
+def single_flight(key: Tuple, window: float, load: Callable[[], Any]) -> Any:
+    with _flight_lock:
+        flight = _flights.get(key)
+        if flight is not None and flight['done'].is_set() and time.monotonic() - flight['finished_at'] >= window:
+            flight = None
+        if flight is None:
+            if len(_flights) >= FLIGHT_TABLE_LIMIT:
+                forget_finished_flights(expired_only=True)
+            flight = {'done': threading.Event(), 'result': None, 'error': None, 'finished_at': 0.0}
+            _flights[key] = flight
+            leader = True
+        else:
+            outcome = (key[0], 'micro_cached' if flight['done'].is_set() else 'coalesced')
+            coalescing_stats[outcome] = coalescing_stats.get(outcome, 0) + 1
+            leader = False
+    
+    if not leader:
+        flight['done'].wait()
+        if flight['error'] is not None:
+            raise flight['error']
+        return flight['result']
+    
+    try:
+        flight['result'] = load()
+    except Exception as error:
+        flight['error'] = error
+        with _flight_lock:
+            _flights.pop(key, None)
+        raise
+    finally:
+        with _flight_lock:
+            coalescing_stats[(key[0], 'leader')] = coalescing_stats.get((key[0], 'leader'), 0) + 1
+        flight['finished_at'] = time.monotonic()
+        flight['done'].set()
+    return flight['result']
+
+def coalesced_read(key: Tuple, run: Callable[[Any], Dict[str, Any]]) -> Dict[str, Any]:
+    def load() -> Dict[str, Any]:
+        conn = get_db_connection()
+        try:
+            return run(conn)
+        finally:
+            conn.close()
+    return copy_response(single_flight(key, COALESCED_READS[key[0]], load))
+
+# Hot statements by name. With PREPARE_STATEMENTS=1 each runs as a server-side prepared statement:
+# PREPARE once per connection (sent with the first EXECUTE, so it costs no extra round trip), then
+# EXECUTE, which skips parsing and, once Postgres settles on a generic plan, planning. Off by default:
+# a serverless invocation's connection serves one request, and transaction-mode poolers do not keep
+# sessions; server/app.py turns it on for its pooled connections. After five executions Postgres may
+# switch to a generic plan, so statements whose best plan depends on the parameter (a per-client
+# ORDER BY ... LIMIT over skewed data) stay plain; tools/bench/prepared.py shows the effect.
+PREPARE_STATEMENTS = os.environ.get('PREPARE_STATEMENTS', '0') == '1'
+PREPARED_QUERIES: Dict[str, str] = {
+    'get_exchange': """
+        SELECT e.*, c.email, c.full_name, c.phone
+        FROM exchanges e
+        LEFT JOIN clients c ON e.client_id = c.id
+        WHERE e.id = %s
+    """,
+    'get_rates': """
+        SELECT id, from_currency, to_currency, rate::text, source, updated_at FROM exchange_rates
+        WHERE updated_at > NOW() - INTERVAL '1 hour'
+        ORDER BY updated_at DESC
+    """,
+    'list_currencies': "SELECT * FROM currencies WHERE is_active = true ORDER BY type, symbol"
+}
+PREPARED_PREFIX = FUNCTION_NAME.replace('-', '_') + '_'
+FEATURE_NOT_SUPPORTED = '0A000'
+INVALID_SQL_STATEMENT_NAME = '26000'
+_prepared_lock = threading.Lock()
+# connection -> {name: 'ready' | 'stale'}; weak, so entries leave with their connections
+_prepared_sessions: 'weakref.WeakKeyDictionary' = weakref.WeakKeyDictionary()
+_prepared_unknown: 'weakref.WeakSet' = weakref.WeakSet()
+
+def server_placeholders(query: str) -> str:
+    parts = query.split('%s')
+    return parts[0] + ''.join(f'${index}{part}' for index, part in enumerate(parts[1:], 1))
+
+PREPARE_SQL = {name: f'PREPARE {PREPARED_PREFIX}{name} AS {server_placeholders(query)}' for name, query in PREPARED_QUERIES.items()}
+
+def prepared_session(conn) -> Dict[str, str]:
+    with _prepared_lock:
+        session = _prepared_sessions.get(conn)
+        unknown = conn in _prepared_unknown
+    if session is not None and not unknown:
+        return session
+    session = {}
+    if unknown:
+        # A PREPARE went out with a statement that failed, so ask the session what it holds.
+        cursor = conn.cursor()
+        cursor.execute("SELECT name FROM pg_prepared_statements WHERE starts_with(name, %s)", (PREPARED_PREFIX,))
+        session = {row[0][len(PREPARED_PREFIX):]: 'ready' for row in cursor.fetchall()}
+    with _prepared_lock:
+        _prepared_sessions[conn] = session
+        _prepared_unknown.discard(conn)
+    return session
+
+def execute_prepared(cursor, name: str, params: Tuple = ()) -> None:
+    if not PREPARE_STATEMENTS:
+        cursor.execute(PREPARED_QUERIES[name], params)
+        return
+    conn = cursor.connection
+    session = prepared_session(conn)
+    status = session.get(name)
+    statement = PREPARED_PREFIX + name
+    execute = f"EXECUTE {statement}({', '.join(['%s'] * len(params))})" if params else f'EXECUTE {statement}'
+    if status == 'ready':
+        query = execute
+    elif status == 'stale':
+        query = f'DEALLOCATE {statement}; {PREPARE_SQL[name]}; {execute}'
+    else:
+        query = f'{PREPARE_SQL[name]}; {execute}'
+    try:
+        cursor.execute(query, params)
+    except psycopg2.Error as error:
+        with _prepared_lock:
+            if status == 'ready' and error.pgcode == FEATURE_NOT_SUPPORTED:
+                # "cached plan must not change result type": a migration changed a table under SELECT *,
+                # so every connection re-prepares the statement rather than failing once each.
+                for other in _prepared_sessions.values():
+                    if other.get(name) == 'ready':
+                        other[name] = 'stale'
+            elif status != 'ready' or error.pgcode == INVALID_SQL_STATEMENT_NAME:
+                _prepared_unknown.add(conn)
+        raise
+    session[name] = 'ready'
+
+# Fee engine. Active commission_settings rows compile into a table keyed by (from, to), where
+# either side may be FEE_WILDCARD; fee_rule tries the exact pair, then (from, *), (*, to) and
+# (*, *), then DEFAULT_COMMISSION. A trigger bumps fee_settings_version on every change to
+# commission_settings (V0013), and fee_table compares it at most every FEE_CHECK_SECONDS,
+# rebuilding only when it moved, so admin edits apply within that delay. Fees are Decimal end to
+# end: the settings are NUMERIC columns and nothing on the way passes through float.
+FEE_WILDCARD = '*'
+FEE_CHECK_SECONDS = float(os.environ.get('FEE_CHECK_SECONDS', '5'))
+AMOUNT_QUANTUM = Decimal('0.00000001')
+# Used when no row matches, wildcards included: the column defaults.
+DEFAULT_COMMISSION = (Decimal('2.00'), Decimal('0'), None)
+# Referral code -> (checked_at, (id, discount_percent) or None for unknown and inactive codes).
+REFERRAL_CACHE_SECONDS = 60.0
+REFERRAL_CACHE_LIMIT = 4096
+MAX_FEE_ITEMS = 1000
+_fee_lock = threading.Lock()
+_fee_table: Dict[str, Any] = {'checked_at': float('-inf'), 'version': None, 'rules': {}}
+_referral_lock = threading.Lock()
+_referral_terms: 'OrderedDict[str, Tuple[float, Optional[Tuple[int, Decimal]]]]' = OrderedDict()
+
+def compile_fee_rules(rows: List[Tuple]) -> Dict[Tuple[str, str], Tuple[Decimal, Decimal, Optional[Decimal]]]:
+    return {(source, target): (DEFAULT_COMMISSION[0] if percent is None else percent, minimum or Decimal(0), maximum)
+            for source, target, percent, minimum, maximum in rows}
+
+def load_fee_table(conn, current: Dict[str, Any]) -> Dict[str, Any]:
+    cursor = conn.cursor()
+    cursor.execute('SELECT version FROM fee_settings_version')
+    row = cursor.fetchone()
+    version = row[0] if row else None
+    if version is not None and version == current['version']:
+        return {**current, 'checked_at': time.monotonic()}
+    # Read after the version, so a change committed in between is at worst loaded twice.
+    cursor.execute("""
+        SELECT from_currency, to_currency, commission_percent, min_commission, max_commission
+        FROM commission_settings WHERE is_active = true
+    """)
+    return {'checked_at': time.monotonic(), 'version': version, 'rules': compile_fee_rules(cursor.fetchall())}
+
+def fee_table(conn=None) -> Dict[str, Any]:
+    global _fee_table
+    if time.monotonic() - _fee_table['checked_at'] < FEE_CHECK_SECONDS:
+        return _fee_table
+    with _fee_lock:
+        if time.monotonic() - _fee_table['checked_at'] < FEE_CHECK_SECONDS:
+            return _fee_table
+        if conn is not None:
+            _fee_table = load_fee_table(conn, _fee_table)
+        else:
+            conn = get_db_connection()
+            try:
+                _fee_table = load_fee_table(conn, _fee_table)
+            finally:
+                conn.close()
+        return _fee_table
+
+def fee_rule(rules: Dict[Tuple[str, str], Tuple], from_currency: str,
+             to_currency: str) -> Tuple[Decimal, Decimal, Optional[Decimal]]:
+    for key in ((from_currency, to_currency), (from_currency, FEE_WILDCARD),
+                (FEE_WILDCARD, to_currency), (FEE_WILDCARD, FEE_WILDCARD)):
+        rule = rules.get(key)
+        if rule is not None:
+            return rule
+    return DEFAULT_COMMISSION
+
+def calculate_fee(rule: Tuple[Decimal, Decimal, Optional[Decimal]], amount: Decimal,
+                  discount_percent: Decimal = Decimal(0)) -> Decimal:
+    # The referral discount lowers the percentage only: min_commission and max_commission still
+    # bound the result. Charged in from_currency and rounded up to AMOUNT_QUANTUM.
+    percent, minimum, maximum = rule
+    commission = max(amount * percent * (100 - discount_percent) / 10000, minimum)
+    if maximum is not None:
+        commission = min(commission, maximum)
+    return commission.quantize(AMOUNT_QUANTUM, ROUND_UP)
+
+def positive_amount(value: Any) -> Optional[Decimal]:
+    try:
+        amount = Decimal(str(value))
+    except InvalidOperation:
+        return None
+    return amount if amount.is_finite() and amount > 0 else None
+
+def load_referral_terms(conn, code: str) -> Optional[Tuple[int, Decimal]]:
+    cursor = conn.cursor()
+    cursor.execute('SELECT id, discount_percent FROM referral_codes WHERE code = %s AND is_active = true', (code,))
+    row = cursor.fetchone()
+    return (row[0], row[1] or Decimal(0)) if row else None
+
+def referral_terms(code: str, conn=None) -> Optional[Tuple[int, Decimal]]:
+    with _referral_lock:
+        cached = _referral_terms.get(code)
+        if cached is not None and time.monotonic() - cached[0] < REFERRAL_CACHE_SECONDS:
+            _referral_terms.move_to_end(code)
+            return cached[1]
+    if conn is not None:
+        terms = load_referral_terms(conn, code)
+    else:
+        conn = get_db_connection()
+        try:
+            terms = load_referral_terms(conn, code)
+        finally:
+            conn.close()
+    with _referral_lock:
+        _referral_terms[code] = (time.monotonic(), terms)
+        _referral_terms.move_to_end(code)
+        if len(_referral_terms) > REFERRAL_CACHE_LIMIT:
+            _referral_terms.popitem(last=False)
+    return terms
+
+# Quotes. get_quote prices an amount from an in-process book of current rates (reloaded every
+# QUOTE_BOOK_TTL_SECONDS) and the fee engine above, and returns the price as a quote id: the
+# fields, base64url JSON, plus a truncated HMAC-SHA256 over them. create_exchange checks the
+# signature and expiry and takes the amounts from the quote, so it neither trusts the client's
+# figures nor looks rates up again, and no quote is stored anywhere. A quote is used at most
+# once through the unique exchanges.quote_ref (V0012). Whichever instance takes the order checks
+# the quote, so every instance (and server/worker.py) must share QUOTE_SECRET; there is no
+# default, and the function refuses to load without it.
+QUOTE_SECRET = os.environ.get('QUOTE_SECRET', '').encode()
+if not QUOTE_SECRET:
+    raise RuntimeError('QUOTE_SECRET is not set; every exchange-api instance must sign quotes with the same secret')
+QUOTE_TTL_SECONDS = int(os.environ.get('QUOTE_TTL_SECONDS', '30'))
+QUOTE_BOOK_TTL_SECONDS = float(os.environ.get('QUOTE_BOOK_TTL_SECONDS', '2'))
+# Rates older than this are not quoted (the same window get_rates shows).
+QUOTE_MAX_RATE_AGE_SECONDS = 3600
+REQUIRE_QUOTES = os.environ.get('REQUIRE_QUOTES', '0') == '1'
+QUOTE_SIGNATURE_BYTES = 16
+QUOTE_FIELDS = ('ref', 'from_currency', 'to_currency', 'from_amount', 'to_amount', 'rate', 'commission',
+                'from_rate_usd', 'referral_code_id', 'expires_at')
+USD_CURRENCIES = ('USD', 'USDT', 'USDC')
+UNIQUE_VIOLATION = '23505'
+_quote_book_lock = threading.Lock()
+_quote_book: Dict[str, Any] = {'loaded_at': float('-inf'), 'rates': {}, 'usd': {}}
+
+def load_quote_book(conn) -> Dict[str, Any]:
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT DISTINCT ON (from_currency, to_currency) from_currency, to_currency, rate
+        FROM exchange_rates
+        WHERE updated_at > LOCALTIMESTAMP - make_interval(secs => %s)
+        ORDER BY from_currency, to_currency, updated_at DESC
+    """, (QUOTE_MAX_RATE_AGE_SECONDS,))
+    rates = {(source, target): rate for source, target, rate in cursor.fetchall() if rate > 0}
+    for (source, target), rate in list(rates.items()):
+        rates.setdefault((target, source), 1 / rate)
+    
+    usd = {currency: Decimal(1) for currency in USD_CURRENCIES}
+    for (source, target), rate in rates.items():
+        if target in USD_CURRENCIES and source not in usd:
+            usd[source] = rate
+    return {'loaded_at': time.monotonic(), 'rates': rates, 'usd': usd}
+
+def quote_book(conn=None) -> Dict[str, Any]:
+    global _quote_book
+    if time.monotonic() - _quote_book['loaded_at'] < QUOTE_BOOK_TTL_SECONDS:
+        return _quote_book
+    with _quote_book_lock:
+        if time.monotonic() - _quote_book['loaded_at'] < QUOTE_BOOK_TTL_SECONDS:
+            return _quote_book
+        if conn is not None:
+            _quote_book = load_quote_book(conn)
+        else:
+            conn = get_db_connection()
+            try:
+                _quote_book = load_quote_book(conn)
+            finally:
+                conn.close()
+        return _quote_book
+
+def quote_signature(body: bytes) -> bytes:
+    digest = hmac.new(QUOTE_SECRET, body, hashlib.sha256).digest()[:QUOTE_SIGNATURE_BYTES]
+    return base64.urlsafe_b64encode(digest).rstrip(b'=')
+
+def sign_quote(quote: Dict[str, Any]) -> str:
+    body = base64.urlsafe_b64encode(dump_json([quote[field] for field in QUOTE_FIELDS]).encode()).rstrip(b'=')
+    return (body + b'.' + quote_signature(body)).decode()
+
+def verify_quote(quote_id: str) -> Optional[Dict[str, Any]]:
+    body, _, signature = quote_id.encode().partition(b'.')
+    if not hmac.compare_digest(quote_signature(body), signature):
+        return None
+    try:
+        fields = json.loads(base64.urlsafe_b64decode(body + b'=' * (-len(body) % 4)))
+    except ValueError:
+        return None
+    quote = dict(zip(QUOTE_FIELDS, fields))
+    if len(fields) != len(QUOTE_FIELDS) or quote['expires_at'] < time.time():
+        return None
+    return quote
+
+# API keys. A request carrying X-Auth-Token is authenticated by the token's SHA-256 (api_keys.key_hash,
+# V0020) through an LRU of recent lookups that also remembers unknown and revoked tokens, so a bad
+# token costs one query per API_KEY_CACHE_SECONDS. Each key has a token bucket holding up to
+# rate_limit_per_minute calls and refilling at that rate; a call that finds it empty gets 429 with
+# Retry-After before any cache, coalescing or database work. Calls are counted in memory and added
+# to api_keys.request_count by a background sync at most every API_KEY_SYNC_SECONDS; the totals it
+# reads back include other instances' calls, which are taken out of the local bucket, so the limit
+# holds across instances to within one sync interval. With API_AUTH_REQUIRED=1 requests without a
+# token are refused; otherwise they pass, limited per caller address when
+# ANONYMOUS_RATE_LIMIT_PER_MINUTE is set.
+API_KEY_HEADER = 'x-auth-token'
+API_AUTH_REQUIRED = os.environ.get('API_AUTH_REQUIRED', '0') == '1'
+ANONYMOUS_RATE_LIMIT_PER_MINUTE = int(os.environ.get('ANONYMOUS_RATE_LIMIT_PER_MINUTE', '0'))
+API_KEY_CACHE_SECONDS = float(os.environ.get('API_KEY_CACHE_SECONDS', '60'))
+API_KEY_CACHE_LIMIT = 10000
+API_KEY_SYNC_SECONDS = float(os.environ.get('API_KEY_SYNC_SECONDS', '5'))
+# Issued keys are at most this long; longer tokens are refused without a lookup.
+MAX_API_KEY_LENGTH = 64
+CALLER_BUCKET_LIMIT = 100000
+# Key hash -> (checked_at, (id, rate_limit_per_minute) or None for unknown and inactive keys).
+_api_key_lock = threading.Lock()
+_api_keys: 'OrderedDict[str, Tuple[float, Optional[Tuple[int, int]]]]' = OrderedDict()
+# Key id -> [tokens, refilled_at, calls not yet synced, request_count at the last sync, last sync].
+_rate_lock = threading.Lock()
+_key_buckets: Dict[int, List[Any]] = {}
+# Caller address -> [tokens, refilled_at] for requests without a key.
+_caller_buckets: 'OrderedDict[str, List[float]]' = OrderedDict()
+_rate_sync: Dict[str, Any] = {'due': 0.0, 'thread': None}
+
+def load_api_key(key_hash: str) -> Optional[Tuple[int, int]]:
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT id, rate_limit_per_minute FROM api_keys WHERE key_hash = %s AND is_active",
+            (key_hash,)
+        )
+        row = cursor.fetchone()
+    finally:
+        conn.close()
+    return (row[0], row[1]) if row else None
+
+def api_key_for(token: str) -> Optional[Tuple[int, int]]:
+    key_hash = hashlib.sha256(token.encode()).hexdigest()
+    with _api_key_lock:
+        cached = _api_keys.get(key_hash)
+        if cached is not None and time.monotonic() - cached[0] < API_KEY_CACHE_SECONDS:
+            _api_keys.move_to_end(key_hash)
+            return cached[1]
+    key = load_api_key(key_hash)
+    with _api_key_lock:
+        _api_keys[key_hash] = (time.monotonic(), key)
+        _api_keys.move_to_end(key_hash)
+        if len(_api_keys) > API_KEY_CACHE_LIMIT:
+            _api_keys.popitem(last=False)
+    return key
+
+def take_token(bucket: List[Any], per_minute: int, now: float) -> float:
+    # 0 when the call may go ahead, otherwise the seconds until the bucket holds a token again.
+    per_second = per_minute / 60.0
+    bucket[0] = min(float(per_minute), bucket[0] + (now - bucket[1]) * per_second)
+    bucket[1] = now
+    if bucket[0] >= 1:
+        bucket[0] -= 1
+        return 0.0
+    return (1 - bucket[0]) / per_second
+
+def sync_api_key_usage() -> None:
+    try:
+        with _rate_lock:
+            calls = {key_id: bucket[2] for key_id, bucket in _key_buckets.items() if bucket[2]}
+            for key_id in calls:
+                _key_buckets[key_id][2] = 0
+        if not calls:
+            return
+        try:
+            conn = get_db_connection()
+            try:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    UPDATE api_keys k
+                    SET request_count = k.request_count + u.calls, last_used_at = CURRENT_TIMESTAMP
+                    FROM unnest(%s::int[], %s::bigint[]) AS u(id, calls)
+                    WHERE k.id = u.id
+                    RETURNING k.id, k.request_count
+                """, (list(calls), list(calls.values())))
+                totals = cursor.fetchall()
+                conn.commit()
+            finally:
+                conn.close()
+        except Exception as error:
+            # Nothing waits on this thread: the calls go back into their buckets for the next sync.
+            with _rate_lock:
+                for key_id, count in calls.items():
+                    _key_buckets[key_id][2] += count
+            print(dump_json({
+                'level': 'error',
+                'event': 'api_key_sync_failed',
+                'function': FUNCTION_NAME,
+                'keys': len(calls),
+                'error': f'{type(error).__name__}: {error}'
+            }), flush=True)
+            return
+        now = time.monotonic()
+        with _rate_lock:
+            for key_id, total in totals:
+                bucket = _key_buckets[key_id]
+                # A bucket refills completely within a minute, so only other instances' calls since
+                # a recent sync still count against it.
+                if bucket[3] is not None and now - bucket[4] < 60:
+                    bucket[0] = max(0.0, bucket[0] - (total - bucket[3] - calls[key_id]))
+                bucket[3], bucket[4] = total, now
+    finally:
+        with _rate_lock:
+            _rate_sync['thread'] = None
+
+def rate_limited(retry_after: float) -> Dict[str, Any]:
+    seconds = max(1, int(retry_after + 0.999))
+    response = json_response(429, {'error': 'Rate limit exceeded', 'retry_after': seconds})
+    response['headers'] = {**response['headers'], 'Retry-After': str(seconds)}
+    return response
+
+def admit_request(event: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    # None when the request may proceed, otherwise the 429 to answer with.
+    token = get_request_header(event, API_KEY_HEADER)
+    now = time.monotonic()
+    if token:
+        key = api_key_for(token) if len(token) <= MAX_API_KEY_LENGTH else None
+        if key is None:
+            raise RequestError(401, 'Invalid API key')
+        key_id, per_minute = key
+        with _rate_lock:
+            bucket = _key_buckets.get(key_id)
+            if bucket is None:
+                bucket = _key_buckets[key_id] = [float(per_minute), now, 0, None, now]
+            wait = take_token(bucket, per_minute, now)
+            if not wait:
+                bucket[2] += 1
+            if now >= _rate_sync['due'] and _rate_sync['thread'] is None:
+                _rate_sync['due'] = now + API_KEY_SYNC_SECONDS
+                _rate_sync['thread'] = threading.Thread(target=sync_api_key_usage, daemon=True)
+                _rate_sync['thread'].start()
+    elif API_AUTH_REQUIRED:
+        raise RequestError(401, 'API key required')
+    else:
+        caller = request_caller(event)
+        if ANONYMOUS_RATE_LIMIT_PER_MINUTE <= 0 or not caller:
+            return None
+        with _rate_lock:
+            bucket = _caller_buckets.get(caller)
+            if bucket is None:
+                bucket = _caller_buckets[caller] = [float(ANONYMOUS_RATE_LIMIT_PER_MINUTE), now]
+                if len(_caller_buckets) > CALLER_BUCKET_LIMIT:
+                    _caller_buckets.popitem(last=False)
+            _caller_buckets.move_to_end(caller)
+            wait = take_token(bucket, ANONYMOUS_RATE_LIMIT_PER_MINUTE, now)
+    return rate_limited(wait) if wait else None
+
+OPTIONS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, X-Auth-Token, X-Read-After',
+    'Access-Control-Max-Age': '86400'
+}
+
+# Action table per method: each route takes (conn, data, event) where data is the
+# query string for GET and the parsed JSON body otherwise.
+ROUTE_KEY = 'action'
+QUERY_METHODS = ('GET', 'DELETE')
+# GET actions that write, so they never read from a replica.
+PRIMARY_GET_ACTIONS = frozenset()
+# GET actions served from in-process state: they get no connection and open one only to refresh it.
+IN_MEMORY_ACTIONS = frozenset({'get_quote'})
+DEFAULT_ACTIONS = {'GET': 'list_exchanges', 'PUT': 'update_exchange_status'}
+# Ids per bulk_update_status request; they are moved in one statement.
+MAX_TRANSITION_IDS = 10000
+ROUTES: Dict[str, Dict[str, Callable[[Any, Dict[str, Any], Dict[str, Any]], Dict[str, Any]]]] = {
+    'GET': {
+        'list_exchanges': lambda conn, params, event: list_exchanges(conn, params),
+        'get_exchange': lambda conn, params, event: get_exchange(conn, params.get('id')),
+        'list_clients': lambda conn, params, event: list_clients(conn),
+        'get_rates': lambda conn, params, event: get_rates(conn),
+        'get_candles': lambda conn, params, event: get_candles(conn, params),
+        'get_quote': lambda conn, params, event: get_quote(params),
+        'list_currencies': lambda conn, params, event: list_currencies(conn)
+    },
+    'POST': {
+        'create_exchange': lambda conn, body, event: create_exchange(conn, body),
+        'create_client': lambda conn, body, event: create_client(conn, body),
+        'calculate_fees': lambda conn, body, event: calculate_fees(conn, body),
+        'update_rate': lambda conn, body, event: update_rate(conn, body)
+    },
+    'PUT': {
+        'update_exchange_status': lambda conn, body, event: update_exchange_status(conn, body.get('id'), body),
+        'bulk_update_status': lambda conn, body, event: bulk_update_status(conn, body)
+    }
+}
+SCHEMAS: Dict[Tuple[str, str], Dict[str, str]] = {
+    ('GET', 'list_exchanges'): {'limit': 'int?', 'offset': 'int?'},
+    ('GET', 'get_candles'): {
+        'from_currency': 'str', 'to_currency': 'str', 'resolution': 'str?', 'start': 'int?', 'end': 'int?', 'limit': 'int?'
+    },
+    ('GET', 'get_quote'): {'from_currency': 'str', 'to_currency': 'str', 'from_amount': 'number', 'referral_code': 'str?'},
+    ('POST', 'create_exchange'): {
+        'from_amount': 'number?', 'to_amount': 'number?', 'exchange_rate': 'number?', 'quote_id': 'str?',
+        'from_currency': 'str', 'to_currency': 'str', 'client_id': 'int?', 'from_rate_usd': 'number?',
+        'referral_code': 'str?'
+    },
+    ('POST', 'calculate_fees'): {'items': 'list'},
+    ('POST', 'create_client'): {'email': 'str', 'wallet_addresses': 'dict?'},
+    ('POST', 'update_rate'): {'from_currency': 'str', 'to_currency': 'str', 'rate': 'number'},
+    ('PUT', 'update_exchange_status'): {'id': 'int', 'status': 'str', 'transaction_hash': 'str?', 'notes': 'str?'},
+    ('PUT', 'bulk_update_status'): {'ids': 'list', 'status': 'str', 'notes': 'str?'}
+}
+VALIDATORS = {route: compile_schema(schema) for route, schema in SCHEMAS.items()}
+FEE_ITEM_VALIDATOR = compile_schema({'from_currency': 'str', 'to_currency': 'str', 'amount': 'number', 'referral_code': 'str?'})
+
+# Rate history (V0011): every exchange_rates write is appended to rate_ticks by a trigger and
+# rate_rollup folds the ticks into candles per tier (resolution in seconds -> retention in days,
+# None keeps them). get_candles reads the coarsest tier that divides the requested resolution,
+# so finer resolutions only reach back as far as the 1m tier is kept.
+CANDLE_RESOLUTIONS = {'1m': 60, '5m': 300, '15m': 900, '30m': 1800, '1h': 3600, '4h': 14400, '1d': 86400, '1w': 604800}
+RATE_TIERS: Dict[int, Optional[int]] = {60: 30, 3600: 730, 86400: None}
+RATE_TICK_RETENTION_DAYS = int(os.environ.get('RATE_TICK_RETENTION_DAYS', '7'))
+RATE_PARTITION_DAYS_AHEAD = 3
+RATE_ROLLUP_SECONDS = float(os.environ.get('RATE_ROLLUP_SECONDS', '60'))
+# Each rollup re-reads ticks from this long before the previous one, which picks up ticks whose
+# transaction started earlier (ts is the transaction time) but committed after it ran.
+RATE_ROLLUP_GRACE_SECONDS = 120
+CANDLE_ORIGIN = datetime(2000, 1, 3)  # a Monday, so 1w candles start on Mondays
+DEFAULT_CANDLES = 500
+MAX_CANDLES = 1000
+
+# Expiry (V0015): expiry_sweep expires pending exchanges older than PENDING_EXCHANGE_TTL_SECONDS
+# (with their pending payment invoices), other pending invoices older than
+# PAYMENT_INVOICE_TTL_SECONDS and active limit orders past expiry_date, and prunes the
+# code_reservations (V0019) of codes now held by a referral code or wallet verification, whose own
+# tables keep them from being reserved again. Each run takes at most EXPIRY_BATCH rows of each,
+# oldest first and skipping rows another worker holds, and queues itself again while a backlog is
+# left, so a large backlog drains in short transactions.
+PENDING_EXCHANGE_TTL_SECONDS = float(os.environ.get('PENDING_EXCHANGE_TTL_SECONDS', '86400'))
+PAYMENT_INVOICE_TTL_SECONDS = float(os.environ.get('PAYMENT_INVOICE_TTL_SECONDS', '86400'))
+EXPIRY_SWEEP_SECONDS = float(os.environ.get('EXPIRY_SWEEP_SECONDS', '60'))
+EXPIRY_BATCH = 1000
+
+# Rate feed: rate_feed stores the USD price of every active currency as a <symbol>/USD rate
+# every RATE_FEED_SECONDS, from RATE_FEED_URL (CryptoCompare's pricemulti, the default rate
+# source of V0001; RATE_FEED_API_KEY is sent as its Apikey). Quotes and create_exchange price
+# only from rates newer than QUOTE_MAX_RATE_AGE_SECONDS, so a deployment must run this job
+# (server/worker.py) or write rates through update_rate itself.
+RATE_FEED_URL = os.environ.get('RATE_FEED_URL', 'https://min-api.cryptocompare.com/data/pricemulti')
+RATE_FEED_API_KEY = os.environ.get('RATE_FEED_API_KEY', '')
+RATE_FEED_SECONDS = float(os.environ.get('RATE_FEED_SECONDS', '30'))
+RATE_FEED_SOURCE = 'cryptocompare'
+RATE_FEED_TIMEOUT_SECONDS = 10
+
+# Background jobs owned by this function: server/worker.py runs them as (conn, payload) -> result
+# inside its own transaction, so they must not commit.
+JOBS: Dict[str, Callable[[Any, Dict[str, Any]], Optional[Dict[str, Any]]]] = {
+    'rate_rollup': lambda conn, payload: run_rate_rollup(conn, payload),
+    'rate_retention': lambda conn, payload: run_rate_retention(conn, payload),
+    'expiry_sweep': lambda conn, payload: run_expiry_sweep(conn, payload),
+    'rate_feed': lambda conn, payload: run_rate_feed(conn, payload)
+}
+# Recurring jobs (kind -> interval in seconds) that server/worker.py keeps queued.
+SCHEDULES: Dict[str, float] = {
+    'rate_feed': RATE_FEED_SECONDS,
+    'rate_rollup': RATE_ROLLUP_SECONDS,
+    'rate_retention': 3600.0,
+    'expiry_sweep': EXPIRY_SWEEP_SECONDS
+}
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    started = time.perf_counter()
+    state = begin_request(event, context)
+    token = _request_state.set(state)
+    status_code = 500
+    try:
+        response = finalize_response(event, dispatch(event, context))
+        status_code = response['statusCode']
+        if state['request_id']:
+            response['headers'] = {**response['headers'], 'X-Request-Id': state['request_id']}
+        return response
+    finally:
+        _request_state.reset(token)
+        method = event.get('httpMethod', 'GET')
+        finish_request(state, method if method in ROUTES or method == 'OPTIONS' else 'OTHER', status_code,
+                       time.perf_counter() - started)
+
+def dispatch(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, X-Auth-Token',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
+        return {'statusCode': 200, 'headers': OPTIONS_HEADERS, 'body': '', 'isBase64Encoded': False}
     
-    conn = get_db_connection()
+    if method == 'GET' and (event.get('queryStringParameters') or {}).get(ROUTE_KEY) == 'metrics':
+        tag_request('metrics')
+        return metrics_response(event)
     
     try:
-        if method == 'GET':
-            params = event.get('queryStringParameters') or {}
-            action = params.get('action', 'list_exchanges')
-            
-            if action == 'list_exchanges':
-                return list_exchanges(conn, params)
-            elif action == 'get_exchange':
-                return get_exchange(conn, params.get('id'))
-            elif action == 'list_clients':
-                return list_clients(conn)
-            elif action == 'get_rates':
-                return get_rates(conn)
-            elif action == 'list_currencies':
-                return list_currencies(conn)
-            
-        elif method == 'POST':
-            body = json.loads(event.get('body', '{}'))
-            action = body.get('action')
-            
-            if action == 'create_exchange':
-                return create_exchange(conn, body)
-            elif action == 'create_client':
-                return create_client(conn, body)
-            elif action == 'update_rate':
-                return update_rate(conn, body)
-            
-        elif method == 'PUT':
-            body = json.loads(event.get('body', '{}'))
-            exchange_id = body.get('id')
-            return update_exchange_status(conn, exchange_id, body)
-        
-        return {
-            'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Invalid action'}),
-            'isBase64Encoded': False
-        }
-        
+        return route_request(event, method)
+    except RequestError as error:
+        return json_response(error.status_code, {'error': error.message})
+
+def route_request(event: Dict[str, Any], method: str) -> Dict[str, Any]:
+    routes = ROUTES.get(method, {})
+    if method in QUERY_METHODS:
+        data = event.get('queryStringParameters') or {}
+    else:
+        data = parse_body(event) if routes else {}
+    action = data.get(ROUTE_KEY) or DEFAULT_ACTIONS.get(method)
+    route = routes.get(action)
+    if route is None:
+        raise RequestError(400, 'Invalid action')
+    tag_request(action)
+    refused = admit_request(event)
+    if refused is not None:
+        return refused
+    validate = VALIDATORS.get((method, action))
+    if validate is not None:
+        validate(data)
+    run = lambda conn: route(conn, data, event)
+    readonly = method == 'GET' and action not in PRIMARY_GET_ACTIONS
+    
+    if method == 'GET':
+        if action in IN_MEMORY_ACTIONS:
+            return run(None)
+        policy = CACHE_POLICIES.get(action)
+        # A caller that must see its own writes does not share another request's result.
+        flight_key = coalesce_key(action, data) if not readonly or route_read(event) else None
+        if policy:
+            return serve_cacheable(event, action, policy, run, flight_key)
+        if flight_key is not None:
+            return coalesced_read(flight_key, run)
+    else:
+        _last_modified.clear()
+        with _flight_lock:
+            forget_finished_flights(expired_only=False)
+    
+    conn = get_db_connection()
+    try:
+        response = run(conn)
+        if not readonly and REPLICA_DSNS and response['statusCode'] < 400:
+            remember_write(event, conn, response)
+        return response
     finally:
         conn.close()
 
 def list_exchanges(conn, params: Dict) -> Dict:
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor = conn.cursor()
     
     limit = int(params.get('limit', 50))
     offset = int(params.get('offset', 0))
@@ -84,86 +1457,165 @@ def list_exchanges(conn, params: Dict) -> Dict:
     client_id = params.get('client_id')
     client_email = params.get('client_email')
     
-    query = """
-        SELECT e.*, c.email, c.full_name, c.telegram_username
-        FROM exchanges e
-        LEFT JOIN clients c ON e.client_id = c.id
-        WHERE 1=1
-    """
+    if client_email and not (client_id and client_id.isdigit()):
+        # Resolved to an id up front: filtering through the join hides the client from the planner's
+        # per-client statistics, so busy clients got a full sort of their history for every page
+        cursor.execute("SELECT id FROM clients WHERE email = %s", (client_email,))
+        row = cursor.fetchone()
+        if row is None:
+            return json_response(200, {'exchanges': [], 'total': 0, 'limit': limit, 'offset': offset})
+        client_id = str(row[0])
     
+    filters = ""
+    args: List[Any] = []
     if client_id and client_id.isdigit():
-        query += f" AND e.client_id = {client_id}"
-    elif client_email:
-        query += f" AND c.email = '{client_email}'"
+        filters += " AND e.client_id = %s"
+        args.append(int(client_id))
     
     if status:
-        query += f" AND e.status = '{status}'"
-    
-    query += f" ORDER BY e.created_at DESC LIMIT {limit} OFFSET {offset}"
+        filters += " AND e.status = %s"
+        args.append(status)
     
-    cursor.execute(query)
-    exchanges = cursor.fetchall()
-    
-    count_query = "SELECT COUNT(*) as total FROM exchanges e LEFT JOIN clients c ON e.client_id = c.id WHERE 1=1"
-    if client_id and client_id.isdigit():
-        count_query += f" AND e.client_id = {client_id}"
-    elif client_email:
-        count_query += f" AND c.email = '{client_email}'"
-    if status:
-        count_query += f" AND e.status = '{status}'"
+    cursor.execute(f"""
+        SELECT e.id, e.client_id, e.from_currency, e.to_currency, e.from_amount::text, e.to_amount::text,
+               e.exchange_rate::text, e.status, e.from_wallet, e.to_wallet, e.transaction_hash, e.created_at,
+               e.completed_at, e.notes, e.deposit_tx_hash, e.deposit_confirmed_at, e.withdrawal_tx_hash,
+               e.withdrawal_confirmed_at, e.blockchain_from, e.blockchain_to, e.referral_code_id, e.order_number,
+               e.quote_ref, e.commission::text, e.commission_usd::text, c.email, c.full_name, c.telegram_username
+        FROM exchanges e
+        LEFT JOIN clients c ON e.client_id = c.id
+        WHERE 1=1{filters}
+        ORDER BY e.created_at DESC LIMIT %s OFFSET %s
+    """, (*args, limit, offset))
+    exchanges = fetch_rows(cursor)
     
-    cursor.execute(count_query)
-    total = cursor.fetchone()['total']
+    cursor.execute(f"SELECT COUNT(*) as total FROM exchanges e WHERE 1=1{filters}", args)
+    total = cursor.fetchone()[0]
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({
-            'exchanges': [dict(e) for e in exchanges],
-            'total': total,
-            'limit': limit,
-            'offset': offset
-        }, default=str),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {
+        'exchanges': exchanges,
+        'total': total,
+        'limit': limit,
+        'offset': offset
+    })
 
 def get_exchange(conn, exchange_id: str) -> Dict:
     if not exchange_id:
-        return {
-            'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Exchange ID required'}),
-            'isBase64Encoded': False
-        }
+        return json_response(400, {'error': 'Exchange ID required'})
     
     cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute("""
-        SELECT e.*, c.email, c.full_name, c.phone
-        FROM exchanges e
-        LEFT JOIN clients c ON e.client_id = c.id
-        WHERE e.id = %s
-    """, (exchange_id,))
+    execute_prepared(cursor, 'get_exchange', (exchange_id,))
     
     exchange = cursor.fetchone()
     
     if not exchange:
-        return {
-            'statusCode': 404,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Exchange not found'}),
-            'isBase64Encoded': False
-        }
+        return json_response(404, {'error': 'Exchange not found'})
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'exchange': dict(exchange)}, default=str),
-        'isBase64Encoded': False
+    return json_response(200, {'exchange': dict(exchange)})
+
+def price_exchange(from_currency: str, to_currency: str, from_amount: Decimal, discount_percent: Decimal,
+                   conn=None) -> Optional[Tuple[Decimal, Decimal, Decimal, Decimal]]:
+    # (rate, from_rate_usd, commission, to_amount) from the quote book and the fee engine, or None
+    # when the pair has no current rate. The client receives what is left after the commission,
+    # rounded down.
+    book = quote_book(conn)
+    rate = book['rates'].get((from_currency, to_currency))
+    from_rate_usd = book['usd'].get(from_currency)
+    if rate is None and from_rate_usd is not None and book['usd'].get(to_currency):
+        rate = from_rate_usd / book['usd'][to_currency]
+    if rate is None or from_rate_usd is None:
+        return None
+    commission = calculate_fee(fee_rule(fee_table(conn)['rules'], from_currency, to_currency), from_amount, discount_percent)
+    to_amount = ((from_amount - commission) * rate).quantize(AMOUNT_QUANTUM, ROUND_DOWN)
+    return rate, from_rate_usd, commission, to_amount
+
+def get_quote(params: Dict) -> Dict:
+    from_currency = params['from_currency']
+    to_currency = params['to_currency']
+    from_amount = positive_amount(params['from_amount'])
+    if from_amount is None:
+        return json_response(400, {'error': 'from_amount must be a positive number'})
+    referral_code_id, discount_percent = None, Decimal(0)
+    if params.get('referral_code'):
+        terms = referral_terms(params['referral_code'])
+        if terms is None:
+            return json_response(400, {'error': 'Invalid referral code'})
+        referral_code_id, discount_percent = terms
+    
+    priced = price_exchange(from_currency, to_currency, from_amount, discount_percent)
+    if priced is None:
+        return json_response(404, {'error': f'No current rate for {from_currency}/{to_currency}'})
+    rate, from_rate_usd, commission, to_amount = priced
+    if to_amount <= 0:
+        return json_response(400, {'error': 'Amount does not cover the commission', 'commission': commission})
+    
+    quote = {
+        'ref': secrets.token_hex(8),
+        'from_currency': from_currency,
+        'to_currency': to_currency,
+        'from_amount': from_amount,
+        'to_amount': to_amount,
+        'rate': rate,
+        'commission': commission,
+        'from_rate_usd': from_rate_usd,
+        'referral_code_id': referral_code_id,
+        'expires_at': int(time.time()) + QUOTE_TTL_SECONDS
     }
+    
+    return json_response(200, {
+        'quote_id': sign_quote(quote),
+        'from_currency': from_currency,
+        'to_currency': to_currency,
+        'from_amount': from_amount,
+        'to_amount': to_amount,
+        'rate': rate,
+        'commission': commission,
+        'discount_percent': discount_percent,
+        'expires_at': quote['expires_at']
+    })
 
 def create_exchange(conn, data: Dict) -> Dict:
     cursor = conn.cursor(cursor_factory=RealDictCursor)
     
+    quote_ref = None
+    if data.get('quote_id'):
+        quote = verify_quote(data['quote_id'])
+        if quote is None:
+            return json_response(400, {'success': False, 'error': 'Quote is invalid or expired'})
+        if (quote['from_currency'], quote['to_currency']) != (data['from_currency'], data['to_currency']):
+            return json_response(400, {'success': False, 'error': 'Quote is for a different currency pair'})
+        data = {**data, 'from_amount': quote['from_amount'], 'to_amount': quote['to_amount'],
+                'exchange_rate': quote['rate'], 'from_rate_usd': quote['from_rate_usd']}
+        quote_ref = quote['ref']
+        commission = Decimal(quote['commission'])
+        referral_code_id = quote['referral_code_id']
+    else:
+        # Without a quote (refused when REQUIRE_QUOTES is on) the exchange is priced here, as
+        # get_quote would price it; any to_amount, exchange_rate or from_rate_usd the client sent
+        # is ignored.
+        for field in ('quote_id',) if REQUIRE_QUOTES else ('from_amount',):
+            if data.get(field) is None:
+                raise RequestError(400, f'Missing required field: {field}')
+        from_amount = positive_amount(data['from_amount'])
+        if from_amount is None:
+            return json_response(400, {'success': False, 'error': 'from_amount must be a positive number'})
+        referral_code_id, discount_percent = None, Decimal(0)
+        if data.get('referral_code'):
+            terms = referral_terms(data['referral_code'], conn)
+            if terms is None:
+                return json_response(400, {'success': False, 'error': 'Invalid referral code'})
+            referral_code_id, discount_percent = terms
+        priced = price_exchange(data['from_currency'], data['to_currency'], from_amount, discount_percent, conn)
+        if priced is None:
+            return json_response(400, {'success': False,
+                                       'error': f"No current rate for {data['from_currency']}/{data['to_currency']}"})
+        rate, from_rate_usd, commission, to_amount = priced
+        if to_amount <= 0:
+            return json_response(400, {'success': False, 'error': 'Amount does not cover the commission',
+                                       'commission': commission})
+        data = {**data, 'from_amount': from_amount, 'to_amount': to_amount, 'exchange_rate': rate,
+                'from_rate_usd': from_rate_usd}
+    
     client_id = data.get('client_id')
     from_amount = float(data['from_amount'])
     from_currency = data['from_currency']
@@ -171,6 +1623,9 @@ def create_exchange(conn, data: Dict) -> Dict:
     email = data.get('email', 'anonymous@exchange.com')
     telegram = data.get('telegram', '')
     
+    from_rate_usd = data['from_rate_usd']
+    commission_usd = (commission * Decimal(str(from_rate_usd))).quantize(AMOUNT_QUANTUM)
+    
     if not client_id:
         cursor.execute("SELECT id FROM clients WHERE email = %s", (email,))
         existing_client = cursor.fetchone()
@@ -200,38 +1655,43 @@ def create_exchange(conn, data: Dict) -> Dict:
     """, (verification_level,))
     limits = cursor.fetchone()
     
-    from_rate_usd = data.get('from_rate_usd', from_amount)
-    amount_usd = from_amount * from_rate_usd
+    amount_usd = from_amount * float(from_rate_usd)
     
     if amount_usd > float(limits['single_transaction_limit_usd']):
-        return {
-            'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({
-                'success': False,
-                'error': 'Amount exceeds limit',
-                'limit': float(limits['single_transaction_limit_usd']),
-                'verification_level': verification_level
-            }),
-            'isBase64Encoded': False
-        }
+        return json_response(400, {
+            'success': False,
+            'error': 'Amount exceeds limit',
+            'limit': float(limits['single_transaction_limit_usd']),
+            'verification_level': verification_level
+        })
     
-    cursor.execute("""
-        INSERT INTO exchanges 
-        (client_id, from_currency, to_currency, from_amount, to_amount, exchange_rate, from_wallet, to_wallet, status, notes)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, 'pending', %s)
-        RETURNING id, created_at
-    """, (
-        client_id,
-        from_currency,
-        to_currency,
-        data['from_amount'],
-        data['to_amount'],
-        data['exchange_rate'],
-        data.get('from_address', ''),
-        data.get('to_address', ''),
-        data.get('comment', '')
-    ))
+    try:
+        cursor.execute("""
+            INSERT INTO exchanges 
+            (client_id, from_currency, to_currency, from_amount, to_amount, exchange_rate, from_wallet, to_wallet, status, notes,
+             quote_ref, commission, commission_usd, referral_code_id)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, 'pending', %s, %s, %s, %s, %s)
+            RETURNING id, created_at
+        """, (
+            client_id,
+            from_currency,
+            to_currency,
+            data['from_amount'],
+            data['to_amount'],
+            data['exchange_rate'],
+            data.get('from_address', ''),
+            data.get('to_address', ''),
+            data.get('comment', ''),
+            quote_ref,
+            commission,
+            commission_usd,
+            referral_code_id
+        ))
+    except psycopg2.IntegrityError as error:
+        if quote_ref is None or error.pgcode != UNIQUE_VIOLATION:
+            raise
+        conn.rollback()
+        return json_response(409, {'success': False, 'error': 'Quote has already been used'})
     
     result = cursor.fetchone()
     exchange_id = result['id']
@@ -248,50 +1708,111 @@ def create_exchange(conn, data: Dict) -> Dict:
     
     conn.commit()
     
-    return {
-        'statusCode': 201,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({
-            'success': True,
-            'exchange_id': exchange_id,
-            'client_id': client_id,
-            'status': 'pending',
-            'created_at': str(result['created_at'])
-        }, default=str),
-        'isBase64Encoded': False
-    }
+    return json_response(201, {
+        'success': True,
+        'exchange_id': exchange_id,
+        'client_id': client_id,
+        'status': 'pending',
+        'from_amount': data['from_amount'],
+        'to_amount': data['to_amount'],
+        'exchange_rate': data['exchange_rate'],
+        'commission': commission,
+        'created_at': result['created_at']
+    })
+
+def calculate_fees(conn, data: Dict) -> Dict:
+    # Batch form of the fee engine for reporting: one fee table and quote book snapshot for all
+    # items, each referral code looked up once.
+    items = data['items']
+    if len(items) > MAX_FEE_ITEMS:
+        raise RequestError(400, f'At most {MAX_FEE_ITEMS} items per request')
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            raise RequestError(400, f'Invalid item {index}: expected an object')
+        try:
+            FEE_ITEM_VALIDATOR(item)
+        except RequestError as error:
+            raise RequestError(400, f'Invalid item {index}: {error.message}')
+    
+    table = fee_table(conn)
+    usd = quote_book(conn)['usd']
+    terms = {code: referral_terms(code, conn) for code in {item.get('referral_code') for item in items} if code}
+    fees = []
+    total_usd = Decimal(0)
+    for index, item in enumerate(items):
+        amount = positive_amount(item['amount'])
+        if amount is None:
+            raise RequestError(400, f'Invalid item {index}: amount must be a positive number')
+        referral_code_id, discount_percent = None, Decimal(0)
+        if item.get('referral_code'):
+            if terms[item['referral_code']] is None:
+                raise RequestError(400, f"Invalid item {index}: unknown referral code {item['referral_code']}")
+            referral_code_id, discount_percent = terms[item['referral_code']]
+        rule = fee_rule(table['rules'], item['from_currency'], item['to_currency'])
+        commission = calculate_fee(rule, amount, discount_percent)
+        commission_usd = None
+        if item['from_currency'] in usd:
+            commission_usd = (commission * usd[item['from_currency']]).quantize(AMOUNT_QUANTUM)
+            total_usd += commission_usd
+        fees.append({
+            'from_currency': item['from_currency'],
+            'to_currency': item['to_currency'],
+            'amount': amount,
+            'commission': commission,
+            'commission_usd': commission_usd,
+            'commission_percent': rule[0],
+            'discount_percent': discount_percent,
+            'referral_code_id': referral_code_id
+        })
+    
+    return json_response(200, {'fees': fees, 'total_commission_usd': total_usd, 'settings_version': table['version']})
 
 def update_exchange_status(conn, exchange_id: int, data: Dict) -> Dict:
     cursor = conn.cursor()
     
-    status = data.get('status')
+    exchange_id = int(exchange_id)
+    status = data['status']
     transaction_hash = data.get('transaction_hash')
     
-    query = "UPDATE exchanges SET status = %s"
-    params = [status]
+    status_from, moved = transition_exchanges(conn, [exchange_id], status, 'admin', data.get('notes', ''))[exchange_id]
+    if status_from is None:
+        return json_response(404, {'error': 'Exchange not found'})
+    # Repeating the current status is not a transition, but still records a transaction hash.
+    if not moved and status_from != status:
+        conn.rollback()
+        cursor.execute("SELECT requires_deposit FROM exchange_transitions WHERE from_status = %s AND to_status = %s",
+                       (status_from, status))
+        transition = cursor.fetchone()
+        if transition and transition[0]:
+            return json_response(409, {'error': f'Cannot move exchange from {status_from} to {status} before its deposit is confirmed',
+                                       'status': status_from})
+        return json_response(409, {'error': f'Cannot move exchange from {status_from} to {status}', 'status': status_from})
     
     if transaction_hash:
-        query += ", transaction_hash = %s"
-        params.append(transaction_hash)
-    
-    if status == 'completed':
-        query += ", completed_at = CURRENT_TIMESTAMP"
+        cursor.execute("UPDATE exchanges SET transaction_hash = %s WHERE id = %s", (transaction_hash, exchange_id))
+    conn.commit()
     
-    query += " WHERE id = %s"
-    params.append(exchange_id)
+    return json_response(200, {'success': True, 'message': 'Exchange updated', 'status_from': status_from})
+
+def bulk_update_status(conn, data: Dict) -> Dict:
+    ids = data['ids']
+    if len(ids) > MAX_TRANSITION_IDS:
+        raise RequestError(400, f'At most {MAX_TRANSITION_IDS} ids per request')
+    if not all(is_integer(exchange_id) for exchange_id in ids):
+        raise RequestError(400, 'Invalid field ids: expected a list of int')
     
-    cursor.execute(query, params)
+    results = transition_exchanges(conn, [int(exchange_id) for exchange_id in ids], data['status'], 'admin',
+                                   data.get('notes', ''))
     conn.commit()
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'success': True, 'message': 'Exchange updated'}),
-        'isBase64Encoded': False
-    }
+    moved = [exchange_id for exchange_id, (status_from, done) in results.items() if done]
+    rejected = [{'id': exchange_id, 'status': status_from}
+                for exchange_id, (status_from, done) in results.items() if not done and status_from != data['status']]
+    unchanged = [exchange_id for exchange_id, (status_from, done) in results.items() if status_from == data['status']]
+    return json_response(200, {'success': True, 'moved': len(moved), 'unchanged': unchanged, 'rejected': rejected})
 
 def list_clients(conn) -> Dict:
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor = conn.cursor()
     cursor.execute("""
         SELECT c.*, 
                COUNT(e.id) as total_exchanges,
@@ -302,14 +1823,9 @@ def list_clients(conn) -> Dict:
         ORDER BY c.created_at DESC
     """)
     
-    clients = cursor.fetchall()
+    clients = fetch_rows(cursor)
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'clients': [dict(c) for c in clients]}, default=str),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {'clients': clients})
 
 def create_client(conn, data: Dict) -> Dict:
     cursor = conn.cursor(cursor_factory=RealDictCursor)
@@ -335,67 +1851,276 @@ def create_client(conn, data: Dict) -> Dict:
     result = cursor.fetchone()
     conn.commit()
     
-    return {
-        'statusCode': 201,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({
-            'success': True,
-            'client_id': result['id'],
-            'created_at': str(result['created_at'])
-        }, default=str),
-        'isBase64Encoded': False
-    }
+    return json_response(201, {
+        'success': True,
+        'client_id': result['id'],
+        'created_at': result['created_at']
+    })
 
 def get_rates(conn) -> Dict:
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute("""
-        SELECT * FROM exchange_rates
-        WHERE updated_at > NOW() - INTERVAL '1 hour'
-        ORDER BY updated_at DESC
-    """)
+    cursor = conn.cursor()
+    execute_prepared(cursor, 'get_rates')
     
-    rates = cursor.fetchall()
+    rates = fetch_rows(cursor)
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'rates': [dict(r) for r in rates]}, default=str),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {'rates': rates})
 
-def update_rate(conn, data: Dict) -> Dict:
+def get_candles(conn, params: Dict) -> Dict:
+    resolution = params.get('resolution') or '1h'
+    step = CANDLE_RESOLUTIONS.get(resolution)
+    if step is None:
+        return json_response(400, {'error': f"resolution must be one of: {', '.join(CANDLE_RESOLUTIONS)}"})
+    limit = max(1, min(int(params.get('limit') or DEFAULT_CANDLES), MAX_CANDLES))
+    tier = max(size for size in RATE_TIERS if step % size == 0)
+    
+    # Whole buckets only: the range ends with the bucket holding 'end' (default now) and keeps
+    # at most 'limit' buckets, counting back from there.
+    origin = CANDLE_ORIGIN.replace(tzinfo=timezone.utc).timestamp()
+    end = origin + ((int(params.get('end') or time.time()) - origin) // step + 1) * step
+    start = end - limit * step
+    if params.get('start') is not None:
+        start = max(start, origin + ((int(params['start']) - origin) // step) * step)
+    
     cursor = conn.cursor()
+    # Candles of the tier plus the ticks newer than the last rollup (aggregated per minute here),
+    # re-binned to the requested resolution in one pass and returned as one array per column.
+    cursor.execute("""
+        WITH series AS (
+            SELECT id FROM rate_series WHERE from_currency = %(from_currency)s AND to_currency = %(to_currency)s
+        ), parts AS (
+            SELECT c.bucket, 0 AS part, c.open, c.high, c.low, c.close, c.ticks
+            FROM rate_candles c JOIN series s ON c.series_id = s.id
+            WHERE c.resolution = %(tier)s AND c.bucket >= %(start)s AND c.bucket < %(end)s
+            UNION ALL
+            SELECT date_trunc('minute', t.ts), 1, (array_agg(t.rate ORDER BY t.ts))[1], MAX(t.rate), MIN(t.rate),
+                   (array_agg(t.rate ORDER BY t.ts DESC))[1], COUNT(*)
+            FROM rate_ticks t JOIN series s ON t.series_id = s.id
+            WHERE t.ts >= GREATEST(%(start)s, (SELECT rolled_through FROM rate_rollup_state)) AND t.ts < %(end)s
+            GROUP BY 1
+        ), candles AS (
+            SELECT date_bin(make_interval(secs => %(step)s), bucket, %(origin)s) AS bucket,
+                   (array_agg(open ORDER BY bucket, part))[1] AS open, MAX(high) AS high, MIN(low) AS low,
+                   (array_agg(close ORDER BY bucket DESC, part DESC))[1] AS close, SUM(ticks)::integer AS ticks
+            FROM parts
+            GROUP BY 1
+        )
+        SELECT array_agg(EXTRACT(EPOCH FROM bucket)::bigint ORDER BY bucket), array_agg(open ORDER BY bucket),
+               array_agg(high ORDER BY bucket), array_agg(low ORDER BY bucket), array_agg(close ORDER BY bucket),
+               array_agg(ticks ORDER BY bucket)
+        FROM candles
+    """, {
+        'from_currency': params['from_currency'],
+        'to_currency': params['to_currency'],
+        'tier': tier,
+        'step': step,
+        'start': datetime.fromtimestamp(start, timezone.utc).replace(tzinfo=None),
+        'end': datetime.fromtimestamp(end, timezone.utc).replace(tzinfo=None),
+        'origin': CANDLE_ORIGIN
+    })
+    row = cursor.fetchone()
     
+    return json_response(200, {
+        'pair': f"{params['from_currency']}/{params['to_currency']}",
+        'resolution': resolution,
+        'candles': {name: values or [] for name, values in zip(('time', 'open', 'high', 'low', 'close', 'ticks'), row)}
+    })
+
+def store_rates(cursor, rates: List[Tuple[str, str, Any]], source: str) -> None:
     cursor.execute("""
         INSERT INTO exchange_rates (from_currency, to_currency, rate, source)
-        VALUES (%s, %s, %s, %s)
+        SELECT r.from_currency, r.to_currency, r.rate, %s
+        FROM unnest(%s::text[], %s::text[], %s::numeric[]) AS r(from_currency, to_currency, rate)
         ON CONFLICT (from_currency, to_currency, source) 
         DO UPDATE SET rate = EXCLUDED.rate, updated_at = CURRENT_TIMESTAMP
-    """, (
-        data['from_currency'],
-        data['to_currency'],
-        data['rate'],
-        data.get('source', 'manual')
-    ))
+    """, (source, [rate[0] for rate in rates], [rate[1] for rate in rates], [rate[2] for rate in rates]))
+
+def update_rate(conn, data: Dict) -> Dict:
+    cursor = conn.cursor()
+    
+    store_rates(cursor, [(data['from_currency'], data['to_currency'], data['rate'])], data.get('source', 'manual'))
     
     conn.commit()
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'success': True, 'message': 'Rate updated'}),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {'success': True, 'message': 'Rate updated'})
 
 def list_currencies(conn) -> Dict:
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute("SELECT * FROM currencies WHERE is_active = true ORDER BY type, symbol")
+    cursor = conn.cursor()
+    execute_prepared(cursor, 'list_currencies')
     
-    currencies = cursor.fetchall()
+    currencies = fetch_rows(cursor)
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'currencies': [dict(c) for c in currencies]}, default=str),
-        'isBase64Encoded': False
-    }
\ No newline at end of file
+    return json_response(200, {'currencies': currencies})
+
+def fetch_feed_prices(symbols: List[str]) -> Dict[str, Decimal]:
+    query = urllib.parse.urlencode({'fsyms': ','.join(symbols), 'tsyms': 'USD'})
+    request = urllib.request.Request(f'{RATE_FEED_URL}?{query}')
+    if RATE_FEED_API_KEY:
+        request.add_header('Authorization', f'Apikey {RATE_FEED_API_KEY}')
+    with urllib.request.urlopen(request, timeout=RATE_FEED_TIMEOUT_SECONDS) as response:
+        prices = json.loads(response.read(), parse_float=Decimal, parse_int=Decimal)
+    if prices.get('Response') == 'Error':
+        raise RuntimeError(f"Rate feed refused the request: {prices.get('Message')}")
+    return {symbol: quote['USD'] for symbol, quote in prices.items()
+            if isinstance(quote, dict) and isinstance(quote.get('USD'), Decimal) and quote['USD'] > 0}
+
+def run_rate_feed(conn, payload: Dict) -> Dict:
+    cursor = conn.cursor()
+    cursor.execute("SELECT symbol FROM currencies WHERE is_active AND symbol <> ALL(%s) ORDER BY symbol",
+                   (list(USD_CURRENCIES),))
+    symbols = [row[0] for row in cursor.fetchall()]
+    # Fetched before anything is written, so the job's transaction holds no locks while it waits.
+    prices = fetch_feed_prices(symbols) if symbols else {}
+    if prices:
+        store_rates(cursor, [(symbol, 'USD', price) for symbol, price in prices.items()], RATE_FEED_SOURCE)
+    return {'rates': len(prices), 'missing': sorted(set(symbols) - set(prices))}
+
+def run_rate_rollup(conn, payload: Dict) -> Dict:
+    cursor = conn.cursor()
+    # The state row lock serializes rollups. A 'since' timestamp in the payload also rebuilds
+    # older candles, e.g. after ticks were backfilled.
+    cursor.execute("""
+        SELECT date_trunc('minute', LEAST(rolled_through - make_interval(secs => %s), %s::timestamp)), LOCALTIMESTAMP
+        FROM rate_rollup_state
+        FOR UPDATE
+    """, (RATE_ROLLUP_GRACE_SECONDS, payload.get('since')))
+    since, until = cursor.fetchone()
+    
+    tiers = sorted(RATE_TIERS)
+    params = {'since': since, 'until': until, 'origin': CANDLE_ORIGIN, 'resolution': tiers[0]}
+    upsert = """
+        ON CONFLICT (series_id, resolution, bucket) DO UPDATE
+        SET open = EXCLUDED.open, high = EXCLUDED.high, low = EXCLUDED.low, close = EXCLUDED.close, ticks = EXCLUDED.ticks
+    """
+    cursor.execute("""
+        INSERT INTO rate_candles (series_id, resolution, bucket, open, high, low, close, ticks)
+        SELECT series_id, %(resolution)s, date_bin(make_interval(secs => %(resolution)s), ts, %(origin)s) AS bucket,
+               (array_agg(rate ORDER BY ts))[1], MAX(rate), MIN(rate), (array_agg(rate ORDER BY ts DESC))[1], COUNT(*)
+        FROM rate_ticks
+        WHERE ts >= %(since)s AND ts < %(until)s
+        GROUP BY series_id, bucket
+    """ + upsert, params)
+    candles = {tiers[0]: cursor.rowcount}
+    
+    # Each coarser tier is rebuilt from the one below, from the start of its bucket holding 'since'.
+    for finer, coarser in zip(tiers, tiers[1:]):
+        cursor.execute("""
+            INSERT INTO rate_candles (series_id, resolution, bucket, open, high, low, close, ticks)
+            SELECT series_id, %(resolution)s, date_bin(make_interval(secs => %(resolution)s), bucket, %(origin)s) AS coarse,
+                   (array_agg(open ORDER BY bucket))[1], MAX(high), MIN(low), (array_agg(close ORDER BY bucket DESC))[1], SUM(ticks)
+            FROM rate_candles
+            WHERE resolution = %(finer)s AND bucket < %(until)s
+              AND bucket >= date_bin(make_interval(secs => %(resolution)s), %(since)s, %(origin)s)
+            GROUP BY series_id, coarse
+        """ + upsert, {**params, 'resolution': coarser, 'finer': finer})
+        candles[coarser] = cursor.rowcount
+    
+    cursor.execute("UPDATE rate_rollup_state SET rolled_through = %s", (until,))
+    return {'since': str(since), 'until': str(until), 'candles': candles}
+
+def run_rate_retention(conn, payload: Dict) -> Dict:
+    cursor = conn.cursor()
+    # Attaching and dropping partitions locks rate_ticks, which every rate update writes through
+    # its trigger: fail and retry later rather than hold updates behind a long-running read.
+    cursor.execute("SELECT current_setting('lock_timeout'), set_config('lock_timeout', '2s', true)")
+    lock_timeout = cursor.fetchone()[0]
+    cursor.execute("SELECT ensure_rate_tick_partitions(%s)", (RATE_PARTITION_DAYS_AHEAD,))
+    created = cursor.fetchone()[0]
+    cursor.execute("SELECT drop_rate_tick_partitions((LOCALTIMESTAMP - make_interval(days => %s))::date)",
+                   (RATE_TICK_RETENTION_DAYS,))
+    dropped = cursor.fetchone()[0]
+    cursor.execute("SELECT set_config('lock_timeout', %s, true)", (lock_timeout,))
+    
+    cursor.execute("DELETE FROM rate_ticks_default WHERE ts < LOCALTIMESTAMP - make_interval(days => %s)",
+                   (RATE_TICK_RETENTION_DAYS,))
+    deleted = {'ticks': cursor.rowcount}
+    for resolution, days in RATE_TIERS.items():
+        if days is not None:
+            cursor.execute("DELETE FROM rate_candles WHERE resolution = %s AND bucket < LOCALTIMESTAMP - make_interval(days => %s)",
+                           (resolution, days))
+            deleted[resolution] = cursor.rowcount
+    
+    return {'partitions_created': created, 'partitions_dropped': dropped, 'deleted': deleted}
+
+def run_expiry_sweep(conn, payload: Dict) -> Dict:
+    cursor = conn.cursor()
+    batch = int(payload.get('batch', EXPIRY_BATCH))
+    
+    cursor.execute("""
+        SELECT id FROM exchanges
+        WHERE status = 'pending' AND created_at < CURRENT_TIMESTAMP - make_interval(secs => %s)
+        ORDER BY created_at
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    """, (PENDING_EXCHANGE_TTL_SECONDS, batch))
+    candidates = [row[0] for row in cursor.fetchall()]
+    moved = transition_exchanges(conn, candidates, 'expired', 'expiry_sweeper', 'No deposit received in time') if candidates else {}
+    expired = [exchange_id for exchange_id, (status_from, done) in moved.items() if done]
+    if expired:
+        cursor.execute("""
+            INSERT INTO notifications (client_id, type, title, message)
+            SELECT client_id, 'exchange_expired', 'Exchange Expired',
+                   'Exchange ' || id || ': no deposit was received in time'
+            FROM exchanges WHERE id = ANY(%s)
+        """, (expired,))
+        # Their invoices can no longer be paid either, whatever their own age.
+        cursor.execute("""
+            UPDATE payment_provider_transactions SET status = 'expired', updated_at = CURRENT_TIMESTAMP
+            WHERE exchange_id = ANY(%s) AND status = 'pending'
+        """, (expired,))
+    invoices = cursor.rowcount if expired else 0
+    
+    cursor.execute("""
+        UPDATE payment_provider_transactions SET status = 'expired', updated_at = CURRENT_TIMESTAMP
+        WHERE id IN (
+            SELECT id FROM payment_provider_transactions
+            WHERE status = 'pending' AND created_at < CURRENT_TIMESTAMP - make_interval(secs => %s)
+            ORDER BY created_at
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+    """, (PAYMENT_INVOICE_TTL_SECONDS, batch))
+    stale_invoices = cursor.rowcount
+    
+    cursor.execute("""
+        WITH expired AS (
+            UPDATE limit_orders SET status = 'expired'
+            WHERE id IN (
+                SELECT id FROM limit_orders
+                WHERE status = 'active' AND expiry_date < CURRENT_TIMESTAMP
+                ORDER BY expiry_date
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, client_id, from_currency, to_currency
+        )
+        INSERT INTO notifications (client_id, type, title, message)
+        SELECT client_id, 'limit_order_expired', 'Limit Order Expired',
+               'Limit order ' || id || ' (' || from_currency || ' -> ' || to_currency || ') expired'
+        FROM expired
+    """, (batch,))
+    limit_orders = cursor.rowcount
+    
+    cursor.execute("""
+        DELETE FROM code_reservations
+        WHERE (kind, code) IN (
+            SELECT kind, code FROM code_reservations r
+            WHERE (r.kind = 'referral' AND EXISTS (SELECT 1 FROM referral_codes c WHERE c.code = r.code))
+               OR (r.kind = 'wallet_verification'
+                   AND EXISTS (SELECT 1 FROM wallet_verifications w WHERE w.verification_code = r.code))
+            ORDER BY reserved_at
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+    """, (batch,))
+    code_reservations = cursor.rowcount
+    
+    # A full batch means more is probably due; the next run starts as soon as this one commits. The
+    # dedupe key alternates because this job's own row still counts as queued until then.
+    again = batch in (len(candidates), stale_invoices, limit_orders, code_reservations)
+    if again:
+        round_number = int(payload.get('round', 0)) + 1
+        enqueue_job(conn, 'expiry_sweep', {**payload, 'round': round_number},
+                    dedupe_key=f'expiry_sweep:backlog:{round_number % 2}')
+    
+    return {'exchanges': len(expired), 'invoices': invoices + stale_invoices, 'limit_orders': limit_orders,
+            'code_reservations': code_reservations, 'again': again}
@@ -4,77 +4,784 @@ Args: event with httpMethod, body, queryStringParameters; context with request_i
 Returns: HTTP response with verification status, risk assessment, or operation results
 """
 
+import base64
+import gzip
+import hashlib
+import hmac
 import json
 import os
-from datetime import datetime, timedelta
-from typing import Dict, Any
+import random
+import re
+import secrets
+import string
+import threading
+import time
+import weakref
+import urllib.request
+from bisect import bisect_left
+from contextvars import ContextVar
+from functools import lru_cache
+from itertools import repeat
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from collections import OrderedDict
+from typing import Dict, Any, Iterator, List, Optional, Tuple, Callable
 import psycopg2
 from psycopg2.extras import RealDictCursor
 
+def connect_database(dsn: Optional[str] = None):
+    # Long-running hosts (server/) replace this with a pooled factory; close() hands the connection back.
+    return psycopg2.connect(dsn or os.environ['DATABASE_URL'])
+
 def get_db_connection():
-    return psycopg2.connect(os.environ['DATABASE_URL'])
+    started = time.perf_counter()
+    state = _request_state.get()
+    conn = None
+    if state is not None and state['replica']:
+        conn = connect_replica(state['read_after'])
+        state['read_from'] = 'primary' if conn is None else 'replica'
+    if conn is None:
+        conn = connect_database()
+    if state is None:
+        return conn
+    state['connect_seconds'] += time.perf_counter() - started
+    return TimedConnection(conn, state['queries']) if state['sampled'] else conn
+
+# Read replicas (streaming standbys of DATABASE_URL). Read-only GET actions go to the next replica
+# (round_robin) or the fastest one (least_latency) whose replay lag is within REPLICA_MAX_LAG_SECONDS,
+# and to the primary otherwise. Successful writes answer with X-Read-After, the primary's WAL position;
+# a GET that sends it back is only served by a replica that has replayed that far. Callers that do not
+# echo it read from the primary for READ_YOUR_WRITES_SECONDS after writing through this instance.
+REPLICA_DSNS = [dsn.strip() for dsn in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if dsn.strip()]
+REPLICA_SELECTION = os.environ.get('REPLICA_SELECTION', 'round_robin')
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get('REPLICA_MAX_LAG_SECONDS', '5'))
+REPLICA_CHECK_SECONDS = float(os.environ.get('REPLICA_CHECK_SECONDS', '1'))
+REPLICA_RETRY_SECONDS = 10.0
+READ_YOUR_WRITES_SECONDS = float(os.environ.get('READ_YOUR_WRITES_SECONDS', '10'))
+READ_AFTER_HEADER = 'X-Read-After'
+RECENT_WRITERS_LIMIT = 4096
+# Lag is zero while everything received is replayed, so an idle primary does not look like lag.
+REPLICA_STATUS_SQL = """
+    SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                ELSE COALESCE(EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - pg_last_xact_replay_timestamp())::float8, 'Infinity')
+           END,
+           (CASE WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn() ELSE pg_current_wal_lsn() END - '0/0'::pg_lsn)::bigint
+"""
+_replica_lock = threading.Lock()
+_replicas: List[Dict[str, Any]] = [
+    {'dsn': dsn, 'checked_at': float('-inf'), 'lag': 0.0, 'replayed': 0, 'latency': 0.0, 'down_until': 0.0}
+    for dsn in REPLICA_DSNS
+]
+_replica_turn = [0]
+_recent_writers: 'OrderedDict[str, float]' = OrderedDict()
+
+def parse_lsn(value: str) -> Optional[int]:
+    high, separator, low = value.strip().partition('/')
+    try:
+        return (int(high, 16) << 32) + int(low, 16) if separator else None
+    except ValueError:
+        return None
+
+def request_caller(event: Dict[str, Any]) -> str:
+    forwarded = get_request_header(event, 'x-forwarded-for').split(',')[0].strip()
+    return forwarded or ((event.get('requestContext') or {}).get('identity') or {}).get('sourceIp') or ''
+
+def route_read(event: Dict[str, Any]) -> bool:
+    """Sends this request's reads to a replica; False when its result is specific to the caller."""
+    state = _request_state.get()
+    if not REPLICA_DSNS or state is None:
+        return True
+    read_after = parse_lsn(get_request_header(event, 'x-read-after'))
+    if read_after is None:
+        caller = request_caller(event)
+        with _replica_lock:
+            recent = caller and _recent_writers.get(caller, 0.0) > time.monotonic()
+        if recent:
+            state['read_from'] = 'primary'
+            return False
+    state['replica'] = True
+    state['read_after'] = read_after
+    return read_after is None
+
+def remember_write(event: Dict[str, Any], conn, response: Dict[str, Any]) -> None:
+    cursor = conn.cursor()
+    cursor.execute('SELECT pg_current_wal_lsn()::text')
+    response['headers'] = {**response['headers'], READ_AFTER_HEADER: cursor.fetchone()[0],
+                           'Access-Control-Expose-Headers': READ_AFTER_HEADER}
+    caller = request_caller(event)
+    if caller:
+        with _replica_lock:
+            _recent_writers[caller] = time.monotonic() + READ_YOUR_WRITES_SECONDS
+            _recent_writers.move_to_end(caller)
+            if len(_recent_writers) > RECENT_WRITERS_LIMIT:
+                _recent_writers.popitem(last=False)
+
+def replica_candidates() -> List[Dict[str, Any]]:
+    now = time.monotonic()
+    with _replica_lock:
+        # A lagging replica stays a candidate once its status is stale, so it is checked again.
+        usable = [replica for replica in _replicas if replica['down_until'] <= now and (
+            replica['lag'] <= REPLICA_MAX_LAG_SECONDS or now - replica['checked_at'] >= REPLICA_CHECK_SECONDS)]
+        if REPLICA_SELECTION == 'least_latency':
+            return sorted(usable, key=lambda replica: replica['latency'])
+        _replica_turn[0] += 1
+        start = _replica_turn[0] % len(usable) if usable else 0
+        return usable[start:] + usable[:start]
+
+def check_replica(replica: Dict[str, Any], conn) -> None:
+    started = time.perf_counter()
+    cursor = conn.cursor()
+    cursor.execute(REPLICA_STATUS_SQL)
+    lag, replayed = cursor.fetchone()
+    elapsed = time.perf_counter() - started
+    with _replica_lock:
+        replica['lag'] = float(lag)
+        replica['replayed'] = replayed
+        replica['checked_at'] = time.monotonic()
+        replica['latency'] = 0.8 * replica['latency'] + 0.2 * elapsed if replica['latency'] else elapsed
+
+def connect_replica(read_after: Optional[int]):
+    """Connection to a replica that is fresh enough, or None to read from the primary."""
+    for replica in replica_candidates():
+        conn = None
+        try:
+            conn = connect_database(replica['dsn'])
+            if (time.monotonic() - replica['checked_at'] >= REPLICA_CHECK_SECONDS
+                    or (read_after is not None and replica['replayed'] < read_after)):
+                check_replica(replica, conn)
+        except psycopg2.Error:
+            if conn is not None:
+                conn.close()
+            with _replica_lock:
+                replica['down_until'] = time.monotonic() + REPLICA_RETRY_SECONDS
+            continue
+        if replica['lag'] <= REPLICA_MAX_LAG_SECONDS and (read_after is None or replica['replayed'] >= read_after):
+            return conn
+        conn.close()
+    return None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+class Rows:
+    # A result set as fetched: the driver's tuples plus the column names, read once per statement.
+    # Handlers that look at a row get it as a dict; the encoders turn the whole set into objects in
+    # one pass of C-level maps. Numeric columns are cast to text in SQL, so no value calls back.
+    __slots__ = ('keys', 'rows')
+
+    def __init__(self, keys: Tuple[str, ...], rows: List[Tuple]):
+        self.keys = keys
+        self.rows = rows
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __getitem__(self, index: int) -> Dict[str, Any]:
+        return dict(zip(self.keys, self.rows[index]))
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        return map(dict, map(zip, repeat(self.keys), self.rows))
+
+# Timestamps go out as ISO 8601 ('2025-01-02T03:04:05.123456'), as orjson writes them natively.
+JSON_ENCODERS = {
+    Rows: list,
+    Decimal: str,
+    datetime: datetime.isoformat,
+    date: date.isoformat,
+}
+
+def encode_json_value(value: Any) -> Any:
+    encoder = JSON_ENCODERS.get(type(value), str)
+    return encoder(value)
+
+if orjson is not None:
+    def dump_json(payload: Any) -> str:
+        return orjson.dumps(payload, default=encode_json_value).decode()
+else:
+    _json_encoder = json.JSONEncoder(default=encode_json_value, ensure_ascii=False, separators=(',', ':'))
+
+    def dump_json(payload: Any) -> str:
+        return _json_encoder.encode(payload)
+
+def fetch_rows(cursor) -> Rows:
+    return Rows(tuple(column[0] for column in cursor.description), cursor.fetchall())
+
+def enqueue_job(conn, kind: str, payload: Dict[str, Any], priority: int = 0, delay_seconds: float = 0,
+                dedupe_key: Optional[str] = None) -> Optional[int]:
+    # Inserted in the caller's transaction, so the job exists only if the request's writes commit;
+    # server/worker.py runs it. A dedupe_key that is already queued returns the existing job.
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO jobs (kind, payload, priority, run_at, dedupe_key)
+        VALUES (%s, %s, %s, CURRENT_TIMESTAMP + make_interval(secs => %s), %s)
+        ON CONFLICT (dedupe_key) WHERE status = 'queued' DO NOTHING
+        RETURNING id
+    """, (kind, dump_json(payload), priority, delay_seconds, dedupe_key))
+    row = cursor.fetchone()
+    if row is None:
+        cursor.execute("SELECT id FROM jobs WHERE dedupe_key = %s AND status = 'queued'", (dedupe_key,))
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+FUNCTION_NAME = 'kyc-aml-api'
+# Request instrumentation. Latency histograms (per action, connection acquire,
+# serialization) are always recorded; per-statement timing and the structured log
+# line are kept for a sampled fraction of requests, plus a log line for slow ones.
+METRICS_SAMPLE_RATE = float(os.environ.get('METRICS_SAMPLE_RATE', '0.05'))
+SLOW_REQUEST_SECONDS = float(os.environ.get('SLOW_REQUEST_MS', '500')) / 1000
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+QUERY_TEXT_LIMIT = 200
+_metrics_lock = threading.Lock()
+_histograms: Dict[Tuple[str, Tuple], List[float]] = {}
+_request_counts: Dict[Tuple, int] = {}
+_query_stats: Dict[str, List[Any]] = {}
+_routed_reads: Dict[str, int] = {}
+_request_state: ContextVar[Optional[Dict[str, Any]]] = ContextVar('request_state', default=None)
+_literal_pattern = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_space_pattern = re.compile(r'\s+')
+
+@lru_cache(maxsize=512)
+def query_fingerprint(query: str) -> Tuple[str, str]:
+    normalized = _space_pattern.sub(' ', _literal_pattern.sub('?', query)).strip()
+    return hashlib.blake2b(normalized.encode('utf-8'), digest_size=6).hexdigest(), normalized
+
+class TimedCursor:
+    def __init__(self, cursor, queries: List[Tuple[Any, float, int]]):
+        self._cursor = cursor
+        self._queries = queries
+    
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._cursor, name)
+    
+    def __iter__(self):
+        return iter(self._cursor)
+    
+    def execute(self, query, params=None):
+        started = time.perf_counter()
+        try:
+            return self._cursor.execute(query, params)
+        finally:
+            self._queries.append((query, time.perf_counter() - started, self._cursor.rowcount))
+
+class TimedConnection:
+    def __init__(self, conn, queries: List[Tuple[Any, float, int]]):
+        self._conn = conn
+        self._queries = queries
+    
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._conn, name)
+    
+    def cursor(self, *args, **kwargs) -> TimedCursor:
+        return TimedCursor(self._conn.cursor(*args, **kwargs), self._queries)
+
+def begin_request(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    request_id = getattr(context, 'request_id', None) or get_request_header(event, 'x-request-id')[:128]
+    return {
+        'request_id': request_id or None,
+        'action': None,
+        'sampled': random.random() < METRICS_SAMPLE_RATE,
+        'connect_seconds': 0.0,
+        'serialize_seconds': 0.0,
+        'queries': [],
+        'replica': False,
+        'read_after': None,
+        'read_from': None
+    }
+
+def tag_request(action: str) -> None:
+    state = _request_state.get()
+    if state is not None:
+        state['action'] = action
+
+def observe(name: str, labels: Tuple, seconds: float) -> None:
+    histogram = _histograms.get((name, labels))
+    if histogram is None:
+        histogram = _histograms[(name, labels)] = [0.0] * (len(LATENCY_BUCKETS) + 2)
+    histogram[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+    histogram[-1] += seconds
+
+def finish_request(state: Dict[str, Any], method: str, status_code: int, seconds: float) -> None:
+    action = state['action'] or 'unknown'
+    queries = [(query_fingerprint(query if isinstance(query, str) else str(query)), elapsed, rows)
+               for query, elapsed, rows in state['queries']]
+    
+    with _metrics_lock:
+        observe('request_duration_seconds', (('method', method), ('action', action)), seconds)
+        if state['connect_seconds']:
+            observe('db_connect_duration_seconds', (), state['connect_seconds'])
+        if state['serialize_seconds']:
+            observe('serialization_duration_seconds', (), state['serialize_seconds'])
+        count_key = (('action', action), ('status', str(status_code)))
+        _request_counts[count_key] = _request_counts.get(count_key, 0) + 1
+        if state['read_from']:
+            _routed_reads[state['read_from']] = _routed_reads.get(state['read_from'], 0) + 1
+        for (fingerprint, text), elapsed, rows in queries:
+            stats = _query_stats.get(fingerprint)
+            if stats is None:
+                stats = _query_stats[fingerprint] = [text[:QUERY_TEXT_LIMIT], 0, 0.0, 0]
+            stats[1] += 1
+            stats[2] += elapsed
+            stats[3] += max(rows, 0)
+    
+    if state['sampled'] or seconds >= SLOW_REQUEST_SECONDS:
+        print(dump_json({
+            'level': 'warning' if seconds >= SLOW_REQUEST_SECONDS else 'info',
+            'event': 'request',
+            'function': FUNCTION_NAME,
+            'request_id': state['request_id'],
+            'method': method,
+            'action': action,
+            'status': status_code,
+            'duration_ms': round(seconds * 1000, 3),
+            'db_connect_ms': round(state['connect_seconds'] * 1000, 3),
+            'serialize_ms': round(state['serialize_seconds'] * 1000, 3),
+            'queries': [
+                {'fingerprint': fingerprint, 'ms': round(elapsed * 1000, 3), 'rows': rows}
+                for (fingerprint, _), elapsed, rows in queries
+            ]
+        }), flush=True)
+
+def escape_label(value: Any) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+
+def prometheus_labels(labels: Tuple) -> str:
+    pairs = (('function', FUNCTION_NAME),) + labels
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in pairs) + '}'
+
+def render_metrics() -> str:
+    lines = []
+    with _metrics_lock:
+        histograms = sorted((key, list(values)) for key, values in _histograms.items())
+        request_counts = sorted(_request_counts.items())
+        routed_reads = sorted(_routed_reads.items())
+        query_stats = sorted((fingerprint, list(stats)) for fingerprint, stats in _query_stats.items())
+    
+    declared = set()
+    for (name, labels), values in histograms:
+        metric = f'backend_{name}'
+        if metric not in declared:
+            declared.add(metric)
+            lines.append(f'# TYPE {metric} histogram')
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), values[:-1]):
+            cumulative += count
+            lines.append(f"{metric}_bucket{prometheus_labels(labels + (('le', bound),))} {int(cumulative)}")
+        lines.append(f'{metric}_sum{prometheus_labels(labels)} {values[-1]:.6f}')
+        lines.append(f'{metric}_count{prometheus_labels(labels)} {int(cumulative)}')
+    
+    lines.append('# TYPE backend_requests_total counter')
+    for labels, count in request_counts:
+        lines.append(f'backend_requests_total{prometheus_labels(labels)} {count}')
+    
+    if routed_reads:
+        lines.append('# TYPE backend_replica_eligible_reads_total counter')
+    for database, count in routed_reads:
+        lines.append(f"backend_replica_eligible_reads_total{prometheus_labels((('database', database),))} {count}")
+    
+    lines.append('# TYPE backend_sampled_query_calls_total counter')
+    lines.append('# TYPE backend_sampled_query_seconds_total counter')
+    lines.append('# TYPE backend_sampled_query_rows_total counter')
+    lines.append('# TYPE backend_query_info gauge')
+    for fingerprint, (text, calls, seconds, rows) in query_stats:
+        labels = (('fingerprint', fingerprint),)
+        lines.append(f'backend_sampled_query_calls_total{prometheus_labels(labels)} {calls}')
+        lines.append(f'backend_sampled_query_seconds_total{prometheus_labels(labels)} {seconds:.6f}')
+        lines.append(f'backend_sampled_query_rows_total{prometheus_labels(labels)} {rows}')
+        lines.append(f"backend_query_info{prometheus_labels(labels + (('statement', text),))} 1")
+    return '\n'.join(lines) + '\n'
+
+def metrics_response(event: Dict[str, Any]) -> Dict[str, Any]:
+    token = os.environ.get('METRICS_TOKEN')
+    if token and not hmac.compare_digest(get_request_header(event, 'x-metrics-token'), token):
+        return json_response(403, {'error': 'Forbidden'})
+    return {'statusCode': 200, 'headers': METRICS_HEADERS, 'body': render_metrics(), 'isBase64Encoded': False}
+
+# Shared by every response of a kind; code that adds headers builds a new dict.
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+METRICS_HEADERS = {'Content-Type': 'text/plain; version=0.0.4', 'Access-Control-Allow-Origin': '*'}
+
+def json_response(status_code: int, payload: Any) -> Dict[str, Any]:
+    started = time.perf_counter()
+    body = dump_json(payload)
+    state = _request_state.get()
+    if state is not None:
+        state['serialize_seconds'] += time.perf_counter() - started
+    return {
+        'statusCode': status_code,
+        'headers': JSON_HEADERS,
+        'body': body,
+        'isBase64Encoded': False
+    }
+
+MAX_BODY_BYTES = 64 * 1024
+
+class RequestError(Exception):
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+
+def parse_body(event: Dict[str, Any]) -> Dict[str, Any]:
+    body = event.get('body') or '{}'
+    try:
+        if event.get('isBase64Encoded'):
+            body = base64.b64decode(body)
+        if len(body) > MAX_BODY_BYTES:
+            raise RequestError(413, 'Request body too large')
+        data = json.loads(body)
+    except ValueError:
+        raise RequestError(400, 'Invalid JSON body')
+    if not isinstance(data, dict):
+        raise RequestError(400, 'JSON body must be an object')
+    return data
+
+def is_number(value: Any) -> bool:
+    if isinstance(value, str):
+        try:
+            float(value)
+        except ValueError:
+            return False
+        return True
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def is_integer(value: Any) -> bool:
+    if isinstance(value, str):
+        return value.lstrip('-').isdigit()
+    return isinstance(value, int) and not isinstance(value, bool)
+
+FIELD_TYPES: Dict[str, Callable[[Any], bool]] = {
+    'str': lambda value: isinstance(value, str),
+    'number': is_number,
+    'int': is_integer,
+    'bool': lambda value: isinstance(value, bool),
+    'dict': lambda value: isinstance(value, dict),
+    'any': lambda value: True
+}
+
+def compile_schema(schema: Dict[str, str]) -> Callable[[Dict[str, Any]], None]:
+    # 'type' marks a required field, 'type?' an optional one (None counts as absent).
+    fields = tuple(
+        (name, not spec.endswith('?'), spec.rstrip('?'), FIELD_TYPES[spec.rstrip('?')])
+        for name, spec in schema.items()
+    )
+    
+    def validate(data: Dict[str, Any]) -> None:
+        for name, required, type_name, check in fields:
+            value = data.get(name)
+            if value is None:
+                if required:
+                    raise RequestError(400, f'Missing required field: {name}')
+            elif not check(value):
+                raise RequestError(400, f'Invalid field {name}: expected {type_name}')
+    return validate
+
+COMPRESSION_MIN_BYTES = 1024
+COMPRESSED_BODY_CACHE_SIZE = 64
+_compressed_bodies: 'OrderedDict[Tuple[str, str], str]' = OrderedDict()
+
+def get_request_header(event: Dict[str, Any], name: str) -> str:
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name:
+            return value or ''
+    return ''
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    weights = {}
+    for part in accept_encoding.lower().split(','):
+        token, _, param = part.partition(';')
+        param = param.strip()
+        try:
+            weight = float(param[2:]) if param.startswith('q=') else 1.0
+        except ValueError:
+            weight = 0.0
+        weights[token.strip()] = weight
+    for encoding in ('br', 'gzip'):
+        if encoding == 'br' and brotli is None:
+            continue
+        if weights.get(encoding, weights.get('*', 0.0)) > 0:
+            return encoding
+    return None
+
+def compress_body(raw: bytes, encoding: str) -> str:
+    if encoding == 'br':
+        compressed = brotli.compress(raw, quality=5)
+    else:
+        compressed = gzip.compress(raw, compresslevel=6)
+    return base64.b64encode(compressed).decode('ascii')
+
+def opaque_tag(etag: str) -> str:
+    # Weak comparison (RFC 7232 section 2.3.2); '-br'/'-gzip' are the variant suffixes older
+    # responses carried.
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    for encoding in ('br', 'gzip'):
+        etag = etag.replace(f'-{encoding}"', '"')
+    return etag
+
+def etag_matches(if_none_match: str, etag: Optional[str]) -> bool:
+    if not if_none_match or etag is None:
+        return False
+    opaque = opaque_tag(etag)
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*' or opaque_tag(candidate) == opaque:
+            return True
+    return False
+
+def finalize_response(event: Dict[str, Any], response: Dict[str, Any]) -> Dict[str, Any]:
+    body = response.get('body')
+    if not body or response.get('isBase64Encoded'):
+        return response
+    
+    headers = response['headers']
+    raw = body.encode('utf-8')
+    if len(raw) >= COMPRESSION_MIN_BYTES:
+        headers = response['headers'] = {**headers, 'Vary': 'Accept-Encoding'}
+    
+    # ETags are weak and name the body whatever its encoding, so a 304 carries the tag the 200 had.
+    etag = headers.get('ETag')
+    if etag is None and event.get('httpMethod') == 'GET' and response['statusCode'] == 200:
+        etag = 'W/"' + hashlib.blake2b(raw, digest_size=16).hexdigest() + '"'
+        headers = response['headers'] = {**headers, 'ETag': etag}
+        if etag_matches(get_request_header(event, 'if-none-match'), etag):
+            return {'statusCode': 304, 'headers': headers, 'body': '', 'isBase64Encoded': False}
+    
+    if len(raw) < COMPRESSION_MIN_BYTES:
+        return response
+    
+    encoding = choose_encoding(get_request_header(event, 'accept-encoding'))
+    if encoding is None:
+        return response
+    
+    cache_key = (etag, encoding)
+    encoded = _compressed_bodies.get(cache_key) if etag else None
+    if encoded is None:
+        encoded = compress_body(raw, encoding)
+        if etag:
+            _compressed_bodies[cache_key] = encoded
+            if len(_compressed_bodies) > COMPRESSED_BODY_CACHE_SIZE:
+                _compressed_bodies.popitem(last=False)
+    else:
+        _compressed_bodies.move_to_end(cache_key)
+    
+    headers['Content-Encoding'] = encoding
+    response['body'] = encoded
+    response['isBase64Encoded'] = True
+    return response
+
+# Hot statements by name. With PREPARE_STATEMENTS=1 each runs as a server-side prepared statement:
+# PREPARE once per connection (sent with the first EXECUTE, so it costs no extra round trip), then
+# EXECUTE, which skips parsing and, once Postgres settles on a generic plan, planning. Off by default:
+# a serverless invocation's connection serves one request, and transaction-mode poolers do not keep
+# sessions; server/app.py turns it on for its pooled connections. After five executions Postgres may
+# switch to a generic plan, so statements whose best plan depends on the parameter (a per-client
+# ORDER BY ... LIMIT over skewed data) stay plain; tools/bench/prepared.py shows the effect.
+PREPARE_STATEMENTS = os.environ.get('PREPARE_STATEMENTS', '0') == '1'
+PREPARED_QUERIES: Dict[str, str] = {
+    'client_verification_level': "SELECT verification_level FROM clients WHERE id = %s",
+    'exchange_limits': """
+        SELECT * FROM exchange_limits 
+        WHERE verification_level = %s
+    """,
+    'daily_volume': """
+        SELECT COALESCE(SUM(from_amount), 0) as daily_volume
+        FROM exchanges
+        WHERE client_id = %s 
+        AND created_at > NOW() - INTERVAL '1 day'
+        AND status IN ('completed', 'processing', 'pending')
+    """,
+    'latest_kyc': """
+        SELECT * FROM kyc_verifications 
+        WHERE client_id = %s 
+        ORDER BY created_at DESC 
+        LIMIT 1
+    """
+}
+PREPARED_PREFIX = FUNCTION_NAME.replace('-', '_') + '_'
+FEATURE_NOT_SUPPORTED = '0A000'
+INVALID_SQL_STATEMENT_NAME = '26000'
+_prepared_lock = threading.Lock()
+# connection -> {name: 'ready' | 'stale'}; weak, so entries leave with their connections
+_prepared_sessions: 'weakref.WeakKeyDictionary' = weakref.WeakKeyDictionary()
+_prepared_unknown: 'weakref.WeakSet' = weakref.WeakSet()
+
+def server_placeholders(query: str) -> str:
+    parts = query.split('%s')
+    return parts[0] + ''.join(f'${index}{part}' for index, part in enumerate(parts[1:], 1))
+
+PREPARE_SQL = {name: f'PREPARE {PREPARED_PREFIX}{name} AS {server_placeholders(query)}' for name, query in PREPARED_QUERIES.items()}
+
+def prepared_session(conn) -> Dict[str, str]:
+    with _prepared_lock:
+        session = _prepared_sessions.get(conn)
+        unknown = conn in _prepared_unknown
+    if session is not None and not unknown:
+        return session
+    session = {}
+    if unknown:
+        # A PREPARE went out with a statement that failed, so ask the session what it holds.
+        cursor = conn.cursor()
+        cursor.execute("SELECT name FROM pg_prepared_statements WHERE starts_with(name, %s)", (PREPARED_PREFIX,))
+        session = {row[0][len(PREPARED_PREFIX):]: 'ready' for row in cursor.fetchall()}
+    with _prepared_lock:
+        _prepared_sessions[conn] = session
+        _prepared_unknown.discard(conn)
+    return session
+
+def execute_prepared(cursor, name: str, params: Tuple = ()) -> None:
+    if not PREPARE_STATEMENTS:
+        cursor.execute(PREPARED_QUERIES[name], params)
+        return
+    conn = cursor.connection
+    session = prepared_session(conn)
+    status = session.get(name)
+    statement = PREPARED_PREFIX + name
+    execute = f"EXECUTE {statement}({', '.join(['%s'] * len(params))})" if params else f'EXECUTE {statement}'
+    if status == 'ready':
+        query = execute
+    elif status == 'stale':
+        query = f'DEALLOCATE {statement}; {PREPARE_SQL[name]}; {execute}'
+    else:
+        query = f'{PREPARE_SQL[name]}; {execute}'
+    try:
+        cursor.execute(query, params)
+    except psycopg2.Error as error:
+        with _prepared_lock:
+            if status == 'ready' and error.pgcode == FEATURE_NOT_SUPPORTED:
+                # "cached plan must not change result type": a migration changed a table under SELECT *,
+                # so every connection re-prepares the statement rather than failing once each.
+                for other in _prepared_sessions.values():
+                    if other.get(name) == 'ready':
+                        other[name] = 'stale'
+            elif status != 'ready' or error.pgcode == INVALID_SQL_STATEMENT_NAME:
+                _prepared_unknown.add(conn)
+        raise
+    session[name] = 'ready'
+
+OPTIONS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, POST, PUT, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, X-Read-After',
+    'Access-Control-Max-Age': '86400'
+}
+
+# Action table per method: each route takes (conn, data, event) where data is the
+# query string for GET and the parsed JSON body otherwise.
+ROUTE_KEY = 'action'
+QUERY_METHODS = ('GET', 'DELETE')
+# GET actions that write, so they never read from a replica.
+PRIMARY_GET_ACTIONS = frozenset({'verify_wallet'})
+DEFAULT_ACTIONS: Dict[str, str] = {}
+ROUTES: Dict[str, Dict[str, Callable[[Any, Dict[str, Any], Dict[str, Any]], Dict[str, Any]]]] = {
+    'GET': {
+        'check_limits': lambda conn, params, event: check_exchange_limits(conn, params),
+        'get_kyc_status': lambda conn, params, event: get_kyc_status(conn, params.get('client_id'), params.get('email')),
+        'get_aml_status': lambda conn, params, event: get_aml_status(conn, params.get('client_id')),
+        'verify_wallet': lambda conn, params, event: verify_wallet_ownership(conn, params)
+    },
+    'POST': {
+        'submit_kyc': lambda conn, body, event: submit_kyc_documents(conn, body),
+        'perform_aml_check': lambda conn, body, event: perform_aml_check(conn, body),
+        'verify_exchange': lambda conn, body, event: verify_exchange_compliance(conn, body),
+        'request_wallet_verification': lambda conn, body, event: request_wallet_verification(conn, body)
+    },
+    'PUT': {
+        'approve_kyc': lambda conn, body, event: approve_kyc(conn, body),
+        'reject_kyc': lambda conn, body, event: reject_kyc(conn, body)
+    }
+}
+SCHEMAS: Dict[Tuple[str, str], Dict[str, str]] = {
+    ('GET', 'check_limits'): {'amount_usd': 'number?'},
+    ('POST', 'perform_aml_check'): {'client_id': 'int', 'exchange_id': 'int?'},
+    ('POST', 'verify_exchange'): {'exchange_id': 'int', 'client_id': 'int', 'amount_usd': 'number'},
+    ('POST', 'request_wallet_verification'): {'client_id': 'int', 'wallet_address': 'str', 'currency': 'str'},
+    ('PUT', 'approve_kyc'): {'kyc_id': 'int'},
+    ('PUT', 'reject_kyc'): {'kyc_id': 'int'}
+}
+VALIDATORS = {route: compile_schema(schema) for route, schema in SCHEMAS.items()}
+
+# Wallet verification code allocator (V0019): codes are drawn with secrets, reserved
+# CODE_BLOCK_SIZE at a time in code_reservations and handed out from this process's pool. Below
+# CODE_POOL_LOW_WATER a background thread reserves the next block, so a request reserves for
+# itself only when the pool is empty (the first one in a process).
+CODE_ALPHABET = string.ascii_uppercase + string.digits
+CODE_LENGTH = 8
+CODE_BLOCK_SIZE = 256
+CODE_POOL_LOW_WATER = 64
+_code_pool: List[str] = []
+_code_pool_lock = threading.Lock()
+_code_refill: Dict[str, Optional[threading.Thread]] = {'thread': None}
+
+# Background jobs owned by this function: server/worker.py runs them as (conn, payload) -> result
+# inside its own transaction, so they must not commit.
+JOBS: Dict[str, Callable[[Any, Dict[str, Any]], Optional[Dict[str, Any]]]] = {
+    'aml_check': lambda conn, payload: run_aml_check(conn, payload),
+    'kyc_review_handoff': lambda conn, payload: run_kyc_review_handoff(conn, payload)
+}
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    started = time.perf_counter()
+    state = begin_request(event, context)
+    token = _request_state.set(state)
+    status_code = 500
+    try:
+        response = finalize_response(event, dispatch(event, context))
+        status_code = response['statusCode']
+        if state['request_id']:
+            response['headers'] = {**response['headers'], 'X-Request-Id': state['request_id']}
+        return response
+    finally:
+        _request_state.reset(token)
+        method = event.get('httpMethod', 'GET')
+        finish_request(state, method if method in ROUTES or method == 'OPTIONS' else 'OTHER', status_code,
+                       time.perf_counter() - started)
+
+def dispatch(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, PUT, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
+        return {'statusCode': 200, 'headers': OPTIONS_HEADERS, 'body': '', 'isBase64Encoded': False}
     
-    conn = get_db_connection()
+    if method == 'GET' and (event.get('queryStringParameters') or {}).get(ROUTE_KEY) == 'metrics':
+        tag_request('metrics')
+        return metrics_response(event)
     
     try:
-        if method == 'GET':
-            params = event.get('queryStringParameters') or {}
-            action = params.get('action')
-            
-            if action == 'check_limits':
-                return check_exchange_limits(conn, params)
-            elif action == 'get_kyc_status':
-                return get_kyc_status(conn, params.get('client_id'), params.get('email'))
-            elif action == 'get_aml_status':
-                return get_aml_status(conn, params.get('client_id'))
-            elif action == 'verify_wallet':
-                return verify_wallet_ownership(conn, params)
-            
-        elif method == 'POST':
-            body = json.loads(event.get('body', '{}'))
-            action = body.get('action')
-            
-            if action == 'submit_kyc':
-                return submit_kyc_documents(conn, body)
-            elif action == 'perform_aml_check':
-                return perform_aml_check(conn, body)
-            elif action == 'verify_exchange':
-                return verify_exchange_compliance(conn, body)
-            elif action == 'request_wallet_verification':
-                return request_wallet_verification(conn, body)
-            
-        elif method == 'PUT':
-            body = json.loads(event.get('body', '{}'))
-            action = body.get('action')
-            
-            if action == 'approve_kyc':
-                return approve_kyc(conn, body)
-            elif action == 'reject_kyc':
-                return reject_kyc(conn, body)
-        
-        return {
-            'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Invalid action'}),
-            'isBase64Encoded': False
-        }
-        
+        return route_request(event, method)
+    except RequestError as error:
+        return json_response(error.status_code, {'error': error.message})
+
+def route_request(event: Dict[str, Any], method: str) -> Dict[str, Any]:
+    routes = ROUTES.get(method, {})
+    if method in QUERY_METHODS:
+        data = event.get('queryStringParameters') or {}
+    else:
+        data = parse_body(event) if routes else {}
+    action = data.get(ROUTE_KEY) or DEFAULT_ACTIONS.get(method)
+    route = routes.get(action)
+    if route is None:
+        raise RequestError(400, 'Invalid action')
+    tag_request(action)
+    validate = VALIDATORS.get((method, action))
+    if validate is not None:
+        validate(data)
+    readonly = method == 'GET' and action not in PRIMARY_GET_ACTIONS
+    if readonly:
+        route_read(event)
+    
+    conn = get_db_connection()
+    try:
+        response = route(conn, data, event)
+        if not readonly and REPLICA_DSNS and response['statusCode'] < 400:
+            remember_write(event, conn, response)
+        return response
     finally:
         conn.close()
 
@@ -84,51 +791,32 @@ def check_exchange_limits(conn, params: Dict) -> Dict:
     client_id = params.get('client_id')
     amount_usd = float(params.get('amount_usd', 0))
     
-    cursor.execute("SELECT verification_level FROM clients WHERE id = %s", (client_id,))
+    execute_prepared(cursor, 'client_verification_level', (client_id,))
     client = cursor.fetchone()
     
     if not client:
-        return {
-            'statusCode': 404,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Client not found'}),
-            'isBase64Encoded': False
-        }
+        return json_response(404, {'error': 'Client not found'})
     
     verification_level = client['verification_level'] or 'none'
     
-    cursor.execute("""
-        SELECT * FROM exchange_limits 
-        WHERE verification_level = %s
-    """, (verification_level,))
+    execute_prepared(cursor, 'exchange_limits', (verification_level,))
     limits = cursor.fetchone()
     
-    cursor.execute("""
-        SELECT COALESCE(SUM(from_amount), 0) as daily_volume
-        FROM exchanges
-        WHERE client_id = %s 
-        AND created_at > NOW() - INTERVAL '1 day'
-        AND status IN ('completed', 'processing', 'pending')
-    """, (client_id,))
+    execute_prepared(cursor, 'daily_volume', (client_id,))
     usage = cursor.fetchone()
     
     daily_remaining = float(limits['daily_limit_usd']) - float(usage['daily_volume'])
     can_proceed = amount_usd <= daily_remaining and amount_usd <= float(limits['single_transaction_limit_usd'])
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({
-            'can_proceed': can_proceed,
-            'verification_level': verification_level,
-            'limits': dict(limits),
-            'daily_used': float(usage['daily_volume']),
-            'daily_remaining': daily_remaining,
-            'requires_kyc': limits['requires_kyc'],
-            'requires_aml': limits['requires_aml']
-        }, default=str),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {
+        'can_proceed': can_proceed,
+        'verification_level': verification_level,
+        'limits': dict(limits),
+        'daily_used': float(usage['daily_volume']),
+        'daily_remaining': daily_remaining,
+        'requires_kyc': limits['requires_kyc'],
+        'requires_aml': limits['requires_aml']
+    })
 
 def get_kyc_status(conn, client_id: str = None, email: str = None) -> Dict:
     cursor = conn.cursor(cursor_factory=RealDictCursor)
@@ -140,45 +828,27 @@ def get_kyc_status(conn, client_id: str = None, email: str = None) -> Dict:
             client_id = client['id']
     
     if not client_id:
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'kyc': None}, default=str),
-            'isBase64Encoded': False
-        }
+        return json_response(200, {'kyc': None})
     
-    cursor.execute("""
-        SELECT * FROM kyc_verifications 
-        WHERE client_id = %s 
-        ORDER BY created_at DESC 
-        LIMIT 1
-    """, (client_id,))
+    execute_prepared(cursor, 'latest_kyc', (client_id,))
     kyc = cursor.fetchone()
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'kyc': dict(kyc) if kyc else None}, default=str),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {'kyc': dict(kyc) if kyc else None})
 
 def get_aml_status(conn, client_id: str) -> Dict:
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor = conn.cursor()
     
     cursor.execute("""
-        SELECT * FROM aml_checks 
+        SELECT id, client_id, exchange_id, check_type, risk_level, risk_score::text, sanctions_hit, pep_hit,
+               adverse_media_hit, check_result, notes, checked_by, created_at
+        FROM aml_checks
         WHERE client_id = %s 
         ORDER BY created_at DESC 
         LIMIT 5
     """, (client_id,))
-    checks = cursor.fetchall()
+    checks = fetch_rows(cursor)
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'aml_checks': [dict(c) for c in checks]}, default=str),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {'aml_checks': checks})
 
 def submit_kyc_documents(conn, data: Dict) -> Dict:
     cursor = conn.cursor(cursor_factory=RealDictCursor)
@@ -189,12 +859,7 @@ def submit_kyc_documents(conn, data: Dict) -> Dict:
         cursor.execute("SELECT id FROM clients WHERE email = %s", (client_id,))
         client = cursor.fetchone()
         if not client:
-            return {
-                'statusCode': 404,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Client not found'}),
-                'isBase64Encoded': False
-            }
+            return json_response(404, {'error': 'Client not found'})
         client_id = client['id']
     
     cursor.execute("""
@@ -220,27 +885,73 @@ def submit_kyc_documents(conn, data: Dict) -> Dict:
         UPDATE clients SET kyc_status = 'reviewing' WHERE id = %s
     """, (client_id,))
     
+    job_id = enqueue_job(conn, 'kyc_review_handoff', {'kyc_id': result['id']})
+    
     conn.commit()
     
-    return {
-        'statusCode': 201,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({
-            'success': True,
-            'kyc_id': result['id'],
-            'message': 'KYC documents submitted for review'
-        }),
-        'isBase64Encoded': False
-    }
+    return json_response(201, {
+        'success': True,
+        'kyc_id': result['id'],
+        'job_id': job_id,
+        'message': 'KYC documents submitted for review'
+    })
 
-def perform_aml_check(conn, data: Dict) -> Dict:
+def run_kyc_review_handoff(conn, payload: Dict) -> Dict:
     cursor = conn.cursor(cursor_factory=RealDictCursor)
     
+    cursor.execute("""
+        SELECT id, client_id, verification_level, status, document_type, document_number,
+               document_front_url, document_back_url, selfie_url, address_proof_url
+        FROM kyc_verifications WHERE id = %s
+    """, (payload['kyc_id'],))
+    kyc = cursor.fetchone()
+    if not kyc or kyc['status'] != 'reviewing':
+        return {'kyc_id': payload['kyc_id'], 'handed_off': False}
+    
+    # Without a configured review provider the submission waits for manual review in the admin panel.
+    webhook_url = os.environ.get('KYC_REVIEW_WEBHOOK_URL')
+    if not webhook_url:
+        return {'kyc_id': kyc['id'], 'handed_off': False}
+    
+    request = urllib.request.Request(webhook_url, data=dump_json(dict(kyc)).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=10) as response:
+        response.read()
+    
+    return {'kyc_id': kyc['id'], 'handed_off': True}
+
+def perform_aml_check(conn, data: Dict) -> Dict:
+    cursor = conn.cursor()
+    
     client_id = data['client_id']
     exchange_id = data.get('exchange_id')
     
+    cursor.execute("SELECT 1 FROM clients WHERE id = %s", (client_id,))
+    if not cursor.fetchone():
+        return json_response(404, {'error': 'Client not found'})
+    
+    job_id = enqueue_job(conn, 'aml_check', {'client_id': client_id, 'exchange_id': exchange_id},
+                         priority=5, dedupe_key=f'aml_check:{client_id}:{exchange_id or 0}')
+    
+    conn.commit()
+    
+    return json_response(202, {
+        'success': True,
+        'job_id': job_id,
+        'status': 'queued',
+        'message': 'AML check queued; the result appears in get_aml_status'
+    })
+
+def run_aml_check(conn, payload: Dict) -> Dict:
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    
+    client_id = payload['client_id']
+    exchange_id = payload.get('exchange_id')
+    
     cursor.execute("SELECT * FROM clients WHERE id = %s", (client_id,))
     client = cursor.fetchone()
+    if not client:
+        return {'error': 'Client not found'}
     
     risk_score = 0.0
     sanctions_hit = False
@@ -290,19 +1001,11 @@ def perform_aml_check(conn, data: Dict) -> Dict:
         UPDATE clients SET aml_status = %s, risk_level = %s WHERE id = %s
     """, ('checked', risk_level, client_id))
     
-    conn.commit()
-    
     return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({
-            'success': True,
-            'aml_check_id': result['id'],
-            'risk_level': risk_level,
-            'risk_score': float(risk_score),
-            'passed': risk_level in ['low', 'medium']
-        }, default=str),
-        'isBase64Encoded': False
+        'aml_check_id': result['id'],
+        'risk_level': risk_level,
+        'risk_score': float(risk_score),
+        'passed': risk_level in ['low', 'medium']
     }
 
 def verify_exchange_compliance(conn, data: Dict) -> Dict:
@@ -353,18 +1056,13 @@ def verify_exchange_compliance(conn, data: Dict) -> Dict:
     
     conn.commit()
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({
-            'can_proceed': can_proceed,
-            'issues': issues,
-            'verification_level': verification_level,
-            'requires_kyc': limits['requires_kyc'],
-            'requires_aml': limits['requires_aml']
-        }),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {
+        'can_proceed': can_proceed,
+        'issues': issues,
+        'verification_level': verification_level,
+        'requires_kyc': limits['requires_kyc'],
+        'requires_aml': limits['requires_aml']
+    })
 
 def approve_kyc(conn, data: Dict) -> Dict:
     cursor = conn.cursor()
@@ -393,12 +1091,7 @@ def approve_kyc(conn, data: Dict) -> Dict:
     
     conn.commit()
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'success': True, 'message': 'KYC approved'}),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {'success': True, 'message': 'KYC approved'})
 
 def reject_kyc(conn, data: Dict) -> Dict:
     cursor = conn.cursor()
@@ -422,19 +1115,59 @@ def reject_kyc(conn, data: Dict) -> Dict:
     
     conn.commit()
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'success': True, 'message': 'KYC rejected', 'reason': reason}),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {'success': True, 'message': 'KYC rejected', 'reason': reason})
+
+def generate_verification_code() -> str:
+    return ''.join(secrets.choice(CODE_ALPHABET) for _ in range(CODE_LENGTH))
+
+def reserve_verification_codes(count: int) -> List[str]:
+    # Reserves the drawn codes no wallet verification or other reservation holds, in one statement.
+    # Its own connection commits them whatever becomes of the request that needed them.
+    candidates = list({generate_verification_code() for _ in range(count)})
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO code_reservations (kind, code)
+            SELECT 'wallet_verification', c.code FROM unnest(%s::text[]) AS c(code)
+            WHERE NOT EXISTS (SELECT 1 FROM wallet_verifications w WHERE w.verification_code = c.code)
+            ON CONFLICT (kind, code) DO NOTHING
+            RETURNING code
+        """, (candidates,))
+        codes = [row[0] for row in cursor.fetchall()]
+        conn.commit()
+        return codes
+    finally:
+        conn.close()
+
+def refill_code_pool() -> None:
+    try:
+        codes = reserve_verification_codes(CODE_BLOCK_SIZE)
+        with _code_pool_lock:
+            _code_pool.extend(codes)
+    finally:
+        with _code_pool_lock:
+            _code_refill['thread'] = None
+
+def allocate_verification_code() -> str:
+    with _code_pool_lock:
+        if _code_pool:
+            code = _code_pool.pop()
+            if len(_code_pool) < CODE_POOL_LOW_WATER and _code_refill['thread'] is None:
+                _code_refill['thread'] = threading.Thread(target=refill_code_pool, daemon=True)
+                _code_refill['thread'].start()
+            return code
+    codes: List[str] = []
+    while not codes:
+        codes = reserve_verification_codes(CODE_BLOCK_SIZE)
+    with _code_pool_lock:
+        _code_pool.extend(codes[1:])
+    return codes[0]
 
 def request_wallet_verification(conn, data: Dict) -> Dict:
     cursor = conn.cursor(cursor_factory=RealDictCursor)
     
-    import random
-    import string
-    verification_code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
+    verification_code = allocate_verification_code()
     
     cursor.execute("""
         INSERT INTO wallet_verifications 
@@ -454,17 +1187,12 @@ def request_wallet_verification(conn, data: Dict) -> Dict:
     result = cursor.fetchone()
     conn.commit()
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({
-            'success': True,
-            'verification_id': result['id'],
-            'verification_code': verification_code,
-            'message': f'Send {verification_code} from your wallet to verify ownership'
-        }),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {
+        'success': True,
+        'verification_id': result['id'],
+        'verification_code': verification_code,
+        'message': f'Send {verification_code} from your wallet to verify ownership'
+    })
 
 def verify_wallet_ownership(conn, params: Dict) -> Dict:
     cursor = conn.cursor()
@@ -486,16 +1214,6 @@ def verify_wallet_ownership(conn, params: Dict) -> Dict:
         """, (verification_id,))
         conn.commit()
         
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'success': True, 'verified': True}),
-            'isBase64Encoded': False
-        }
+        return json_response(200, {'success': True, 'verified': True})
     
-    return {
-        'statusCode': 400,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'success': False, 'verified': False, 'error': 'Invalid verification code'}),
-        'isBase64Encoded': False
-    }
\ No newline at end of file
+    return json_response(400, {'success': False, 'verified': False, 'error': 'Invalid verification code'})
\ No newline at end of file
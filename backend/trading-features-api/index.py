@@ -4,248 +4,1180 @@ Args: event with httpMethod, body, queryStringParameters; context with request_i
 Returns: HTTP response with trading data, referral info, or alerts
 """
 
+import base64
+import gzip
+import hashlib
+import hmac
 import json
 import os
+import re
+import threading
+from bisect import bisect_left
+from contextvars import ContextVar
+from functools import lru_cache
+from itertools import repeat
+import time
+import weakref
 import random
+import secrets
 import string
-from typing import Dict, Any
+from datetime import date, datetime, timezone
+from decimal import Decimal, ROUND_DOWN
+from collections import OrderedDict
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Dict, Any, Iterator, List, Optional, Tuple, Callable
 import psycopg2
 from psycopg2.extras import RealDictCursor
 
+def connect_database(dsn: Optional[str] = None):
+    # Long-running hosts (server/) replace this with a pooled factory; close() hands the connection back.
+    return psycopg2.connect(dsn or os.environ['DATABASE_URL'])
+
 def get_db_connection():
-    return psycopg2.connect(os.environ['DATABASE_URL'])
+    started = time.perf_counter()
+    state = _request_state.get()
+    conn = None
+    if state is not None and state['replica']:
+        conn = connect_replica(state['read_after'])
+        state['read_from'] = 'primary' if conn is None else 'replica'
+    if conn is None:
+        conn = connect_database()
+    if state is None:
+        return conn
+    state['connect_seconds'] += time.perf_counter() - started
+    return TimedConnection(conn, state['queries']) if state['sampled'] else conn
+
+# Read replicas (streaming standbys of DATABASE_URL). Read-only GET actions go to the next replica
+# (round_robin) or the fastest one (least_latency) whose replay lag is within REPLICA_MAX_LAG_SECONDS,
+# and to the primary otherwise. Successful writes answer with X-Read-After, the primary's WAL position;
+# a GET that sends it back is only served by a replica that has replayed that far. Callers that do not
+# echo it read from the primary for READ_YOUR_WRITES_SECONDS after writing through this instance.
+REPLICA_DSNS = [dsn.strip() for dsn in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if dsn.strip()]
+REPLICA_SELECTION = os.environ.get('REPLICA_SELECTION', 'round_robin')
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get('REPLICA_MAX_LAG_SECONDS', '5'))
+REPLICA_CHECK_SECONDS = float(os.environ.get('REPLICA_CHECK_SECONDS', '1'))
+REPLICA_RETRY_SECONDS = 10.0
+READ_YOUR_WRITES_SECONDS = float(os.environ.get('READ_YOUR_WRITES_SECONDS', '10'))
+READ_AFTER_HEADER = 'X-Read-After'
+RECENT_WRITERS_LIMIT = 4096
+# Lag is zero while everything received is replayed, so an idle primary does not look like lag.
+REPLICA_STATUS_SQL = """
+    SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                ELSE COALESCE(EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - pg_last_xact_replay_timestamp())::float8, 'Infinity')
+           END,
+           (CASE WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn() ELSE pg_current_wal_lsn() END - '0/0'::pg_lsn)::bigint
+"""
+_replica_lock = threading.Lock()
+_replicas: List[Dict[str, Any]] = [
+    {'dsn': dsn, 'checked_at': float('-inf'), 'lag': 0.0, 'replayed': 0, 'latency': 0.0, 'down_until': 0.0}
+    for dsn in REPLICA_DSNS
+]
+_replica_turn = [0]
+_recent_writers: 'OrderedDict[str, float]' = OrderedDict()
+
+def parse_lsn(value: str) -> Optional[int]:
+    high, separator, low = value.strip().partition('/')
+    try:
+        return (int(high, 16) << 32) + int(low, 16) if separator else None
+    except ValueError:
+        return None
+
+def request_caller(event: Dict[str, Any]) -> str:
+    forwarded = get_request_header(event, 'x-forwarded-for').split(',')[0].strip()
+    return forwarded or ((event.get('requestContext') or {}).get('identity') or {}).get('sourceIp') or ''
+
+def route_read(event: Dict[str, Any]) -> bool:
+    """Sends this request's reads to a replica; False when its result is specific to the caller."""
+    state = _request_state.get()
+    if not REPLICA_DSNS or state is None:
+        return True
+    read_after = parse_lsn(get_request_header(event, 'x-read-after'))
+    if read_after is None:
+        caller = request_caller(event)
+        with _replica_lock:
+            recent = caller and _recent_writers.get(caller, 0.0) > time.monotonic()
+        if recent:
+            state['read_from'] = 'primary'
+            return False
+    state['replica'] = True
+    state['read_after'] = read_after
+    return read_after is None
+
+def remember_write(event: Dict[str, Any], conn, response: Dict[str, Any]) -> None:
+    cursor = conn.cursor()
+    cursor.execute('SELECT pg_current_wal_lsn()::text')
+    response['headers'] = {**response['headers'], READ_AFTER_HEADER: cursor.fetchone()[0],
+                           'Access-Control-Expose-Headers': READ_AFTER_HEADER}
+    caller = request_caller(event)
+    if caller:
+        with _replica_lock:
+            _recent_writers[caller] = time.monotonic() + READ_YOUR_WRITES_SECONDS
+            _recent_writers.move_to_end(caller)
+            if len(_recent_writers) > RECENT_WRITERS_LIMIT:
+                _recent_writers.popitem(last=False)
+
+def replica_candidates() -> List[Dict[str, Any]]:
+    now = time.monotonic()
+    with _replica_lock:
+        # A lagging replica stays a candidate once its status is stale, so it is checked again.
+        usable = [replica for replica in _replicas if replica['down_until'] <= now and (
+            replica['lag'] <= REPLICA_MAX_LAG_SECONDS or now - replica['checked_at'] >= REPLICA_CHECK_SECONDS)]
+        if REPLICA_SELECTION == 'least_latency':
+            return sorted(usable, key=lambda replica: replica['latency'])
+        _replica_turn[0] += 1
+        start = _replica_turn[0] % len(usable) if usable else 0
+        return usable[start:] + usable[:start]
+
+def check_replica(replica: Dict[str, Any], conn) -> None:
+    started = time.perf_counter()
+    cursor = conn.cursor()
+    cursor.execute(REPLICA_STATUS_SQL)
+    lag, replayed = cursor.fetchone()
+    elapsed = time.perf_counter() - started
+    with _replica_lock:
+        replica['lag'] = float(lag)
+        replica['replayed'] = replayed
+        replica['checked_at'] = time.monotonic()
+        replica['latency'] = 0.8 * replica['latency'] + 0.2 * elapsed if replica['latency'] else elapsed
+
+def connect_replica(read_after: Optional[int]):
+    """Connection to a replica that is fresh enough, or None to read from the primary."""
+    for replica in replica_candidates():
+        conn = None
+        try:
+            conn = connect_database(replica['dsn'])
+            if (time.monotonic() - replica['checked_at'] >= REPLICA_CHECK_SECONDS
+                    or (read_after is not None and replica['replayed'] < read_after)):
+                check_replica(replica, conn)
+        except psycopg2.Error:
+            if conn is not None:
+                conn.close()
+            with _replica_lock:
+                replica['down_until'] = time.monotonic() + REPLICA_RETRY_SECONDS
+            continue
+        if replica['lag'] <= REPLICA_MAX_LAG_SECONDS and (read_after is None or replica['replayed'] >= read_after):
+            return conn
+        conn.close()
+    return None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+class Rows:
+    # A result set as fetched: the driver's tuples plus the column names, read once per statement.
+    # Handlers that look at a row get it as a dict; the encoders turn the whole set into objects in
+    # one pass of C-level maps. Numeric columns are cast to text in SQL, so no value calls back.
+    __slots__ = ('keys', 'rows')
+
+    def __init__(self, keys: Tuple[str, ...], rows: List[Tuple]):
+        self.keys = keys
+        self.rows = rows
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __getitem__(self, index: int) -> Dict[str, Any]:
+        return dict(zip(self.keys, self.rows[index]))
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        return map(dict, map(zip, repeat(self.keys), self.rows))
+
+# Timestamps go out as ISO 8601 ('2025-01-02T03:04:05.123456'), as orjson writes them natively.
+JSON_ENCODERS = {
+    Rows: list,
+    Decimal: str,
+    datetime: datetime.isoformat,
+    date: date.isoformat,
+}
+
+def encode_json_value(value: Any) -> Any:
+    encoder = JSON_ENCODERS.get(type(value), str)
+    return encoder(value)
+
+if orjson is not None:
+    def dump_json(payload: Any) -> str:
+        return orjson.dumps(payload, default=encode_json_value).decode()
+else:
+    _json_encoder = json.JSONEncoder(default=encode_json_value, ensure_ascii=False, separators=(',', ':'))
+
+    def dump_json(payload: Any) -> str:
+        return _json_encoder.encode(payload)
+
+def fetch_rows(cursor) -> Rows:
+    return Rows(tuple(column[0] for column in cursor.description), cursor.fetchall())
+
+def enqueue_job(conn, kind: str, payload: Dict[str, Any], priority: int = 0, delay_seconds: float = 0,
+                dedupe_key: Optional[str] = None) -> Optional[int]:
+    # Inserted in the caller's transaction, so the job exists only if the request's writes commit;
+    # server/worker.py runs it. A dedupe_key that is already queued returns the existing job.
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO jobs (kind, payload, priority, run_at, dedupe_key)
+        VALUES (%s, %s, %s, CURRENT_TIMESTAMP + make_interval(secs => %s), %s)
+        ON CONFLICT (dedupe_key) WHERE status = 'queued' DO NOTHING
+        RETURNING id
+    """, (kind, dump_json(payload), priority, delay_seconds, dedupe_key))
+    row = cursor.fetchone()
+    if row is None:
+        cursor.execute("SELECT id FROM jobs WHERE dedupe_key = %s AND status = 'queued'", (dedupe_key,))
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+def post_ledger_entry(conn, kind: str, reference: str, exchange_id: Optional[int],
+                      lines: List[Tuple[str, str, Any]]) -> Optional[int]:
+    # Appends a balanced entry of (account code, currency, amount) lines to the ledger (V0017) in
+    # the caller's transaction, keeping the accounts' cached balances in step. Returns None when
+    # (kind, reference) is already posted.
+    cursor = conn.cursor()
+    cursor.execute("SELECT post_ledger_entry(%s, %s, %s, %s::jsonb)", (kind, reference, exchange_id, dump_json([
+        {'account': account, 'currency': currency, 'amount': amount} for account, currency, amount in lines
+    ])))
+    return cursor.fetchone()[0]
+
+FUNCTION_NAME = 'trading-features-api'
+# Request instrumentation. Latency histograms (per action, connection acquire,
+# serialization) are always recorded; per-statement timing and the structured log
+# line are kept for a sampled fraction of requests, plus a log line for slow ones.
+METRICS_SAMPLE_RATE = float(os.environ.get('METRICS_SAMPLE_RATE', '0.05'))
+SLOW_REQUEST_SECONDS = float(os.environ.get('SLOW_REQUEST_MS', '500')) / 1000
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+QUERY_TEXT_LIMIT = 200
+_metrics_lock = threading.Lock()
+_histograms: Dict[Tuple[str, Tuple], List[float]] = {}
+_request_counts: Dict[Tuple, int] = {}
+_query_stats: Dict[str, List[Any]] = {}
+_routed_reads: Dict[str, int] = {}
+_request_state: ContextVar[Optional[Dict[str, Any]]] = ContextVar('request_state', default=None)
+_literal_pattern = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_space_pattern = re.compile(r'\s+')
+
+@lru_cache(maxsize=512)
+def query_fingerprint(query: str) -> Tuple[str, str]:
+    normalized = _space_pattern.sub(' ', _literal_pattern.sub('?', query)).strip()
+    return hashlib.blake2b(normalized.encode('utf-8'), digest_size=6).hexdigest(), normalized
+
+class TimedCursor:
+    def __init__(self, cursor, queries: List[Tuple[Any, float, int]]):
+        self._cursor = cursor
+        self._queries = queries
+    
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._cursor, name)
+    
+    def __iter__(self):
+        return iter(self._cursor)
+    
+    def execute(self, query, params=None):
+        started = time.perf_counter()
+        try:
+            return self._cursor.execute(query, params)
+        finally:
+            self._queries.append((query, time.perf_counter() - started, self._cursor.rowcount))
+
+class TimedConnection:
+    def __init__(self, conn, queries: List[Tuple[Any, float, int]]):
+        self._conn = conn
+        self._queries = queries
+    
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._conn, name)
+    
+    def cursor(self, *args, **kwargs) -> TimedCursor:
+        return TimedCursor(self._conn.cursor(*args, **kwargs), self._queries)
+
+def begin_request(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    request_id = getattr(context, 'request_id', None) or get_request_header(event, 'x-request-id')[:128]
+    return {
+        'request_id': request_id or None,
+        'action': None,
+        'sampled': random.random() < METRICS_SAMPLE_RATE,
+        'connect_seconds': 0.0,
+        'serialize_seconds': 0.0,
+        'queries': [],
+        'replica': False,
+        'read_after': None,
+        'read_from': None
+    }
+
+def tag_request(action: str) -> None:
+    state = _request_state.get()
+    if state is not None:
+        state['action'] = action
+
+def observe(name: str, labels: Tuple, seconds: float) -> None:
+    histogram = _histograms.get((name, labels))
+    if histogram is None:
+        histogram = _histograms[(name, labels)] = [0.0] * (len(LATENCY_BUCKETS) + 2)
+    histogram[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+    histogram[-1] += seconds
+
+def finish_request(state: Dict[str, Any], method: str, status_code: int, seconds: float) -> None:
+    action = state['action'] or 'unknown'
+    queries = [(query_fingerprint(query if isinstance(query, str) else str(query)), elapsed, rows)
+               for query, elapsed, rows in state['queries']]
+    
+    with _metrics_lock:
+        observe('request_duration_seconds', (('method', method), ('action', action)), seconds)
+        if state['connect_seconds']:
+            observe('db_connect_duration_seconds', (), state['connect_seconds'])
+        if state['serialize_seconds']:
+            observe('serialization_duration_seconds', (), state['serialize_seconds'])
+        count_key = (('action', action), ('status', str(status_code)))
+        _request_counts[count_key] = _request_counts.get(count_key, 0) + 1
+        if state['read_from']:
+            _routed_reads[state['read_from']] = _routed_reads.get(state['read_from'], 0) + 1
+        for (fingerprint, text), elapsed, rows in queries:
+            stats = _query_stats.get(fingerprint)
+            if stats is None:
+                stats = _query_stats[fingerprint] = [text[:QUERY_TEXT_LIMIT], 0, 0.0, 0]
+            stats[1] += 1
+            stats[2] += elapsed
+            stats[3] += max(rows, 0)
+    
+    if state['sampled'] or seconds >= SLOW_REQUEST_SECONDS:
+        print(dump_json({
+            'level': 'warning' if seconds >= SLOW_REQUEST_SECONDS else 'info',
+            'event': 'request',
+            'function': FUNCTION_NAME,
+            'request_id': state['request_id'],
+            'method': method,
+            'action': action,
+            'status': status_code,
+            'duration_ms': round(seconds * 1000, 3),
+            'db_connect_ms': round(state['connect_seconds'] * 1000, 3),
+            'serialize_ms': round(state['serialize_seconds'] * 1000, 3),
+            'queries': [
+                {'fingerprint': fingerprint, 'ms': round(elapsed * 1000, 3), 'rows': rows}
+                for (fingerprint, _), elapsed, rows in queries
+            ]
+        }), flush=True)
+
+def escape_label(value: Any) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+
+def prometheus_labels(labels: Tuple) -> str:
+    pairs = (('function', FUNCTION_NAME),) + labels
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in pairs) + '}'
+
+def render_metrics() -> str:
+    lines = []
+    with _metrics_lock:
+        histograms = sorted((key, list(values)) for key, values in _histograms.items())
+        request_counts = sorted(_request_counts.items())
+        routed_reads = sorted(_routed_reads.items())
+        query_stats = sorted((fingerprint, list(stats)) for fingerprint, stats in _query_stats.items())
+    
+    declared = set()
+    for (name, labels), values in histograms:
+        metric = f'backend_{name}'
+        if metric not in declared:
+            declared.add(metric)
+            lines.append(f'# TYPE {metric} histogram')
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), values[:-1]):
+            cumulative += count
+            lines.append(f"{metric}_bucket{prometheus_labels(labels + (('le', bound),))} {int(cumulative)}")
+        lines.append(f'{metric}_sum{prometheus_labels(labels)} {values[-1]:.6f}')
+        lines.append(f'{metric}_count{prometheus_labels(labels)} {int(cumulative)}')
+    
+    lines.append('# TYPE backend_requests_total counter')
+    for labels, count in request_counts:
+        lines.append(f'backend_requests_total{prometheus_labels(labels)} {count}')
+    
+    if routed_reads:
+        lines.append('# TYPE backend_replica_eligible_reads_total counter')
+    for database, count in routed_reads:
+        lines.append(f"backend_replica_eligible_reads_total{prometheus_labels((('database', database),))} {count}")
+    
+    lines.append('# TYPE backend_sampled_query_calls_total counter')
+    lines.append('# TYPE backend_sampled_query_seconds_total counter')
+    lines.append('# TYPE backend_sampled_query_rows_total counter')
+    lines.append('# TYPE backend_query_info gauge')
+    for fingerprint, (text, calls, seconds, rows) in query_stats:
+        labels = (('fingerprint', fingerprint),)
+        lines.append(f'backend_sampled_query_calls_total{prometheus_labels(labels)} {calls}')
+        lines.append(f'backend_sampled_query_seconds_total{prometheus_labels(labels)} {seconds:.6f}')
+        lines.append(f'backend_sampled_query_rows_total{prometheus_labels(labels)} {rows}')
+        lines.append(f"backend_query_info{prometheus_labels(labels + (('statement', text),))} 1")
+    return '\n'.join(lines) + '\n'
+
+def metrics_response(event: Dict[str, Any]) -> Dict[str, Any]:
+    token = os.environ.get('METRICS_TOKEN')
+    if token and not hmac.compare_digest(get_request_header(event, 'x-metrics-token'), token):
+        return json_response(403, {'error': 'Forbidden'})
+    return {'statusCode': 200, 'headers': METRICS_HEADERS, 'body': render_metrics(), 'isBase64Encoded': False}
+
+# Shared by every response of a kind; code that adds headers builds a new dict.
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+METRICS_HEADERS = {'Content-Type': 'text/plain; version=0.0.4', 'Access-Control-Allow-Origin': '*'}
+
+def json_response(status_code: int, payload: Any) -> Dict[str, Any]:
+    started = time.perf_counter()
+    body = dump_json(payload)
+    state = _request_state.get()
+    if state is not None:
+        state['serialize_seconds'] += time.perf_counter() - started
+    return {
+        'statusCode': status_code,
+        'headers': JSON_HEADERS,
+        'body': body,
+        'isBase64Encoded': False
+    }
+
+MAX_BODY_BYTES = 64 * 1024
+
+class RequestError(Exception):
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+
+def parse_body(event: Dict[str, Any]) -> Dict[str, Any]:
+    body = event.get('body') or '{}'
+    try:
+        if event.get('isBase64Encoded'):
+            body = base64.b64decode(body)
+        if len(body) > MAX_BODY_BYTES:
+            raise RequestError(413, 'Request body too large')
+        data = json.loads(body)
+    except ValueError:
+        raise RequestError(400, 'Invalid JSON body')
+    if not isinstance(data, dict):
+        raise RequestError(400, 'JSON body must be an object')
+    return data
+
+def is_number(value: Any) -> bool:
+    if isinstance(value, str):
+        try:
+            float(value)
+        except ValueError:
+            return False
+        return True
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def is_integer(value: Any) -> bool:
+    if isinstance(value, str):
+        return value.lstrip('-').isdigit()
+    return isinstance(value, int) and not isinstance(value, bool)
+
+FIELD_TYPES: Dict[str, Callable[[Any], bool]] = {
+    'str': lambda value: isinstance(value, str),
+    'number': is_number,
+    'int': is_integer,
+    'bool': lambda value: isinstance(value, bool),
+    'dict': lambda value: isinstance(value, dict),
+    'any': lambda value: True
+}
+
+def compile_schema(schema: Dict[str, str]) -> Callable[[Dict[str, Any]], None]:
+    # 'type' marks a required field, 'type?' an optional one (None counts as absent).
+    fields = tuple(
+        (name, not spec.endswith('?'), spec.rstrip('?'), FIELD_TYPES[spec.rstrip('?')])
+        for name, spec in schema.items()
+    )
+    
+    def validate(data: Dict[str, Any]) -> None:
+        for name, required, type_name, check in fields:
+            value = data.get(name)
+            if value is None:
+                if required:
+                    raise RequestError(400, f'Missing required field: {name}')
+            elif not check(value):
+                raise RequestError(400, f'Invalid field {name}: expected {type_name}')
+    return validate
+
+COMPRESSION_MIN_BYTES = 1024
+COMPRESSED_BODY_CACHE_SIZE = 64
+_compressed_bodies: 'OrderedDict[Tuple[str, str], str]' = OrderedDict()
+
+def get_request_header(event: Dict[str, Any], name: str) -> str:
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name:
+            return value or ''
+    return ''
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    weights = {}
+    for part in accept_encoding.lower().split(','):
+        token, _, param = part.partition(';')
+        param = param.strip()
+        try:
+            weight = float(param[2:]) if param.startswith('q=') else 1.0
+        except ValueError:
+            weight = 0.0
+        weights[token.strip()] = weight
+    for encoding in ('br', 'gzip'):
+        if encoding == 'br' and brotli is None:
+            continue
+        if weights.get(encoding, weights.get('*', 0.0)) > 0:
+            return encoding
+    return None
+
+def compress_body(raw: bytes, encoding: str) -> str:
+    if encoding == 'br':
+        compressed = brotli.compress(raw, quality=5)
+    else:
+        compressed = gzip.compress(raw, compresslevel=6)
+    return base64.b64encode(compressed).decode('ascii')
+
+def opaque_tag(etag: str) -> str:
+    # Weak comparison (RFC 7232 section 2.3.2); '-br'/'-gzip' are the variant suffixes older
+    # responses carried.
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    for encoding in ('br', 'gzip'):
+        etag = etag.replace(f'-{encoding}"', '"')
+    return etag
+
+def etag_matches(if_none_match: str, etag: Optional[str]) -> bool:
+    if not if_none_match or etag is None:
+        return False
+    opaque = opaque_tag(etag)
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*' or opaque_tag(candidate) == opaque:
+            return True
+    return False
+
+def finalize_response(event: Dict[str, Any], response: Dict[str, Any]) -> Dict[str, Any]:
+    body = response.get('body')
+    if not body or response.get('isBase64Encoded'):
+        return response
+    
+    headers = response['headers']
+    raw = body.encode('utf-8')
+    if len(raw) >= COMPRESSION_MIN_BYTES:
+        headers = response['headers'] = {**headers, 'Vary': 'Accept-Encoding'}
+    
+    # ETags are weak and name the body whatever its encoding, so a 304 carries the tag the 200 had.
+    # Cacheable reads bring one derived from their version probe (validator_etag); other GETs are
+    # tagged by a hash of the body and can only be answered with 304 after the handler ran.
+    etag = headers.get('ETag')
+    if etag is None and event.get('httpMethod') == 'GET' and response['statusCode'] == 200:
+        etag = 'W/"' + hashlib.blake2b(raw, digest_size=16).hexdigest() + '"'
+        headers = response['headers'] = {**headers, 'ETag': etag}
+        if etag_matches(get_request_header(event, 'if-none-match'), etag):
+            return {'statusCode': 304, 'headers': headers, 'body': '', 'isBase64Encoded': False}
+    
+    if len(raw) < COMPRESSION_MIN_BYTES:
+        return response
+    
+    encoding = choose_encoding(get_request_header(event, 'accept-encoding'))
+    if encoding is None:
+        return response
+    
+    cache_key = (etag, encoding)
+    encoded = _compressed_bodies.get(cache_key) if etag else None
+    if encoded is None:
+        encoded = compress_body(raw, encoding)
+        if etag:
+            _compressed_bodies[cache_key] = encoded
+            if len(_compressed_bodies) > COMPRESSED_BODY_CACHE_SIZE:
+                _compressed_bodies.popitem(last=False)
+    else:
+        _compressed_bodies.move_to_end(cache_key)
+    
+    headers['Content-Encoding'] = encoding
+    response['body'] = encoded
+    response['isBase64Encoded'] = True
+    return response
+
+# Public reads that a CDN/proxy may cache. last_modified_sql is a cheap probe of the
+# underlying tables; actions without one must not need a database connection.
+CACHE_POLICIES: Dict[str, Dict[str, Any]] = {
+    'check_referral_code': {
+        'max_age': 60,
+        'stale_while_revalidate': 300,
+        'last_modified_sql': "SELECT MAX(updated_at) FROM referral_codes"
+    }
+}
+_last_modified: Dict[str, Tuple[float, Optional[datetime]]] = {}
+
+def parse_http_date(value: str) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        parsed = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+def validator_etag(event: Dict[str, Any], key: str, last_modified: Optional[datetime]) -> str:
+    # The body follows from the action, its query and the probed version, so the tag is built from
+    # those and a revalidation is answered before the handler, its SQL or any serialization runs.
+    params = sorted((event.get('queryStringParameters') or {}).items())
+    return 'W/"' + hashlib.blake2b(repr((key, params, last_modified)).encode(), digest_size=16).hexdigest() + '"'
+
+def cache_headers(policy: Dict[str, Any], last_modified: Optional[datetime], etag: Optional[str]) -> Dict[str, str]:
+    headers = {
+        'Cache-Control': f"public, max-age={policy['max_age']}, stale-while-revalidate={policy['stale_while_revalidate']}",
+        'Vary': 'Accept-Encoding'
+    }
+    if last_modified is not None:
+        headers['Last-Modified'] = format_datetime(last_modified.replace(microsecond=0, tzinfo=timezone.utc), usegmt=True)
+    if etag is not None:
+        headers['ETag'] = etag
+    return headers
+
+def is_not_modified(etag: Optional[str], last_modified: Optional[datetime], if_none_match: str,
+                    if_modified_since: Optional[datetime]) -> bool:
+    # If-Modified-Since is ignored when the request also carries If-None-Match (RFC 7232 section 6).
+    if if_none_match:
+        return etag_matches(if_none_match, etag)
+    return last_modified is not None and if_modified_since is not None and last_modified.replace(microsecond=0) <= if_modified_since
+
+def not_modified_response(policy: Dict[str, Any], last_modified: Optional[datetime], etag: Optional[str]) -> Dict[str, Any]:
+    return {
+        'statusCode': 304,
+        'headers': {'Access-Control-Allow-Origin': '*', **cache_headers(policy, last_modified, etag)},
+        'body': '',
+        'isBase64Encoded': False
+    }
+
+def serve_cacheable(event: Dict[str, Any], key: str, policy: Dict[str, Any], run: Callable[[Any], Dict[str, Any]]) -> Dict[str, Any]:
+    if_none_match = get_request_header(event, 'if-none-match')
+    if_modified_since = parse_http_date(get_request_header(event, 'if-modified-since'))
+    
+    known = _last_modified.get(key)
+    if known and time.monotonic() - known[0] < policy['max_age']:
+        etag = validator_etag(event, key, known[1])
+        if is_not_modified(etag, known[1], if_none_match, if_modified_since):
+            return not_modified_response(policy, known[1], etag)
+    
+    last_modified = etag = None
+    if policy['last_modified_sql'] is None:
+        response = run(None)
+    else:
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(policy['last_modified_sql'])
+            last_modified = cursor.fetchone()[0]
+            _last_modified[key] = (time.monotonic(), last_modified)
+            etag = validator_etag(event, key, last_modified)
+            if is_not_modified(etag, last_modified, if_none_match, if_modified_since):
+                return not_modified_response(policy, last_modified, etag)
+            response = run(conn)
+        finally:
+            conn.close()
+    
+    if response['statusCode'] == 200:
+        response['headers'] = {**response['headers'], **cache_headers(policy, last_modified, etag)}
+    return response
+
+# Hot statements by name. With PREPARE_STATEMENTS=1 each runs as a server-side prepared statement:
+# PREPARE once per connection (sent with the first EXECUTE, so it costs no extra round trip), then
+# EXECUTE, which skips parsing and, once Postgres settles on a generic plan, planning. Off by default:
+# a serverless invocation's connection serves one request, and transaction-mode poolers do not keep
+# sessions; server/app.py turns it on for its pooled connections. After five executions Postgres may
+# switch to a generic plan, so statements whose best plan depends on the parameter (a per-client
+# ORDER BY ... LIMIT over skewed data) stay plain; tools/bench/prepared.py shows the effect.
+PREPARE_STATEMENTS = os.environ.get('PREPARE_STATEMENTS', '0') == '1'
+PREPARED_QUERIES: Dict[str, str] = {
+    'get_referral_code': """
+        SELECT * FROM referral_codes 
+        WHERE client_id = %s AND is_active = true
+    """,
+    'check_referral_code': """
+        SELECT rc.*, c.full_name, c.email
+        FROM referral_codes rc
+        JOIN clients c ON rc.client_id = c.id
+        WHERE rc.code = %s AND rc.is_active = true
+    """
+}
+PREPARED_PREFIX = FUNCTION_NAME.replace('-', '_') + '_'
+FEATURE_NOT_SUPPORTED = '0A000'
+INVALID_SQL_STATEMENT_NAME = '26000'
+_prepared_lock = threading.Lock()
+# connection -> {name: 'ready' | 'stale'}; weak, so entries leave with their connections
+_prepared_sessions: 'weakref.WeakKeyDictionary' = weakref.WeakKeyDictionary()
+_prepared_unknown: 'weakref.WeakSet' = weakref.WeakSet()
+
+def server_placeholders(query: str) -> str:
+    parts = query.split('%s')
+    return parts[0] + ''.join(f'${index}{part}' for index, part in enumerate(parts[1:], 1))
+
+PREPARE_SQL = {name: f'PREPARE {PREPARED_PREFIX}{name} AS {server_placeholders(query)}' for name, query in PREPARED_QUERIES.items()}
+
+def prepared_session(conn) -> Dict[str, str]:
+    with _prepared_lock:
+        session = _prepared_sessions.get(conn)
+        unknown = conn in _prepared_unknown
+    if session is not None and not unknown:
+        return session
+    session = {}
+    if unknown:
+        # A PREPARE went out with a statement that failed, so ask the session what it holds.
+        cursor = conn.cursor()
+        cursor.execute("SELECT name FROM pg_prepared_statements WHERE starts_with(name, %s)", (PREPARED_PREFIX,))
+        session = {row[0][len(PREPARED_PREFIX):]: 'ready' for row in cursor.fetchall()}
+    with _prepared_lock:
+        _prepared_sessions[conn] = session
+        _prepared_unknown.discard(conn)
+    return session
+
+def execute_prepared(cursor, name: str, params: Tuple = ()) -> None:
+    if not PREPARE_STATEMENTS:
+        cursor.execute(PREPARED_QUERIES[name], params)
+        return
+    conn = cursor.connection
+    session = prepared_session(conn)
+    status = session.get(name)
+    statement = PREPARED_PREFIX + name
+    execute = f"EXECUTE {statement}({', '.join(['%s'] * len(params))})" if params else f'EXECUTE {statement}'
+    if status == 'ready':
+        query = execute
+    elif status == 'stale':
+        query = f'DEALLOCATE {statement}; {PREPARE_SQL[name]}; {execute}'
+    else:
+        query = f'{PREPARE_SQL[name]}; {execute}'
+    try:
+        cursor.execute(query, params)
+    except psycopg2.Error as error:
+        with _prepared_lock:
+            if status == 'ready' and error.pgcode == FEATURE_NOT_SUPPORTED:
+                # "cached plan must not change result type": a migration changed a table under SELECT *,
+                # so every connection re-prepares the statement rather than failing once each.
+                for other in _prepared_sessions.values():
+                    if other.get(name) == 'ready':
+                        other[name] = 'stale'
+            elif status != 'ready' or error.pgcode == INVALID_SQL_STATEMENT_NAME:
+                _prepared_unknown.add(conn)
+        raise
+    session[name] = 'ready'
+
+OPTIONS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, X-Read-After',
+    'Access-Control-Max-Age': '86400'
+}
+
+# Action table per method: each route takes (conn, data, event) where data is the
+# query string for GET and the parsed JSON body otherwise.
+ROUTE_KEY = 'action'
+QUERY_METHODS = ('GET', 'DELETE')
+# GET actions that write, so they never read from a replica.
+PRIMARY_GET_ACTIONS = frozenset()
+DEFAULT_ACTIONS: Dict[str, str] = {}
+ROUTES: Dict[str, Dict[str, Callable[[Any, Dict[str, Any], Dict[str, Any]], Dict[str, Any]]]] = {
+    'GET': {
+        'get_referral_code': lambda conn, params, event: get_referral_code(conn, params.get('client_id')),
+        'check_referral_code': lambda conn, params, event: check_referral_code(conn, params.get('code')),
+        'get_referral_stats': lambda conn, params, event: get_referral_stats(conn, params.get('client_id')),
+        'list_limit_orders': lambda conn, params, event: list_limit_orders(conn, params),
+        'get_price_alerts': lambda conn, params, event: get_price_alerts(conn, params.get('client_id')),
+        'get_trading_analytics': lambda conn, params, event: get_trading_analytics(conn, params)
+    },
+    'POST': {
+        'create_referral_code': lambda conn, body, event: create_referral_code(conn, body),
+        'use_referral_code': lambda conn, body, event: use_referral_code(conn, body),
+        'create_limit_order': lambda conn, body, event: create_limit_order(conn, body),
+        'create_price_alert': lambda conn, body, event: create_price_alert(conn, body)
+    },
+    'PUT': {
+        'cancel_limit_order': lambda conn, body, event: cancel_limit_order(conn, body.get('order_id'))
+    }
+}
+SCHEMAS: Dict[Tuple[str, str], Dict[str, str]] = {
+    ('GET', 'get_trading_analytics'): {'days': 'int?'},
+    ('POST', 'create_referral_code'): {'client_id': 'int', 'discount_percent': 'number?', 'commission_percent': 'number?'},
+    ('POST', 'use_referral_code'): {'code': 'str', 'exchange_id': 'int'},
+    ('POST', 'create_limit_order'): {'client_id': 'int', 'from_currency': 'str', 'to_currency': 'str',
+                                     'from_amount': 'number', 'target_rate': 'number', 'expiry_date': 'str?'},
+    ('POST', 'create_price_alert'): {'client_id': 'int', 'currency': 'str', 'target_price': 'number', 'condition': 'str'},
+    ('PUT', 'cancel_limit_order'): {'order_id': 'int'}
+}
+VALIDATORS = {route: compile_schema(schema) for route, schema in SCHEMAS.items()}
+
+# Referral settlement (V0018): uses accrue as referral_usage rows and are credited to their codes
+# REFERRAL_SETTLEMENT_BATCH at a time, oldest first, once their exchange has completed.
+REFERRAL_SETTLEMENT_SECONDS = float(os.environ.get('REFERRAL_SETTLEMENT_SECONDS', '30'))
+REFERRAL_SETTLEMENT_BATCH = 5000
+
+# Referral code allocator (V0019): codes are drawn with secrets, reserved CODE_BLOCK_SIZE at a time
+# in code_reservations and handed out from this process's pool. Below CODE_POOL_LOW_WATER a
+# background thread reserves the next block, so a request reserves for itself only when the pool
+# is empty (the first one in a process).
+CODE_ALPHABET = string.ascii_uppercase + string.digits
+CODE_LENGTH = 8
+CODE_BLOCK_SIZE = 256
+CODE_POOL_LOW_WATER = 64
+_code_pool: List[str] = []
+_code_pool_lock = threading.Lock()
+_code_refill: Dict[str, Optional[threading.Thread]] = {'thread': None}
+
+# Background jobs owned by this function: server/worker.py runs them as (conn, payload) -> result
+# inside its own transaction, so they must not commit.
+JOBS: Dict[str, Callable[[Any, Dict[str, Any]], Optional[Dict[str, Any]]]] = {
+    'referral_commission': lambda conn, payload: run_referral_commission(conn, payload),
+    'referral_settlement': lambda conn, payload: run_referral_settlement(conn, payload)
+}
+# Recurring jobs (kind -> interval in seconds) that server/worker.py keeps queued.
+SCHEDULES: Dict[str, float] = {
+    'referral_settlement': REFERRAL_SETTLEMENT_SECONDS
+}
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    started = time.perf_counter()
+    state = begin_request(event, context)
+    token = _request_state.set(state)
+    status_code = 500
+    try:
+        response = finalize_response(event, dispatch(event, context))
+        status_code = response['statusCode']
+        if state['request_id']:
+            response['headers'] = {**response['headers'], 'X-Request-Id': state['request_id']}
+        return response
+    finally:
+        _request_state.reset(token)
+        method = event.get('httpMethod', 'GET')
+        finish_request(state, method if method in ROUTES or method == 'OPTIONS' else 'OTHER', status_code,
+                       time.perf_counter() - started)
+
+def dispatch(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
+        return {'statusCode': 200, 'headers': OPTIONS_HEADERS, 'body': '', 'isBase64Encoded': False}
     
-    conn = get_db_connection()
+    if method == 'GET' and (event.get('queryStringParameters') or {}).get(ROUTE_KEY) == 'metrics':
+        tag_request('metrics')
+        return metrics_response(event)
     
     try:
-        if method == 'GET':
-            params = event.get('queryStringParameters') or {}
-            action = params.get('action')
-            
-            if action == 'get_referral_code':
-                return get_referral_code(conn, params.get('client_id'))
-            elif action == 'check_referral_code':
-                return check_referral_code(conn, params.get('code'))
-            elif action == 'get_referral_stats':
-                return get_referral_stats(conn, params.get('client_id'))
-            elif action == 'list_limit_orders':
-                return list_limit_orders(conn, params)
-            elif action == 'get_price_alerts':
-                return get_price_alerts(conn, params.get('client_id'))
-            elif action == 'get_trading_analytics':
-                return get_trading_analytics(conn, params)
-            
-        elif method == 'POST':
-            body = json.loads(event.get('body', '{}'))
-            action = body.get('action')
-            
-            if action == 'create_referral_code':
-                return create_referral_code(conn, body)
-            elif action == 'use_referral_code':
-                return use_referral_code(conn, body)
-            elif action == 'create_limit_order':
-                return create_limit_order(conn, body)
-            elif action == 'create_price_alert':
-                return create_price_alert(conn, body)
-            
-        elif method == 'PUT':
-            body = json.loads(event.get('body', '{}'))
-            if body.get('action') == 'cancel_limit_order':
-                return cancel_limit_order(conn, body.get('order_id'))
-            
-        return {
-            'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Invalid action'}),
-            'isBase64Encoded': False
-        }
-        
+        return route_request(event, method)
+    except RequestError as error:
+        return json_response(error.status_code, {'error': error.message})
+
+def route_request(event: Dict[str, Any], method: str) -> Dict[str, Any]:
+    routes = ROUTES.get(method, {})
+    if method in QUERY_METHODS:
+        data = event.get('queryStringParameters') or {}
+    else:
+        data = parse_body(event) if routes else {}
+    action = data.get(ROUTE_KEY) or DEFAULT_ACTIONS.get(method)
+    route = routes.get(action)
+    if route is None:
+        raise RequestError(400, 'Invalid action')
+    tag_request(action)
+    validate = VALIDATORS.get((method, action))
+    if validate is not None:
+        validate(data)
+    run = lambda conn: route(conn, data, event)
+    readonly = method == 'GET' and action not in PRIMARY_GET_ACTIONS
+    
+    if method == 'GET':
+        if readonly:
+            route_read(event)
+        policy = CACHE_POLICIES.get(action)
+        if policy:
+            return serve_cacheable(event, action, policy, run)
+    else:
+        _last_modified.clear()
+    
+    conn = get_db_connection()
+    try:
+        response = run(conn)
+        if not readonly and REPLICA_DSNS and response['statusCode'] < 400:
+            remember_write(event, conn, response)
+        return response
     finally:
         conn.close()
 
 def generate_referral_code() -> str:
-    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
+    return ''.join(secrets.choice(CODE_ALPHABET) for _ in range(CODE_LENGTH))
+
+def reserve_referral_codes(count: int) -> List[str]:
+    # Reserves the drawn codes no referral code or other reservation holds, in one statement. Its
+    # own connection commits them whatever becomes of the request that needed them.
+    candidates = list({generate_referral_code() for _ in range(count)})
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO code_reservations (kind, code)
+            SELECT 'referral', c.code FROM unnest(%s::text[]) AS c(code)
+            WHERE NOT EXISTS (SELECT 1 FROM referral_codes r WHERE r.code = c.code)
+            ON CONFLICT (kind, code) DO NOTHING
+            RETURNING code
+        """, (candidates,))
+        codes = [row[0] for row in cursor.fetchall()]
+        conn.commit()
+        return codes
+    finally:
+        conn.close()
+
+def refill_code_pool() -> None:
+    try:
+        codes = reserve_referral_codes(CODE_BLOCK_SIZE)
+        with _code_pool_lock:
+            _code_pool.extend(codes)
+    finally:
+        with _code_pool_lock:
+            _code_refill['thread'] = None
+
+def allocate_referral_code() -> str:
+    with _code_pool_lock:
+        if _code_pool:
+            code = _code_pool.pop()
+            if len(_code_pool) < CODE_POOL_LOW_WATER and _code_refill['thread'] is None:
+                _code_refill['thread'] = threading.Thread(target=refill_code_pool, daemon=True)
+                _code_refill['thread'].start()
+            return code
+    codes: List[str] = []
+    while not codes:
+        codes = reserve_referral_codes(CODE_BLOCK_SIZE)
+    with _code_pool_lock:
+        _code_pool.extend(codes[1:])
+    return codes[0]
 
 def create_referral_code(conn, data: Dict) -> Dict:
     cursor = conn.cursor(cursor_factory=RealDictCursor)
     
     client_id = data['client_id']
+    code = allocate_referral_code()
     
+    # One round trip: the client's active code if it has one, otherwise the new one.
     cursor.execute("""
-        SELECT code FROM referral_codes WHERE client_id = %s AND is_active = true
-    """, (client_id,))
-    
-    existing = cursor.fetchone()
-    if existing:
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({
-                'success': True,
-                'code': existing['code'],
-                'message': 'Referral code already exists'
-            }),
-            'isBase64Encoded': False
-        }
-    
-    code = generate_referral_code()
-    discount = data.get('discount_percent', 0)
-    commission = data.get('commission_percent', 10)
-    
-    cursor.execute("""
-        INSERT INTO referral_codes (client_id, code, discount_percent, commission_percent)
-        VALUES (%s, %s, %s, %s)
-        RETURNING id, code
-    """, (client_id, code, discount, commission))
+        WITH existing AS (
+            SELECT id, code FROM referral_codes WHERE client_id = %(client_id)s AND is_active = true LIMIT 1
+        ), created AS (
+            INSERT INTO referral_codes (client_id, code, discount_percent, commission_percent)
+            SELECT %(client_id)s, %(code)s, %(discount)s, %(commission)s
+            WHERE NOT EXISTS (SELECT 1 FROM existing)
+            RETURNING id, code
+        )
+        SELECT id, code, true AS created FROM created
+        UNION ALL
+        SELECT id, code, false FROM existing
+    """, {'client_id': client_id, 'code': code, 'discount': data.get('discount_percent', 0),
+          'commission': data.get('commission_percent', 10)})
     
     result = cursor.fetchone()
     conn.commit()
     
-    return {
-        'statusCode': 201,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({
+    if not result['created']:
+        # Still reserved and unused: the next signup gets it.
+        with _code_pool_lock:
+            _code_pool.append(code)
+        return json_response(200, {
             'success': True,
-            'referral_id': result['id'],
-            'code': result['code']
-        }),
-        'isBase64Encoded': False
-    }
+            'code': result['code'],
+            'message': 'Referral code already exists'
+        })
+    
+    return json_response(201, {
+        'success': True,
+        'referral_id': result['id'],
+        'code': result['code']
+    })
 
 def get_referral_code(conn, client_id: str) -> Dict:
     cursor = conn.cursor(cursor_factory=RealDictCursor)
     
-    cursor.execute("""
-        SELECT * FROM referral_codes 
-        WHERE client_id = %s AND is_active = true
-    """, (client_id,))
+    execute_prepared(cursor, 'get_referral_code', (client_id,))
     
     code = cursor.fetchone()
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'referral_code': dict(code) if code else None}, default=str),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {'referral_code': dict(code) if code else None})
 
 def check_referral_code(conn, code: str) -> Dict:
     cursor = conn.cursor(cursor_factory=RealDictCursor)
     
-    cursor.execute("""
-        SELECT rc.*, c.full_name, c.email
-        FROM referral_codes rc
-        JOIN clients c ON rc.client_id = c.id
-        WHERE rc.code = %s AND rc.is_active = true
-    """, (code,))
+    execute_prepared(cursor, 'check_referral_code', (code,))
     
     referral = cursor.fetchone()
     
     if not referral:
-        return {
-            'statusCode': 404,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'valid': False, 'error': 'Invalid referral code'}),
-            'isBase64Encoded': False
-        }
+        return json_response(404, {'valid': False, 'error': 'Invalid referral code'})
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({
-            'valid': True,
-            'discount_percent': float(referral['discount_percent']),
-            'referrer_name': referral['full_name']
-        }, default=str),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {
+        'valid': True,
+        'discount_percent': float(referral['discount_percent']),
+        'referrer_name': referral['full_name']
+    })
 
 def use_referral_code(conn, data: Dict) -> Dict:
     cursor = conn.cursor()
     
     code = data['code']
     exchange_id = data['exchange_id']
-    commission_usd = data['commission_usd']
     
     cursor.execute("""
-        SELECT id, client_id FROM referral_codes WHERE code = %s AND is_active = true
+        SELECT id, client_id, commission_percent FROM referral_codes WHERE code = %s AND is_active = true
     """, (code,))
     
     referral = cursor.fetchone()
     if not referral:
-        return {
-            'statusCode': 404,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Invalid referral code'}),
-            'isBase64Encoded': False
-        }
+        return json_response(404, {'error': 'Invalid referral code'})
     
-    referral_id, referrer_id = referral
+    referral_id, referrer_id, commission_percent = referral
     
     cursor.execute("""
-        SELECT client_id FROM exchanges WHERE id = %s
+        SELECT client_id, commission_usd, referral_code_id FROM exchanges WHERE id = %s
     """, (exchange_id,))
-    referred_client = cursor.fetchone()
+    exchange = cursor.fetchone()
+    if not exchange:
+        return json_response(404, {'error': 'Exchange not found'})
     
+    referred_client_id, exchange_commission_usd, exchange_referral_id = exchange
+    if referred_client_id == referrer_id:
+        return json_response(400, {'error': 'A referral code cannot be used on its owner\'s exchange'})
+    # The referrer's share comes from the commission exchange-api recorded on the exchange (V0013),
+    # not from the caller.
+    if exchange_commission_usd is None:
+        return json_response(409, {'error': 'Exchange has no recorded commission'})
+    if exchange_referral_id is not None and exchange_referral_id != referral_id:
+        return json_response(409, {'error': 'Exchange was placed with another referral code'})
+    commission_usd = (exchange_commission_usd * (commission_percent or 0) / 100).quantize(Decimal('0.01'), ROUND_DOWN)
+    
+    # An exchange is referred once (V0023); a repeated or concurrent claim inserts nothing.
     cursor.execute("""
         INSERT INTO referral_usage (referral_code_id, referred_client_id, exchange_id, commission_usd)
         VALUES (%s, %s, %s, %s)
-    """, (referral_id, referred_client[0], exchange_id, commission_usd))
+        ON CONFLICT (exchange_id) DO NOTHING
+        RETURNING id
+    """, (referral_id, referred_client_id, exchange_id, commission_usd))
+    usage = cursor.fetchone()
+    if not usage:
+        return json_response(409, {'error': 'Exchange was already referred'})
+    usage_id = usage[0]
+    
+    cursor.execute("""
+        UPDATE exchanges SET referral_code_id = %s WHERE id = %s AND referral_code_id IS NULL
+    """, (referral_id, exchange_id))
+    
+    # Only the usage row is written: popular codes would make the referrer's totals and ledger
+    # account a hot spot, so referral_settlement credits them in batches (V0018), and only once
+    # the exchange has completed.
+    conn.commit()
+    
+    return json_response(200, {'success': True, 'commission_earned': float(commission_usd), 'referral_usage_id': usage_id})
+
+def run_referral_commission(conn, payload: Dict) -> Dict:
+    # Credits one use; only jobs queued before referral_settlement replaced them (V0018) run this.
+    cursor = conn.cursor()
     
     cursor.execute("""
         UPDATE referral_codes 
         SET total_referrals = total_referrals + 1,
             total_earnings_usd = total_earnings_usd + %s
         WHERE id = %s
-    """, (commission_usd, referral_id))
+    """, (payload['commission_usd'], payload['referral_code_id']))
+    credited = cursor.rowcount == 1
     
-    conn.commit()
+    # Jobs queued before the ledger (V0017) carry no referral_usage_id and are not posted.
+    if credited and payload.get('referral_usage_id') is not None:
+        commission_usd = Decimal(str(payload['commission_usd']))
+        post_ledger_entry(conn, 'referral_commission', f"referral_usage:{payload['referral_usage_id']}",
+                          payload.get('exchange_id'), [
+                              ('referral_expense:USD', 'USD', commission_usd),
+                              (f"referral:{payload['referral_code_id']}:USD", 'USD', -commission_usd)
+                          ])
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'success': True, 'commission_earned': float(commission_usd)}),
-        'isBase64Encoded': False
-    }
+    return {'referral_code_id': payload['referral_code_id'], 'credited': credited}
+
+def run_referral_settlement(conn, payload: Dict) -> Dict:
+    cursor = conn.cursor()
+    batch = int(payload.get('batch', REFERRAL_SETTLEMENT_BATCH))
+    
+    # Claims the oldest unsettled uses of completed exchanges and records one settlement per code
+    # for them; uses of exchanges still open wait, and those of exchanges that never complete are
+    # never credited.
+    cursor.execute("""
+        WITH claimed AS (
+            SELECT u.id, u.referral_code_id, u.commission_usd FROM referral_usage u
+            JOIN exchanges e ON e.id = u.exchange_id
+            WHERE u.settlement_id IS NULL AND u.referral_code_id IS NOT NULL AND e.status = 'completed'
+            ORDER BY u.id
+            LIMIT %s
+            FOR UPDATE OF u SKIP LOCKED
+        ), settled AS (
+            INSERT INTO referral_settlements (referral_code_id, usage_count, commission_usd)
+            SELECT referral_code_id, COUNT(*), COALESCE(SUM(commission_usd), 0)
+            FROM claimed
+            GROUP BY referral_code_id
+            ORDER BY referral_code_id
+            RETURNING id, referral_code_id, usage_count, commission_usd
+        ), marked AS (
+            UPDATE referral_usage u SET settlement_id = s.id
+            FROM claimed c
+            JOIN settled s ON s.referral_code_id = c.referral_code_id
+            WHERE u.id = c.id
+            RETURNING u.id
+        )
+        SELECT s.id, s.referral_code_id, s.usage_count, s.commission_usd, (SELECT COUNT(*) FROM marked)
+        FROM settled s
+        ORDER BY s.referral_code_id
+    """, (batch,))
+    settlements = cursor.fetchall()
+    if not settlements:
+        return {'settled_uses': 0, 'codes': 0}
+    settlement_ids = [row[0] for row in settlements]
+    
+    # One update per code, the rows locked in id order so concurrent runs cannot deadlock.
+    cursor.execute("SELECT id FROM referral_codes WHERE id = ANY(%s) ORDER BY id FOR UPDATE",
+                   ([row[1] for row in settlements],))
+    cursor.execute("""
+        UPDATE referral_codes rc
+        SET total_referrals = rc.total_referrals + s.usage_count,
+            total_earnings_usd = rc.total_earnings_usd + s.commission_usd
+        FROM referral_settlements s
+        WHERE s.id = ANY(%s) AND rc.id = s.referral_code_id
+    """, (settlement_ids,))
+    
+    # One compound ledger entry for the batch, keyed by its first settlement.
+    total = sum((row[3] for row in settlements), Decimal(0))
+    post_ledger_entry(conn, 'referral_commission', f'referral_settlement:{settlement_ids[0]}', None, [
+        ('referral_expense:USD', 'USD', total),
+        *((f'referral:{referral_code_id}:USD', 'USD', -commission_usd)
+          for _, referral_code_id, _, commission_usd, _ in settlements)
+    ])
+    
+    settled_uses = settlements[0][4]
+    # A full batch means more is probably waiting; the dedupe key alternates because this job's
+    # own row still counts as queued until it commits.
+    if settled_uses == batch:
+        round_number = int(payload.get('round', 0)) + 1
+        enqueue_job(conn, 'referral_settlement', {**payload, 'round': round_number},
+                    dedupe_key=f'referral_settlement:backlog:{round_number % 2}')
+    
+    return {'settled_uses': settled_uses, 'codes': len(settlements), 'commission_usd': total}
 
 def get_referral_stats(conn, client_id: str) -> Dict:
     cursor = conn.cursor(cursor_factory=RealDictCursor)
     
+    # The settled totals on the code plus the uses of completed exchanges referral_settlement has
+    # not reached yet.
     cursor.execute("""
         SELECT 
             rc.*,
-            COUNT(ru.id) as usage_count,
-            SUM(ru.commission_usd) as total_commission
+            rc.total_referrals + u.usage_count as usage_count,
+            rc.total_earnings_usd + u.commission as total_commission,
+            u.usage_count as unsettled_count
         FROM referral_codes rc
-        LEFT JOIN referral_usage ru ON rc.id = ru.referral_code_id
+        CROSS JOIN LATERAL (
+            SELECT COUNT(*) as usage_count, COALESCE(SUM(ru.commission_usd), 0) as commission
+            FROM referral_usage ru
+            JOIN exchanges e ON e.id = ru.exchange_id
+            WHERE ru.referral_code_id = rc.id AND ru.settlement_id IS NULL AND e.status = 'completed'
+        ) u
         WHERE rc.client_id = %s
-        GROUP BY rc.id
     """, (client_id,))
     
     stats = cursor.fetchone()
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'stats': dict(stats) if stats else None}, default=str),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {'stats': dict(stats) if stats else None})
 
 def create_limit_order(conn, data: Dict) -> Dict:
     cursor = conn.cursor(cursor_factory=RealDictCursor)
@@ -267,24 +1199,23 @@ def create_limit_order(conn, data: Dict) -> Dict:
     result = cursor.fetchone()
     conn.commit()
     
-    return {
-        'statusCode': 201,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({
-            'success': True,
-            'order_id': result['id'],
-            'message': 'Limit order created'
-        }),
-        'isBase64Encoded': False
-    }
+    return json_response(201, {
+        'success': True,
+        'order_id': result['id'],
+        'message': 'Limit order created'
+    })
 
 def list_limit_orders(conn, params: Dict) -> Dict:
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor = conn.cursor()
     
     client_id = params.get('client_id')
     status = params.get('status', 'active')
     
-    query = "SELECT * FROM limit_orders WHERE client_id = %s"
+    query = """
+        SELECT id, client_id, from_currency, to_currency, from_amount::text, target_rate::text, status,
+               expiry_date, filled_exchange_id, created_at, filled_at
+        FROM limit_orders WHERE client_id = %s
+    """
     query_params = [client_id]
     
     if status != 'all':
@@ -294,14 +1225,9 @@ def list_limit_orders(conn, params: Dict) -> Dict:
     query += " ORDER BY created_at DESC"
     
     cursor.execute(query, query_params)
-    orders = cursor.fetchall()
+    orders = fetch_rows(cursor)
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'orders': [dict(o) for o in orders]}, default=str),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {'orders': orders})
 
 def cancel_limit_order(conn, order_id: int) -> Dict:
     cursor = conn.cursor()
@@ -312,12 +1238,7 @@ def cancel_limit_order(conn, order_id: int) -> Dict:
     
     conn.commit()
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'success': True, 'message': 'Order cancelled'}),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {'success': True, 'message': 'Order cancelled'})
 
 def create_price_alert(conn, data: Dict) -> Dict:
     cursor = conn.cursor(cursor_factory=RealDictCursor)
@@ -336,53 +1257,42 @@ def create_price_alert(conn, data: Dict) -> Dict:
     result = cursor.fetchone()
     conn.commit()
     
-    return {
-        'statusCode': 201,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({
-            'success': True,
-            'alert_id': result['id'],
-            'message': 'Price alert created'
-        }),
-        'isBase64Encoded': False
-    }
+    return json_response(201, {
+        'success': True,
+        'alert_id': result['id'],
+        'message': 'Price alert created'
+    })
 
 def get_price_alerts(conn, client_id: str) -> Dict:
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor = conn.cursor()
     
     cursor.execute("""
-        SELECT * FROM price_alerts 
+        SELECT id, client_id, currency, target_price::text, condition, is_triggered, is_active, triggered_at,
+               created_at
+        FROM price_alerts
         WHERE client_id = %s AND is_active = true
         ORDER BY created_at DESC
     """, (client_id,))
     
-    alerts = cursor.fetchall()
+    alerts = fetch_rows(cursor)
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'alerts': [dict(a) for a in alerts]}, default=str),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {'alerts': alerts})
 
 def get_trading_analytics(conn, params: Dict) -> Dict:
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor = conn.cursor()
     
     currency_pair = params.get('currency_pair', 'BTC-USDT')
     days = int(params.get('days', 7))
     
     cursor.execute("""
-        SELECT * FROM trading_analytics 
+        SELECT id, date, currency_pair, volume_24h::text, high_24h::text, low_24h::text, avg_price::text,
+               trades_count, created_at
+        FROM trading_analytics
         WHERE currency_pair = %s 
         AND date >= CURRENT_DATE - INTERVAL '%s days'
         ORDER BY date DESC
     """, (currency_pair, days))
     
-    analytics = cursor.fetchall()
+    analytics = fetch_rows(cursor)
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'analytics': [dict(a) for a in analytics]}, default=str),
-        'isBase64Encoded': False
-    }
+    return json_response(200, {'analytics': analytics})
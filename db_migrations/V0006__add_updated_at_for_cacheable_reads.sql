@@ -0,0 +1,8 @@
+-- Track modification time on tables behind cacheable public reads (Last-Modified)
+ALTER TABLE t_p7012082_overnight_exchange_d.currencies ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP;
+ALTER TABLE t_p7012082_overnight_exchange_d.referral_codes ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP;
+
+-- MAX(updated_at) probes stay index-only as the tables grow
+CREATE INDEX IF NOT EXISTS idx_exchange_rates_updated_at ON t_p7012082_overnight_exchange_d.exchange_rates(updated_at DESC);
+CREATE INDEX IF NOT EXISTS idx_referral_codes_updated_at ON t_p7012082_overnight_exchange_d.referral_codes(updated_at DESC);
+CREATE INDEX IF NOT EXISTS idx_site_content_updated_at ON t_p7012082_overnight_exchange_d.site_content(updated_at DESC);
@@ -0,0 +1,9 @@
+-- Per-client history reads (list_exchanges by client_id / client email, get_aml_status) take the
+-- newest N rows; a (client_id, created_at) index serves them without sorting the client's full history
+CREATE INDEX IF NOT EXISTS idx_exchanges_client_id_created_at ON t_p7012082_overnight_exchange_d.exchanges(client_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_aml_checks_client_id_created_at ON t_p7012082_overnight_exchange_d.aml_checks(client_id, created_at);
+
+-- The single-column client_id indexes are prefixes of the new ones and only let the planner pick
+-- bitmap scans plus a sort when it underestimates a busy client
+DROP INDEX IF EXISTS t_p7012082_overnight_exchange_d.idx_exchanges_client_id;
+DROP INDEX IF EXISTS t_p7012082_overnight_exchange_d.idx_aml_checks_client_id;
@@ -0,0 +1,87 @@
+-- Journal of per-exchange events pushed to stream subscribers (server/stream.py).
+-- NOTIFY is fire-and-forget, so every event is also stored here: its id is the SSE event id
+-- and a reconnecting client resumes with Last-Event-ID by reading id > last seen.
+CREATE TABLE IF NOT EXISTS t_p7012082_overnight_exchange_d.exchange_events (
+    id BIGSERIAL PRIMARY KEY,
+    exchange_id INTEGER NOT NULL REFERENCES t_p7012082_overnight_exchange_d.exchanges(id) ON DELETE CASCADE,
+    kind VARCHAR(30) NOT NULL CHECK (kind IN ('status', 'confirmation', 'log')),
+    data JSONB NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_exchange_events_exchange_id_id ON t_p7012082_overnight_exchange_d.exchange_events(exchange_id, id);
+CREATE INDEX IF NOT EXISTS idx_exchange_events_created_at ON t_p7012082_overnight_exchange_d.exchange_events(created_at);
+
+-- Store the event and announce it on channel exchange_events; the payload stays far below
+-- the 8000-byte NOTIFY limit because free-text fields are truncated.
+CREATE OR REPLACE FUNCTION t_p7012082_overnight_exchange_d.publish_exchange_event(p_exchange_id INTEGER, p_kind VARCHAR, p_data JSONB)
+RETURNS VOID AS $$
+DECLARE
+    v_id BIGINT;
+BEGIN
+    IF p_exchange_id IS NULL THEN
+        RETURN;
+    END IF;
+    INSERT INTO t_p7012082_overnight_exchange_d.exchange_events (exchange_id, kind, data)
+    VALUES (p_exchange_id, p_kind, p_data)
+    RETURNING id INTO v_id;
+    PERFORM pg_notify('exchange_events', json_build_object(
+        'id', v_id, 'exchange_id', p_exchange_id, 'kind', p_kind, 'data', p_data
+    )::text);
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION t_p7012082_overnight_exchange_d.notify_exchange_status()
+RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM t_p7012082_overnight_exchange_d.publish_exchange_event(NEW.id, 'status', jsonb_build_object(
+        'status_from', OLD.status, 'status_to', NEW.status, 'completed_at', NEW.completed_at
+    ));
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION t_p7012082_overnight_exchange_d.notify_blockchain_confirmation()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' AND OLD.confirmations IS NOT DISTINCT FROM NEW.confirmations
+            AND OLD.status IS NOT DISTINCT FROM NEW.status THEN
+        RETURN NULL;
+    END IF;
+    PERFORM t_p7012082_overnight_exchange_d.publish_exchange_event(NEW.exchange_id, 'confirmation', jsonb_build_object(
+        'tx_hash', NEW.tx_hash, 'blockchain', NEW.blockchain, 'confirmations', NEW.confirmations,
+        'status', NEW.status, 'confirmed_at', NEW.confirmed_at
+    ));
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION t_p7012082_overnight_exchange_d.notify_transaction_log()
+RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM t_p7012082_overnight_exchange_d.publish_exchange_event(NEW.exchange_id, 'log', jsonb_build_object(
+        'action', NEW.action, 'status_from', NEW.status_from, 'status_to', NEW.status_to,
+        'notes', left(NEW.notes, 1000)
+    ));
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Bulk loads running with session_replication_role = replica (tools/bench/datagen.py) skip these.
+DROP TRIGGER IF EXISTS trg_exchanges_status_event ON t_p7012082_overnight_exchange_d.exchanges;
+CREATE TRIGGER trg_exchanges_status_event
+    AFTER UPDATE OF status ON t_p7012082_overnight_exchange_d.exchanges
+    FOR EACH ROW WHEN (OLD.status IS DISTINCT FROM NEW.status)
+    EXECUTE FUNCTION t_p7012082_overnight_exchange_d.notify_exchange_status();
+
+DROP TRIGGER IF EXISTS trg_blockchain_transactions_event ON t_p7012082_overnight_exchange_d.blockchain_transactions;
+CREATE TRIGGER trg_blockchain_transactions_event
+    AFTER INSERT OR UPDATE OF confirmations, status ON t_p7012082_overnight_exchange_d.blockchain_transactions
+    FOR EACH ROW
+    EXECUTE FUNCTION t_p7012082_overnight_exchange_d.notify_blockchain_confirmation();
+
+DROP TRIGGER IF EXISTS trg_transaction_logs_event ON t_p7012082_overnight_exchange_d.transaction_logs;
+CREATE TRIGGER trg_transaction_logs_event
+    AFTER INSERT ON t_p7012082_overnight_exchange_d.transaction_logs
+    FOR EACH ROW
+    EXECUTE FUNCTION t_p7012082_overnight_exchange_d.notify_transaction_log();
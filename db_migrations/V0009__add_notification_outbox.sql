@@ -0,0 +1,35 @@
+-- Delivery state for the notifications outbox (server/outbox.py). Handlers keep inserting into
+-- notifications inside their own transaction; the dispatcher claims pending rows, delivers them
+-- and records the result.
+ALTER TABLE t_p7012082_overnight_exchange_d.notifications ADD COLUMN IF NOT EXISTS delivery_status VARCHAR(20) DEFAULT 'pending';
+ALTER TABLE t_p7012082_overnight_exchange_d.notifications ADD COLUMN IF NOT EXISTS attempts INTEGER DEFAULT 0;
+ALTER TABLE t_p7012082_overnight_exchange_d.notifications ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP;
+ALTER TABLE t_p7012082_overnight_exchange_d.notifications ADD COLUMN IF NOT EXISTS delivered_channels VARCHAR(20)[] DEFAULT '{}';
+ALTER TABLE t_p7012082_overnight_exchange_d.notifications ADD COLUMN IF NOT EXISTS sent_at TIMESTAMP;
+ALTER TABLE t_p7012082_overnight_exchange_d.notifications ADD COLUMN IF NOT EXISTS last_error TEXT;
+
+-- Notifications written before the outbox existed are not delivered retroactively.
+UPDATE t_p7012082_overnight_exchange_d.notifications SET delivery_status = 'skipped' WHERE delivery_status = 'pending' AND attempts = 0 AND sent_at IS NULL;
+
+ALTER TABLE t_p7012082_overnight_exchange_d.notifications DROP CONSTRAINT IF EXISTS notifications_delivery_status_check;
+ALTER TABLE t_p7012082_overnight_exchange_d.notifications ADD CONSTRAINT notifications_delivery_status_check
+    CHECK (delivery_status IN ('pending', 'sent', 'failed', 'skipped'));
+
+-- The claim query only ever reads due pending rows; the partial index stays as small as the backlog.
+CREATE INDEX IF NOT EXISTS idx_notifications_outbox ON t_p7012082_overnight_exchange_d.notifications(next_attempt_at, id) WHERE delivery_status = 'pending';
+
+-- Wake idle dispatchers. Statement-level and payload-free, so a transaction inserting many rows
+-- sends a single notification and the insert path never waits on delivery.
+CREATE OR REPLACE FUNCTION t_p7012082_overnight_exchange_d.notify_notifications_outbox()
+RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_notify('notifications_outbox', '');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_notifications_outbox ON t_p7012082_overnight_exchange_d.notifications;
+CREATE TRIGGER trg_notifications_outbox
+    AFTER INSERT ON t_p7012082_overnight_exchange_d.notifications
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION t_p7012082_overnight_exchange_d.notify_notifications_outbox();
@@ -0,0 +1,41 @@
+-- Durable background job queue (server/worker.py). Handlers insert jobs in their own transaction
+-- and return; workers claim due rows with FOR UPDATE SKIP LOCKED, highest priority first.
+CREATE TABLE IF NOT EXISTS t_p7012082_overnight_exchange_d.jobs (
+    id BIGSERIAL PRIMARY KEY,
+    kind VARCHAR(50) NOT NULL,
+    payload JSONB NOT NULL DEFAULT '{}',
+    priority SMALLINT NOT NULL DEFAULT 0,
+    run_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    status VARCHAR(20) NOT NULL DEFAULT 'queued' CHECK (status IN ('queued', 'done', 'failed')),
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 5,
+    dedupe_key VARCHAR(100),
+    result JSONB,
+    last_error TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    finished_at TIMESTAMP
+);
+
+-- Claim order; the partial index only holds the backlog, not the finished history.
+CREATE INDEX IF NOT EXISTS idx_jobs_claim ON t_p7012082_overnight_exchange_d.jobs(priority DESC, run_at, id) WHERE status = 'queued';
+-- At most one queued job per dedupe key (e.g. one pending withdrawal per exchange).
+CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_dedupe_key ON t_p7012082_overnight_exchange_d.jobs(dedupe_key) WHERE status = 'queued';
+CREATE INDEX IF NOT EXISTS idx_jobs_finished_at ON t_p7012082_overnight_exchange_d.jobs(finished_at) WHERE status = 'done';
+
+-- Every job row is updated once and deleted later; vacuum the queue far more often than the default 20%.
+ALTER TABLE t_p7012082_overnight_exchange_d.jobs SET (autovacuum_vacuum_scale_factor = 0.01, autovacuum_analyze_scale_factor = 0.02);
+
+-- Wake idle workers; statement-level, so a batch insert sends one notification.
+CREATE OR REPLACE FUNCTION t_p7012082_overnight_exchange_d.notify_jobs()
+RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_notify('jobs', '');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_jobs_notify ON t_p7012082_overnight_exchange_d.jobs;
+CREATE TRIGGER trg_jobs_notify
+    AFTER INSERT ON t_p7012082_overnight_exchange_d.jobs
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION t_p7012082_overnight_exchange_d.notify_jobs();
@@ -0,0 +1,136 @@
+-- Rate history. exchange_rates keeps only the latest rate per (pair, source); every write to it
+-- is also appended to rate_ticks, and a rollup job (exchange-api rate_rollup, run by
+-- server/worker.py) folds the ticks into 1m/1h/1d OHLC candles that get_candles serves.
+CREATE TABLE IF NOT EXISTS t_p7012082_overnight_exchange_d.rate_series (
+    id SERIAL PRIMARY KEY,
+    from_currency VARCHAR(20) NOT NULL,
+    to_currency VARCHAR(20) NOT NULL,
+    UNIQUE(from_currency, to_currency)
+);
+
+-- Append-only and narrow (no id, float rates): one daily partition per day, so retention drops
+-- whole partitions instead of deleting rows. The default partition catches ticks dated outside
+-- the created days (backfills, or a worker that has not run for a while).
+CREATE TABLE IF NOT EXISTS t_p7012082_overnight_exchange_d.rate_ticks (
+    ts TIMESTAMP NOT NULL,
+    rate DOUBLE PRECISION NOT NULL,
+    series_id INTEGER NOT NULL
+) PARTITION BY RANGE (ts);
+
+CREATE TABLE IF NOT EXISTS t_p7012082_overnight_exchange_d.rate_ticks_default
+    PARTITION OF t_p7012082_overnight_exchange_d.rate_ticks DEFAULT;
+
+CREATE INDEX IF NOT EXISTS idx_rate_ticks_ts ON t_p7012082_overnight_exchange_d.rate_ticks(ts);
+
+-- One row per (series, resolution in seconds, bucket start). The rollup rewrites the open
+-- buckets every run; fillfactor leaves room for those updates to stay HOT.
+CREATE TABLE IF NOT EXISTS t_p7012082_overnight_exchange_d.rate_candles (
+    series_id INTEGER NOT NULL REFERENCES t_p7012082_overnight_exchange_d.rate_series(id),
+    resolution INTEGER NOT NULL CHECK (resolution IN (60, 3600, 86400)),
+    bucket TIMESTAMP NOT NULL,
+    open DOUBLE PRECISION NOT NULL,
+    high DOUBLE PRECISION NOT NULL,
+    low DOUBLE PRECISION NOT NULL,
+    close DOUBLE PRECISION NOT NULL,
+    ticks INTEGER NOT NULL,
+    PRIMARY KEY (series_id, resolution, bucket)
+) WITH (fillfactor = 90);
+
+-- Rollup and retention work on a time range across all series.
+CREATE INDEX IF NOT EXISTS idx_rate_candles_resolution_bucket ON t_p7012082_overnight_exchange_d.rate_candles(resolution, bucket);
+
+-- Ticks before rolled_through are in rate_candles; get_candles aggregates the newer ones itself.
+CREATE TABLE IF NOT EXISTS t_p7012082_overnight_exchange_d.rate_rollup_state (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    rolled_through TIMESTAMP NOT NULL
+);
+
+CREATE OR REPLACE FUNCTION t_p7012082_overnight_exchange_d.record_rate_tick()
+RETURNS TRIGGER AS $$
+DECLARE
+    v_series_id INTEGER;
+BEGIN
+    SELECT id INTO v_series_id FROM t_p7012082_overnight_exchange_d.rate_series
+    WHERE from_currency = NEW.from_currency AND to_currency = NEW.to_currency;
+    IF v_series_id IS NULL THEN
+        INSERT INTO t_p7012082_overnight_exchange_d.rate_series (from_currency, to_currency)
+        VALUES (NEW.from_currency, NEW.to_currency)
+        ON CONFLICT (from_currency, to_currency) DO NOTHING
+        RETURNING id INTO v_series_id;
+        IF v_series_id IS NULL THEN
+            SELECT id INTO v_series_id FROM t_p7012082_overnight_exchange_d.rate_series
+            WHERE from_currency = NEW.from_currency AND to_currency = NEW.to_currency;
+        END IF;
+    END IF;
+    INSERT INTO t_p7012082_overnight_exchange_d.rate_ticks (ts, rate, series_id)
+    VALUES (COALESCE(NEW.updated_at, LOCALTIMESTAMP), NEW.rate, v_series_id);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_exchange_rates_tick ON t_p7012082_overnight_exchange_d.exchange_rates;
+CREATE TRIGGER trg_exchange_rates_tick
+    AFTER INSERT OR UPDATE OF rate, updated_at ON t_p7012082_overnight_exchange_d.exchange_rates
+    FOR EACH ROW
+    EXECUTE FUNCTION t_p7012082_overnight_exchange_d.record_rate_tick();
+
+-- Create the daily partitions from today through p_days_ahead. Ticks of that day already in the
+-- default partition move into the new one first, or ATTACH would reject the range.
+CREATE OR REPLACE FUNCTION t_p7012082_overnight_exchange_d.ensure_rate_tick_partitions(p_days_ahead INTEGER)
+RETURNS INTEGER AS $$
+DECLARE
+    v_day DATE;
+    v_name TEXT;
+    v_created INTEGER := 0;
+BEGIN
+    FOR v_day IN SELECT day::date FROM generate_series(LOCALTIMESTAMP::date, LOCALTIMESTAMP::date + p_days_ahead, INTERVAL '1 day') AS day LOOP
+        v_name := 'rate_ticks_' || to_char(v_day, 'YYYYMMDD');
+        CONTINUE WHEN to_regclass('t_p7012082_overnight_exchange_d.' || v_name) IS NOT NULL;
+        EXECUTE format('CREATE TABLE t_p7012082_overnight_exchange_d.%I (LIKE t_p7012082_overnight_exchange_d.rate_ticks)', v_name);
+        EXECUTE format(
+            'WITH moved AS (DELETE FROM t_p7012082_overnight_exchange_d.rate_ticks_default WHERE ts >= %L AND ts < %L RETURNING ts, rate, series_id) '
+            'INSERT INTO t_p7012082_overnight_exchange_d.%I (ts, rate, series_id) SELECT ts, rate, series_id FROM moved',
+            v_day, v_day + 1, v_name);
+        EXECUTE format('ALTER TABLE t_p7012082_overnight_exchange_d.rate_ticks ATTACH PARTITION t_p7012082_overnight_exchange_d.%I FOR VALUES FROM (%L) TO (%L)',
+            v_name, v_day, v_day + 1);
+        v_created := v_created + 1;
+    END LOOP;
+    RETURN v_created;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Drop the daily partitions that end on or before p_before.
+CREATE OR REPLACE FUNCTION t_p7012082_overnight_exchange_d.drop_rate_tick_partitions(p_before DATE)
+RETURNS INTEGER AS $$
+DECLARE
+    v_name TEXT;
+    v_dropped INTEGER := 0;
+BEGIN
+    FOR v_name IN
+        SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 't_p7012082_overnight_exchange_d.rate_ticks'::regclass
+          AND c.relname ~ '^rate_ticks_[0-9]{8}$'
+          AND to_date(substr(c.relname, 12), 'YYYYMMDD') < p_before
+    LOOP
+        EXECUTE format('DROP TABLE t_p7012082_overnight_exchange_d.%I', v_name);
+        v_dropped := v_dropped + 1;
+    END LOOP;
+    RETURN v_dropped;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT t_p7012082_overnight_exchange_d.ensure_rate_tick_partitions(7);
+
+-- Start the history from the rates stored today.
+INSERT INTO t_p7012082_overnight_exchange_d.rate_series (from_currency, to_currency)
+SELECT DISTINCT from_currency, to_currency FROM t_p7012082_overnight_exchange_d.exchange_rates
+ON CONFLICT (from_currency, to_currency) DO NOTHING;
+
+INSERT INTO t_p7012082_overnight_exchange_d.rate_ticks (ts, rate, series_id)
+SELECT COALESCE(r.updated_at, LOCALTIMESTAMP), r.rate, s.id
+FROM t_p7012082_overnight_exchange_d.exchange_rates r
+JOIN t_p7012082_overnight_exchange_d.rate_series s ON s.from_currency = r.from_currency AND s.to_currency = r.to_currency;
+
+INSERT INTO t_p7012082_overnight_exchange_d.rate_rollup_state (rolled_through)
+SELECT COALESCE(MIN(ts), LOCALTIMESTAMP) FROM t_p7012082_overnight_exchange_d.rate_ticks
+ON CONFLICT (id) DO NOTHING;
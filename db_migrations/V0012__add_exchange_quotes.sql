@@ -0,0 +1,3 @@
+-- Quote an exchange was created from (exchange-api get_quote); unique, so a quote is used once.
+ALTER TABLE t_p7012082_overnight_exchange_d.exchanges ADD COLUMN IF NOT EXISTS quote_ref VARCHAR(32);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_exchanges_quote_ref ON t_p7012082_overnight_exchange_d.exchanges(quote_ref) WHERE quote_ref IS NOT NULL;
@@ -0,0 +1,29 @@
+-- Fee engine (exchange-api). commission_settings rows may use '*' for either currency as a
+-- fallback; exchanges record the commission charged and the referral code that discounted it,
+-- so referral payouts are computed from what the client actually paid.
+ALTER TABLE t_p7012082_overnight_exchange_d.exchanges ADD COLUMN IF NOT EXISTS commission DECIMAL(20, 8);
+ALTER TABLE t_p7012082_overnight_exchange_d.exchanges ADD COLUMN IF NOT EXISTS commission_usd DECIMAL(20, 8);
+
+-- Bumped in the writer's transaction by every change to commission_settings. Instances compare it
+-- with the version their compiled fee table was built from and rebuild only when it moved.
+CREATE TABLE IF NOT EXISTS t_p7012082_overnight_exchange_d.fee_settings_version (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    version BIGINT NOT NULL DEFAULT 1
+);
+
+INSERT INTO t_p7012082_overnight_exchange_d.fee_settings_version (version) VALUES (1)
+ON CONFLICT (id) DO NOTHING;
+
+CREATE OR REPLACE FUNCTION t_p7012082_overnight_exchange_d.bump_fee_settings_version()
+RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE t_p7012082_overnight_exchange_d.fee_settings_version SET version = version + 1;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_commission_settings_version ON t_p7012082_overnight_exchange_d.commission_settings;
+CREATE TRIGGER trg_commission_settings_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON t_p7012082_overnight_exchange_d.commission_settings
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION t_p7012082_overnight_exchange_d.bump_fee_settings_version();
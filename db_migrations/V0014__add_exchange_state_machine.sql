@@ -0,0 +1,16 @@
+-- Exchange status machine: the only status changes the handlers make (transition_exchanges in
+-- exchange-api, blockchain-api and admin-api) are the pairs listed here. completed, failed and
+-- cancelled are final.
+CREATE TABLE IF NOT EXISTS t_p7012082_overnight_exchange_d.exchange_transitions (
+    from_status VARCHAR(20) NOT NULL,
+    to_status VARCHAR(20) NOT NULL,
+    PRIMARY KEY (from_status, to_status)
+);
+
+INSERT INTO t_p7012082_overnight_exchange_d.exchange_transitions (from_status, to_status) VALUES
+    ('pending', 'processing'),
+    ('pending', 'cancelled'),
+    ('pending', 'failed'),
+    ('processing', 'completed'),
+    ('processing', 'failed')
+ON CONFLICT (from_status, to_status) DO NOTHING;
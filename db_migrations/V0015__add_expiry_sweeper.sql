@@ -0,0 +1,23 @@
+-- Expiry (exchange-api expiry_sweep job). Pending exchanges without a deposit in time become
+-- expired, a move the status machine allows only from pending.
+ALTER TABLE t_p7012082_overnight_exchange_d.exchanges DROP CONSTRAINT IF EXISTS exchanges_status_check;
+ALTER TABLE t_p7012082_overnight_exchange_d.exchanges ADD CONSTRAINT exchanges_status_check
+    CHECK (status IN ('pending', 'processing', 'completed', 'failed', 'cancelled', 'expired'));
+
+INSERT INTO t_p7012082_overnight_exchange_d.exchange_transitions (from_status, to_status) VALUES ('pending', 'expired')
+ON CONFLICT (from_status, to_status) DO NOTHING;
+
+-- The sweeper walks each backlog oldest first through these; they hold only the rows still
+-- waiting, so they stay as small as the backlog however large the tables grow.
+CREATE INDEX IF NOT EXISTS idx_exchanges_pending_created_at
+    ON t_p7012082_overnight_exchange_d.exchanges(created_at) WHERE status = 'pending';
+CREATE INDEX IF NOT EXISTS idx_payment_provider_transactions_pending_created_at
+    ON t_p7012082_overnight_exchange_d.payment_provider_transactions(created_at) WHERE status = 'pending';
+CREATE INDEX IF NOT EXISTS idx_limit_orders_active_expiry_date
+    ON t_p7012082_overnight_exchange_d.limit_orders(expiry_date) WHERE status = 'active';
+
+-- The sweeper tells clients about what it expired.
+ALTER TABLE t_p7012082_overnight_exchange_d.notifications DROP CONSTRAINT IF EXISTS notifications_type_check;
+ALTER TABLE t_p7012082_overnight_exchange_d.notifications ADD CONSTRAINT notifications_type_check
+    CHECK (type IN ('exchange_created', 'exchange_completed', 'exchange_failed', 'exchange_expired', 'limit_order_expired',
+                    'kyc_approved', 'kyc_rejected', 'aml_alert'));
@@ -0,0 +1,223 @@
+-- Double-entry ledger. Every movement of funds is an entry whose lines sum to zero per currency
+-- (debits positive, credits negative). Lines are never changed; each account row caches its
+-- balance and line count, updated in the same transaction as the lines it adds, so a balance
+-- read is one row. admin-api's ledger_checkpoint job re-derives the cached balances from the
+-- lines. The ledger starts empty: it records the flows from this migration on.
+--
+-- Accounts are named kind:...:currency and created on first use:
+--   hot_wallet:C        on-chain funds held (deposits in, withdrawals out)
+--   provider:P:C        funds collected by payment provider P
+--   client_funds:C      owed to clients: deposits not yet exchanged, payouts not yet sent
+--   fee_revenue:C       commission earned
+--   treasury:C          the exchange's own position, which gives and takes each side of a trade
+--   referral:R:USD      commission owed to the holder of referral code R
+--   referral_expense:USD
+CREATE TABLE IF NOT EXISTS t_p7012082_overnight_exchange_d.ledger_accounts (
+    id SERIAL PRIMARY KEY,
+    code VARCHAR(100) UNIQUE NOT NULL,
+    kind VARCHAR(30) NOT NULL,
+    currency VARCHAR(20) NOT NULL,
+    balance DECIMAL(30, 8) NOT NULL DEFAULT 0,
+    line_count BIGINT NOT NULL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_ledger_accounts_kind ON t_p7012082_overnight_exchange_d.ledger_accounts(kind, currency);
+
+-- (kind, reference) names the event an entry records, so posting it twice is a no-op.
+CREATE TABLE IF NOT EXISTS t_p7012082_overnight_exchange_d.ledger_entries (
+    id BIGSERIAL PRIMARY KEY,
+    kind VARCHAR(30) NOT NULL CHECK (kind IN ('deposit', 'withdrawal', 'payment', 'settlement', 'referral_commission')),
+    reference VARCHAR(100) NOT NULL,
+    exchange_id INTEGER REFERENCES t_p7012082_overnight_exchange_d.exchanges(id),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE (kind, reference)
+);
+
+CREATE INDEX IF NOT EXISTS idx_ledger_entries_exchange_id
+    ON t_p7012082_overnight_exchange_d.ledger_entries(exchange_id) WHERE exchange_id IS NOT NULL;
+
+-- account_seq numbers an account's lines 1..line_count; balance_after is its balance once the
+-- line is applied.
+CREATE TABLE IF NOT EXISTS t_p7012082_overnight_exchange_d.ledger_lines (
+    id BIGSERIAL PRIMARY KEY,
+    entry_id BIGINT NOT NULL REFERENCES t_p7012082_overnight_exchange_d.ledger_entries(id),
+    account_id INTEGER NOT NULL REFERENCES t_p7012082_overnight_exchange_d.ledger_accounts(id),
+    account_seq BIGINT NOT NULL,
+    amount DECIMAL(30, 8) NOT NULL CHECK (amount <> 0),
+    balance_after DECIMAL(30, 8) NOT NULL,
+    UNIQUE (account_id, account_seq)
+);
+
+CREATE INDEX IF NOT EXISTS idx_ledger_lines_entry_id ON t_p7012082_overnight_exchange_d.ledger_lines(entry_id);
+
+CREATE OR REPLACE FUNCTION t_p7012082_overnight_exchange_d.reject_ledger_change()
+RETURNS TRIGGER AS $$
+BEGIN
+    RAISE EXCEPTION '% is append-only', TG_TABLE_NAME;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_ledger_entries_append_only ON t_p7012082_overnight_exchange_d.ledger_entries;
+CREATE TRIGGER trg_ledger_entries_append_only
+    BEFORE UPDATE OR DELETE ON t_p7012082_overnight_exchange_d.ledger_entries
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION t_p7012082_overnight_exchange_d.reject_ledger_change();
+
+DROP TRIGGER IF EXISTS trg_ledger_lines_append_only ON t_p7012082_overnight_exchange_d.ledger_lines;
+CREATE TRIGGER trg_ledger_lines_append_only
+    BEFORE UPDATE OR DELETE ON t_p7012082_overnight_exchange_d.ledger_lines
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION t_p7012082_overnight_exchange_d.reject_ledger_change();
+
+-- Posts an entry from p_lines, a JSON array of {"account", "currency", "amount"}, in the caller's
+-- transaction. Returns the entry id, or NULL when (p_kind, p_reference) is already posted. The
+-- accounts are locked in id order until the caller commits, which serialises postings per account.
+CREATE OR REPLACE FUNCTION t_p7012082_overnight_exchange_d.post_ledger_entry(
+    p_kind VARCHAR, p_reference VARCHAR, p_exchange_id INTEGER, p_lines JSONB
+) RETURNS BIGINT AS $$
+DECLARE
+    v_entry_id BIGINT;
+    v_currency VARCHAR;
+BEGIN
+    SELECT currency INTO v_currency
+    FROM jsonb_to_recordset(p_lines) AS l(account VARCHAR, currency VARCHAR, amount NUMERIC)
+    GROUP BY currency HAVING SUM(amount) <> 0
+    LIMIT 1;
+    IF FOUND THEN
+        RAISE EXCEPTION 'ledger entry % % does not balance in %', p_kind, p_reference, v_currency;
+    END IF;
+
+    INSERT INTO t_p7012082_overnight_exchange_d.ledger_entries (kind, reference, exchange_id)
+    VALUES (p_kind, p_reference, p_exchange_id)
+    ON CONFLICT (kind, reference) DO NOTHING
+    RETURNING id INTO v_entry_id;
+    IF v_entry_id IS NULL THEN
+        RETURN NULL;
+    END IF;
+
+    INSERT INTO t_p7012082_overnight_exchange_d.ledger_accounts (code, kind, currency)
+    SELECT account, split_part(account, ':', 1), MIN(currency)
+    FROM jsonb_to_recordset(p_lines) AS l(account VARCHAR, currency VARCHAR, amount NUMERIC)
+    GROUP BY account HAVING SUM(amount) <> 0
+    ON CONFLICT (code) DO NOTHING;
+
+    PERFORM 1 FROM t_p7012082_overnight_exchange_d.ledger_accounts
+    WHERE code IN (SELECT account FROM jsonb_to_recordset(p_lines) AS l(account VARCHAR))
+    ORDER BY id
+    FOR UPDATE;
+
+    WITH posting AS (
+        SELECT account, SUM(amount) AS amount
+        FROM jsonb_to_recordset(p_lines) AS l(account VARCHAR, currency VARCHAR, amount NUMERIC)
+        GROUP BY account HAVING SUM(amount) <> 0
+    ), moved AS (
+        UPDATE t_p7012082_overnight_exchange_d.ledger_accounts a
+        SET balance = a.balance + p.amount, line_count = a.line_count + 1, updated_at = CURRENT_TIMESTAMP
+        FROM posting p
+        WHERE a.code = p.account
+        RETURNING a.id, a.line_count, p.amount, a.balance
+    )
+    INSERT INTO t_p7012082_overnight_exchange_d.ledger_lines (entry_id, account_id, account_seq, amount, balance_after)
+    SELECT v_entry_id, id, line_count, amount, balance FROM moved;
+
+    RETURN v_entry_id;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Postings driven by the rows that record the money moving, whichever handler changes them.
+-- A confirmed blockchain transaction is the exchange's payout when it carries its
+-- withdrawal_tx_hash and a deposit otherwise (the same rule verify_transaction applies).
+CREATE OR REPLACE FUNCTION t_p7012082_overnight_exchange_d.post_blockchain_transaction()
+RETURNS TRIGGER AS $$
+DECLARE
+    v_withdrawal BOOLEAN;
+BEGIN
+    SELECT withdrawal_tx_hash IS NOT DISTINCT FROM NEW.tx_hash INTO v_withdrawal
+    FROM t_p7012082_overnight_exchange_d.exchanges WHERE id = NEW.exchange_id;
+    IF v_withdrawal THEN
+        PERFORM t_p7012082_overnight_exchange_d.post_ledger_entry('withdrawal', NEW.tx_hash, NEW.exchange_id, jsonb_build_array(
+            jsonb_build_object('account', 'client_funds:' || NEW.currency, 'currency', NEW.currency, 'amount', NEW.amount),
+            jsonb_build_object('account', 'hot_wallet:' || NEW.currency, 'currency', NEW.currency, 'amount', -NEW.amount)));
+    ELSE
+        PERFORM t_p7012082_overnight_exchange_d.post_ledger_entry('deposit', NEW.tx_hash, NEW.exchange_id, jsonb_build_array(
+            jsonb_build_object('account', 'hot_wallet:' || NEW.currency, 'currency', NEW.currency, 'amount', NEW.amount),
+            jsonb_build_object('account', 'client_funds:' || NEW.currency, 'currency', NEW.currency, 'amount', -NEW.amount)));
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION t_p7012082_overnight_exchange_d.post_provider_payment()
+RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM t_p7012082_overnight_exchange_d.post_ledger_entry('payment', NEW.id::TEXT, NEW.exchange_id, jsonb_build_array(
+        jsonb_build_object('account', 'provider:' || NEW.provider_id || ':' || NEW.currency, 'currency', NEW.currency, 'amount', NEW.amount),
+        jsonb_build_object('account', 'client_funds:' || NEW.currency, 'currency', NEW.currency, 'amount', -NEW.amount)));
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- A completed exchange converts the client's deposit into what they are owed: the commission
+-- (charged in from_currency, V0013) goes to fee revenue and the rest to the treasury, which pays
+-- out to_amount.
+CREATE OR REPLACE FUNCTION t_p7012082_overnight_exchange_d.post_exchange_settlement()
+RETURNS TRIGGER AS $$
+DECLARE
+    v_commission NUMERIC := COALESCE(NEW.commission, 0);
+BEGIN
+    PERFORM t_p7012082_overnight_exchange_d.post_ledger_entry('settlement', NEW.id::TEXT, NEW.id, jsonb_build_array(
+        jsonb_build_object('account', 'client_funds:' || NEW.from_currency, 'currency', NEW.from_currency, 'amount', NEW.from_amount),
+        jsonb_build_object('account', 'fee_revenue:' || NEW.from_currency, 'currency', NEW.from_currency, 'amount', -v_commission),
+        jsonb_build_object('account', 'treasury:' || NEW.from_currency, 'currency', NEW.from_currency, 'amount', v_commission - NEW.from_amount),
+        jsonb_build_object('account', 'treasury:' || NEW.to_currency, 'currency', NEW.to_currency, 'amount', NEW.to_amount),
+        jsonb_build_object('account', 'client_funds:' || NEW.to_currency, 'currency', NEW.to_currency, 'amount', -NEW.to_amount)));
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_blockchain_transactions_ledger_insert ON t_p7012082_overnight_exchange_d.blockchain_transactions;
+CREATE TRIGGER trg_blockchain_transactions_ledger_insert
+    AFTER INSERT ON t_p7012082_overnight_exchange_d.blockchain_transactions
+    FOR EACH ROW WHEN (NEW.status = 'confirmed' AND NEW.exchange_id IS NOT NULL)
+    EXECUTE FUNCTION t_p7012082_overnight_exchange_d.post_blockchain_transaction();
+
+DROP TRIGGER IF EXISTS trg_blockchain_transactions_ledger_update ON t_p7012082_overnight_exchange_d.blockchain_transactions;
+CREATE TRIGGER trg_blockchain_transactions_ledger_update
+    AFTER UPDATE OF status ON t_p7012082_overnight_exchange_d.blockchain_transactions
+    FOR EACH ROW WHEN (NEW.status = 'confirmed' AND OLD.status IS DISTINCT FROM 'confirmed' AND NEW.exchange_id IS NOT NULL)
+    EXECUTE FUNCTION t_p7012082_overnight_exchange_d.post_blockchain_transaction();
+
+DROP TRIGGER IF EXISTS trg_payment_provider_transactions_ledger_insert ON t_p7012082_overnight_exchange_d.payment_provider_transactions;
+CREATE TRIGGER trg_payment_provider_transactions_ledger_insert
+    AFTER INSERT ON t_p7012082_overnight_exchange_d.payment_provider_transactions
+    FOR EACH ROW WHEN (NEW.status = 'completed')
+    EXECUTE FUNCTION t_p7012082_overnight_exchange_d.post_provider_payment();
+
+DROP TRIGGER IF EXISTS trg_payment_provider_transactions_ledger_update ON t_p7012082_overnight_exchange_d.payment_provider_transactions;
+CREATE TRIGGER trg_payment_provider_transactions_ledger_update
+    AFTER UPDATE OF status ON t_p7012082_overnight_exchange_d.payment_provider_transactions
+    FOR EACH ROW WHEN (NEW.status = 'completed' AND OLD.status IS DISTINCT FROM 'completed')
+    EXECUTE FUNCTION t_p7012082_overnight_exchange_d.post_provider_payment();
+
+DROP TRIGGER IF EXISTS trg_exchanges_ledger_settlement ON t_p7012082_overnight_exchange_d.exchanges;
+CREATE TRIGGER trg_exchanges_ledger_settlement
+    AFTER UPDATE OF status ON t_p7012082_overnight_exchange_d.exchanges
+    FOR EACH ROW WHEN (NEW.status = 'completed' AND OLD.status IS DISTINCT FROM 'completed')
+    EXECUTE FUNCTION t_p7012082_overnight_exchange_d.post_exchange_settlement();
+
+-- Written by ledger_checkpoint: the cached balance at account_seq and the balance re-derived from
+-- the previous verified checkpoint plus the lines since. verified is false on any mismatch.
+CREATE TABLE IF NOT EXISTS t_p7012082_overnight_exchange_d.ledger_checkpoints (
+    id BIGSERIAL PRIMARY KEY,
+    account_id INTEGER NOT NULL REFERENCES t_p7012082_overnight_exchange_d.ledger_accounts(id),
+    account_seq BIGINT NOT NULL,
+    balance DECIMAL(30, 8) NOT NULL,
+    computed_balance DECIMAL(30, 8) NOT NULL,
+    verified BOOLEAN NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_ledger_checkpoints_account_seq
+    ON t_p7012082_overnight_exchange_d.ledger_checkpoints(account_id, account_seq);
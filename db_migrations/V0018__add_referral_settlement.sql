@@ -0,0 +1,38 @@
+-- Referral settlement (trading-features-api referral_settlement job). use_referral_code only
+-- appends referral_usage rows; the job credits them in batches, one referral_settlements row and
+-- one referral_codes update per code per batch, so a popular code's row is no longer written on
+-- every use. referral_codes.total_referrals / total_earnings_usd are the settled totals; the rows
+-- with no settlement_id yet are the unsettled delta.
+CREATE TABLE IF NOT EXISTS t_p7012082_overnight_exchange_d.referral_settlements (
+    id BIGSERIAL PRIMARY KEY,
+    referral_code_id INTEGER NOT NULL REFERENCES t_p7012082_overnight_exchange_d.referral_codes(id),
+    usage_count INTEGER NOT NULL,
+    commission_usd DECIMAL(20, 2) NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_referral_settlements_code
+    ON t_p7012082_overnight_exchange_d.referral_settlements(referral_code_id);
+
+ALTER TABLE t_p7012082_overnight_exchange_d.referral_usage
+    ADD COLUMN IF NOT EXISTS settlement_id BIGINT REFERENCES t_p7012082_overnight_exchange_d.referral_settlements(id);
+
+-- Existing uses were credited one by one (by referral_commission jobs, some possibly still
+-- queued): record them as settled so the job does not credit them again.
+WITH opening AS (
+    INSERT INTO t_p7012082_overnight_exchange_d.referral_settlements (referral_code_id, usage_count, commission_usd)
+    SELECT referral_code_id, COUNT(*), COALESCE(SUM(commission_usd), 0)
+    FROM t_p7012082_overnight_exchange_d.referral_usage
+    WHERE settlement_id IS NULL AND referral_code_id IS NOT NULL
+    GROUP BY referral_code_id
+    RETURNING id, referral_code_id
+)
+UPDATE t_p7012082_overnight_exchange_d.referral_usage u SET settlement_id = o.id
+FROM opening o
+WHERE u.referral_code_id = o.referral_code_id AND u.settlement_id IS NULL;
+
+-- The job claims the oldest unsettled rows; get_referral_stats sums a code's.
+CREATE INDEX IF NOT EXISTS idx_referral_usage_unsettled
+    ON t_p7012082_overnight_exchange_d.referral_usage(referral_code_id, id) WHERE settlement_id IS NULL;
+CREATE INDEX IF NOT EXISTS idx_referral_usage_unsettled_id
+    ON t_p7012082_overnight_exchange_d.referral_usage(id) WHERE settlement_id IS NULL;
@@ -0,0 +1,9 @@
+-- Code allocator (trading-features-api referral codes, kyc-aml-api wallet verification codes).
+-- Each process reserves a block of random codes here in one statement and hands them out from
+-- memory; the primary key makes every code reserved once, whichever process drew it.
+CREATE TABLE IF NOT EXISTS t_p7012082_overnight_exchange_d.code_reservations (
+    kind VARCHAR(30) NOT NULL,
+    code VARCHAR(20) NOT NULL,
+    reserved_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (kind, code)
+);
@@ -0,0 +1,18 @@
+-- API key authentication (exchange-api). Requests present the key in X-Auth-Token and are looked
+-- up by its SHA-256, so authentication never needs the stored plaintext; new keys can be issued
+-- with key_hash alone. Each key gets its own token bucket of rate_limit_per_minute requests;
+-- exchange-api counts calls in memory and adds them to request_count every few seconds, which is
+-- also how its instances see each other's use of a key.
+ALTER TABLE t_p7012082_overnight_exchange_d.api_keys
+    ADD COLUMN IF NOT EXISTS key_hash CHAR(64),
+    ADD COLUMN IF NOT EXISTS rate_limit_per_minute INTEGER NOT NULL DEFAULT 600 CHECK (rate_limit_per_minute > 0),
+    ADD COLUMN IF NOT EXISTS request_count BIGINT NOT NULL DEFAULT 0;
+
+ALTER TABLE t_p7012082_overnight_exchange_d.api_keys ALTER COLUMN api_key DROP NOT NULL;
+
+UPDATE t_p7012082_overnight_exchange_d.api_keys
+SET key_hash = encode(sha256(convert_to(api_key, 'UTF8')), 'hex')
+WHERE key_hash IS NULL AND api_key IS NOT NULL;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_api_keys_key_hash
+    ON t_p7012082_overnight_exchange_d.api_keys(key_hash);
@@ -0,0 +1,6 @@
+-- Operators complete exchanges by hand from the admin transactions list, straight from pending
+-- (update_exchange_status in exchange-api); V0014 only allowed completion from processing, so
+-- those requests were refused with 409.
+INSERT INTO t_p7012082_overnight_exchange_d.exchange_transitions (from_status, to_status) VALUES
+    ('pending', 'completed')
+ON CONFLICT (from_status, to_status) DO NOTHING;
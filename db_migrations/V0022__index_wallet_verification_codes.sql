@@ -0,0 +1,5 @@
+-- kyc-aml-api reserves wallet verification codes only where no verification holds them, and the
+-- exchange-api expiry_sweep job prunes code_reservations rows whose code is now in use; both look
+-- codes up here.
+CREATE INDEX IF NOT EXISTS idx_wallet_verifications_verification_code
+    ON t_p7012082_overnight_exchange_d.wallet_verifications(verification_code);
@@ -0,0 +1,11 @@
+-- An exchange is referred at most once: use_referral_code inserts with ON CONFLICT (exchange_id)
+-- DO NOTHING and answers 409 to a repeat, which before this appended another referral_usage row
+-- (and another commission) on every call. Earlier repeats are removed, keeping the first use of
+-- each exchange; what referral_settlement already credited for them stays in the settled totals.
+DELETE FROM t_p7012082_overnight_exchange_d.referral_usage u
+USING t_p7012082_overnight_exchange_d.referral_usage first_use
+WHERE u.exchange_id = first_use.exchange_id AND u.id > first_use.id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_referral_usage_exchange_id
+    ON t_p7012082_overnight_exchange_d.referral_usage(exchange_id);
+
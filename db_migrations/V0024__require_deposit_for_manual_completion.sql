@@ -0,0 +1,11 @@
+-- V0021 let operators complete a pending exchange, also one whose deposit never arrived: the
+-- ledger then posted a settlement nothing was credited for and reconcile flagged it
+-- completed_without_deposit. A transition marked requires_deposit is taken (by transition_exchanges
+-- in every function) only when the exchange's deposit transaction is confirmed or a provider
+-- payment in its from_currency has completed, the same evidence reconcile accepts.
+ALTER TABLE t_p7012082_overnight_exchange_d.exchange_transitions
+    ADD COLUMN IF NOT EXISTS requires_deposit BOOLEAN NOT NULL DEFAULT false;
+
+UPDATE t_p7012082_overnight_exchange_d.exchange_transitions
+SET requires_deposit = true
+WHERE from_status = 'pending' AND to_status = 'completed';
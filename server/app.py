@@ -0,0 +1,356 @@
+"""
+Long-running ASGI host for the five backend functions
+Mounts every backend/<name>/index.py at /<name>/ with the same event/context shape the
+cloud runtime passes to handler(), so the serverless deployment keeps working unchanged:
+
+- legacy handlers run in a thread pool and get their connections from a per-process
+  psycopg2 pool per database (each module's connect_database() is swapped for
+  ConnectionPools.connection, which also serves the replicas in DATABASE_REPLICA_URLS)
+- NATIVE_ROUTES answer the polled reads (get_exchange, check_transaction) directly on an
+  asyncpg pool, reusing the module's response helpers; a module's admit_request (API key and
+  rate limit checks) still runs first, in the thread pool since a key lookup may block
+- /events streams exchange progress over SSE or WebSocket (server/stream.py)
+- GET /healthz checks the async pool
+
+Serve with server/run.py (SO_REUSEPORT workers) or any ASGI server: uvicorn server.app:app
+
+Settings (environment): DATABASE_URL, QUOTE_SECRET (exchange-api will not load without it),
+SERVER_THREADS (default 32), DB_POOL_SIZE (default SERVER_THREADS), ASYNC_POOL_SIZE (default 10),
+SERVER_MAX_BODY_BYTES (default 1 MiB), PREPARE_STATEMENTS (default 1 here: the modules' hot statements are prepared once per pooled
+connection; set 0 when DATABASE_URL points at a transaction-mode pooler).
+"""
+
+import asyncio
+import base64
+import importlib.util
+import os
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from types import ModuleType, SimpleNamespace
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl
+
+import asyncpg
+import psycopg2
+
+from server.stream import EventBroker, create_broker, serve_sse, serve_websocket
+
+ROOT = Path(__file__).resolve().parents[1]
+FUNCTIONS = ('admin-api', 'blockchain-api', 'exchange-api', 'kyc-aml-api', 'trading-features-api')
+POOL_TIMEOUT_SECONDS = 10.0
+
+def load_function(name: str) -> ModuleType:
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), ROOT / 'backend' / name / 'index.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# -- Legacy (blocking) path -------------------------------------------------------------
+
+class PooledConnection:
+    """psycopg2 connection on loan from ConnectionPool; close() rolls back and returns it."""
+
+    def __init__(self, conn, pool: 'ConnectionPool'):
+        self._conn = conn
+        self._pool = pool
+        self._released = False
+
+    def close(self) -> None:
+        if not self._released:
+            self._released = True
+            self._pool.release(self._conn)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._conn, name)
+
+class ConnectionPool:
+    """Blocking LIFO pool: at most `size` connections, opened lazily, replaced when broken."""
+
+    def __init__(self, dsn: str, size: int):
+        self._dsn = dsn
+        self._idle: 'queue.LifoQueue' = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def connection(self) -> PooledConnection:
+        if not self._slots.acquire(timeout=POOL_TIMEOUT_SECONDS):
+            raise RuntimeError('Database connection pool exhausted')
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = None
+            if conn is None or conn.closed:
+                conn = psycopg2.connect(self._dsn)
+        except Exception:
+            self._slots.release()
+            raise
+        return PooledConnection(conn, self)
+
+    def release(self, conn) -> None:
+        try:
+            if not conn.closed:
+                # Anything the handler left uncommitted is discarded, like the serverless close().
+                conn.rollback()
+                self._idle.put(conn)
+        except psycopg2.Error:
+            conn.close()
+        finally:
+            self._slots.release()
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+class ConnectionPools:
+    """A ConnectionPool per DSN: the primary, plus each read replica the modules route to."""
+
+    def __init__(self, dsn: str, size: int):
+        self._primary = dsn
+        self._size = size
+        self._pools = {dsn: ConnectionPool(dsn, size)}
+        self._lock = threading.Lock()
+
+    def connection(self, dsn: Optional[str] = None) -> PooledConnection:
+        dsn = dsn or self._primary
+        pool = self._pools.get(dsn)
+        if pool is None:
+            with self._lock:
+                pool = self._pools.setdefault(dsn, ConnectionPool(dsn, self._size))
+        return pool.connection()
+
+    def close(self) -> None:
+        for pool in list(self._pools.values()):
+            pool.close()
+
+# -- Native (async) path ----------------------------------------------------------------
+
+NativeRoute = Callable[[asyncpg.Pool, ModuleType, Dict[str, Any]], Awaitable[Dict[str, Any]]]
+
+async def get_exchange(pool: asyncpg.Pool, module: ModuleType, params: Dict[str, Any]) -> Dict[str, Any]:
+    exchange_id = params.get('id')
+    if not exchange_id or not str(exchange_id).isdigit():
+        return module.json_response(400, {'error': 'Exchange ID required'})
+    exchange = await pool.fetchrow("""
+        SELECT e.*, c.email, c.full_name, c.phone
+        FROM exchanges e
+        LEFT JOIN clients c ON e.client_id = c.id
+        WHERE e.id = $1
+    """, int(exchange_id))
+    if not exchange:
+        return module.json_response(404, {'error': 'Exchange not found'})
+    return module.json_response(200, {'exchange': dict(exchange)})
+
+async def check_transaction(pool: asyncpg.Pool, module: ModuleType, params: Dict[str, Any]) -> Dict[str, Any]:
+    transaction = await pool.fetchrow("""
+        SELECT bt.*, e.id as exchange_id, e.status as exchange_status
+        FROM blockchain_transactions bt
+        LEFT JOIN exchanges e ON bt.exchange_id = e.id
+        WHERE bt.tx_hash = $1
+    """, params.get('tx_hash'))
+    if not transaction:
+        return module.json_response(404, {'error': 'Transaction not found'})
+    return module.json_response(200, {
+        'transaction': dict(transaction),
+        'confirmations': transaction['confirmations'],
+        'is_confirmed': transaction['confirmations'] >= module.get_required_confirmations(transaction['blockchain'])
+    })
+
+# (function, method, action) -> coroutine mirroring the handler's action on asyncpg.
+NATIVE_ROUTES: Dict[Tuple[str, str, str], NativeRoute] = {
+    ('exchange-api', 'GET', 'get_exchange'): get_exchange,
+    ('blockchain-api', 'GET', 'check_transaction'): check_transaction
+}
+
+async def admit_native(module: ModuleType, event: Dict[str, Any], executor: Optional[ThreadPoolExecutor]
+                       ) -> Optional[Dict[str, Any]]:
+    # The module's admission as route_request applies it: None to go ahead, otherwise the refusal.
+    admit = getattr(module, 'admit_request', None)
+    if admit is None:
+        return None
+    try:
+        return await asyncio.get_running_loop().run_in_executor(executor, admit, event)
+    except module.RequestError as error:
+        return module.json_response(error.status_code, {'error': error.message})
+
+async def serve_native(route: NativeRoute, pool: asyncpg.Pool, module: ModuleType, action: str,
+                       event: Dict[str, Any], context: Any,
+                       executor: Optional[ThreadPoolExecutor] = None) -> Dict[str, Any]:
+    # Same bookkeeping as module.handler(): request state, metrics, compression/ETag, request id.
+    started = time.perf_counter()
+    state = module.begin_request(event, context)
+    token = module._request_state.set(state)
+    status_code = 500
+    try:
+        module.tag_request(action)
+        response = await admit_native(module, event, executor)
+        if response is None:
+            response = await route(pool, module, event['queryStringParameters'])
+        response = module.finalize_response(event, response)
+        status_code = response['statusCode']
+        if state['request_id']:
+            response['headers'] = {**response['headers'], 'X-Request-Id': state['request_id']}
+        return response
+    finally:
+        module._request_state.reset(token)
+        module.finish_request(state, 'GET', status_code, time.perf_counter() - started)
+
+# -- ASGI -------------------------------------------------------------------------------
+
+class FunctionHost:
+    def __init__(self, threads: int, pool_size: int, async_pool_size: int, max_body_bytes: int,
+                 prepare_statements: bool = True):
+        self.threads = threads
+        self.pool_size = pool_size
+        self.async_pool_size = async_pool_size
+        self.max_body_bytes = max_body_bytes
+        self.prepare_statements = prepare_statements
+        self.modules: Dict[str, ModuleType] = {}
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.legacy_pool: Optional[ConnectionPools] = None
+        self.async_pool: Optional[asyncpg.Pool] = None
+        self.broker: Optional[EventBroker] = None
+
+    async def startup(self) -> None:
+        dsn = os.environ['DATABASE_URL']
+        self.executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='legacy-handler')
+        self.legacy_pool = ConnectionPools(dsn, self.pool_size)
+        self.async_pool = await asyncpg.create_pool(dsn, min_size=1, max_size=self.async_pool_size)
+        self.broker = create_broker(dsn, self.async_pool)
+        await self.broker.start()
+        for name in FUNCTIONS:
+            module = load_function(name)
+            module.connect_database = self.legacy_pool.connection
+            if hasattr(module, 'PREPARE_STATEMENTS'):
+                module.PREPARE_STATEMENTS = self.prepare_statements
+            self.modules[name] = module
+
+    async def shutdown(self) -> None:
+        if self.broker is not None:
+            await self.broker.stop()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+        if self.legacy_pool is not None:
+            self.legacy_pool.close()
+        if self.async_pool is not None:
+            await self.async_pool.close()
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+        elif scope['type'] == 'websocket':
+            if scope['path'].strip('/') == 'events':
+                await serve_websocket(self.broker, scope, receive, send)
+            else:
+                await send({'type': 'websocket.close', 'code': 1008})
+
+    async def lifespan(self, receive: Callable, send: Callable) -> None:
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.startup()
+                except Exception as error:
+                    await send({'type': 'lifespan.startup.failed', 'message': str(error)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+        name = scope['path'].strip('/').partition('/')[0]
+        if name == 'healthz':
+            await self.healthz(send)
+            return
+        if name == 'events' and scope['method'] == 'GET':
+            await serve_sse(self.broker, scope, receive, send, reply)
+            return
+        module = self.modules.get(name)
+        if module is None:
+            await reply(send, 404, {'Content-Type': 'text/plain'}, b'Unknown function')
+            return
+        body = await read_body(receive, self.max_body_bytes)
+        if body is None:
+            await reply(send, 413, {'Content-Type': 'text/plain'}, b'Request body too large')
+            return
+
+        event = build_event(scope, body)
+        context = SimpleNamespace(request_id=uuid.uuid4().hex, function_name=name)
+        action = event['queryStringParameters'].get(module.ROUTE_KEY)
+        native = NATIVE_ROUTES.get((name, event['httpMethod'], action))
+        if native is not None:
+            response = await serve_native(native, self.async_pool, module, action, event, context, self.executor)
+        else:
+            response = await asyncio.get_running_loop().run_in_executor(self.executor, module.handler, event, context)
+
+        payload = response.get('body') or ''
+        raw = base64.b64decode(payload) if response.get('isBase64Encoded') else payload.encode('utf-8')
+        await reply(send, response['statusCode'], response.get('headers') or {}, raw)
+
+    async def healthz(self, send: Callable) -> None:
+        try:
+            await self.async_pool.fetchval('SELECT 1')
+        except Exception as error:
+            await reply(send, 503, {'Content-Type': 'text/plain'}, str(error).encode('utf-8'))
+            return
+        await reply(send, 200, {'Content-Type': 'text/plain'}, b'ok')
+
+def build_event(scope: Dict[str, Any], body: bytes) -> Dict[str, Any]:
+    headers: Dict[str, str] = {}
+    for key, value in scope['headers']:
+        name, text = key.decode('latin-1'), value.decode('latin-1')
+        headers[name] = f'{headers[name]}, {text}' if name in headers else text
+    try:
+        text_body, encoded = body.decode('utf-8'), False
+    except UnicodeDecodeError:
+        text_body, encoded = base64.b64encode(body).decode('ascii'), True
+    return {
+        'httpMethod': scope['method'],
+        'headers': headers,
+        'queryStringParameters': dict(parse_qsl(scope.get('query_string', b'').decode('latin-1'))),
+        'body': text_body,
+        'isBase64Encoded': encoded,
+        'requestContext': {'identity': {'sourceIp': (scope.get('client') or ('',))[0]}}
+    }
+
+async def read_body(receive: Callable, limit: int) -> Optional[bytes]:
+    chunks: List[bytes] = []
+    size = 0
+    while True:
+        message = await receive()
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > limit:
+            return None
+        chunks.append(chunk)
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+async def reply(send: Callable, status: int, headers: Dict[str, str], raw: bytes) -> None:
+    encoded = [(key.lower().encode('latin-1'), str(value).encode('latin-1')) for key, value in headers.items()]
+    encoded.append((b'content-length', str(len(raw)).encode('latin-1')))
+    await send({'type': 'http.response.start', 'status': status, 'headers': encoded})
+    await send({'type': 'http.response.body', 'body': raw})
+
+def create_app(threads: Optional[int] = None, pool_size: Optional[int] = None,
+               async_pool_size: Optional[int] = None) -> FunctionHost:
+    threads = threads or int(os.environ.get('SERVER_THREADS', '32'))
+    return FunctionHost(
+        threads=threads,
+        pool_size=pool_size or int(os.environ.get('DB_POOL_SIZE', str(threads))),
+        async_pool_size=async_pool_size or int(os.environ.get('ASYNC_POOL_SIZE', '10')),
+        max_body_bytes=int(os.environ.get('SERVER_MAX_BODY_BYTES', str(1024 * 1024))),
+        prepare_statements=os.environ.get('PREPARE_STATEMENTS', '1') == '1'
+    )
+
+app = create_app()
@@ -0,0 +1,298 @@
+"""
+Notification outbox dispatcher
+Handlers only INSERT INTO notifications inside their own transaction (create_exchange, ...);
+this process delivers them out of band so order creation never waits on SMTP or Telegram:
+
+1. claim a batch of due pending rows with FOR UPDATE SKIP LOCKED and lease them by pushing
+   next_attempt_at forward (a short transaction; no row locks are held while delivering)
+2. deliver every row on each channel it has not reached yet, concurrently, under a
+   per-channel concurrency limit
+3. write all results back with a single UPDATE ... FROM unnest(...)
+
+Failures are retried with exponential backoff up to MAX_ATTEMPTS. A dispatcher that dies
+mid-batch loses nothing: its lease expires and the rows are claimed again (at-least-once),
+so any number of dispatchers can run side by side. Idle dispatchers wait on
+LISTEN notifications_outbox (statement trigger from V0009) with a slow poll for retries.
+
+Channels: email to the client (SMTP_HOST, SMTP_PORT, SMTP_USER, SMTP_PASSWORD, SMTP_FROM) and
+the operators' Telegram chat the admin UI already notifies (TELEGRAM_BOT_TOKEN,
+TELEGRAM_ADMIN_CHAT_ID). A channel without configuration is replaced by a stub that only
+records the delivery, which is what runs locally.
+
+Usage:
+    DATABASE_URL=... python -m server.outbox [--batch-size 200] [--once] [--stub-latency-ms 50]
+"""
+
+import argparse
+import asyncio
+import html
+import json
+import os
+import signal
+import smtplib
+import time
+import urllib.error
+import urllib.request
+from email.message import EmailMessage
+from typing import List, Optional, Sequence, Tuple
+
+import asyncpg
+
+CHANNEL = 'notifications_outbox'
+MAX_ATTEMPTS = 8
+BASE_RETRY_SECONDS = 30.0
+MAX_RETRY_SECONDS = 3600.0
+LEASE_SECONDS = 300.0
+SEND_TIMEOUT_SECONDS = 20.0
+IDLE_POLL_SECONDS = 5.0
+
+class DeliveryError(Exception):
+    """Temporary failure; the notification is retried."""
+
+class PermanentDeliveryError(DeliveryError):
+    """The notification can never be delivered on this channel."""
+
+# -- Channel adapters ---------------------------------------------------------------------
+
+class Channel:
+    name = ''
+
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+
+    def recipient(self, note: asyncpg.Record) -> Optional[str]:
+        raise NotImplementedError
+
+    async def send(self, note: asyncpg.Record, recipient: str) -> None:
+        raise NotImplementedError
+
+class EmailChannel(Channel):
+    name = 'email'
+
+    def __init__(self, concurrency: int, host: str, port: int, user: str, password: str, sender: str):
+        super().__init__(concurrency)
+        self.host, self.port, self.user, self.password, self.sender = host, port, user, password, sender
+
+    def recipient(self, note: asyncpg.Record) -> Optional[str]:
+        return note['email']
+
+    async def send(self, note: asyncpg.Record, recipient: str) -> None:
+        message = EmailMessage()
+        message['From'] = self.sender
+        message['To'] = recipient
+        message['Subject'] = note['title']
+        message.set_content(f"{note['full_name'] or ''}\n\n{note['message'] or note['title']}".strip())
+        await asyncio.to_thread(self._deliver, message)
+
+    def _deliver(self, message: EmailMessage) -> None:
+        try:
+            with smtplib.SMTP(self.host, self.port, timeout=SEND_TIMEOUT_SECONDS) as smtp:
+                smtp.starttls()
+                if self.user:
+                    smtp.login(self.user, self.password)
+                smtp.send_message(message)
+        except smtplib.SMTPRecipientsRefused as error:
+            raise PermanentDeliveryError(f'recipient refused: {error.recipients}')
+        except (smtplib.SMTPException, OSError) as error:
+            raise DeliveryError(str(error))
+
+class TelegramChannel(Channel):
+    name = 'telegram'
+
+    def __init__(self, concurrency: int, token: str, chat_id: str):
+        super().__init__(concurrency)
+        self.url = f'https://api.telegram.org/bot{token}/sendMessage'
+        self.chat_id = chat_id
+
+    def recipient(self, note: asyncpg.Record) -> Optional[str]:
+        return self.chat_id
+
+    async def send(self, note: asyncpg.Record, recipient: str) -> None:
+        client = note['telegram_username'] or note['email'] or '-'
+        text = f"<b>{html.escape(note['title'])}</b>\n{html.escape(note['message'] or '')}\n{html.escape(client)}"
+        body = json.dumps({'chat_id': recipient, 'text': text, 'parse_mode': 'HTML'}).encode('utf-8')
+        await asyncio.to_thread(self._deliver, body)
+
+    def _deliver(self, body: bytes) -> None:
+        request = urllib.request.Request(self.url, data=body, headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=SEND_TIMEOUT_SECONDS) as response:
+                response.read()
+        except urllib.error.HTTPError as error:
+            # 429 and 5xx are worth retrying; any other 4xx will fail the same way again.
+            if error.code == 429 or error.code >= 500:
+                raise DeliveryError(f'telegram HTTP {error.code}')
+            raise PermanentDeliveryError(f'telegram HTTP {error.code}')
+        except OSError as error:
+            raise DeliveryError(str(error))
+
+class StubChannel(Channel):
+    """Stands in for an unconfigured channel: records the delivery after an optional delay."""
+
+    def __init__(self, name: str, concurrency: int, recipient_column: Optional[str], latency: float):
+        super().__init__(concurrency)
+        self.name = name
+        self.recipient_column = recipient_column
+        self.latency = latency
+
+    def recipient(self, note: asyncpg.Record) -> Optional[str]:
+        return note[self.recipient_column] if self.recipient_column else 'stub'
+
+    async def send(self, note: asyncpg.Record, recipient: str) -> None:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+def configured_channels(stub_latency: float) -> List[Channel]:
+    email_concurrency = int(os.environ.get('OUTBOX_EMAIL_CONCURRENCY', '8'))
+    # Telegram allows about 30 messages per second per bot.
+    telegram_concurrency = int(os.environ.get('OUTBOX_TELEGRAM_CONCURRENCY', '4'))
+    channels: List[Channel] = []
+    if os.environ.get('SMTP_HOST'):
+        channels.append(EmailChannel(
+            email_concurrency, os.environ['SMTP_HOST'], int(os.environ.get('SMTP_PORT', '587')),
+            os.environ.get('SMTP_USER', ''), os.environ.get('SMTP_PASSWORD', ''),
+            os.environ.get('SMTP_FROM', 'noreply@localhost')
+        ))
+    else:
+        channels.append(StubChannel('email', email_concurrency, 'email', stub_latency))
+    if os.environ.get('TELEGRAM_BOT_TOKEN') and os.environ.get('TELEGRAM_ADMIN_CHAT_ID'):
+        channels.append(TelegramChannel(telegram_concurrency, os.environ['TELEGRAM_BOT_TOKEN'],
+                                        os.environ['TELEGRAM_ADMIN_CHAT_ID']))
+    else:
+        channels.append(StubChannel('telegram', telegram_concurrency, None, stub_latency))
+    return channels
+
+# -- Dispatcher ---------------------------------------------------------------------------
+
+def retry_delay(attempts: int) -> float:
+    return min(BASE_RETRY_SECONDS * 2 ** (attempts - 1), MAX_RETRY_SECONDS)
+
+class Dispatcher:
+    def __init__(self, pool: asyncpg.Pool, channels: Sequence[Channel], batch_size: int):
+        self.pool = pool
+        self.channels = channels
+        self.batch_size = batch_size
+        self.limits = {channel.name: asyncio.Semaphore(channel.concurrency) for channel in channels}
+        self.totals = {'sent': 0, 'retry': 0, 'failed': 0}
+
+    async def claim(self) -> List[asyncpg.Record]:
+        return await self.pool.fetch("""
+            WITH due AS (
+                SELECT id, client_id FROM notifications
+                WHERE delivery_status = 'pending' AND next_attempt_at <= CURRENT_TIMESTAMP
+                ORDER BY next_attempt_at, id
+                LIMIT $1
+                FOR UPDATE SKIP LOCKED
+            )
+            UPDATE notifications n
+            SET attempts = n.attempts + 1,
+                next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => $2)
+            FROM due LEFT JOIN clients c ON c.id = due.client_id
+            WHERE n.id = due.id
+            RETURNING n.id, n.type, n.title, n.message, n.attempts, n.delivered_channels,
+                      c.email, c.full_name, c.telegram_username
+        """, self.batch_size, LEASE_SECONDS)
+
+    async def deliver(self, note: asyncpg.Record) -> Tuple[int, str, List[str], float, Optional[str]]:
+        delivered = list(note['delivered_channels'] or [])
+        errors: List[str] = []
+        retryable = False
+        for channel in self.channels:
+            recipient = channel.recipient(note)
+            if channel.name in delivered or not recipient:
+                continue
+            try:
+                async with self.limits[channel.name]:
+                    await asyncio.wait_for(channel.send(note, recipient), SEND_TIMEOUT_SECONDS)
+                delivered.append(channel.name)
+            except PermanentDeliveryError as error:
+                errors.append(f'{channel.name}: {error}')
+            except (DeliveryError, OSError, asyncio.TimeoutError) as error:
+                errors.append(f'{channel.name}: {error or type(error).__name__}')
+                retryable = True
+
+        if not errors:
+            return note['id'], 'sent', delivered, 0.0, None
+        if retryable and note['attempts'] < MAX_ATTEMPTS:
+            return note['id'], 'pending', delivered, retry_delay(note['attempts']), '; '.join(errors)
+        return note['id'], 'failed', delivered, 0.0, '; '.join(errors)
+
+    async def record(self, results: List[Tuple[int, str, List[str], float, Optional[str]]]) -> None:
+        await self.pool.execute("""
+            UPDATE notifications n
+            SET delivery_status = r.status,
+                delivered_channels = string_to_array(r.channels, ',')::varchar[],
+                sent_at = CASE WHEN r.status = 'sent' THEN CURRENT_TIMESTAMP ELSE n.sent_at END,
+                next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => r.delay),
+                last_error = r.error
+            FROM unnest($1::int[], $2::text[], $3::text[], $4::float8[], $5::text[]) AS r(id, status, channels, delay, error)
+            WHERE n.id = r.id
+        """, [r[0] for r in results], [r[1] for r in results], [','.join(r[2]) for r in results],
+            [r[3] for r in results], [r[4] for r in results])
+
+    async def run_once(self) -> int:
+        notes = await self.claim()
+        if not notes:
+            return 0
+        results = await asyncio.gather(*(self.deliver(note) for note in notes))
+        await self.record(results)
+        for result in results:
+            self.totals['retry' if result[1] == 'pending' else result[1]] += 1
+        return len(notes)
+
+    async def run(self, dsn: str, stop: asyncio.Event, once: bool) -> None:
+        wakeup = asyncio.Event()
+        listener = None if once else await asyncpg.connect(dsn)
+        if listener is not None:
+            await listener.add_listener(CHANNEL, lambda *_: wakeup.set())
+        try:
+            while not stop.is_set():
+                # Cleared before claiming, so an insert committed during the batch still wakes us.
+                wakeup.clear()
+                claimed = await self.run_once()
+                if claimed == self.batch_size:
+                    continue
+                if once:
+                    return
+                waiters = [asyncio.ensure_future(wakeup.wait()), asyncio.ensure_future(stop.wait())]
+                await asyncio.wait(waiters, timeout=IDLE_POLL_SECONDS, return_when=asyncio.FIRST_COMPLETED)
+                for waiter in waiters:
+                    waiter.cancel()
+        finally:
+            if listener is not None:
+                await listener.close()
+
+async def main_async(args: argparse.Namespace) -> None:
+    dsn = os.environ['DATABASE_URL']
+    channels = configured_channels(args.stub_latency_ms / 1000.0)
+    pool = await asyncpg.create_pool(dsn, min_size=1, max_size=2)
+    dispatcher = Dispatcher(pool, channels, args.batch_size)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    started = time.perf_counter()
+    print(f"dispatching via {', '.join(type(channel).__name__ + ':' + channel.name for channel in channels)}", flush=True)
+    try:
+        await dispatcher.run(dsn, stop, args.once)
+    finally:
+        await pool.close()
+        elapsed = time.perf_counter() - started
+        totals = dispatcher.totals
+        print(f"sent {totals['sent']}, retrying {totals['retry']}, failed {totals['failed']} in {elapsed:.1f}s "
+              f"({totals['sent'] / elapsed:,.0f} sent/s)", flush=True)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch-size', type=int, default=200)
+    parser.add_argument('--once', action='store_true', help='drain what is due now and exit')
+    parser.add_argument('--stub-latency-ms', type=float, default=0.0,
+                        help='simulated delivery time for stubbed channels')
+    args = parser.parse_args()
+    if not os.environ.get('DATABASE_URL'):
+        raise SystemExit('DATABASE_URL is not set')
+    asyncio.run(main_async(args))
+
+if __name__ == '__main__':
+    main()
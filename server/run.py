@@ -0,0 +1,90 @@
+"""
+Runs server.app under uvicorn in several worker processes sharing one port via SO_REUSEPORT
+Every worker binds its own listening socket, so the kernel balances new connections
+across processes without a master accept loop; each worker owns its thread pool,
+psycopg2 pool and asyncpg pool. The parent restarts workers that die and stops them
+all on SIGINT/SIGTERM.
+
+Usage:
+    DATABASE_URL=... QUOTE_SECRET=... python -m server.run [--host 0.0.0.0] [--port 8000] [--workers 4]
+                                                          [--threads 32] [--pool-size 32] [--async-pool-size 10]
+"""
+
+import argparse
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+from typing import List
+
+def bind_socket(host: str, port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+def serve(args: argparse.Namespace) -> None:
+    import uvicorn
+    from server.app import create_app
+
+    sock = bind_socket(args.host, args.port)
+    app = create_app(threads=args.threads, pool_size=args.pool_size, async_pool_size=args.async_pool_size)
+    config = uvicorn.Config(app, lifespan='on', access_log=False, log_level=args.log_level,
+                            timeout_keep_alive=args.keep_alive)
+    uvicorn.Server(config).run(sockets=[sock])
+
+def start_worker(args: argparse.Namespace) -> multiprocessing.Process:
+    process = multiprocessing.Process(target=serve, args=(args,), daemon=False)
+    process.start()
+    return process
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--threads', type=int, default=32, help='legacy handler threads per worker')
+    parser.add_argument('--pool-size', type=int, help='psycopg2 connections per worker (default: --threads)')
+    parser.add_argument('--async-pool-size', type=int, default=10, help='asyncpg connections per worker')
+    parser.add_argument('--keep-alive', type=int, default=75, help='idle keep-alive timeout, seconds')
+    parser.add_argument('--log-level', default='warning')
+    args = parser.parse_args()
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        sys.exit('SO_REUSEPORT is not available on this platform; run a single uvicorn process instead')
+    for setting in ('DATABASE_URL', 'QUOTE_SECRET'):
+        if not os.environ.get(setting):
+            sys.exit(f'{setting} is not set')
+
+    # Fail fast on a taken port before forking workers.
+    bind_socket(args.host, args.port).close()
+
+    workers: List[multiprocessing.Process] = [start_worker(args) for _ in range(args.workers)]
+    stopping = False
+
+    def stop(signum, frame) -> None:
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    print(f'serving {args.workers} workers on http://{args.host}:{args.port}/<function>/', flush=True)
+
+    while not stopping:
+        time.sleep(0.5)
+        for index, process in enumerate(workers):
+            if not process.is_alive() and not stopping:
+                print(f'worker {process.pid} exited with {process.exitcode}; restarting', flush=True)
+                workers[index] = start_worker(args)
+
+    for process in workers:
+        process.terminate()
+    for process in workers:
+        process.join(timeout=10)
+
+if __name__ == '__main__':
+    main()
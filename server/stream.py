@@ -0,0 +1,336 @@
+"""
+Server-push stream of exchange progress for the long-running host (server/app.py)
+Replaces polling get_exchange / check_transaction: triggers from V0008 journal every status
+change, confirmation update and transaction_logs insert into exchange_events and announce it
+with NOTIFY exchange_events. Each worker process holds one LISTEN connection and fans the
+notifications out to its in-process subscribers:
+
+    GET /events?exchange_id=42[,43...]          text/event-stream (EventSource)
+    WebSocket /events?exchange_id=42[,43...]    one JSON text message per event
+
+Every event carries the journal id. A fresh subscription starts with a `snapshot` event (current
+status and transactions); a reconnect with Last-Event-ID (or ?last_event_id= for WebSockets)
+replays the journal after that id instead. A subscriber that falls more than `queue_size`
+events behind — slow socket, or the LISTEN connection was lost — has its buffer dropped and
+catches up from the journal, so memory per subscriber stays bounded and nothing is skipped.
+
+Settings (environment): STREAM_MAX_SUBSCRIBERS (per worker, default 10000), STREAM_QUEUE_SIZE
+(default 256), STREAM_RETENTION_DAYS (journal retention, default 7).
+"""
+
+import asyncio
+import json
+import os
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, NamedTuple, Optional, Set
+from urllib.parse import parse_qsl
+
+import asyncpg
+
+CHANNEL = 'exchange_events'
+MAX_EXCHANGES_PER_STREAM = 50
+HEARTBEAT_SECONDS = 15.0
+REPLAY_PAGE_SIZE = 500
+RECONNECT_DELAYS = (0.5, 1.0, 2.0, 5.0, 10.0)
+PRUNE_INTERVAL_SECONDS = 3600.0
+
+class StreamEvent(NamedTuple):
+    id: int
+    kind: str
+    text: str
+
+    def sse_frame(self) -> bytes:
+        return f'id: {self.id}\nevent: {self.kind}\ndata: {self.text}\n\n'.encode('utf-8')
+
+class Subscriber:
+    """Bounded per-connection buffer; overflowing it switches the subscriber to journal catch-up."""
+
+    __slots__ = ('exchange_ids', 'limit', 'pending', 'lagging', 'wakeup')
+
+    def __init__(self, exchange_ids: List[int], limit: int):
+        self.exchange_ids = exchange_ids
+        self.limit = limit
+        self.pending: Deque[StreamEvent] = deque()
+        self.lagging = False
+        self.wakeup = asyncio.Event()
+
+    def push(self, event: StreamEvent) -> None:
+        if self.lagging:
+            return
+        if len(self.pending) >= self.limit:
+            self.lagging = True
+            self.pending.clear()
+        else:
+            self.pending.append(event)
+        self.wakeup.set()
+
+    def fall_behind(self) -> None:
+        self.lagging = True
+        self.pending.clear()
+        self.wakeup.set()
+
+class StreamError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+Emit = Callable[[List[StreamEvent]], Awaitable[None]]
+
+class EventBroker:
+    def __init__(self, dsn: str, pool: asyncpg.Pool, max_subscribers: int, queue_size: int, retention_days: int):
+        self.dsn = dsn
+        self.pool = pool
+        self.max_subscribers = max_subscribers
+        self.queue_size = queue_size
+        self.retention_days = retention_days
+        self.topics: Dict[int, Set[Subscriber]] = {}
+        self.subscribers = 0
+        self.connected = False
+        self._tasks: List[asyncio.Task] = []
+
+    # -- LISTEN side -----------------------------------------------------------------------
+
+    async def start(self) -> None:
+        self._tasks = [asyncio.create_task(self.listen()), asyncio.create_task(self.prune())]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def listen(self) -> None:
+        attempt = 0
+        while True:
+            conn = None
+            try:
+                conn = await asyncpg.connect(self.dsn)
+                lost = asyncio.get_running_loop().create_future()
+                conn.add_termination_listener(lambda _: lost.done() or lost.set_result(None))
+                await conn.add_listener(CHANNEL, self.on_notify)
+                if attempt:
+                    # Notifications sent while we were away are gone; every subscriber re-reads the journal.
+                    for subscribers in self.topics.values():
+                        for subscriber in subscribers:
+                            subscriber.fall_behind()
+                self.connected = True
+                attempt = 0
+                await lost
+            except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError):
+                pass
+            finally:
+                self.connected = False
+                if conn is not None and not conn.is_closed():
+                    conn.terminate()
+            await asyncio.sleep(RECONNECT_DELAYS[min(attempt, len(RECONNECT_DELAYS) - 1)])
+            attempt += 1
+
+    def on_notify(self, conn, pid: int, channel: str, payload: str) -> None:
+        head = json.loads(payload)
+        subscribers = self.topics.get(head['exchange_id'])
+        if not subscribers:
+            return
+        event = StreamEvent(head['id'], head['kind'], payload)
+        for subscriber in subscribers:
+            subscriber.push(event)
+
+    async def prune(self) -> None:
+        while True:
+            await asyncio.sleep(PRUNE_INTERVAL_SECONDS)
+            try:
+                await self.pool.execute(
+                    "DELETE FROM exchange_events WHERE created_at < CURRENT_TIMESTAMP - make_interval(days => $1)",
+                    self.retention_days
+                )
+            except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError):
+                pass
+
+    # -- Subscriber side -------------------------------------------------------------------
+
+    def subscribe(self, exchange_ids: List[int]) -> Subscriber:
+        if self.subscribers >= self.max_subscribers:
+            raise StreamError(503, 'Too many stream subscribers')
+        subscriber = Subscriber(exchange_ids, self.queue_size)
+        for exchange_id in exchange_ids:
+            self.topics.setdefault(exchange_id, set()).add(subscriber)
+        self.subscribers += 1
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        for exchange_id in subscriber.exchange_ids:
+            subscribers = self.topics.get(exchange_id)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self.topics[exchange_id]
+        self.subscribers -= 1
+
+    async def snapshot(self, exchange_ids: List[int]) -> StreamEvent:
+        # One statement, so the journal cursor and the state it summarises come from the same snapshot.
+        row = await self.pool.fetchrow("""
+            SELECT
+                (SELECT COALESCE(MAX(id), 0) FROM exchange_events WHERE exchange_id = ANY($1::int[])) AS cursor,
+                (SELECT jsonb_agg(jsonb_build_object(
+                    'id', e.id, 'status', e.status, 'completed_at', e.completed_at,
+                    'transactions', COALESCE((
+                        SELECT jsonb_agg(jsonb_build_object(
+                            'tx_hash', bt.tx_hash, 'blockchain', bt.blockchain,
+                            'confirmations', bt.confirmations, 'status', bt.status
+                        ) ORDER BY bt.id)
+                        FROM blockchain_transactions bt WHERE bt.exchange_id = e.id
+                    ), '[]'::jsonb)
+                ) ORDER BY e.id) FROM exchanges e WHERE e.id = ANY($1::int[]))::text AS exchanges
+        """, exchange_ids)
+        if row['exchanges'] is None:
+            raise StreamError(404, 'Exchange not found')
+        text = f'{{"id": {row["cursor"]}, "kind": "snapshot", "data": {{"exchanges": {row["exchanges"]}}}}}'
+        return StreamEvent(row['cursor'], 'snapshot', text)
+
+    async def replay(self, subscriber: Subscriber, emit: Emit, last_id: int) -> int:
+        while True:
+            rows = await self.pool.fetch("""
+                SELECT id, kind, json_build_object(
+                    'id', id, 'exchange_id', exchange_id, 'kind', kind, 'data', data
+                )::text AS text
+                FROM exchange_events
+                WHERE exchange_id = ANY($1::int[]) AND id > $2
+                ORDER BY id
+                LIMIT $3
+            """, subscriber.exchange_ids, last_id, REPLAY_PAGE_SIZE)
+            if rows:
+                await emit([StreamEvent(row['id'], row['kind'], row['text']) for row in rows])
+                last_id = rows[-1]['id']
+            if len(rows) < REPLAY_PAGE_SIZE:
+                return last_id
+
+    async def run(self, subscriber: Subscriber, emit: Emit, heartbeat: Optional[Callable[[], Awaitable[None]]],
+                  last_id: Optional[int]) -> None:
+        # The subscriber is registered before the snapshot/replay, so nothing committed in
+        # between is lost; anything seen twice is dropped by the id check.
+        if last_id is None:
+            event = await self.snapshot(subscriber.exchange_ids)
+            await emit([event])
+            last_id = event.id
+        else:
+            last_id = await self.replay(subscriber, emit, last_id)
+
+        while True:
+            try:
+                await asyncio.wait_for(subscriber.wakeup.wait(), HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                if heartbeat is not None:
+                    await heartbeat()
+                continue
+            subscriber.wakeup.clear()
+            if subscriber.lagging:
+                subscriber.lagging = False
+                last_id = await self.replay(subscriber, emit, last_id)
+                continue
+            batch: List[StreamEvent] = []
+            while subscriber.pending:
+                event = subscriber.pending.popleft()
+                if event.id > last_id:
+                    batch.append(event)
+                    last_id = event.id
+            if batch:
+                await emit(batch)
+
+# -- ASGI endpoints -----------------------------------------------------------------------
+
+def parse_subscription(query_string: bytes, headers: Dict[str, str]) -> tuple:
+    params = dict(parse_qsl(query_string.decode('latin-1')))
+    raw_ids = [part.strip() for part in params.get('exchange_id', '').split(',') if part.strip()]
+    if not raw_ids or not all(part.isdigit() for part in raw_ids):
+        raise StreamError(400, 'exchange_id required')
+    exchange_ids = sorted({int(part) for part in raw_ids})
+    if len(exchange_ids) > MAX_EXCHANGES_PER_STREAM:
+        raise StreamError(400, f'At most {MAX_EXCHANGES_PER_STREAM} exchanges per stream')
+    resume = headers.get('last-event-id') or params.get('last_event_id')
+    last_id = int(resume) if resume and resume.isdigit() else None
+    return exchange_ids, last_id
+
+async def until_disconnect(receive: Callable, kind: str) -> None:
+    while (await receive())['type'] != kind:
+        pass
+
+async def supervise(work: Awaitable[None], disconnected: Awaitable[None]) -> None:
+    tasks = {asyncio.ensure_future(work), asyncio.ensure_future(disconnected)}
+    done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    for task in done:
+        task.result()
+
+async def serve_sse(broker: EventBroker, scope: Dict, receive: Callable, send: Callable,
+                    reply: Callable[..., Awaitable[None]]) -> None:
+    headers = {key.decode('latin-1'): value.decode('latin-1') for key, value in scope['headers']}
+    try:
+        exchange_ids, last_id = parse_subscription(scope.get('query_string', b''), headers)
+        subscriber = broker.subscribe(exchange_ids)
+    except StreamError as error:
+        await reply(send, error.status, {'Content-Type': 'application/json'},
+                    json.dumps({'error': str(error)}).encode('utf-8'))
+        return
+
+    started = False
+
+    async def start() -> None:
+        nonlocal started
+        if not started:
+            started = True
+            await send({'type': 'http.response.start', 'status': 200, 'headers': [
+                (b'content-type', b'text/event-stream; charset=utf-8'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'),
+                (b'access-control-allow-origin', b'*')
+            ]})
+            await send({'type': 'http.response.body', 'body': b'retry: 3000\n\n', 'more_body': True})
+
+    async def emit(events: List[StreamEvent]) -> None:
+        await start()
+        await send({'type': 'http.response.body', 'body': b''.join(event.sse_frame() for event in events),
+                    'more_body': True})
+
+    async def heartbeat() -> None:
+        await send({'type': 'http.response.body', 'body': b': keep-alive\n\n', 'more_body': True})
+
+    try:
+        await supervise(broker.run(subscriber, emit, heartbeat, last_id), until_disconnect(receive, 'http.disconnect'))
+    except StreamError as error:
+        if not started:
+            await reply(send, error.status, {'Content-Type': 'application/json'},
+                        json.dumps({'error': str(error)}).encode('utf-8'))
+    finally:
+        broker.unsubscribe(subscriber)
+
+async def serve_websocket(broker: EventBroker, scope: Dict, receive: Callable, send: Callable) -> None:
+    if (await receive())['type'] != 'websocket.connect':
+        return
+    headers = {key.decode('latin-1'): value.decode('latin-1') for key, value in scope['headers']}
+    try:
+        exchange_ids, last_id = parse_subscription(scope.get('query_string', b''), headers)
+        subscriber = broker.subscribe(exchange_ids)
+    except StreamError as error:
+        await send({'type': 'websocket.close', 'code': 1013 if error.status == 503 else 1008, 'reason': str(error)})
+        return
+    await send({'type': 'websocket.accept'})
+
+    async def emit(events: List[StreamEvent]) -> None:
+        for event in events:
+            await send({'type': 'websocket.send', 'text': event.text})
+
+    try:
+        # Keep-alive is left to the server's protocol-level pings.
+        await supervise(broker.run(subscriber, emit, None, last_id), until_disconnect(receive, 'websocket.disconnect'))
+    except StreamError as error:
+        await send({'type': 'websocket.close', 'code': 1008, 'reason': str(error)})
+    finally:
+        broker.unsubscribe(subscriber)
+
+def create_broker(dsn: str, pool: asyncpg.Pool) -> EventBroker:
+    return EventBroker(
+        dsn, pool,
+        max_subscribers=int(os.environ.get('STREAM_MAX_SUBSCRIBERS', '10000')),
+        queue_size=int(os.environ.get('STREAM_QUEUE_SIZE', '256')),
+        retention_days=int(os.environ.get('STREAM_RETENTION_DAYS', '7'))
+    )
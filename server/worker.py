@@ -0,0 +1,276 @@
+"""
+Background job worker for the jobs table (V0010)
+Loads every backend/<name>/index.py, merges the JOBS tables they export
+(kind -> (conn, payload) -> result) and runs several processes that each loop:
+
+    BEGIN
+    SELECT ... FROM jobs WHERE status = 'queued' AND run_at <= now
+        ORDER BY priority DESC, run_at, id LIMIT batch FOR UPDATE SKIP LOCKED
+    per job, inside a savepoint: handler(conn, payload) (ROLLBACK TO on error)
+    UPDATE jobs ... FROM unnest(...)   -- done / retry with backoff / failed, one statement
+    COMMIT
+
+The row locks are what mark a job as running. If a worker dies, its transaction rolls back
+and the jobs are claimable again with no lease to expire, and a job's own writes commit
+atomically with its completion. The price is that a batch commits together, so handlers keep
+external calls short and bounded by timeouts. Idle workers sleep on LISTEN jobs; finished
+jobs are kept for JOB_RETENTION_HOURS (default 24) and then deleted.
+
+Modules may also export SCHEDULES (kind -> interval in seconds) for recurring jobs: every
+worker periodically inserts the next occurrence, due at the next multiple of the interval,
+under the dedupe key schedule:<kind>. Only one occurrence can be queued at a time, so the
+job runs once per interval however many workers there are.
+
+Usage:
+    DATABASE_URL=... QUOTE_SECRET=... python -m server.worker [--processes 2] [--batch-size 50] [--kinds withdrawal,aml_check]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import select
+import signal
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import psycopg2
+
+from server.app import FUNCTIONS, load_function
+
+BASE_RETRY_SECONDS = 10.0
+MAX_RETRY_SECONDS = 1800.0
+IDLE_POLL_SECONDS = 1.0
+RECONNECT_SECONDS = 2.0
+PRUNE_INTERVAL_SECONDS = 60.0
+PRUNE_CHUNK = 10000
+SCHEDULE_CHECK_SECONDS = 10.0
+ERROR_TEXT_LIMIT = 2000
+
+JobHandler = Callable[[Any, Dict[str, Any]], Optional[Dict[str, Any]]]
+
+def collect_handlers(kinds: Optional[List[str]] = None) -> Dict[str, JobHandler]:
+    handlers: Dict[str, JobHandler] = {}
+    for name in FUNCTIONS:
+        handlers.update(getattr(load_function(name), 'JOBS', {}))
+    if kinds:
+        unknown = sorted(set(kinds) - set(handlers))
+        if unknown:
+            raise SystemExit(f"unknown job kinds: {', '.join(unknown)} (known: {', '.join(sorted(handlers))})")
+        handlers = {kind: handlers[kind] for kind in kinds}
+    return handlers
+
+def collect_schedules(handlers: Dict[str, JobHandler]) -> Dict[str, float]:
+    schedules: Dict[str, float] = {}
+    for name in FUNCTIONS:
+        schedules.update(getattr(load_function(name), 'SCHEDULES', {}))
+    return {kind: interval for kind, interval in schedules.items() if kind in handlers}
+
+def retry_delay(attempts: int) -> float:
+    # Jittered so jobs that failed together (e.g. a provider outage) do not retry in lockstep.
+    return min(BASE_RETRY_SECONDS * 2 ** (attempts - 1), MAX_RETRY_SECONDS) * random.uniform(0.8, 1.2)
+
+class JobWorker:
+    def __init__(self, conn, handlers: Dict[str, JobHandler], batch_size: int):
+        self.conn = conn
+        self.handlers = handlers
+        self.kinds = sorted(handlers)
+        self.batch_size = batch_size
+        self.totals = {'done': 0, 'retry': 0, 'failed': 0}
+
+    def run_batch(self) -> int:
+        cursor = self.conn.cursor()
+        cursor.execute("""
+            SELECT id, kind, payload, attempts, max_attempts FROM jobs
+            WHERE status = 'queued' AND run_at <= CURRENT_TIMESTAMP AND kind = ANY(%s)
+            ORDER BY priority DESC, run_at, id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        """, (self.kinds, self.batch_size))
+        jobs = cursor.fetchall()
+        if not jobs:
+            self.conn.rollback()
+            return 0
+
+        ids: List[int] = []
+        statuses: List[str] = []
+        delays: List[float] = []
+        results: List[Optional[str]] = []
+        errors: List[Optional[str]] = []
+        # ROLLBACK TO keeps the savepoint and RELEASE + SAVEPOINT share a round trip, so isolating
+        # each job costs one extra statement rather than two.
+        cursor.execute('SAVEPOINT job')
+        for job_id, kind, payload, attempts, max_attempts in jobs:
+            try:
+                result = self.handlers[kind](self.conn, payload)
+            except psycopg2.OperationalError:
+                raise
+            except Exception as error:
+                cursor.execute('ROLLBACK TO SAVEPOINT job')
+                exhausted = attempts + 1 >= max_attempts
+                ids.append(job_id)
+                statuses.append('failed' if exhausted else 'queued')
+                delays.append(0.0 if exhausted else retry_delay(attempts + 1))
+                results.append(None)
+                errors.append(f'{type(error).__name__}: {error}'[:ERROR_TEXT_LIMIT])
+                self.totals['failed' if exhausted else 'retry'] += 1
+                continue
+            cursor.execute('RELEASE SAVEPOINT job; SAVEPOINT job')
+            ids.append(job_id)
+            statuses.append('done')
+            delays.append(0.0)
+            results.append(json.dumps(result, default=str) if result is not None else None)
+            errors.append(None)
+            self.totals['done'] += 1
+
+        cursor.execute("""
+            UPDATE jobs j
+            SET status = r.status,
+                attempts = j.attempts + 1,
+                run_at = CASE WHEN r.status = 'queued' THEN CURRENT_TIMESTAMP + make_interval(secs => r.delay) ELSE j.run_at END,
+                result = r.result::jsonb,
+                last_error = r.error,
+                finished_at = CASE WHEN r.status = 'queued' THEN NULL ELSE CURRENT_TIMESTAMP END
+            FROM unnest(%s::bigint[], %s::text[], %s::float8[], %s::text[], %s::text[]) AS r(id, status, delay, result, error)
+            WHERE j.id = r.id
+        """, (ids, statuses, delays, results, errors))
+        self.conn.commit()
+        return len(jobs)
+
+    def schedule(self, schedules: Dict[str, float]) -> None:
+        kinds = sorted(schedules)
+        cursor = self.conn.cursor()
+        cursor.execute("""
+            INSERT INTO jobs (kind, run_at, dedupe_key)
+            SELECT s.kind,
+                   date_bin(make_interval(secs => s.seconds), LOCALTIMESTAMP, TIMESTAMP 'epoch') + make_interval(secs => s.seconds),
+                   'schedule:' || s.kind
+            FROM unnest(%s::text[], %s::float8[]) AS s(kind, seconds)
+            ON CONFLICT (dedupe_key) WHERE status = 'queued' DO NOTHING
+        """, (kinds, [schedules[kind] for kind in kinds]))
+        self.conn.commit()
+
+    def prune(self, retention_hours: float) -> int:
+        cursor = self.conn.cursor()
+        cursor.execute("""
+            DELETE FROM jobs WHERE id IN (
+                SELECT id FROM jobs
+                WHERE status = 'done' AND finished_at < CURRENT_TIMESTAMP - make_interval(secs => %s)
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+        """, (retention_hours * 3600, PRUNE_CHUNK))
+        deleted = cursor.rowcount
+        self.conn.commit()
+        return deleted
+
+def wait_for_jobs(listener, timeout: float) -> None:
+    # A NOTIFY that arrived while the batch ran is still unread on the socket, so select returns at once.
+    if select.select([listener], [], [], timeout)[0]:
+        listener.poll()
+        listener.notifies.clear()
+
+def run_worker(dsn: str, handlers: Dict[str, JobHandler], batch_size: int, should_stop: Callable[[], bool],
+               drain: bool = False, retention_hours: float = 24.0,
+               schedules: Optional[Dict[str, float]] = None) -> Dict[str, int]:
+    """Claims and runs jobs until should_stop(); with drain=True also returns once nothing is due."""
+    worker: Optional[JobWorker] = None
+    totals = {'done': 0, 'retry': 0, 'failed': 0}
+    last_prune = time.monotonic()
+    next_schedule = 0.0
+    while not should_stop():
+        conn = listener = None
+        try:
+            conn = psycopg2.connect(dsn)
+            listener = psycopg2.connect(dsn)
+            listener.autocommit = True
+            listener.cursor().execute('LISTEN jobs')
+            worker = JobWorker(conn, handlers, batch_size)
+            while not should_stop():
+                if schedules and time.monotonic() >= next_schedule:
+                    next_schedule = time.monotonic() + min(SCHEDULE_CHECK_SECONDS, *schedules.values())
+                    worker.schedule(schedules)
+                claimed = worker.run_batch()
+                if claimed == batch_size:
+                    continue
+                if drain and claimed == 0:
+                    return {key: totals[key] + worker.totals[key] for key in totals}
+                if retention_hours and time.monotonic() - last_prune > PRUNE_INTERVAL_SECONDS:
+                    last_prune = time.monotonic()
+                    while worker.prune(retention_hours) == PRUNE_CHUNK and not should_stop():
+                        pass
+                if not drain:
+                    wait_for_jobs(listener, IDLE_POLL_SECONDS)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as error:
+            print(f'worker {os.getpid()}: database unavailable ({error}); reconnecting', file=sys.stderr, flush=True)
+            time.sleep(RECONNECT_SECONDS)
+        finally:
+            if worker is not None:
+                for key in totals:
+                    totals[key] += worker.totals[key]
+                worker = None
+            for connection in (conn, listener):
+                if connection is not None and not connection.closed:
+                    connection.close()
+    return totals
+
+def serve(args: argparse.Namespace) -> None:
+    stopping = False
+
+    def stop(signum, frame) -> None:
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    handlers = collect_handlers(args.kinds)
+    totals = run_worker(os.environ['DATABASE_URL'], handlers, args.batch_size, lambda: stopping,
+                        retention_hours=float(os.environ.get('JOB_RETENTION_HOURS', '24')),
+                        schedules=collect_schedules(handlers))
+    print(f"worker {os.getpid()}: done {totals['done']}, retried {totals['retry']}, failed {totals['failed']}", flush=True)
+
+def start_worker(args: argparse.Namespace) -> multiprocessing.Process:
+    process = multiprocessing.Process(target=serve, args=(args,))
+    process.start()
+    return process
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--batch-size', type=int, default=50)
+    parser.add_argument('--kinds', type=lambda value: [kind for kind in value.split(',') if kind],
+                        help='comma-separated job kinds this pool runs (default: all)')
+    args = parser.parse_args()
+    for setting in ('DATABASE_URL', 'QUOTE_SECRET'):
+        if not os.environ.get(setting):
+            sys.exit(f'{setting} is not set')
+    kinds = sorted(collect_handlers(args.kinds))
+
+    workers = [start_worker(args) for _ in range(args.processes)]
+    stopping = False
+
+    def stop(signum, frame) -> None:
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    print(f"running {args.processes} job workers for {', '.join(kinds)}", flush=True)
+
+    while not stopping:
+        time.sleep(0.5)
+        for index, process in enumerate(workers):
+            if not process.is_alive() and not stopping:
+                print(f'worker {process.pid} exited with {process.exitcode}; restarting', flush=True)
+                workers[index] = start_worker(args)
+
+    # Workers finish their current batch before exiting.
+    for process in workers:
+        process.terminate()
+    for process in workers:
+        process.join(timeout=30)
+
+if __name__ == '__main__':
+    main()
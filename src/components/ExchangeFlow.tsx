@@ -6,8 +6,8 @@ import { Card } from '@/components/ui/card';
 import { Dialog, DialogContent, DialogHeader, DialogTitle } from '@/components/ui/dialog';
 import Icon from '@/components/ui/icon';
 import { useToast } from '@/hooks/use-toast';
+import { createQuotedExchange } from '@/utils/exchangeQuote';
 
-const EXCHANGE_API_URL = 'https://functions.poehali.dev/cb22a964-580b-490f-a97e-6a94308c6580';
 const KYC_AML_API_URL = 'https://functions.poehali.dev/4f24f2ad-e009-45ce-9f47-ee953647179a';
 
 interface ExchangeFlowProps {
@@ -61,25 +61,13 @@ export default function ExchangeFlow({
     setLoading(true);
     
     try {
-      const response = await fetch(EXCHANGE_API_URL, {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({
-          action: 'create_exchange',
-          email: clientData.email,
-          name: clientData.full_name || 'Anonymous',
-          from_currency: fromCurrency,
-          to_currency: toCurrency,
-          from_amount: parseFloat(fromAmount),
-          to_amount: parseFloat(toAmount),
-          exchange_rate: exchangeRate,
-          from_wallet: clientData.from_wallet,
-          to_wallet: clientData.to_wallet,
-        }),
+      const { result } = await createQuotedExchange(fromCurrency, toCurrency, fromAmount, {
+        email: clientData.email,
+        name: clientData.full_name || 'Anonymous',
+        from_wallet: clientData.from_wallet,
+        to_wallet: clientData.to_wallet,
       });
 
-      const result = await response.json();
-
       if (result.success) {
         setExchangeId(result.exchange_id);
         setClientId(result.client_id);
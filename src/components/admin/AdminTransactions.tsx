@@ -58,6 +58,9 @@ const AdminTransactions = () => {
       if (res.ok) {
         toast({ title: 'Успешно', description: `Статус обновлён на "${newStatus}"` });
         loadTransactions();
+      } else {
+        const result = await res.json();
+        toast({ title: 'Ошибка', description: result.error || 'Не удалось обновить статус', variant: 'destructive' });
       }
     } catch (error) {
       toast({ title: 'Ошибка', description: 'Не удалось обновить статус', variant: 'destructive' });
@@ -7,8 +7,7 @@ import { Button } from '@/components/ui/button';
 import Icon from '@/components/ui/icon';
 import { useToast } from '@/hooks/use-toast';
 import { useAuth } from '@/contexts/AuthContext';
-
-const EXCHANGE_API_URL = 'https://functions.poehali.dev/cb22a964-580b-490f-a97e-6a94308c6580';
+import { createQuotedExchange } from '@/utils/exchangeQuote';
 
 interface ExchangeRequestModalProps {
   isOpen: boolean;
@@ -64,27 +63,14 @@ const ExchangeRequestModal = ({
     setLoading(true);
 
     try {
-      const response = await fetch(EXCHANGE_API_URL, {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({
-          action: 'create_exchange',
-          email: formData.email,
-          telegram: formData.telegram,
-          from_currency: fromCrypto,
-          to_currency: toCrypto,
-          from_amount: parseFloat(fromAmount),
-          to_amount: parseFloat(toAmount),
-          exchange_rate: exchangeRate,
-          from_address: formData.fromAddress,
-          to_address: formData.toAddress,
-          comment: formData.comment,
-          status: 'pending',
-        }),
+      const { result } = await createQuotedExchange(fromCrypto, toCrypto, fromAmount, {
+        email: formData.email,
+        telegram: formData.telegram,
+        from_address: formData.fromAddress,
+        to_address: formData.toAddress,
+        comment: formData.comment,
       });
 
-      const result = await response.json();
-
       if (result.success) {
         toast({
           title: 'Заявка создана',
@@ -1,7 +1,6 @@
 import { useToast } from '@/hooks/use-toast';
 import { notifyNewExchange } from '@/utils/telegramNotifications';
-
-const EXCHANGE_API_URL = 'https://functions.poehali.dev/cb22a964-580b-490f-a97e-6a94308c6580';
+import { createQuotedExchange } from '@/utils/exchangeQuote';
 
 interface CryptoRate {
   symbol: string;
@@ -43,35 +42,19 @@ export const useExchangeSubmit = () => {
         return;
       }
 
-      const exchangeRate = fromRate.price / toRate.price;
-
-      const response = await fetch(EXCHANGE_API_URL, {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({
-          action: 'create_exchange',
-          from_currency: fromCrypto,
-          to_currency: toCrypto,
-          from_amount: parseFloat(fromAmount),
-          to_amount: parseFloat(toAmount),
-          exchange_rate: exchangeRate,
-          status: 'pending',
-        }),
-      });
-
-      const result = await response.json();
+      const { result } = await createQuotedExchange(fromCrypto, toCrypto, fromAmount);
 
       if (result.success) {
         toast({
           title: 'Обмен создан',
-          description: `${fromAmount} ${fromCrypto} → ${toAmount} ${toCrypto}. ID: ${result.exchange_id}`,
+          description: `${result.from_amount} ${fromCrypto} → ${result.to_amount} ${toCrypto}. ID: ${result.exchange_id}`,
         });
         
         notifyNewExchange({
           from_currency: fromCrypto,
           to_currency: toCrypto,
-          from_amount: fromAmount,
-          to_amount: toAmount,
+          from_amount: result.from_amount,
+          to_amount: result.to_amount,
           exchange_id: result.exchange_id,
           user_email: isAuthenticated ? 'authenticated-user' : 'guest',
         });
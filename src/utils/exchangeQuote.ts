@@ -0,0 +1,55 @@
+const EXCHANGE_API_URL = 'https://functions.poehali.dev/cb22a964-580b-490f-a97e-6a94308c6580';
+
+export interface ExchangeQuote {
+  quote_id: string;
+  from_currency: string;
+  to_currency: string;
+  from_amount: string;
+  to_amount: string;
+  rate: string;
+  commission: string;
+  expires_at: number;
+}
+
+// Exchanges are priced by the server: get_quote returns signed figures (valid for a few seconds)
+// and create_exchange takes them from the quote id, not from the amounts shown in the form.
+export const requestQuote = async (
+  fromCurrency: string,
+  toCurrency: string,
+  fromAmount: string,
+): Promise<ExchangeQuote> => {
+  const params = new URLSearchParams({
+    action: 'get_quote',
+    from_currency: fromCurrency,
+    to_currency: toCurrency,
+    from_amount: String(parseFloat(fromAmount)),
+  });
+  const response = await fetch(`${EXCHANGE_API_URL}?${params}`);
+  const result = await response.json();
+  if (!response.ok) {
+    throw new Error(result.error || 'Failed to get a quote');
+  }
+  return result;
+};
+
+export const createQuotedExchange = async (
+  fromCurrency: string,
+  toCurrency: string,
+  fromAmount: string,
+  details: Record<string, unknown> = {},
+) => {
+  const quote = await requestQuote(fromCurrency, toCurrency, fromAmount);
+  const response = await fetch(EXCHANGE_API_URL, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({
+      ...details,
+      action: 'create_exchange',
+      quote_id: quote.quote_id,
+      from_currency: fromCurrency,
+      to_currency: toCurrency,
+    }),
+  });
+  const result = await response.json();
+  return { quote, result };
+};
@@ -0,0 +1,106 @@
+import importlib.util
+import json
+import os
+import sys
+from pathlib import Path
+from types import ModuleType, SimpleNamespace
+from typing import Any, Dict, List, Optional, Tuple
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+os.environ.setdefault('QUOTE_SECRET', 'test-quote-secret')
+
+class FakeCursor:
+    """Answers every statement with the rows the test queued for it, in order."""
+
+    def __init__(self, results: List[Tuple[Tuple[str, ...], List[Tuple]]]):
+        self._results = results
+        self.description: Optional[List[Tuple[str]]] = None
+        self._rows: List[Tuple] = []
+
+    def execute(self, query: str, params: Any = None) -> None:
+        columns, self._rows = self._results.pop(0)
+        self.description = [(column,) for column in columns]
+
+    def fetchone(self) -> Optional[Tuple]:
+        return self._rows[0] if self._rows else None
+
+    def fetchall(self) -> List[Tuple]:
+        return self._rows
+
+class FakeConnection:
+    def __init__(self, results: List[Tuple[Tuple[str, ...], List[Tuple]]]):
+        self._results = results
+        self.closed = False
+
+    def cursor(self, *args: Any, **kwargs: Any) -> FakeCursor:
+        return FakeCursor(self._results)
+
+    def commit(self) -> None:
+        pass
+
+    def rollback(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+class RoutedCursor:
+    """Answers each statement with the rows of the first fragment it contains; others return none."""
+
+    def __init__(self, connection: 'RoutedConnection', as_dicts: bool):
+        self._connection = connection
+        self._as_dicts = as_dicts
+        self.description: Optional[List[Tuple[str]]] = None
+        self._rows: List[Any] = []
+        self.rowcount = 0
+
+    def execute(self, query: str, params: Any = None) -> None:
+        self._connection.executed.append((query, params))
+        columns, rows = next(((columns, rows) for fragment, columns, rows in self._connection.answers
+                              if fragment in query), ((), []))
+        self.description = [(column,) for column in columns]
+        self._rows = [dict(zip(columns, row)) for row in rows] if self._as_dicts else list(rows)
+        self.rowcount = len(rows)
+
+    def fetchone(self) -> Any:
+        return self._rows[0] if self._rows else None
+
+    def fetchall(self) -> List[Any]:
+        return self._rows
+
+class RoutedConnection(FakeConnection):
+    """A connection whose answers are picked by query text, for flows of many statements."""
+
+    def __init__(self, answers: List[Tuple[str, Tuple[str, ...], List[Tuple]]]):
+        super().__init__([])
+        self.answers = answers
+        self.executed: List[Tuple[str, Any]] = []
+
+    def cursor(self, cursor_factory: Any = None, **kwargs: Any) -> RoutedCursor:
+        return RoutedCursor(self, as_dicts=cursor_factory is not None)
+
+    def statements(self, fragment: str) -> List[Any]:
+        return [params for query, params in self.executed if fragment in query]
+
+@pytest.fixture
+def load_function():
+    # A fresh copy per test, so in-process caches and buckets start empty.
+    def load(name: str) -> ModuleType:
+        spec = importlib.util.spec_from_file_location(name.replace('-', '_'), ROOT / 'backend' / name / 'index.py')
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    return load
+
+def get_event(params: Dict[str, str], headers: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    return {'httpMethod': 'GET', 'queryStringParameters': params, 'headers': headers or {}, 'isBase64Encoded': False}
+
+def post_event(body: Dict[str, Any]) -> Dict[str, Any]:
+    return {'httpMethod': 'POST', 'queryStringParameters': {}, 'headers': {}, 'body': json.dumps(body),
+            'isBase64Encoded': False}
+
+def call(module: ModuleType, event: Dict[str, Any]) -> Dict[str, Any]:
+    return module.handler(event, SimpleNamespace(request_id=None))
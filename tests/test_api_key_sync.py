@@ -0,0 +1,26 @@
+import json
+
+import psycopg2
+
+from conftest import FakeConnection
+
+def test_failed_sync_keeps_the_calls_for_the_next_one(load_function, monkeypatch, capsys):
+    module = load_function('exchange-api')
+    module._key_buckets[7] = [10.0, 0.0, 3, None, 0.0]
+
+    def unavailable():
+        raise psycopg2.OperationalError('connection refused')
+
+    monkeypatch.setattr(module, 'get_db_connection', unavailable)
+    module.sync_api_key_usage()
+
+    assert module._key_buckets[7][2] == 3
+    assert module._rate_sync['thread'] is None
+    logged = json.loads(capsys.readouterr().out)
+    assert (logged['level'], logged['event'], logged['keys']) == ('error', 'api_key_sync_failed', 1)
+
+    conn = FakeConnection([(('id', 'request_count'), [(7, 3)])])
+    monkeypatch.setattr(module, 'get_db_connection', lambda: conn)
+    module.sync_api_key_usage()
+
+    assert module._key_buckets[7][2:4] == [0, 3]
@@ -0,0 +1,29 @@
+import threading
+
+def test_coalesced_and_leader_requests_are_exported(load_function):
+    module = load_function('exchange-api')
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_load():
+        started.set()
+        release.wait(5)
+        return 'rates'
+
+    leader = threading.Thread(target=module.single_flight, args=(('get_rates', ()), 1.0, slow_load))
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(target=module.single_flight, args=(('get_rates', ()), 1.0, slow_load))
+    follower.start()
+    while module.coalescing_stats.get(('get_rates', 'coalesced')) is None:
+        pass
+    release.set()
+    leader.join()
+    follower.join()
+    assert module.single_flight(('get_rates', ()), 1.0, slow_load) == 'rates'
+
+    lines = module.render_metrics().splitlines()
+    assert 'backend_coalescing_leader_requests_total{function="exchange-api",route="get_rates"} 1' in lines
+    assert 'backend_coalesced_requests_total{function="exchange-api",route="get_rates"} 1' in lines
+    assert 'backend_micro_cached_requests_total{function="exchange-api",route="get_rates"} 1' in lines
+    assert '# TYPE backend_coalesced_requests_total counter' in lines
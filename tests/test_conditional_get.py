@@ -0,0 +1,88 @@
+from datetime import datetime
+
+from conftest import FakeConnection, call, get_event
+
+UPDATED_AT = datetime(2025, 1, 2, 3, 4, 5)
+CURRENCY_COLUMNS = ('id', 'symbol', 'name', 'type', 'icon_emoji', 'is_active', 'decimals', 'created_at', 'updated_at')
+CURRENCIES = [(1, 'BTC', 'Bitcoin', 'crypto', None, True, 8, UPDATED_AT, UPDATED_AT)]
+
+def warm_list_currencies(module, monkeypatch, headers=None, currencies=CURRENCIES):
+    # MAX(updated_at) first, then the currencies themselves.
+    conn = FakeConnection([(('max',), [(UPDATED_AT,)]), (CURRENCY_COLUMNS, currencies)])
+    monkeypatch.setattr(module, 'get_db_connection', lambda: conn)
+    response = call(module, get_event({'action': 'list_currencies'}, headers))
+    assert response['statusCode'] == 200
+    return response
+
+def forbid_database(module, monkeypatch):
+    connections = []
+    monkeypatch.setattr(module, 'get_db_connection', lambda: connections.append(1) or FakeConnection([]))
+    return connections
+
+def test_if_modified_since_is_answered_without_the_database(load_function, monkeypatch):
+    module = load_function('exchange-api')
+    warmed = warm_list_currencies(module, monkeypatch)
+    connections = forbid_database(module, monkeypatch)
+
+    response = call(module, get_event({'action': 'list_currencies'},
+                                      {'If-Modified-Since': warmed['headers']['Last-Modified']}))
+
+    assert response['statusCode'] == 304
+    assert response['body'] == ''
+    assert response['headers']['Last-Modified'] == warmed['headers']['Last-Modified']
+    assert connections == []
+
+def test_if_modified_since_is_ignored_next_to_if_none_match(load_function, monkeypatch):
+    module = load_function('exchange-api')
+    warmed = warm_list_currencies(module, monkeypatch)
+    conn = FakeConnection([(('max',), [(UPDATED_AT,)]), (CURRENCY_COLUMNS, CURRENCIES)])
+    monkeypatch.setattr(module, 'get_db_connection', lambda: conn)
+
+    response = call(module, get_event({'action': 'list_currencies'}, {
+        'If-None-Match': '"stale"',
+        'If-Modified-Since': warmed['headers']['Last-Modified']
+    }))
+
+    assert response['statusCode'] == 200
+
+def test_matching_etag_is_answered_without_the_database(load_function, monkeypatch):
+    module = load_function('exchange-api')
+    warmed = warm_list_currencies(module, monkeypatch)
+    connections = forbid_database(module, monkeypatch)
+
+    response = call(module, get_event({'action': 'list_currencies'}, {'If-None-Match': warmed['headers']['ETag']}))
+
+    assert response['statusCode'] == 304
+    assert response['headers']['ETag'] == warmed['headers']['ETag']
+    assert connections == []
+
+def test_revalidation_probes_the_version_without_running_the_read(load_function, monkeypatch):
+    module = load_function('exchange-api')
+    currencies = [(i, f'C{i}', f'Currency {i}', 'crypto', None, True, 8, UPDATED_AT, UPDATED_AT) for i in range(40)]
+    warmed = warm_list_currencies(module, monkeypatch, {'Accept-Encoding': 'gzip'}, currencies)
+    assert warmed['headers']['Content-Encoding'] == 'gzip'
+    module._last_modified.clear()
+    # Only the version probe is answered; running the read itself would find nothing queued.
+    conn = FakeConnection([(('max',), [(UPDATED_AT,)])])
+    monkeypatch.setattr(module, 'get_db_connection', lambda: conn)
+
+    response = call(module, get_event({'action': 'list_currencies'}, {'If-None-Match': warmed['headers']['ETag']}))
+
+    assert response['statusCode'] == 304
+    assert response['headers']['ETag'] == warmed['headers']['ETag']
+    assert warmed['headers']['ETag'].startswith('W/')
+    assert response['headers']['Vary'] == 'Accept-Encoding'
+
+def test_changed_table_is_served_in_full(load_function, monkeypatch):
+    module = load_function('exchange-api')
+    warmed = warm_list_currencies(module, monkeypatch)
+    module._last_modified.clear()
+    later = datetime(2025, 1, 3)
+    conn = FakeConnection([(('max',), [(later,)]), (CURRENCY_COLUMNS, CURRENCIES)])
+    monkeypatch.setattr(module, 'get_db_connection', lambda: conn)
+
+    response = call(module, get_event({'action': 'list_currencies'},
+                                      {'If-Modified-Since': warmed['headers']['Last-Modified']}))
+
+    assert response['statusCode'] == 200
+    assert response['headers']['Last-Modified'] == 'Fri, 03 Jan 2025 00:00:00 GMT'
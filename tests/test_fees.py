@@ -0,0 +1,62 @@
+import json
+from decimal import Decimal
+
+from conftest import RoutedConnection, call, post_event
+
+RULE_COLUMNS = ('from_currency', 'to_currency', 'commission_percent', 'min_commission', 'max_commission')
+
+def fee_database(rules):
+    return RoutedConnection([
+        ('FROM exchange_rates', ('from_currency', 'to_currency', 'rate'), [('BTC', 'USD', Decimal('60000'))]),
+        ('fee_settings_version', ('version',), [(3,)]),
+        ('FROM commission_settings', RULE_COLUMNS, rules)
+    ])
+
+def calculate(module, monkeypatch, rules, items):
+    monkeypatch.setattr(module, 'get_db_connection', lambda: fee_database(rules))
+    response = call(module, post_event({'action': 'calculate_fees', 'items': items}))
+    assert response['statusCode'] == 200
+    return json.loads(response['body'])
+
+def test_most_specific_rule_wins(load_function, monkeypatch):
+    module = load_function('exchange-api')
+    rules = [('*', '*', Decimal('2.5'), Decimal('0'), None), ('*', 'USDT', Decimal('1.5'), Decimal('0'), None),
+             ('BTC', '*', Decimal('1.0'), Decimal('0'), None), ('BTC', 'USDT', Decimal('0.5'), Decimal('0'), None)]
+    pairs = [('BTC', 'USDT'), ('BTC', 'ETH'), ('ETH', 'USDT'), ('ETH', 'BTC')]
+
+    items = [{'from_currency': source, 'to_currency': target, 'amount': 100} for source, target in pairs]
+
+    result = calculate(module, monkeypatch, rules, items)
+
+    percents = [Decimal(fee['commission_percent']) for fee in result['fees']]
+    assert percents == [Decimal('0.5'), Decimal('1.0'), Decimal('1.5'), Decimal('2.5')]
+    assert result['settings_version'] == 3
+
+def test_source_wildcard_outranks_target_wildcard(load_function):
+    module = load_function('exchange-api')
+    rules = module.compile_fee_rules([('*', 'USDT', Decimal('1.5'), Decimal('0'), None),
+                                      ('BTC', '*', Decimal('1.0'), Decimal('0'), None)])
+
+    assert module.fee_rule(rules, 'BTC', 'USDT')[0] == Decimal('1.0')
+
+def test_unmatched_pair_gets_the_default_commission(load_function):
+    module = load_function('exchange-api')
+    rules = module.compile_fee_rules([('BTC', 'USDT', Decimal('0.5'), None, None),
+                                      ('ETH', 'USDT', None, Decimal('1'), None)])
+
+    assert module.fee_rule(rules, 'LTC', 'BTC') == module.DEFAULT_COMMISSION
+    # A rule without a percentage charges the default one, and one without a minimum charges none.
+    assert module.fee_rule(rules, 'ETH', 'USDT') == (module.DEFAULT_COMMISSION[0], Decimal('1'), None)
+    assert module.fee_rule(rules, 'BTC', 'USDT') == (Decimal('0.5'), Decimal('0'), None)
+
+def test_fee_is_bounded_and_discounted(load_function):
+    module = load_function('exchange-api')
+    rule = (Decimal('1'), Decimal('0.5'), Decimal('3'))
+
+    assert module.calculate_fee(rule, Decimal('100')) == Decimal('1')
+    assert module.calculate_fee(rule, Decimal('10')) == Decimal('0.5')
+    assert module.calculate_fee(rule, Decimal('1000')) == Decimal('3')
+    # The discount lowers the percentage, not the bounds.
+    assert module.calculate_fee(rule, Decimal('100'), Decimal('20')) == Decimal('0.8')
+    assert module.calculate_fee(rule, Decimal('10'), Decimal('20')) == Decimal('0.5')
+    assert module.calculate_fee((Decimal('1'), Decimal('0'), None), Decimal('0.000000015')) == Decimal('0.00000001')
@@ -0,0 +1,79 @@
+import json
+from collections import defaultdict
+from decimal import Decimal
+
+from conftest import FakeConnection, RoutedConnection
+
+def posted_entries(conn):
+    return [(kind, reference, exchange_id, json.loads(lines))
+            for kind, reference, exchange_id, lines in conn.statements('SELECT post_ledger_entry')]
+
+def currency_totals(lines):
+    totals = defaultdict(Decimal)
+    for line in lines:
+        totals[line['currency']] += Decimal(str(line['amount']))
+    return dict(totals)
+
+def test_entry_lines_are_sent_as_one_posting(load_function):
+    module = load_function('trading-features-api')
+    conn = RoutedConnection([('SELECT post_ledger_entry', ('post_ledger_entry',), [(11,)])])
+
+    entry_id = module.post_ledger_entry(conn, 'referral_commission', 'referral_usage:5', 42, [
+        ('referral_expense:USD', 'USD', Decimal('1.25')), ('referral:7:USD', 'USD', Decimal('-1.25'))
+    ])
+
+    assert entry_id == 11
+    [(kind, reference, exchange_id, lines)] = posted_entries(conn)
+    assert (kind, reference, exchange_id) == ('referral_commission', 'referral_usage:5', 42)
+    assert [line['account'] for line in lines] == ['referral_expense:USD', 'referral:7:USD']
+    assert currency_totals(lines) == {'USD': 0}
+
+def test_already_posted_entry_returns_none(load_function):
+    module = load_function('trading-features-api')
+    conn = RoutedConnection([('SELECT post_ledger_entry', ('post_ledger_entry',), [(None,)])])
+
+    assert module.post_ledger_entry(conn, 'referral_commission', 'referral_usage:5', None, []) is None
+
+def test_credited_commission_posts_a_balanced_entry(load_function):
+    module = load_function('trading-features-api')
+    # One answer row makes the UPDATE's rowcount 1: the code exists and was credited.
+    conn = RoutedConnection([('UPDATE referral_codes', (), [()]),
+                             ('SELECT post_ledger_entry', ('post_ledger_entry',), [(11,)])])
+
+    result = module.run_referral_commission(conn, {'referral_code_id': 7, 'commission_usd': 1.5,
+                                                   'referral_usage_id': 5, 'exchange_id': 42})
+
+    assert result == {'referral_code_id': 7, 'credited': True}
+    [(kind, reference, exchange_id, lines)] = posted_entries(conn)
+    assert (kind, reference, exchange_id) == ('referral_commission', 'referral_usage:5', 42)
+    assert {line['account']: Decimal(str(line['amount'])) for line in lines} == {
+        'referral_expense:USD': Decimal('1.5'), 'referral:7:USD': Decimal('-1.5')
+    }
+
+def test_commission_for_a_missing_code_is_not_posted(load_function):
+    module = load_function('trading-features-api')
+    conn = RoutedConnection([('SELECT post_ledger_entry', ('post_ledger_entry',), [(11,)])])
+
+    result = module.run_referral_commission(conn, {'referral_code_id': 7, 'commission_usd': 1.5,
+                                                   'referral_usage_id': 5, 'exchange_id': 42})
+
+    assert result == {'referral_code_id': 7, 'credited': False}
+    assert posted_entries(conn) == []
+
+def test_checkpoint_reports_mismatched_accounts_and_unbalanced_currencies(load_function):
+    module = load_function('admin-api')
+    conn = FakeConnection([
+        (('code', 'balance', 'computed_balance', 'verified'), [
+            ('customer:BTC', Decimal('1.5'), Decimal('1.5'), True),
+            ('referral:7:USD', Decimal('-3'), Decimal('-2'), False)
+        ]),
+        (('currency', 'sum'), [('USD', Decimal('-1'))])
+    ])
+
+    result = module.run_ledger_checkpoint(conn, {})
+
+    assert result == {
+        'accounts_checked': 2,
+        'mismatched': [{'account': 'referral:7:USD', 'balance': Decimal('-3'), 'computed_balance': Decimal('-2')}],
+        'unbalanced_currencies': {'USD': Decimal('-1')}
+    }
@@ -0,0 +1,57 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from server.app import FunctionHost
+
+class RecordingPool:
+    """Stands in for the asyncpg pool; every exchange it is asked for does not exist."""
+
+    def __init__(self):
+        self.queries = []
+
+    async def fetchrow(self, query, *args):
+        self.queries.append(args)
+        return None
+
+def get_exchange(host, headers=()):
+    scope = {'type': 'http', 'method': 'GET', 'path': '/exchange-api/',
+             'query_string': b'action=get_exchange&id=1', 'headers': list(headers), 'client': ('10.0.0.1', 5000)}
+    sent = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(host(scope, receive, send))
+    return dict(sent[0]['headers']), sent[0]['status']
+
+def native_host(module):
+    host = FunctionHost(threads=2, pool_size=1, async_pool_size=1, max_body_bytes=1024)
+    host.modules = {'exchange-api': module}
+    host.async_pool = RecordingPool()
+    host.executor = ThreadPoolExecutor(max_workers=2)
+    return host
+
+def test_native_read_without_a_key_is_refused(load_function, monkeypatch):
+    module = load_function('exchange-api')
+    monkeypatch.setattr(module, 'API_AUTH_REQUIRED', True)
+    host = native_host(module)
+
+    headers, status = get_exchange(host)
+
+    assert status == 401
+    assert host.async_pool.queries == []
+
+def test_native_read_over_the_limit_is_refused(load_function, monkeypatch):
+    module = load_function('exchange-api')
+    monkeypatch.setattr(module, 'ANONYMOUS_RATE_LIMIT_PER_MINUTE', 1)
+    host = native_host(module)
+
+    assert get_exchange(host)[1] == 404
+    headers, status = get_exchange(host)
+
+    assert status == 429
+    assert b'retry-after' in headers
+    assert len(host.async_pool.queries) == 1
@@ -0,0 +1,102 @@
+import json
+import time
+from datetime import datetime
+from decimal import Decimal
+
+from conftest import RoutedConnection, call, get_event, post_event
+
+CREATED_AT = datetime(2025, 1, 2, 3, 4, 5)
+
+def exchange_database():
+    return RoutedConnection([
+        ('FROM exchange_rates', ('from_currency', 'to_currency', 'rate'), [('BTC', 'USD', Decimal('60000'))]),
+        ('fee_settings_version', ('version',), [(1,)]),
+        ('FROM commission_settings', ('from_currency', 'to_currency', 'commission_percent', 'min_commission',
+                                      'max_commission'), [('*', '*', Decimal('1.5'), Decimal('0'), None)]),
+        ('SELECT id FROM clients', ('id',), []),
+        ('INSERT INTO clients', ('id',), [(5,)]),
+        ('SELECT * FROM clients', ('id', 'verification_level'), [(5, 'none')]),
+        ('FROM exchange_limits', ('single_transaction_limit_usd',), [(Decimal('1000'),)]),
+        ('INSERT INTO exchanges', ('id', 'created_at'), [(77, CREATED_AT)])
+    ])
+
+def test_exchange_is_created_from_the_quote(load_function, monkeypatch):
+    module = load_function('exchange-api')
+    conn = exchange_database()
+    monkeypatch.setattr(module, 'get_db_connection', lambda: conn)
+
+    quoted = call(module, get_event({'action': 'get_quote', 'from_currency': 'BTC', 'to_currency': 'USD',
+                                     'from_amount': '0.01'}))
+    assert quoted['statusCode'] == 200
+    quote = json.loads(quoted['body'])
+    assert (quote['commission'], quote['to_amount']) == ('0.00015000', '591.00000000')
+
+    # Whatever the client claims about the price is ignored in favour of the signed quote.
+    created = call(module, post_event({'action': 'create_exchange', 'quote_id': quote['quote_id'],
+                                       'from_currency': 'BTC', 'to_currency': 'USD', 'email': 'a@b.c',
+                                       'to_amount': 1000, 'exchange_rate': 100000}))
+
+    assert created['statusCode'] == 201
+    body = json.loads(created['body'])
+    assert (body['exchange_id'], body['to_amount'], body['commission']) == (77, '591.00000000', '0.00015000')
+    [params] = conn.statements('INSERT INTO exchanges')
+    client_id, from_currency, to_currency, from_amount, to_amount, rate = params[:6]
+    assert (client_id, from_currency, to_currency, from_amount, to_amount) == (5, 'BTC', 'USD', '0.01', '591.00000000')
+    assert Decimal(rate) == Decimal('60000')
+    assert params[9] == module.verify_quote(quote['quote_id'])['ref']
+    assert conn.statements('INSERT INTO transaction_logs')
+
+def signed_quote(module, **fields):
+    quote = {'ref': 'a1b2c3d4e5f60718', 'from_currency': 'BTC', 'to_currency': 'USD', 'from_amount': '0.01',
+             'to_amount': '591.00000000', 'rate': '60000.00000000', 'commission': '0.00015000',
+             'from_rate_usd': '60000.00000000', 'referral_code_id': None, 'expires_at': time.time() + 30, **fields}
+    return module.sign_quote(quote)
+
+def test_signed_quote_verifies(load_function):
+    module = load_function('exchange-api')
+
+    quote = module.verify_quote(signed_quote(module))
+
+    assert (quote['from_currency'], quote['to_currency'], quote['to_amount']) == ('BTC', 'USD', '591.00000000')
+
+def test_tampered_quote_is_refused(load_function):
+    module = load_function('exchange-api')
+    body, _, signature = signed_quote(module).partition('.')
+    richer_body = signed_quote(module, to_amount='5910.00000000').partition('.')[0]
+
+    assert module.verify_quote(f'{richer_body}.{signature}') is None
+    assert module.verify_quote(f'{body}.{signature[::-1]}') is None
+    assert module.verify_quote(body) is None
+
+def test_quote_signed_with_another_secret_is_refused(load_function, monkeypatch):
+    module = load_function('exchange-api')
+    quote_id = signed_quote(module)
+
+    monkeypatch.setattr(module, 'QUOTE_SECRET', b'another-instance')
+
+    assert module.verify_quote(quote_id) is None
+
+def test_expired_quote_is_refused(load_function, monkeypatch):
+    module = load_function('exchange-api')
+    conn = exchange_database()
+    monkeypatch.setattr(module, 'get_db_connection', lambda: conn)
+    expired = signed_quote(module, expires_at=time.time() - 1)
+
+    created = call(module, post_event({'action': 'create_exchange', 'quote_id': expired, 'from_currency': 'BTC',
+                                       'to_currency': 'USD', 'email': 'a@b.c'}))
+
+    assert created['statusCode'] == 400
+    assert json.loads(created['body'])['error'] == 'Quote is invalid or expired'
+    assert not conn.statements('INSERT INTO exchanges')
+
+def test_quote_for_another_pair_is_refused(load_function, monkeypatch):
+    module = load_function('exchange-api')
+    conn = exchange_database()
+    monkeypatch.setattr(module, 'get_db_connection', lambda: conn)
+
+    created = call(module, post_event({'action': 'create_exchange', 'quote_id': signed_quote(module),
+                                       'from_currency': 'ETH', 'to_currency': 'USD', 'email': 'a@b.c'}))
+
+    assert created['statusCode'] == 400
+    assert json.loads(created['body'])['error'] == 'Quote is for a different currency pair'
+    assert not conn.statements('INSERT INTO exchanges')
@@ -0,0 +1,48 @@
+import json
+from decimal import Decimal
+
+from conftest import RoutedConnection
+
+SETTLEMENT_COLUMNS = ('id', 'referral_code_id', 'usage_count', 'commission_usd', 'count')
+
+def settlement_database(settlements):
+    return RoutedConnection([
+        ('WITH claimed AS', SETTLEMENT_COLUMNS, settlements),
+        ('SELECT post_ledger_entry', ('post_ledger_entry',), [(31,)]),
+        ('INSERT INTO jobs', ('id',), [(90,)])
+    ])
+
+def test_batch_is_credited_per_code_in_one_balanced_entry(load_function):
+    module = load_function('trading-features-api')
+    conn = settlement_database([(4, 7, 2, Decimal('3.00'), 3), (5, 9, 1, Decimal('1.50'), 3)])
+
+    result = module.run_referral_settlement(conn, {'batch': 10})
+
+    assert result == {'settled_uses': 3, 'codes': 2, 'commission_usd': Decimal('4.50')}
+    # The codes are locked in id order before their totals move.
+    assert conn.statements('SELECT id FROM referral_codes') == [([7, 9],)]
+    assert conn.statements('UPDATE referral_codes rc') == [([4, 5],)]
+    [(kind, reference, exchange_id, lines)] = conn.statements('SELECT post_ledger_entry')
+    assert (kind, reference, exchange_id) == ('referral_commission', 'referral_settlement:4', None)
+    amounts = {line['account']: Decimal(str(line['amount'])) for line in json.loads(lines)}
+    assert amounts == {'referral_expense:USD': Decimal('4.50'), 'referral:7:USD': Decimal('-3.00'),
+                       'referral:9:USD': Decimal('-1.50')}
+    assert sum(amounts.values()) == 0
+    assert conn.statements('INSERT INTO jobs') == []
+
+def test_full_batch_queues_the_next_round(load_function):
+    module = load_function('trading-features-api')
+    conn = settlement_database([(4, 7, 2, Decimal('3.00'), 2)])
+
+    module.run_referral_settlement(conn, {'batch': 2, 'round': 1})
+
+    [(kind, payload, _, _, dedupe_key)] = conn.statements('INSERT INTO jobs')
+    assert (kind, json.loads(payload), dedupe_key) == ('referral_settlement', {'batch': 2, 'round': 2},
+                                                       'referral_settlement:backlog:0')
+
+def test_nothing_to_settle_posts_nothing(load_function):
+    module = load_function('trading-features-api')
+    conn = settlement_database([])
+
+    assert module.run_referral_settlement(conn, {}) == {'settled_uses': 0, 'codes': 0}
+    assert len(conn.executed) == 1
@@ -0,0 +1,72 @@
+import json
+
+from conftest import RoutedConnection, call, post_event
+
+TRANSITION_COLUMNS = ('id', 'status', 'moved')
+
+def put(module, monkeypatch, conn, body):
+    monkeypatch.setattr(module, 'get_db_connection', lambda: conn)
+    response = call(module, {**post_event(body), 'httpMethod': 'PUT'})
+    return response['statusCode'], json.loads(response['body'])
+
+def test_unknown_exchange_is_not_found(load_function, monkeypatch):
+    module = load_function('exchange-api')
+    conn = RoutedConnection([('WITH current AS', TRANSITION_COLUMNS, [(5, None, False)])])
+
+    status, _ = put(module, monkeypatch, conn, {'action': 'update_exchange_status', 'id': 5, 'status': 'cancelled'})
+
+    assert status == 404
+
+def test_completion_without_a_deposit_is_refused(load_function, monkeypatch):
+    module = load_function('exchange-api')
+    conn = RoutedConnection([('WITH current AS', TRANSITION_COLUMNS, [(5, 'pending', False)]),
+                             ('FROM exchange_transitions', ('requires_deposit',), [(True,)])])
+
+    status, body = put(module, monkeypatch, conn, {'action': 'update_exchange_status', 'id': 5, 'status': 'completed'})
+
+    assert status == 409
+    assert body == {'error': 'Cannot move exchange from pending to completed before its deposit is confirmed',
+                    'status': 'pending'}
+    [params] = conn.statements('WITH current AS')
+    assert (params['ids'], params['status'], params['performed_by']) == ([5], 'completed', 'admin')
+
+def test_transition_that_does_not_exist_is_refused(load_function, monkeypatch):
+    module = load_function('exchange-api')
+    conn = RoutedConnection([('WITH current AS', TRANSITION_COLUMNS, [(5, 'completed', False)])])
+
+    status, body = put(module, monkeypatch, conn, {'action': 'update_exchange_status', 'id': 5, 'status': 'pending'})
+
+    assert (status, body) == (409, {'error': 'Cannot move exchange from completed to pending', 'status': 'completed'})
+
+def test_repeated_status_still_records_the_transaction_hash(load_function, monkeypatch):
+    module = load_function('exchange-api')
+    conn = RoutedConnection([('WITH current AS', TRANSITION_COLUMNS, [(5, 'processing', False)])])
+
+    status, body = put(module, monkeypatch, conn, {'action': 'update_exchange_status', 'id': 5, 'status': 'processing',
+                                                   'transaction_hash': '0xabc'})
+
+    assert (status, body['status_from']) == (200, 'processing')
+    assert conn.statements('SET transaction_hash') == [('0xabc', 5)]
+
+def test_bulk_update_sorts_moved_unchanged_and_rejected(load_function, monkeypatch):
+    module = load_function('exchange-api')
+    conn = RoutedConnection([('WITH current AS', TRANSITION_COLUMNS, [
+        (1, 'pending', True), (2, 'cancelled', False), (3, 'completed', False), (4, None, False)
+    ])])
+
+    status, body = put(module, monkeypatch, conn, {'action': 'bulk_update_status', 'ids': [1, 2, 3, 4],
+                                                   'status': 'cancelled'})
+
+    assert status == 200
+    assert body == {'success': True, 'moved': 1, 'unchanged': [2],
+                    'rejected': [{'id': 3, 'status': 'completed'}, {'id': 4, 'status': None}]}
+
+def test_bulk_update_refuses_too_many_ids(load_function, monkeypatch):
+    module = load_function('exchange-api')
+    conn = RoutedConnection([])
+    ids = list(range(module.MAX_TRANSITION_IDS + 1))
+
+    status, body = put(module, monkeypatch, conn, {'action': 'bulk_update_status', 'ids': ids, 'status': 'cancelled'})
+
+    assert status == 400
+    assert conn.executed == []
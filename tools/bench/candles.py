@@ -0,0 +1,138 @@
+"""
+Rate history benchmark (rate_ticks / rate_candles from V0011, exchange-api get_candles)
+Loads --days of synthetic ticks (one every --tick-seconds) for --series pairs into
+DATABASE_URL, folds them into candles with the rate_rollup job and then, per resolution,
+compares the median time of:
+
+- candles: get_candles(), reading the pre-aggregated tier and re-binning it in SQL
+- raw: the same OHLC aggregation computed from rate_ticks for the same range
+
+It also prints the on-disk size of the ticks and of each candle tier. The benchmark pairs
+(BENCH<n>/USD) are deleted afterwards, so the tool can run against a development database.
+
+Usage:
+    DATABASE_URL=... python tools/bench/candles.py [--series 5] [--days 30] [--tick-seconds 5] [--calls 50]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from typing import Any, Callable, Dict, List
+
+from loadtest import load_functions
+
+RESOLUTIONS = (('1m', 1000), ('15m', 1000), ('1h', 720), ('4h', 180), ('1d', 30), ('1w', 5))
+
+RAW_SQL = """
+    SELECT array_agg(bucket ORDER BY bucket), array_agg(open ORDER BY bucket), array_agg(close ORDER BY bucket)
+    FROM (
+        SELECT date_bin(make_interval(secs => %(step)s), t.ts, %(origin)s) AS bucket,
+               (array_agg(t.rate ORDER BY t.ts))[1] AS open, MAX(t.rate) AS high, MIN(t.rate) AS low,
+               (array_agg(t.rate ORDER BY t.ts DESC))[1] AS close, COUNT(*) AS ticks
+        FROM rate_ticks t JOIN rate_series s ON s.id = t.series_id
+        WHERE s.from_currency = %(from_currency)s AND s.to_currency = %(to_currency)s
+          AND t.ts >= to_timestamp(%(start)s) AT TIME ZONE 'UTC' AND t.ts < to_timestamp(%(end)s) AT TIME ZONE 'UTC'
+        GROUP BY 1
+    ) candles
+"""
+
+def median_ms(run: Callable[[], Any], calls: int) -> float:
+    timings = []
+    for _ in range(calls):
+        started = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1000
+
+def cleanup(cursor) -> None:
+    cursor.execute("SELECT COALESCE(array_agg(id), '{}') FROM rate_series WHERE from_currency LIKE 'BENCH%%' AND to_currency = 'USD'")
+    ids = cursor.fetchone()[0]
+    cursor.execute('DELETE FROM rate_ticks WHERE series_id = ANY(%s)', (ids,))
+    cursor.execute('DELETE FROM rate_candles WHERE series_id = ANY(%s)', (ids,))
+    cursor.execute('DELETE FROM rate_series WHERE id = ANY(%s)', (ids,))
+
+def load_ticks(cursor, series: int, days: int, tick_seconds: int) -> int:
+    # A random walk per series, in one INSERT ... SELECT per series.
+    total = 0
+    for number in range(series):
+        cursor.execute("INSERT INTO rate_series (from_currency, to_currency) VALUES (%s, 'USD') RETURNING id",
+                       (f'BENCH{number}',))
+        series_id = cursor.fetchone()[0]
+        cursor.execute("""
+            INSERT INTO rate_ticks (ts, rate, series_id)
+            SELECT LOCALTIMESTAMP - make_interval(secs => n * %(step)s),
+                   %(base)s * exp(SUM((random() - 0.5) * 0.002) OVER (ORDER BY n DESC)), %(series_id)s
+            FROM generate_series(1, %(count)s) AS n
+        """, {'step': tick_seconds, 'base': 100.0 * (number + 1), 'series_id': series_id,
+              'count': days * 86400 // tick_seconds})
+        total += cursor.rowcount
+    return total
+
+def table_sizes(cursor) -> Dict[str, str]:
+    cursor.execute("""
+        SELECT 'ticks', pg_size_pretty(SUM(pg_total_relation_size(i.inhrelid)))
+        FROM pg_inherits i WHERE i.inhparent = 'rate_ticks'::regclass
+        UNION ALL
+        SELECT resolution || 's candles', pg_size_pretty(SUM(pg_column_size(c.*))) || ' of rows'
+        FROM rate_candles c GROUP BY resolution
+    """)
+    return dict(cursor.fetchall())
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--series', type=int, default=5)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--tick-seconds', type=int, default=5)
+    parser.add_argument('--calls', type=int, default=50, help='calls per resolution and form')
+    args = parser.parse_args()
+    database_url = os.environ.get('DATABASE_URL')
+    if not database_url:
+        sys.exit('DATABASE_URL is not set')
+    os.environ['METRICS_SAMPLE_RATE'] = '0'
+
+    import psycopg2
+    module = load_functions()['exchange-api']
+    conn = psycopg2.connect(database_url)
+    cursor = conn.cursor()
+    try:
+        cleanup(cursor)
+        started = time.perf_counter()
+        ticks = load_ticks(cursor, args.series, args.days, args.tick_seconds)
+        conn.commit()
+        print(f'{ticks:,} ticks for {args.series} series in {time.perf_counter() - started:.1f}s')
+
+        started = time.perf_counter()
+        since = time.strftime('%Y-%m-%d', time.gmtime(time.time() - (args.days + 1) * 86400))
+        result = module.run_rate_rollup(conn, {'since': since})
+        conn.commit()
+        cursor.execute('ANALYZE rate_ticks; ANALYZE rate_candles')
+        conn.commit()
+        print(f"rollup: {result['candles']} candles in {time.perf_counter() - started:.1f}s")
+        for name, size in table_sizes(cursor).items():
+            print(f'  {name:<16} {size}')
+
+        end = int(time.time())
+        print(f"{'resolution':<10} {'candles':>8} {'from tier':>10} {'from ticks':>11} {'speedup':>8}")
+        for resolution, limit in RESOLUTIONS:
+            params = {'from_currency': 'BENCH0', 'to_currency': 'USD', 'resolution': resolution, 'limit': limit, 'end': end}
+            responses: List[Dict[str, Any]] = []
+            served = median_ms(lambda: responses.append(module.get_candles(conn, params)), args.calls)
+            step = module.CANDLE_RESOLUTIONS[resolution]
+            raw = median_ms(lambda: cursor.execute(RAW_SQL, {
+                'step': step, 'origin': module.CANDLE_ORIGIN, 'from_currency': 'BENCH0', 'to_currency': 'USD',
+                'start': end - limit * step, 'end': end
+            }) or cursor.fetchall(), args.calls)
+            conn.rollback()
+            count = len(json.loads(responses[-1]['body'])['candles']['time'])
+            print(f'{resolution:<10} {count:>8} {served:>8.2f}ms {raw:>9.2f}ms {raw / served:>7.1f}x')
+    finally:
+        conn.rollback()
+        cleanup(cursor)
+        conn.commit()
+        conn.close()
+
+if __name__ == '__main__':
+    main()
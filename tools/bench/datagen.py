@@ -0,0 +1,665 @@
+"""
+Synthetic dataset generator for the db_migrations schema (V0001-V0005 tables)
+Fills clients, exchanges and everything hanging off them with skewed, lifecycle-
+consistent data, using COPY from several worker processes:
+
+- clients: power-law activity, KYC level mix, kyc_verifications, wallet_verifications,
+  api_keys, referral_codes, price_alerts and open/cancelled/expired limit_orders
+- exchanges: Zipf-like pair popularity, log-normal USD sizes, volume growing over
+  --days, status by age (pending/processing recent, completed/failed/cancelled older)
+- per exchange: transaction_logs following the status lifecycle, deposit/withdrawal
+  blockchain_transactions, aml_checks for large amounts, notifications,
+  referral_usage, payment_provider_transactions and filled limit_orders
+- exchange_rates, commission_settings and trading_analytics for the popular pairs
+- the ledger, posted from that history as the V0017 triggers would have
+
+Rows are a pure function of (--seed, --exchanges, --clients, --days, --end) and the
+currencies/providers seeded by the migrations, independent of --workers. Ids are
+assigned explicitly and sequences are moved past them afterwards.
+
+Usage:
+    DATABASE_URL=... python tools/bench/datagen.py --exchanges 10000000 [--seed 42]
+        [--clients N] [--days 365] [--end 2025-01-01T00:00] [--workers 8]
+        [--truncate] [--defer-indexes]
+"""
+
+import argparse
+import bisect
+import hashlib
+import io
+import math
+import multiprocessing
+import os
+import random
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+CHUNK_SIZE = 50000
+REFERRAL_EVERY = 33
+GROWTH = 1.6
+EPOCH = datetime(1970, 1, 1)
+
+PRICES_USD = {
+    'BTC': 65000.0, 'ETH': 3200.0, 'USDT': 1.0, 'USDC': 1.0, 'BNB': 580.0, 'USD': 1.0, 'EUR': 1.08,
+    'RUB': 0.011, 'LTC': 80.0, 'XRP': 0.55, 'TRX': 0.12, 'SOL': 150.0, 'ADA': 0.45, 'DOT': 7.0,
+    'DOGE': 0.15, 'MATIC': 0.7, 'AVAX': 35.0, 'SHIB': 0.000025, 'TON': 6.5, 'XMR': 160.0,
+    'BCH': 450.0, 'ATOM': 8.5, 'LINK': 15.0, 'UNI': 9.0, 'DAI': 1.0, 'BUSD': 1.0
+}
+POPULARITY = ('USDT', 'BTC', 'ETH', 'RUB', 'USD', 'USDC', 'TRX', 'TON', 'SOL', 'LTC', 'BNB', 'XRP',
+              'EUR', 'DOGE', 'XMR', 'BCH', 'ADA', 'DOT', 'MATIC', 'AVAX', 'LINK', 'ATOM', 'UNI', 'DAI',
+              'SHIB', 'BUSD')
+NETWORKS = {
+    'BTC': 'bitcoin', 'ETH': 'ethereum', 'USDT': 'tron', 'USDC': 'ethereum', 'BNB': 'bsc',
+    'TRX': 'tron', 'SOL': 'solana', 'TON': 'ton', 'LTC': 'litecoin', 'DOGE': 'dogecoin',
+    'XRP': 'ripple', 'BCH': 'bitcoin-cash', 'XMR': 'monero', 'BUSD': 'bsc'
+}
+CONFIRMATIONS = {'ethereum': 12, 'bsc': 15, 'bitcoin': 3, 'solana': 32}
+LEVELS = (('none', 0.70), ('basic', 0.20), ('advanced', 0.08), ('premium', 0.02))
+FIRST_NAMES = ('Alex', 'Maria', 'Ivan', 'Olga', 'Dmitry', 'Anna', 'Sergey', 'Elena', 'John', 'Emma',
+               'Liam', 'Sofia', 'Mikhail', 'Daria', 'Pavel', 'Nina', 'Artem', 'Yulia', 'Omar', 'Mei')
+LAST_NAMES = ('Ivanov', 'Smirnova', 'Kuznetsov', 'Popova', 'Sokolov', 'Lebedeva', 'Smith', 'Garcia',
+              'Muller', 'Rossi', 'Novak', 'Kowalski', 'Petrov', 'Volkova', 'Chen', 'Kim', 'Silva', 'Haddad')
+DOMAINS = ('gmail.com', 'mail.ru', 'yandex.ru', 'outlook.com', 'proton.me', 'icloud.com')
+COUNTRIES = (('RU', 0.45), ('KZ', 0.1), ('UA', 0.08), ('DE', 0.07), ('US', 0.07), ('TR', 0.06),
+             ('AE', 0.05), ('GE', 0.05), ('AM', 0.04), ('RS', 0.03))
+CODE_ALPHABET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+# Tables written by the generator, parents first; reference data from the migrations is kept.
+GENERATED_TABLES = (
+    'clients', 'referral_codes', 'kyc_verifications', 'wallet_verifications', 'api_keys', 'price_alerts',
+    'exchanges', 'transaction_logs', 'blockchain_transactions', 'aml_checks', 'notifications',
+    'referral_usage', 'payment_provider_transactions', 'limit_orders', 'trading_analytics'
+)
+# Not generated row by row, but derived from the generated history by finish().
+DERIVED_TABLES = ('ledger_accounts', 'ledger_entries', 'ledger_lines', 'ledger_checkpoints', 'referral_settlements')
+COLUMNS = {
+    'clients': ('id', 'email', 'phone', 'full_name', 'telegram_username', 'wallet_addresses', 'created_at',
+                'updated_at', 'is_active', 'verification_level', 'kyc_status', 'aml_status', 'risk_level',
+                'country_code', 'date_of_birth', 'last_login_at', 'ip_address'),
+    'referral_codes': ('id', 'client_id', 'code', 'discount_percent', 'commission_percent', 'is_active',
+                       'created_at', 'updated_at'),
+    'kyc_verifications': ('id', 'client_id', 'verification_level', 'status', 'document_type', 'document_number',
+                          'document_front_url', 'selfie_url', 'rejection_reason', 'verified_at', 'expires_at',
+                          'created_at', 'updated_at'),
+    'wallet_verifications': ('id', 'client_id', 'wallet_address', 'currency', 'verification_method',
+                             'verification_code', 'is_verified', 'verified_at', 'created_at'),
+    'api_keys': ('id', 'client_id', 'api_key', 'key_hash', 'api_secret', 'is_active', 'last_used_at', 'created_at'),
+    'price_alerts': ('id', 'client_id', 'currency', 'target_price', 'condition', 'is_triggered', 'is_active',
+                     'triggered_at', 'created_at'),
+    'limit_orders': ('id', 'client_id', 'from_currency', 'to_currency', 'from_amount', 'target_rate', 'status',
+                     'expiry_date', 'filled_exchange_id', 'created_at', 'filled_at'),
+    'exchanges': ('id', 'client_id', 'from_currency', 'to_currency', 'from_amount', 'to_amount', 'exchange_rate',
+                  'status', 'from_wallet', 'to_wallet', 'transaction_hash', 'created_at', 'completed_at', 'notes',
+                  'deposit_tx_hash', 'deposit_confirmed_at', 'withdrawal_tx_hash', 'withdrawal_confirmed_at',
+                  'blockchain_from', 'blockchain_to', 'referral_code_id', 'order_number', 'commission', 'commission_usd'),
+    'transaction_logs': ('id', 'exchange_id', 'action', 'status_from', 'status_to', 'performed_by', 'notes',
+                         'created_at'),
+    'blockchain_transactions': ('id', 'exchange_id', 'blockchain', 'tx_hash', 'from_address', 'to_address',
+                                'amount', 'currency', 'confirmations', 'status', 'block_number', 'created_at',
+                                'confirmed_at'),
+    'aml_checks': ('id', 'client_id', 'exchange_id', 'check_type', 'risk_level', 'risk_score', 'sanctions_hit',
+                   'pep_hit', 'adverse_media_hit', 'check_result', 'checked_by', 'created_at'),
+    'notifications': ('id', 'client_id', 'type', 'title', 'message', 'is_read', 'created_at'),
+    'referral_usage': ('id', 'referral_code_id', 'referred_client_id', 'exchange_id', 'commission_usd',
+                       'created_at'),
+    'payment_provider_transactions': ('id', 'provider_id', 'exchange_id', 'external_transaction_id', 'amount',
+                                      'currency', 'status', 'payment_address', 'confirmations', 'created_at',
+                                      'updated_at', 'completed_at')
+}
+
+# -- Helpers ----------------------------------------------------------------------------
+
+def stamp(epoch: float) -> str:
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(epoch))
+
+def pick(rng: random.Random, weighted: Tuple[Tuple[str, float], ...]) -> str:
+    roll = rng.random()
+    for value, weight in weighted:
+        roll -= weight
+        if roll < 0:
+            return value
+    return weighted[-1][0]
+
+def referral_code(client_id: int) -> str:
+    # Multiplication by an odd prime (coprime to 36**8) is a bijection, so codes never collide.
+    value = client_id * 1_000_000_007 % 36 ** 8
+    chars = []
+    for _ in range(8):
+        value, digit = divmod(value, 36)
+        chars.append(CODE_ALPHABET[digit])
+    return ''.join(chars)
+
+def tx_hash(rng: random.Random, network: str) -> str:
+    value = rng.getrandbits(256)
+    return f'{value:064x}' if network in ('bitcoin', 'litecoin', 'dogecoin', 'bitcoin-cash') else f'0x{value:064x}'
+
+def address(rng: random.Random, network: Optional[str]) -> str:
+    if network == 'bitcoin':
+        return f'bc1q{rng.getrandbits(160):040x}'
+    if network == 'tron':
+        return f'T{rng.getrandbits(160):040x}'[:34]
+    return f'0x{rng.getrandbits(160):040x}'
+
+def copy_rows(cursor, table: str, rows: List[Tuple]) -> None:
+    if not rows:
+        return
+    buffer = io.StringIO()
+    buffer.writelines('\t'.join('\\N' if value is None else str(value) for value in row) + '\n' for row in rows)
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table} ({', '.join(COLUMNS[table])}) FROM STDIN", buffer)
+
+# -- Plan (computed once, shared with workers) ------------------------------------------
+
+def build_plan(conn, args: argparse.Namespace) -> Dict[str, Any]:
+    cursor = conn.cursor()
+    cursor.execute('SELECT symbol, type FROM currencies WHERE is_active ORDER BY symbol')
+    currencies = {symbol: kind for symbol, kind in cursor.fetchall()}
+    cursor.execute('SELECT id, supported_currencies FROM payment_providers ORDER BY id')
+    providers = {}
+    for provider_id, supported in cursor.fetchall():
+        for symbol in supported or []:
+            providers.setdefault(symbol, []).append(provider_id)
+
+    ranked = [symbol for symbol in POPULARITY if symbol in currencies]
+    ranked += sorted(symbol for symbol in currencies if symbol not in ranked)
+    pairs, weights = [], []
+    for i, source in enumerate(ranked):
+        for j, target in enumerate(ranked):
+            if source == target or (currencies[source] == 'fiat' and currencies[target] == 'fiat'):
+                continue
+            pairs.append((source, target))
+            weights.append(1.0 / ((i + 1) * (j + 1)) ** 1.1)
+    total = sum(weights)
+    cumulative, running = [], 0.0
+    for weight in weights:
+        running += weight / total
+        cumulative.append(running)
+
+    end = args.end.replace(tzinfo=None) if args.end else datetime.now(timezone.utc).replace(tzinfo=None, minute=0, second=0, microsecond=0)
+    end_epoch = (end - EPOCH).total_seconds()
+    return {
+        'seed': args.seed,
+        'clients': args.clients or max(100, args.exchanges // 8),
+        'exchanges': args.exchanges,
+        'start': end_epoch - args.days * 86400,
+        'span': args.days * 86400,
+        'end': end_epoch,
+        'pairs': pairs,
+        'cumulative': cumulative,
+        'prices': {symbol: PRICES_USD.get(symbol, 1.0) for symbol in currencies},
+        'fiat': [symbol for symbol, kind in currencies.items() if kind == 'fiat'],
+        'crypto': [symbol for symbol, kind in currencies.items() if kind == 'crypto'],
+        'providers': providers
+    }
+
+def moment(plan: Dict[str, Any], index: int, total: int, rng: random.Random) -> float:
+    # Volume grows over the window: ids are spread by the inverse of F(t) = t ** GROWTH.
+    fraction = min(1.0, (index + rng.random()) / total) ** (1 / GROWTH)
+    return plan['start'] + plan['span'] * fraction
+
+def price(plan: Dict[str, Any], symbol: str, epoch: float) -> float:
+    base = plan['prices'][symbol]
+    if base in (1.0, 1.08) and symbol in ('USDT', 'USDC', 'DAI', 'BUSD', 'USD', 'EUR'):
+        return base
+    phase = (sum(map(ord, symbol)) % 97) / 97 * 2 * math.pi
+    return base * (1 + 0.25 * math.sin(epoch / (86400 * 45) + phase))
+
+# -- Client chunk -----------------------------------------------------------------------
+
+def client_rows(plan: Dict[str, Any], lo: int, hi: int) -> Dict[str, List[Tuple]]:
+    rng = random.Random(f"{plan['seed']}:clients:{lo}")
+    total = plan['clients']
+    tables: Dict[str, List[Tuple]] = {name: [] for name in (
+        'clients', 'referral_codes', 'kyc_verifications', 'wallet_verifications', 'api_keys', 'price_alerts',
+        'limit_orders')}
+
+    for cid in range(lo, hi):
+        created = moment(plan, cid - 1, total, rng)
+        level = pick(rng, LEVELS)
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        verified = level != 'none'
+        kyc_status = 'approved' if verified else ('pending' if rng.random() < 0.03 else 'none')
+        risk = pick(rng, (('low', 0.92), ('medium', 0.06), ('high', 0.02)))
+        last_login = min(plan['end'], created + rng.expovariate(1 / (86400 * 20)))
+        tables['clients'].append((
+            cid, f'{first.lower()}.{last.lower()}{cid}@{rng.choice(DOMAINS)}',
+            f'+7{rng.randrange(10 ** 9, 10 ** 10)}' if rng.random() < 0.6 else None,
+            f'{first} {last}', f'{first.lower()}_{cid}' if rng.random() < 0.4 else None, '{}',
+            stamp(created), stamp(last_login), 't' if rng.random() < 0.97 else 'f', level, kyc_status,
+            'approved' if verified else 'none', risk, pick(rng, COUNTRIES),
+            f'{rng.randint(1960, 2004)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}' if verified else None,
+            stamp(last_login), f'{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}'
+        ))
+
+        if verified or kyc_status == 'pending':
+            submitted = created + rng.uniform(600, 86400 * 3)
+            if verified and rng.random() < 0.15:
+                tables['kyc_verifications'].append((
+                    cid * 2 + 1, cid, level, 'rejected', 'passport', f'{rng.randrange(10 ** 9):09d}',
+                    f'https://storage.example.com/kyc/{cid}/front-1.jpg', f'https://storage.example.com/kyc/{cid}/selfie-1.jpg',
+                    'Document is blurry', None, None, stamp(submitted), stamp(submitted + 3600)
+                ))
+                submitted += 86400
+            reviewed = submitted + rng.uniform(600, 86400)
+            tables['kyc_verifications'].append((
+                cid * 2, cid, level, 'approved' if verified else 'pending', rng.choice(('passport', 'id_card', 'driver_license')),
+                f'{rng.randrange(10 ** 9):09d}', f'https://storage.example.com/kyc/{cid}/front.jpg',
+                f'https://storage.example.com/kyc/{cid}/selfie.jpg', None,
+                stamp(reviewed) if verified else None, stamp(reviewed + 2 * 365 * 86400) if verified else None,
+                stamp(submitted), stamp(reviewed if verified else submitted)
+            ))
+
+        if rng.random() < 0.1:
+            for k in range(rng.randint(1, 2)):
+                currency = rng.choice(('BTC', 'ETH', 'USDT', 'TRX', 'TON'))
+                is_verified = rng.random() < 0.8
+                at = created + rng.uniform(60, 86400 * 30)
+                tables['wallet_verifications'].append((
+                    cid * 2 + k, cid, address(rng, NETWORKS.get(currency)), currency,
+                    rng.choice(('signature', 'transaction', 'message')), f'{rng.randrange(10 ** 6):06d}',
+                    't' if is_verified else 'f', stamp(at + 300) if is_verified else None, stamp(at)
+                ))
+
+        if rng.random() < 0.01:
+            key = f'ak_{rng.getrandbits(128):032x}'
+            tables['api_keys'].append((
+                cid, cid, key, hashlib.sha256(key.encode()).hexdigest(), f'{rng.getrandbits(256):064x}', 't',
+                stamp(last_login), stamp(created + 86400)
+            ))
+
+        if cid % REFERRAL_EVERY == 0:
+            at = stamp(created + rng.uniform(3600, 86400 * 10))
+            tables['referral_codes'].append((
+                cid // REFERRAL_EVERY, cid, referral_code(cid), rng.choice((0, 0, 5, 10)), rng.choice((5, 10, 10, 15)),
+                't' if rng.random() < 0.95 else 'f', at, at
+            ))
+
+        if rng.random() < 0.2:
+            currency = rng.choice(('BTC', 'ETH', 'SOL', 'TON', 'BNB'))
+            current = price(plan, currency, created)
+            above = rng.random() < 0.5
+            triggered = rng.random() < 0.3
+            tables['price_alerts'].append((
+                cid, cid, currency, f'{current * (1.1 if above else 0.9):.8f}', 'above' if above else 'below',
+                't' if triggered else 'f', 'f' if triggered else 't',
+                stamp(created + 86400 * 5) if triggered else None, stamp(created + 3600)
+            ))
+
+        if rng.random() < 0.15:
+            for k in range(rng.randint(1, 2)):
+                source, target = rng.choice((('BTC', 'USDT'), ('ETH', 'USDT'), ('USDT', 'BTC'), ('SOL', 'USDT'), ('TON', 'USDT')))
+                at = created + rng.uniform(3600, 86400 * 60)
+                status = pick(rng, (('active', 0.35), ('cancelled', 0.4), ('expired', 0.25)))
+                tables['limit_orders'].append((
+                    cid * 3 + k, cid, source, target, f'{rng.uniform(100, 5000) / price(plan, source, at):.8f}',
+                    f'{price(plan, source, at) / price(plan, target, at) * rng.uniform(1.02, 1.15):.8f}', status,
+                    stamp(at + 86400 * 30), None, stamp(at), None
+                ))
+    return tables
+
+# -- Exchange chunk ---------------------------------------------------------------------
+
+def exchange_rows(plan: Dict[str, Any], lo: int, hi: int) -> Dict[str, List[Tuple]]:
+    rng = random.Random(f"{plan['seed']}:exchanges:{lo}")
+    total, clients = plan['exchanges'], plan['clients']
+    pairs, cumulative, providers = plan['pairs'], plan['cumulative'], plan['providers']
+    referral_codes = clients // REFERRAL_EVERY
+    filled_order_base = clients * 3
+    tables: Dict[str, List[Tuple]] = {name: [] for name in (
+        'exchanges', 'transaction_logs', 'blockchain_transactions', 'aml_checks', 'notifications',
+        'referral_usage', 'payment_provider_transactions', 'limit_orders')}
+
+    for eid in range(lo, hi):
+        source, target = pairs[min(len(pairs) - 1, bisect.bisect(cumulative, rng.random()))]
+        # Activity follows a power law: a scrambled rank maps the busy head onto spread-out ids.
+        rank = int(clients * rng.random() ** 3)
+        client_id = (rank * 7919 + 1) % clients + 1 if clients % 7919 else rank + 1
+        created = moment(plan, eid - 1, total, rng)
+        age = plan['end'] - created
+        usd = min(250000.0, rng.lognormvariate(math.log(250), 1.2))
+        source_price, target_price = price(plan, source, created), price(plan, target, created)
+        rate = source_price / target_price * rng.uniform(0.985, 1.0)
+        from_amount = usd / source_price
+        to_amount = from_amount * rate * (1 - rng.uniform(0.005, 0.02))
+        network_from, network_to = NETWORKS.get(source), NETWORKS.get(target)
+
+        roll = rng.random()
+        if age < 3600:
+            status = 'pending' if roll < 0.6 else 'processing' if roll < 0.9 else 'completed'
+        elif age < 86400:
+            status = 'pending' if roll < 0.1 else 'processing' if roll < 0.25 else 'completed' if roll < 0.88 else 'cancelled'
+        else:
+            status = 'completed' if roll < 0.82 else 'failed' if roll < 0.88 else 'cancelled'
+
+        deposited = created + rng.lognormvariate(math.log(600), 0.8)
+        finished = deposited + rng.lognormvariate(math.log(900), 0.9)
+        deposit_hash = withdrawal_hash = None
+        if status in ('processing', 'completed', 'failed'):
+            deposit_hash = tx_hash(rng, network_from) if network_from else None
+        if status == 'completed':
+            withdrawal_hash = tx_hash(rng, network_to) if network_to else None
+
+        referral_id = None
+        if referral_codes and rng.random() < 0.05:
+            referral_id = rng.randint(1, referral_codes)
+            tables['referral_usage'].append((
+                eid, referral_id, client_id, eid, f'{usd * 0.01 * 0.1:.2f}', stamp(created)
+            ))
+
+        tables['exchanges'].append((
+            eid, client_id, source, target, f'{from_amount:.8f}', f'{to_amount:.8f}', f'{rate:.8f}', status,
+            address(rng, network_from) if network_from else None, address(rng, network_to) if network_to else None,
+            withdrawal_hash or deposit_hash, stamp(created), stamp(finished) if status == 'completed' else None, '',
+            deposit_hash, stamp(deposited) if deposit_hash else None, withdrawal_hash,
+            stamp(finished) if withdrawal_hash else None, network_from, network_to, referral_id, f'ORD-{eid:08d}',
+            f'{from_amount * 0.01:.8f}', f'{usd * 0.01:.8f}'
+        ))
+
+        logs = tables['transaction_logs']
+        logs.append((eid * 4, eid, 'created', None, 'pending', 'system', 'Exchange created', stamp(created)))
+        if status == 'cancelled':
+            logs.append((eid * 4 + 1, eid, 'status_changed', 'pending', 'cancelled', 'system', 'Deposit not received',
+                         stamp(created + 3600 * rng.uniform(0.5, 2))))
+        elif status != 'pending':
+            logs.append((eid * 4 + 1, eid, 'deposit_tracked', 'pending', 'processing', 'blockchain_monitor',
+                         'Deposit detected', stamp(deposited)))
+            if status in ('completed', 'failed'):
+                logs.append((eid * 4 + 2, eid, 'status_changed', 'processing', status, rng.choice(('system', 'admin')),
+                             'Payout sent' if status == 'completed' else 'Payout failed', stamp(finished)))
+
+        if deposit_hash:
+            confirmations = CONFIRMATIONS.get(network_from, 12)
+            confirmed = status != 'processing' or rng.random() < 0.5
+            tables['blockchain_transactions'].append((
+                eid * 2, eid, network_from, deposit_hash, address(rng, network_from), address(rng, network_from),
+                f'{from_amount:.8f}', source, confirmations if confirmed else rng.randint(0, confirmations - 1),
+                'confirmed' if confirmed else 'confirming', int(created // 12), stamp(deposited),
+                stamp(deposited + 600) if confirmed else None
+            ))
+            payable = providers.get(source)
+            if payable and rng.random() < 0.08:
+                tables['payment_provider_transactions'].append((
+                    eid, rng.choice(payable), eid, f'pp_{rng.getrandbits(64):016x}', f'{from_amount:.8f}', source,
+                    'completed' if confirmed else 'pending', address(rng, network_from), 3 if confirmed else 1,
+                    stamp(created), stamp(deposited), stamp(deposited + 600) if confirmed else None
+                ))
+        if withdrawal_hash:
+            tables['blockchain_transactions'].append((
+                eid * 2 + 1, eid, network_to, withdrawal_hash, address(rng, network_to), address(rng, network_to),
+                f'{to_amount:.8f}', target, CONFIRMATIONS.get(network_to, 12), 'confirmed', int(finished // 12),
+                stamp(finished), stamp(finished + 600)
+            ))
+
+        if usd >= 1000:
+            risk = pick(rng, (('low', 0.9), ('medium', 0.08), ('high', 0.018), ('critical', 0.002)))
+            score = {'low': 10, 'medium': 40, 'high': 70, 'critical': 90}[risk] + rng.randint(0, 9)
+            tables['aml_checks'].append((
+                eid, client_id, eid, 'automatic', risk, score, 't' if risk == 'critical' else 'f',
+                't' if risk == 'high' and rng.random() < 0.2 else 'f', 'f', f'{{"score": {score}}}', 'system',
+                stamp(created + 30)
+            ))
+
+        tables['notifications'].append((
+            eid * 2, client_id, 'exchange_created', 'Exchange Created',
+            f'Exchange {eid}: {from_amount:.8f} {source} -> {to_amount:.8f} {target}', 't' if age > 86400 else 'f',
+            stamp(created)
+        ))
+        if status in ('completed', 'failed'):
+            tables['notifications'].append((
+                eid * 2 + 1, client_id, f'exchange_{status}', f'Exchange {status.title()}', f'Exchange {eid} {status}',
+                't' if age > 86400 else 'f', stamp(finished)
+            ))
+
+        if status == 'completed' and rng.random() < 0.02:
+            tables['limit_orders'].append((
+                filled_order_base + eid, client_id, source, target, f'{from_amount:.8f}', f'{rate:.8f}', 'filled',
+                stamp(created + 86400 * 30), eid, stamp(created - rng.uniform(3600, 86400 * 7)), stamp(created)
+            ))
+    return tables
+
+# -- Workers ----------------------------------------------------------------------------
+
+_worker_conn = None
+
+def init_worker(database_url: str) -> None:
+    global _worker_conn
+    import psycopg2
+    _worker_conn = psycopg2.connect(database_url)
+    cursor = _worker_conn.cursor()
+    try:
+        # Rows are generated FK-consistent; skipping RI triggers roughly halves COPY time.
+        cursor.execute("SET session_replication_role = replica")
+    except Exception:
+        pass
+    _worker_conn.commit()
+
+def load_chunk(task: Tuple[str, Dict[str, Any], int, int]) -> Dict[str, int]:
+    kind, plan, lo, hi = task
+    tables = client_rows(plan, lo, hi) if kind == 'clients' else exchange_rows(plan, lo, hi)
+    cursor = _worker_conn.cursor()
+    for table in GENERATED_TABLES:
+        copy_rows(cursor, table, tables.get(table, []))
+    _worker_conn.commit()
+    return {table: len(rows) for table, rows in tables.items()}
+
+def run_phase(pool, kind: str, plan: Dict[str, Any], total: int) -> None:
+    started = time.perf_counter()
+    tasks = [(kind, plan, lo, min(lo + CHUNK_SIZE, total + 1)) for lo in range(1, total + 1, CHUNK_SIZE)]
+    counts: Dict[str, int] = {}
+    for done, result in enumerate(pool.imap_unordered(load_chunk, tasks), 1):
+        for table, count in result.items():
+            counts[table] = counts.get(table, 0) + count
+        print(f'\r  {kind}: {done}/{len(tasks)} chunks', end='', flush=True)
+    elapsed = time.perf_counter() - started
+    rows = sum(counts.values())
+    print(f'\r  {kind}: {rows} rows in {elapsed:.1f}s ({rows / elapsed:,.0f} rows/s) '
+          + ', '.join(f'{table}={count}' for table, count in sorted(counts.items())))
+
+# -- Reference data and finishing -------------------------------------------------------
+
+def load_reference_rows(conn, plan: Dict[str, Any]) -> None:
+    rng = random.Random(f"{plan['seed']}:reference")
+    cursor = conn.cursor()
+    top_pairs = [pair for pair in plan['pairs'][:60]]
+    now = plan['end']
+    cursor.executemany("""
+        INSERT INTO exchange_rates (from_currency, to_currency, rate, source, updated_at)
+        VALUES (%s, %s, %s, 'CryptoCompare', %s)
+        ON CONFLICT (from_currency, to_currency, source) DO UPDATE SET rate = EXCLUDED.rate, updated_at = EXCLUDED.updated_at
+    """, [(source, target, price(plan, source, now) / price(plan, target, now), stamp(now)) for source, target in top_pairs])
+    cursor.executemany("""
+        INSERT INTO commission_settings (from_currency, to_currency, commission_percent, min_commission)
+        VALUES (%s, %s, %s, %s) ON CONFLICT (from_currency, to_currency) DO NOTHING
+    """, [(source, target, rng.choice((0.5, 1.0, 1.5, 2.0)), 1) for source, target in top_pairs[:40]])
+
+    rows = []
+    days = int(plan['span'] // 86400)
+    for source, target in top_pairs[:20]:
+        for day in range(days):
+            epoch = plan['start'] + day * 86400
+            mid = price(plan, source, epoch) / price(plan, target, epoch)
+            rows.append((
+                stamp(epoch)[:10], f'{source}-{target}',
+                f'{rng.uniform(1e4, 5e6):.2f}', f'{mid * 1.03:.8f}', f'{mid * 0.97:.8f}', f'{mid:.8f}', rng.randint(10, 5000)
+            ))
+    buffer = io.StringIO(''.join('\t'.join(map(str, row)) + '\n' for row in rows))
+    cursor.copy_expert('COPY trading_analytics (date, currency_pair, volume_24h, high_24h, low_24h, avg_price, trades_count) FROM STDIN', buffer)
+
+    # Fixtures referenced by tests.json and the load-test mixes.
+    fixture_id = plan['clients'] // REFERRAL_EVERY
+    cursor.execute("""
+        INSERT INTO referral_codes (id, client_id, code, discount_percent, commission_percent, created_at, updated_at)
+        VALUES (%(first)s, 1, 'TEST1234', 5, 10, %(at)s, %(at)s), (%(second)s, 1, 'WELCOME1', 10, 10, %(at)s, %(at)s)
+        ON CONFLICT (code) DO NOTHING
+    """, {'first': fixture_id + 1, 'second': fixture_id + 2, 'at': stamp(plan['start'])})
+    conn.commit()
+
+def deferred_indexes(conn) -> List[Tuple[str, str]]:
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT i.indexname, i.indexdef FROM pg_indexes i
+        WHERE i.schemaname = current_schema() AND i.tablename = ANY(%s)
+          AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conname = i.indexname)
+    """, (list(GENERATED_TABLES),))
+    return cursor.fetchall()
+
+def create_index(definition: str) -> None:
+    cursor = _worker_conn.cursor()
+    cursor.execute(definition)
+    _worker_conn.commit()
+
+# The ledger (V0017) is posted by triggers, which COPY bypassed: post the generated history
+# in one pass instead, as those triggers and the referral_commission job would have, with each
+# account's lines numbered and running-balanced in posting order.
+LEDGER_EVENTS = """
+    CREATE TEMP TABLE ledger_events ON COMMIT DROP AS
+    SELECT row_number() OVER (ORDER BY posted_at, kind, reference) AS entry_id, *
+    FROM (
+    SELECT CASE WHEN e.withdrawal_tx_hash = b.tx_hash THEN 'withdrawal' ELSE 'deposit' END AS kind,
+           b.tx_hash AS reference, b.exchange_id, COALESCE(b.confirmed_at, b.created_at) AS posted_at,
+           CASE WHEN e.withdrawal_tx_hash = b.tx_hash
+                THEN jsonb_build_array(
+                    jsonb_build_object('account', 'client_funds:' || b.currency, 'currency', b.currency, 'amount', b.amount),
+                    jsonb_build_object('account', 'hot_wallet:' || b.currency, 'currency', b.currency, 'amount', -b.amount))
+                ELSE jsonb_build_array(
+                    jsonb_build_object('account', 'hot_wallet:' || b.currency, 'currency', b.currency, 'amount', b.amount),
+                    jsonb_build_object('account', 'client_funds:' || b.currency, 'currency', b.currency, 'amount', -b.amount))
+           END AS lines
+    FROM blockchain_transactions b JOIN exchanges e ON e.id = b.exchange_id
+    WHERE b.status = 'confirmed'
+    UNION ALL
+    SELECT 'payment', p.id::TEXT, p.exchange_id, COALESCE(p.completed_at, p.created_at), jsonb_build_array(
+        jsonb_build_object('account', 'provider:' || p.provider_id || ':' || p.currency, 'currency', p.currency, 'amount', p.amount),
+        jsonb_build_object('account', 'client_funds:' || p.currency, 'currency', p.currency, 'amount', -p.amount))
+    FROM payment_provider_transactions p
+    WHERE p.status = 'completed'
+    UNION ALL
+    SELECT 'settlement', e.id::TEXT, e.id, e.completed_at, jsonb_build_array(
+        jsonb_build_object('account', 'client_funds:' || e.from_currency, 'currency', e.from_currency, 'amount', e.from_amount),
+        jsonb_build_object('account', 'fee_revenue:' || e.from_currency, 'currency', e.from_currency, 'amount', -COALESCE(e.commission, 0)),
+        jsonb_build_object('account', 'treasury:' || e.from_currency, 'currency', e.from_currency,
+                           'amount', COALESCE(e.commission, 0) - e.from_amount),
+        jsonb_build_object('account', 'treasury:' || e.to_currency, 'currency', e.to_currency, 'amount', e.to_amount),
+        jsonb_build_object('account', 'client_funds:' || e.to_currency, 'currency', e.to_currency, 'amount', -e.to_amount))
+    FROM exchanges e
+    WHERE e.status = 'completed'
+    UNION ALL
+    SELECT 'referral_commission', 'referral_usage:' || u.id, u.exchange_id, u.created_at, jsonb_build_array(
+        jsonb_build_object('account', 'referral_expense:USD', 'currency', 'USD', 'amount', u.commission_usd),
+        jsonb_build_object('account', 'referral:' || u.referral_code_id || ':USD', 'currency', 'USD', 'amount', -u.commission_usd))
+    FROM referral_usage u
+    WHERE u.commission_usd IS NOT NULL
+    ) events
+"""
+LEDGER_POSTING = (
+    LEDGER_EVENTS,
+    """
+    INSERT INTO ledger_entries (id, kind, reference, exchange_id, created_at)
+    SELECT entry_id, kind, reference, exchange_id, posted_at FROM ledger_events
+    """,
+    "SELECT setval(pg_get_serial_sequence('ledger_entries', 'id'), (SELECT COUNT(*) + 1 FROM ledger_events), false)",
+    """
+    CREATE TEMP TABLE ledger_legs ON COMMIT DROP AS
+    SELECT ev.entry_id, l.account, MIN(l.currency) AS currency, SUM(l.amount) AS amount
+    FROM ledger_events ev
+    CROSS JOIN LATERAL jsonb_to_recordset(ev.lines) AS l(account VARCHAR, currency VARCHAR, amount NUMERIC)
+    GROUP BY ev.entry_id, l.account
+    HAVING SUM(l.amount) <> 0
+    """,
+    """
+    INSERT INTO ledger_accounts (code, kind, currency)
+    SELECT account, split_part(account, ':', 1), MIN(currency) FROM ledger_legs GROUP BY account ORDER BY account
+    """,
+    """
+    INSERT INTO ledger_lines (entry_id, account_id, account_seq, amount, balance_after)
+    SELECT g.entry_id, a.id, row_number() OVER w, g.amount, SUM(g.amount) OVER w
+    FROM ledger_legs g JOIN ledger_accounts a ON a.code = g.account
+    WINDOW w AS (PARTITION BY a.id ORDER BY g.entry_id)
+    """,
+    """
+    UPDATE ledger_accounts a SET balance = t.balance, line_count = t.line_count
+    FROM (SELECT account_id, SUM(amount) AS balance, COUNT(*) AS line_count FROM ledger_lines GROUP BY account_id) t
+    WHERE a.id = t.account_id
+    """
+)
+
+def finish(conn) -> None:
+    cursor = conn.cursor()
+    for table in GENERATED_TABLES:
+        cursor.execute(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT COALESCE(MAX(id), 0) + 1 FROM {table}), false)")
+    # Generated uses count as settled (V0018): one settlement per code, credited to its totals.
+    cursor.execute("""
+        WITH settled AS (
+            INSERT INTO referral_settlements (referral_code_id, usage_count, commission_usd)
+            SELECT referral_code_id, COUNT(*), COALESCE(SUM(commission_usd), 0)
+            FROM referral_usage GROUP BY referral_code_id ORDER BY referral_code_id
+            RETURNING id, referral_code_id, usage_count, commission_usd
+        ), marked AS (
+            UPDATE referral_usage u SET settlement_id = s.id FROM settled s WHERE u.referral_code_id = s.referral_code_id
+        )
+        UPDATE referral_codes rc SET total_referrals = s.usage_count, total_earnings_usd = s.commission_usd
+        FROM settled s
+        WHERE rc.id = s.referral_code_id
+    """)
+    # COPY ran without triggers: queue every exchange for the first reconciliation pass (V0016).
+    cursor.execute("INSERT INTO reconciliation_changes (exchange_id) SELECT id FROM exchanges ON CONFLICT DO NOTHING")
+    # Consistent by construction, like the COPY: skip the per-row foreign key checks.
+    cursor.execute("SET LOCAL session_replication_role = replica")
+    for statement in LEDGER_POSTING:
+        cursor.execute(statement)
+    conn.commit()
+    conn.autocommit = True
+    for table in GENERATED_TABLES + DERIVED_TABLES:
+        cursor.execute(f'ANALYZE {table}')
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--exchanges', type=int, default=1_000_000)
+    parser.add_argument('--clients', type=int, help='defaults to exchanges / 8')
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--end', type=datetime.fromisoformat, help='last moment of the window (default: this hour, UTC)')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 4)
+    parser.add_argument('--truncate', action='store_true', help='empty the generated tables first')
+    parser.add_argument('--defer-indexes', action='store_true', help='drop secondary indexes during the load')
+    args = parser.parse_args()
+
+    import psycopg2
+    database_url = os.environ.get('DATABASE_URL')
+    if not database_url:
+        sys.exit('DATABASE_URL is not set')
+    conn = psycopg2.connect(database_url)
+    cursor = conn.cursor()
+    if args.truncate:
+        cursor.execute(f"TRUNCATE {', '.join(GENERATED_TABLES + DERIVED_TABLES)} RESTART IDENTITY CASCADE")
+        conn.commit()
+    cursor.execute('SELECT EXISTS (SELECT 1 FROM exchanges) OR EXISTS (SELECT 1 FROM clients)')
+    if cursor.fetchone()[0]:
+        sys.exit('clients/exchanges are not empty; pass --truncate to replace them')
+
+    plan = build_plan(conn, args)
+    print(f"generating {plan['clients']} clients and {plan['exchanges']} exchanges "
+          f"(seed {args.seed}, {args.days} days ending {stamp(plan['end'])}, {args.workers} workers)")
+
+    indexes = deferred_indexes(conn) if args.defer_indexes else []
+    for name, _ in indexes:
+        cursor.execute(f'DROP INDEX {name}')
+    conn.commit()
+
+    started = time.perf_counter()
+    with multiprocessing.Pool(args.workers, initializer=init_worker, initargs=(database_url,)) as pool:
+        run_phase(pool, 'clients', plan, plan['clients'])
+        run_phase(pool, 'exchanges', plan, plan['exchanges'])
+        load_reference_rows(conn, plan)
+        if indexes:
+            index_started = time.perf_counter()
+            pool.map(create_index, [definition for _, definition in indexes])
+            print(f'  recreated {len(indexes)} indexes in {time.perf_counter() - index_started:.1f}s')
+    finish(conn)
+    conn.close()
+    print(f'done in {time.perf_counter() - started:.1f}s')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""
+Benchmark: per-request dispatch + response building overhead of backend/exchange-api
+Calls handler() in a loop against an in-memory connection (no database work) so only
+routing, body parsing/validation, header construction and response finalization are
+measured. Pass --baseline <git revision> to run the same requests through that
+revision's index.py for comparison (e.g. the pre-router if/elif handler).
+
+Usage:
+    python tools/bench/dispatch.py [--iterations 20000] [--baseline <rev>]
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import secrets
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[2]
+HANDLER_PATH = 'backend/exchange-api/index.py'
+
+CLIENT_COLUMNS = ('id', 'email', 'phone', 'full_name', 'telegram_username', 'created_at',
+                  'total_exchanges', 'completed_exchanges')
+
+REQUESTS = {
+    'GET list_clients (20 rows)': {
+        'httpMethod': 'GET', 'queryStringParameters': {'action': 'list_clients'}
+    },
+    'POST update_rate': {
+        'httpMethod': 'POST',
+        'body': json.dumps({'action': 'update_rate', 'from_currency': 'BTC', 'to_currency': 'USDT', 'rate': 65000.5})
+    },
+    'PUT update_exchange_status': {
+        'httpMethod': 'PUT', 'body': json.dumps({'id': 42, 'status': 'completed'})
+    },
+    'GET invalid action': {
+        'httpMethod': 'GET', 'queryStringParameters': {'action': 'nope'}
+    },
+    'OPTIONS preflight': {
+        'httpMethod': 'OPTIONS'
+    }
+}
+
+TRANSITION_COLUMNS = ('id', 'status_from', 'moved')
+
+class MemoryCursor:
+    def __init__(self, as_dicts: bool):
+        now = datetime(2024, 1, 1, 12, 0, 0)
+        self.as_dicts = as_dicts
+        self.client_rows = [(i, f'client{i}@mail.com', None, f'Client {i}', None, now, i % 7, i % 3)
+                            for i in range(20)]
+        self.answer(CLIENT_COLUMNS, self.client_rows)
+
+    def answer(self, columns, rows):
+        self.rows = [dict(zip(columns, row)) for row in rows] if self.as_dicts else rows
+        self.description = [(name,) for name in columns]
+
+    def execute(self, query, params=None):
+        # transition_exchanges returns one (id, status before, moved) row per requested id; every
+        # other statement gets the client rows.
+        if 'exchange_transitions' in query:
+            self.answer(TRANSITION_COLUMNS, [(exchange_id, 'pending', True) for exchange_id in params['ids']])
+        else:
+            self.answer(CLIENT_COLUMNS, self.client_rows)
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        return self.rows[0]
+
+class MemoryConnection:
+    def cursor(self, cursor_factory=None):
+        return MemoryCursor(as_dicts=cursor_factory is not None)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+def load_module(name: str, path: Path):
+    # Quotes signed here are only ever checked by this process.
+    os.environ.setdefault('QUOTE_SECRET', secrets.token_hex(32))
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.get_db_connection = MemoryConnection
+    return module
+
+def load_revision(revision: str):
+    source = subprocess.run(['git', 'show', f'{revision}:{HANDLER_PATH}'], cwd=ROOT,
+                            check=True, capture_output=True, text=True).stdout
+    with tempfile.NamedTemporaryFile('w', suffix='.py', delete=False) as handle:
+        handle.write(source)
+    return load_module('exchange_api_baseline', Path(handle.name))
+
+def per_call_us(module, event, iterations: int) -> float:
+    handler = module.handler
+    for _ in range(min(iterations, 1000)):
+        handler(dict(event), None)
+    started = time.perf_counter()
+    for _ in range(iterations):
+        handler(dict(event), None)
+    return (time.perf_counter() - started) / iterations * 1e6
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=20000)
+    parser.add_argument('--baseline', help='git revision whose exchange-api handler is compared')
+    args = parser.parse_args()
+
+    current = load_module('exchange_api', ROOT / HANDLER_PATH)
+    baseline = load_revision(args.baseline) if args.baseline else None
+
+    print(f'{args.iterations} calls per request, python {sys.version.split()[0]}')
+    for label, event in REQUESTS.items():
+        line = f'  {label:<28} current {per_call_us(current, event, args.iterations):7.2f} us'
+        if baseline is not None:
+            line += f'   baseline {per_call_us(baseline, event, args.iterations):7.2f} us'
+        print(line)
+
+if __name__ == '__main__':
+    main()
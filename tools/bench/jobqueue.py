@@ -0,0 +1,146 @@
+"""
+Job queue throughput benchmark (jobs table from V0010, server/worker.py)
+Measures against DATABASE_URL:
+
+- enqueue: the backend's enqueue_job(), one job per committed transaction, from
+  --clients threads (this is what handlers do)
+- enqueue-batch: one INSERT ... SELECT FROM unnest per --insert-batch jobs
+- claim: --processes server.worker processes draining the queue with a no-op handler,
+  --batch-size jobs per claim transaction
+
+and compares each phase with --target jobs/s. Benchmark jobs use kind 'bench_noop' and are
+deleted afterwards, so the tool can run against a seeded development database.
+
+Usage:
+    DATABASE_URL=... python tools/bench/jobqueue.py [--jobs 50000] [--clients 8] [--processes 4]
+                                                    [--batch-size 200] [--target 10000]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict
+
+from loadtest import ROOT, load_functions
+
+sys.path.insert(0, str(ROOT))
+
+BENCH_KIND = 'bench_noop'
+
+def noop_job(conn, payload: Dict[str, Any]) -> None:
+    return None
+
+def timed(run: Callable[[], int]) -> float:
+    started = time.perf_counter()
+    count = run()
+    return count / (time.perf_counter() - started)
+
+def enqueue_single(database_url: str, enqueue_job: Callable, jobs: int, clients: int) -> int:
+    import psycopg2
+    per_client = jobs // clients
+    errors = []
+
+    def client(offset: int) -> None:
+        conn = psycopg2.connect(database_url)
+        try:
+            for index in range(offset, offset + per_client):
+                enqueue_job(conn, BENCH_KIND, {'n': index}, priority=index % 3)
+                conn.commit()
+        except Exception as error:
+            errors.append(error)
+        finally:
+            conn.close()
+
+    threads = [threading.Thread(target=client, args=(n * per_client,)) for n in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return per_client * clients
+
+def enqueue_batched(database_url: str, jobs: int, insert_batch: int) -> int:
+    import psycopg2
+    conn = psycopg2.connect(database_url)
+    try:
+        cursor = conn.cursor()
+        for start in range(0, jobs, insert_batch):
+            payloads = [json.dumps({'n': index}) for index in range(start, min(start + insert_batch, jobs))]
+            cursor.execute("""
+                INSERT INTO jobs (kind, payload, priority)
+                SELECT %s, payload::jsonb, 0 FROM unnest(%s::text[]) AS payload
+            """, (BENCH_KIND, payloads))
+            conn.commit()
+    finally:
+        conn.close()
+    return jobs
+
+def drain_worker(database_url: str, batch_size: int, done: 'multiprocessing.Queue') -> None:
+    from server.worker import run_worker
+    totals = run_worker(database_url, {BENCH_KIND: noop_job}, batch_size, lambda: False, drain=True, retention_hours=0)
+    done.put(totals['done'])
+
+def drain(database_url: str, processes: int, batch_size: int) -> int:
+    done: 'multiprocessing.Queue' = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=drain_worker, args=(database_url, batch_size, done))
+               for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return sum(done.get() for _ in workers)
+
+def cleanup(database_url: str) -> int:
+    import psycopg2
+    conn = psycopg2.connect(database_url)
+    try:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM jobs WHERE kind = %s', (BENCH_KIND,))
+        deleted = cursor.rowcount
+        conn.commit()
+        cursor.execute('SELECT COUNT(*) FROM jobs WHERE status = %s', ('queued',))
+        if cursor.fetchone()[0]:
+            print('note: other queued jobs exist; claim rates include skipping them')
+    finally:
+        conn.close()
+    return deleted
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--jobs', type=int, default=50000)
+    parser.add_argument('--clients', type=int, default=8, help='threads for single-job enqueue')
+    parser.add_argument('--insert-batch', type=int, default=1000, help='jobs per INSERT in enqueue-batch')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1, help='worker processes for claim')
+    parser.add_argument('--batch-size', type=int, default=200, help='jobs claimed per transaction')
+    parser.add_argument('--target', type=float, default=10000.0, help='jobs/s each phase is compared with')
+    args = parser.parse_args()
+    database_url = os.environ.get('DATABASE_URL')
+    if not database_url:
+        sys.exit('DATABASE_URL is not set')
+    os.environ['METRICS_SAMPLE_RATE'] = '0'
+
+    enqueue_job = load_functions()['kyc-aml-api'].enqueue_job
+    cleanup(database_url)
+    print(f'{args.jobs} jobs, {args.clients} enqueue clients, {args.processes} workers x {args.batch_size} per claim, '
+          f'cpu={os.cpu_count()}')
+    try:
+        phases = [
+            ('enqueue', lambda: enqueue_single(database_url, enqueue_job, args.jobs, args.clients)),
+            ('claim', lambda: drain(database_url, args.processes, args.batch_size)),
+            ('enqueue-batch', lambda: enqueue_batched(database_url, args.jobs, args.insert_batch)),
+            ('claim-after-batch', lambda: drain(database_url, args.processes, args.batch_size))
+        ]
+        for name, run in phases:
+            rate = timed(run)
+            verdict = 'ok  ' if rate >= args.target else 'SLOW'
+            print(f'  {verdict} {name:<18} {rate:>10,.0f} jobs/s')
+    finally:
+        cleanup(database_url)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,458 @@
+"""
+Load test: the five backend functions behind a local HTTP shim
+Each backend/<name>/index.py is served in-process at http://127.0.0.1:<port>/<name>/
+with the same event/context shape the cloud runtime passes to handler(). The run
+first replays every backend/*/tests.json case once as a correctness check, then
+drives each requested mix with concurrent keep-alive clients and reports throughput,
+p50/p95/p99 latency per request kind and the most expensive SQL statements.
+
+Usage:
+    python tools/bench/loadtest.py [--mix tests --mix storefront ...] [--duration 20]
+                                   [--concurrency 16] [--ephemeral] [--scale 1000000]
+                                   [--save-baseline] [--check]
+    python tools/bench/loadtest.py --serve [--port 8080]
+
+Postgres: --ephemeral creates a throwaway cluster with initdb/pg_ctl (from PATH or
+--pg-bin) and applies db_migrations; otherwise DATABASE_URL must point at a migrated
+database. --scale N fills the (empty) database with N synthetic exchanges and their
+related rows via tools/bench/datagen.py before the run. --check compares against the baseline file and exits 1 on regressions.
+"""
+
+import argparse
+import base64
+import contextlib
+import http.client
+import importlib.util
+import json
+import os
+import random
+import secrets
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+ROOT = Path(__file__).resolve().parents[2]
+FUNCTIONS = ('admin-api', 'blockchain-api', 'exchange-api', 'kyc-aml-api', 'trading-features-api')
+SCHEMA = 't_p7012082_overnight_exchange_d'
+DEFAULT_BASELINE = ROOT / 'tools' / 'bench' / 'loadtest-baseline.json'
+
+# Weighted request mixes: (weight, function, method, path, body). {client_id} and
+# {exchange_id} are replaced with random existing ids on every request.
+MIXES: Dict[str, List[Tuple[int, str, str, str, Optional[Dict[str, Any]]]]] = {
+    'storefront': [
+        (30, 'exchange-api', 'GET', '/?action=get_rates', None),
+        (15, 'exchange-api', 'GET', '/?action=list_currencies', None),
+        (10, 'admin-api', 'GET', '/?resource=site_content&category=hero', None),
+        (8, 'blockchain-api', 'GET', '/?action=get_blockchain_info&blockchain=ethereum', None),
+        (8, 'trading-features-api', 'GET', '/?action=check_referral_code&code=WELCOME1', None),
+        (8, 'exchange-api', 'GET', '/?action=get_exchange&id={exchange_id}', None),
+        (6, 'kyc-aml-api', 'GET', '/?action=check_limits&client_id={client_id}&amount_usd=500', None),
+        (5, 'exchange-api', 'GET', '/?action=list_exchanges&client_id={client_id}', None),
+        (5, 'trading-features-api', 'GET', '/?action=get_referral_stats&client_id={client_id}', None),
+        (5, 'exchange-api', 'POST', '/', {
+            'action': 'create_exchange', 'from_currency': 'BTC', 'to_currency': 'USDT',
+            'from_amount': 0.001, 'to_amount': 65.0, 'exchange_rate': 65000, 'email': 'loadtest@example.com'
+        })
+    ],
+    'backoffice': [
+        (25, 'exchange-api', 'GET', '/?action=list_exchanges&limit=50', None),
+        (15, 'exchange-api', 'GET', '/?action=list_exchanges&status=pending&limit=50', None),
+        (15, 'admin-api', 'GET', '/?resource=dashboard', None),
+        (10, 'exchange-api', 'GET', '/?action=get_exchange&id={exchange_id}', None),
+        (10, 'kyc-aml-api', 'GET', '/?action=get_kyc_status&client_id={client_id}', None),
+        (10, 'blockchain-api', 'GET', '/?action=get_transaction_history&exchange_id={exchange_id}', None),
+        (5, 'admin-api', 'GET', '/?resource=commissions', None),
+        (5, 'exchange-api', 'GET', '/?action=list_clients', None),
+        (5, 'exchange-api', 'PUT', '/', {'id': '{exchange_id}', 'status': 'processing'})
+    ]
+}
+
+# -- Postgres ---------------------------------------------------------------------
+
+def find_pg_binary(name: str, pg_bin: Optional[str]) -> str:
+    path = shutil.which(name, path=pg_bin) if pg_bin else shutil.which(name)
+    if path is None:
+        sys.exit(f'{name} not found; pass --pg-bin or set DATABASE_URL to an existing database')
+    return path
+
+def start_ephemeral_postgres(pg_bin: Optional[str]) -> Tuple[str, Callable[[], None]]:
+    initdb, pg_ctl = find_pg_binary('initdb', pg_bin), find_pg_binary('pg_ctl', pg_bin)
+    data_dir = tempfile.mkdtemp(prefix='loadtest-pg-')
+    subprocess.run([initdb, '-D', data_dir, '-U', 'postgres', '--auth=trust', '-E', 'UTF8'],
+                   check=True, capture_output=True)
+    options = f"-k {data_dir} -c listen_addresses='' -c fsync=off -c synchronous_commit=off -c max_connections=200"
+    subprocess.run([pg_ctl, '-D', data_dir, '-o', options, '-l', os.path.join(data_dir, 'server.log'), '-w', 'start'],
+                   check=True, capture_output=True)
+
+    def stop() -> None:
+        subprocess.run([pg_ctl, '-D', data_dir, '-m', 'fast', 'stop'], capture_output=True)
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    return f'postgresql://postgres@/postgres?host={data_dir}', stop
+
+def create_database(server_url: str, name: str) -> str:
+    import psycopg2
+    conn = psycopg2.connect(server_url)
+    conn.autocommit = True
+    cursor = conn.cursor()
+    cursor.execute(f'CREATE DATABASE {name}')
+    conn.close()
+
+    database_url = server_url.replace('/postgres?', f'/{name}?')
+    conn = psycopg2.connect(database_url)
+    conn.autocommit = True
+    cursor = conn.cursor()
+    cursor.execute(f'CREATE SCHEMA {SCHEMA}')
+    cursor.execute(f'ALTER DATABASE {name} SET search_path = {SCHEMA}')
+    cursor.execute(f'SET search_path = {SCHEMA}')
+    for migration in sorted((ROOT / 'db_migrations').glob('V*.sql')):
+        cursor.execute(migration.read_text())
+    conn.close()
+    return database_url
+
+def id_ranges(database_url: str) -> Dict[str, int]:
+    import psycopg2
+    conn = psycopg2.connect(database_url)
+    try:
+        cursor = conn.cursor()
+        cursor.execute('SELECT (SELECT COALESCE(MAX(id), 1) FROM clients), (SELECT COALESCE(MAX(id), 1) FROM exchanges)')
+        clients, exchanges = cursor.fetchone()
+    finally:
+        conn.close()
+    return {'client_id': clients, 'exchange_id': exchanges}
+
+# -- HTTP shim ----------------------------------------------------------------------
+
+def load_functions() -> Dict[str, Any]:
+    # Quotes signed here are only ever checked by this process.
+    os.environ.setdefault('QUOTE_SECRET', secrets.token_hex(32))
+    modules = {}
+    for name in FUNCTIONS:
+        spec = importlib.util.spec_from_file_location(name.replace('-', '_'), ROOT / 'backend' / name / 'index.py')
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        modules[name] = module
+    return modules
+
+class ShimHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    functions: Dict[str, Any] = {}
+
+    def invoke(self) -> None:
+        url = urlsplit(self.path)
+        name, _, _ = url.path.strip('/').partition('/')
+        module = self.functions.get(name)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8') if length else ''
+        if module is None:
+            self.reply(404, {'Content-Type': 'text/plain'}, b'unknown function')
+            return
+
+        event = {
+            'httpMethod': self.command,
+            'headers': dict(self.headers.items()),
+            'queryStringParameters': dict(parse_qsl(url.query)),
+            'body': body,
+            'isBase64Encoded': False
+        }
+        response = module.handler(event, SimpleNamespace(request_id=uuid.uuid4().hex))
+        payload = response.get('body') or ''
+        raw = base64.b64decode(payload) if response.get('isBase64Encoded') else payload.encode('utf-8')
+        self.reply(response['statusCode'], response.get('headers') or {}, raw)
+
+    def reply(self, status: int, headers: Dict[str, str], raw: bytes) -> None:
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_OPTIONS = invoke
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+def start_shim(functions: Dict[str, Any], port: int) -> ThreadingHTTPServer:
+    ShimHandler.functions = functions
+    server = ThreadingHTTPServer(('127.0.0.1', port), ShimHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# -- Cases ---------------------------------------------------------------------------
+
+TYPE_CHECKS = {
+    'array': lambda value: isinstance(value, list),
+    'number': lambda value: isinstance(value, (int, float)) and not isinstance(value, bool),
+    'string': lambda value: isinstance(value, str),
+    'boolean': lambda value: isinstance(value, bool),
+    'object': lambda value: isinstance(value, dict)
+}
+
+def load_test_cases() -> List[Dict[str, Any]]:
+    cases = []
+    for name in FUNCTIONS:
+        path = ROOT / 'backend' / name / 'tests.json'
+        if path.exists():
+            for test in json.loads(path.read_text()).get('tests', []):
+                cases.append({**test, 'function': name})
+    return cases
+
+def check_body(expected: Dict[str, Any], body: Any) -> List[str]:
+    problems = []
+    for key, kind in expected.items():
+        if not isinstance(body, dict) or key not in body:
+            problems.append(f'missing {key}')
+        elif kind in TYPE_CHECKS and not TYPE_CHECKS[kind](body[key]):
+            problems.append(f'{key} is not {kind}')
+        elif kind not in TYPE_CHECKS and body[key] != kind:
+            problems.append(f'{key} != {kind!r}')
+    return problems
+
+def send(conn: http.client.HTTPConnection, function: str, method: str, path: str,
+         body: Optional[str], extra_headers: Optional[Dict[str, str]] = None) -> Tuple[int, bytes]:
+    headers = {'Content-Type': 'application/json'} if body is not None else {}
+    headers.update(extra_headers or {})
+    conn.request(method, f'/{function}{path}', body=body, headers=headers)
+    response = conn.getresponse()
+    return response.status, response.read()
+
+def replay_tests(port: int, cases: List[Dict[str, Any]]) -> int:
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    failures = 0
+    for case in cases:
+        body = json.dumps(case['body']) if case.get('body') is not None else None
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            status, raw = send(conn, case['function'], case['method'], case['path'], body, case.get('headers'))
+        problems = []
+        if status != case.get('expectedStatus', 200):
+            problems.append(f"status {status} != {case.get('expectedStatus', 200)}")
+        elif case.get('expectedBody'):
+            problems += check_body(case['expectedBody'], json.loads(raw or b'null'))
+        failures += bool(problems)
+        print(f"  {'FAIL' if problems else 'ok  '} {case['function']:<22} {case['name']}"
+              + (f" ({'; '.join(problems)})" if problems else ''))
+    conn.close()
+    return failures
+
+def mix_entries(mix: str, cases: List[Dict[str, Any]]) -> List[Tuple[int, str, str, str, Optional[Dict[str, Any]]]]:
+    if mix == 'tests':
+        return [(1, case['function'], case['method'], case['path'], case.get('body')) for case in cases]
+    return MIXES[mix]
+
+def render_request(entry: Tuple, ids: Dict[str, int], rng: random.Random) -> Tuple[str, str, str, Optional[str], str]:
+    _, function, method, path, body = entry
+    values = {key: rng.randint(1, upper) for key, upper in ids.items()}
+    target = (body or {}).get('action') or (body or {}).get('resource') or path.split('&')[0].lstrip('/?')
+    label = f'{function} {method} {target or "default"}'
+    text = json.dumps(body) if body is not None else None
+    for key, value in values.items():
+        path = path.replace('{' + key + '}', str(value))
+        if text is not None:
+            text = text.replace('"{' + key + '}"', str(value))
+    return function, method, path, text, label
+
+# -- Load ----------------------------------------------------------------------------
+
+def run_mix(port: int, entries: List[Tuple], ids: Dict[str, int], duration: float, concurrency: int,
+            seed: int) -> Tuple[Dict[str, List[float]], Dict[str, int], float]:
+    latencies: Dict[str, List[float]] = {}
+    errors: Dict[str, int] = {}
+    lock = threading.Lock()
+    weights = [entry[0] for entry in entries]
+    deadline = time.perf_counter() + duration
+
+    def worker(index: int) -> None:
+        rng = random.Random(seed + index)
+        conn = http.client.HTTPConnection('127.0.0.1', port)
+        local: Dict[str, List[float]] = {}
+        local_errors: Dict[str, int] = {}
+        while time.perf_counter() < deadline:
+            function, method, path, body, label = render_request(rng.choices(entries, weights)[0], ids, rng)
+            started = time.perf_counter()
+            try:
+                status, _ = send(conn, function, method, path, body)
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', port)
+                status = 599
+            local.setdefault(label, []).append(time.perf_counter() - started)
+            if status >= 500:
+                local_errors[label] = local_errors.get(label, 0) + 1
+        conn.close()
+        with lock:
+            for label, values in local.items():
+                latencies.setdefault(label, []).extend(values)
+            for label, count in local_errors.items():
+                errors[label] = errors.get(label, 0) + count
+
+    # Sampled requests print structured log lines; keep them out of the report.
+    started = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        threads = [threading.Thread(target=worker, args=(index,)) for index in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return latencies, errors, time.perf_counter() - started
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100))]
+
+def summarize(latencies: Dict[str, List[float]], errors: Dict[str, int], elapsed: float) -> Dict[str, Any]:
+    def stats(values: List[float]) -> Dict[str, float]:
+        ordered = sorted(values)
+        return {
+            'count': len(ordered),
+            'p50_ms': round(percentile(ordered, 50) * 1000, 3),
+            'p95_ms': round(percentile(ordered, 95) * 1000, 3),
+            'p99_ms': round(percentile(ordered, 99) * 1000, 3)
+        }
+
+    everything = [value for values in latencies.values() for value in values]
+    return {
+        'throughput_rps': round(len(everything) / elapsed, 1),
+        'errors': sum(errors.values()),
+        **stats(everything),
+        'requests': {label: {**stats(values), 'errors': errors.get(label, 0)} for label, values in sorted(latencies.items())}
+    }
+
+def reset_metrics(functions: Dict[str, Any]) -> None:
+    for module in functions.values():
+        with module._metrics_lock:
+            module._histograms.clear()
+            module._request_counts.clear()
+            module._query_stats.clear()
+
+def top_queries(functions: Dict[str, Any], limit: int) -> List[Dict[str, Any]]:
+    rows = []
+    for name, module in functions.items():
+        with module._metrics_lock:
+            for fingerprint, (text, calls, seconds, total_rows) in module._query_stats.items():
+                rows.append({
+                    'function': name, 'fingerprint': fingerprint, 'calls': calls,
+                    'total_ms': round(seconds * 1000, 1), 'mean_ms': round(seconds * 1000 / calls, 3),
+                    'rows_per_call': round(total_rows / calls, 1), 'statement': text
+                })
+    return sorted(rows, key=lambda row: row['total_ms'], reverse=True)[:limit]
+
+def print_report(mix: str, summary: Dict[str, Any], queries: List[Dict[str, Any]]) -> None:
+    print(f"\n[{mix}] {summary['count']} requests, {summary['throughput_rps']} req/s, {summary['errors']} errors, "
+          f"p50 {summary['p50_ms']} ms, p95 {summary['p95_ms']} ms, p99 {summary['p99_ms']} ms")
+    print(f"  {'request':<62} {'count':>7} {'p50':>8} {'p95':>8} {'p99':>8} {'5xx':>5}")
+    for label, row in summary['requests'].items():
+        print(f"  {label[:62]:<62} {row['count']:>7} {row['p50_ms']:>8} {row['p95_ms']:>8} {row['p99_ms']:>8} {row['errors']:>5}")
+    if queries:
+        print('  top statements by sampled total time:')
+        for row in queries:
+            print(f"    {row['total_ms']:>9.1f} ms {row['calls']:>6}x {row['mean_ms']:>8.3f} ms/call "
+                  f"{row['rows_per_call']:>8} rows  {row['function']}: {row['statement'][:90]}")
+
+# -- Baseline ------------------------------------------------------------------------
+
+def compare_baseline(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float, min_samples: int) -> List[str]:
+    regressions = []
+    for mix, summary in results.items():
+        reference = baseline.get('mixes', {}).get(mix)
+        if reference is None:
+            continue
+        if summary['throughput_rps'] < reference['throughput_rps'] * (1 - tolerance):
+            regressions.append(f"{mix}: throughput {summary['throughput_rps']} < baseline {reference['throughput_rps']}")
+        for label, row in summary['requests'].items():
+            previous = reference['requests'].get(label)
+            if previous is None or row['count'] < min_samples or previous['count'] < min_samples:
+                continue
+            if row['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+                regressions.append(f"{mix}: {label} p95 {row['p95_ms']} ms > baseline {previous['p95_ms']} ms")
+    return regressions
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mix', action='append', choices=['tests', *MIXES], help='mix to run (repeatable)')
+    parser.add_argument('--duration', type=float, default=20.0, help='seconds per mix')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--sample-rate', default='1.0', help='METRICS_SAMPLE_RATE for the per-query breakdown')
+    parser.add_argument('--top-queries', type=int, default=10)
+    parser.add_argument('--ephemeral', action='store_true', help='create a throwaway Postgres cluster')
+    parser.add_argument('--pg-bin', help='directory with initdb/pg_ctl')
+    parser.add_argument('--scale', type=int, help='seed N synthetic exchanges with datagen.py first')
+    parser.add_argument('--serve', action='store_true', help='only run the HTTP shim until interrupted')
+    parser.add_argument('--baseline', type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--check', action='store_true', help='exit 1 if results regress against the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative regression')
+    parser.add_argument('--min-samples', type=int, default=100, help='requests needed before a label is compared')
+    args = parser.parse_args()
+
+    stop_postgres = None
+    if args.ephemeral:
+        server_url, stop_postgres = start_ephemeral_postgres(args.pg_bin)
+        os.environ['DATABASE_URL'] = create_database(server_url, 'loadtest')
+    elif not os.environ.get('DATABASE_URL'):
+        sys.exit('Set DATABASE_URL or pass --ephemeral')
+    if args.scale:
+        subprocess.run([sys.executable, str(ROOT / 'tools' / 'bench' / 'datagen.py'), '--exchanges', str(args.scale),
+                        '--seed', str(args.seed)], check=True)
+
+    os.environ.setdefault('METRICS_SAMPLE_RATE', args.sample_rate)
+    os.environ.setdefault('SLOW_REQUEST_MS', '60000')
+    functions = load_functions()
+    server = start_shim(functions, args.port)
+    port = server.server_address[1]
+
+    try:
+        if args.serve:
+            print(f'serving {", ".join(FUNCTIONS)} on http://127.0.0.1:{port}/<function>/')
+            threading.Event().wait()
+
+        cases = load_test_cases()
+        print(f'tests.json replay ({len(cases)} cases):')
+        failures = replay_tests(port, cases)
+        ids = id_ranges(os.environ['DATABASE_URL'])
+
+        results = {}
+        for mix in args.mix or ['tests', *MIXES]:
+            reset_metrics(functions)
+            latencies, errors, elapsed = run_mix(port, mix_entries(mix, cases), ids, args.duration, args.concurrency, args.seed)
+            results[mix] = summarize(latencies, errors, elapsed)
+            print_report(mix, results[mix], top_queries(functions, args.top_queries))
+
+        if args.save_baseline:
+            args.baseline.write_text(json.dumps({
+                'meta': {
+                    'duration': args.duration, 'concurrency': args.concurrency,
+                    'python': sys.version.split()[0], 'max_ids': ids, 'scale': args.scale
+                },
+                'mixes': results
+            }, indent=2) + '\n')
+            print(f'\nbaseline written to {args.baseline}')
+        regressions = []
+        if args.check and args.baseline.exists():
+            regressions = compare_baseline(results, json.loads(args.baseline.read_text()), args.tolerance, args.min_samples)
+            print('\nregressions:' if regressions else '\nno regressions against baseline')
+            for line in regressions:
+                print(f'  {line}')
+        if failures or regressions:
+            sys.exit(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        if stop_postgres is not None:
+            stop_postgres()
+
+if __name__ == '__main__':
+    main()
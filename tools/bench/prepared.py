@@ -0,0 +1,125 @@
+"""
+Prepared statement benchmark for the handlers' PREPARED_QUERIES (execute_prepared)
+Runs every registered hot statement against DATABASE_URL (a seeded database, see
+tools/bench/datagen.py) on one connection, alternating rounds of:
+
+- plain: cursor.execute() with the full SQL text, parsed and planned on every call
+- prepared: execute_prepared() with PREPARE_STATEMENTS on, PREPARE once then EXECUTE
+
+and reports the median time per call, the server-side planning time of each form
+(EXPLAIN ANALYZE of the statement vs of its EXECUTE) and whether Postgres settled on a
+generic plan (pg_prepared_statements.generic_plans / custom_plans).
+
+Usage:
+    DATABASE_URL=... python tools/bench/prepared.py [--calls 2000] [--rounds 5] [--only get_exchange,check_transaction]
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+from typing import Any, Dict, List, Tuple
+
+from loadtest import load_functions
+from queryplans import fill, sample_values
+
+# Parameters per (function, statement); {placeholders} are filled from queryplans.SAMPLE_QUERIES.
+SAMPLE_PARAMS: Dict[Tuple[str, str], Tuple[Any, ...]] = {
+    ('exchange-api', 'get_exchange'): ('{exchange_id}',),
+    ('blockchain-api', 'check_transaction'): ('{tx_hash}',),
+    ('blockchain-api', 'transaction_history'): ('{exchange_id}',),
+    ('trading-features-api', 'get_referral_code'): ('{referrer_id}',),
+    ('trading-features-api', 'check_referral_code'): ('WELCOME1',),
+    ('kyc-aml-api', 'client_verification_level'): ('{client_id}',),
+    ('kyc-aml-api', 'exchange_limits'): ('basic',),
+    ('kyc-aml-api', 'daily_volume'): ('{client_id}',),
+    ('kyc-aml-api', 'latest_kyc'): ('{client_id}',)
+}
+
+def time_calls(run, calls: int) -> List[float]:
+    timings = []
+    for _ in range(calls):
+        started = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - started)
+    return timings
+
+def planning_ms(cursor, query: str, params: Tuple[Any, ...]) -> float:
+    cursor.execute(f'EXPLAIN (ANALYZE, FORMAT JSON) {query}', params)
+    return cursor.fetchone()[0][0]['Planning Time']
+
+def bench_statement(conn, module, name: str, params: Tuple[Any, ...], calls: int, rounds: int) -> Dict[str, Any]:
+    cursor = conn.cursor()
+    query = module.PREPARED_QUERIES[name]
+    statement = module.PREPARED_PREFIX + name
+    placeholders = ', '.join(['%s'] * len(params))
+    execute = f'EXECUTE {statement}({placeholders})' if params else f'EXECUTE {statement}'
+
+    def plain() -> None:
+        cursor.execute(query, params)
+        cursor.fetchall()
+
+    def prepared() -> None:
+        module.execute_prepared(cursor, name, params)
+        cursor.fetchall()
+
+    plain_timings: List[float] = []
+    prepared_timings: List[float] = []
+    prepared()
+    for _ in range(rounds):
+        plain_timings += time_calls(plain, calls // rounds)
+        prepared_timings += time_calls(prepared, calls // rounds)
+
+    cursor.execute('SELECT generic_plans, custom_plans FROM pg_prepared_statements WHERE name = %s', (statement,))
+    generic_plans, custom_plans = cursor.fetchone()
+    return {
+        'plain_us': statistics.median(plain_timings) * 1e6,
+        'prepared_us': statistics.median(prepared_timings) * 1e6,
+        'plain_plan_ms': planning_ms(cursor, query, params),
+        'prepared_plan_ms': planning_ms(cursor, execute, params),
+        'plan': 'generic' if generic_plans > custom_plans else 'custom'
+    }
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=2000, help='calls per statement and form')
+    parser.add_argument('--rounds', type=int, default=5, help='alternations between plain and prepared')
+    parser.add_argument('--only', type=lambda value: [name for name in value.split(',') if name],
+                        help='comma-separated statement names (default: all)')
+    args = parser.parse_args()
+    database_url = os.environ.get('DATABASE_URL')
+    if not database_url:
+        sys.exit('DATABASE_URL is not set')
+    os.environ['METRICS_SAMPLE_RATE'] = '0'
+
+    import psycopg2
+    values = sample_values(database_url)
+    modules = load_functions()
+    conn = psycopg2.connect(database_url)
+    conn.autocommit = True
+    print(f"{'statement':<48} {'plain':>9} {'prepared':>9} {'saved':>6}  {'plan ms':>15}  plan")
+    savings = []
+    try:
+        for function, module in modules.items():
+            module.PREPARE_STATEMENTS = True
+            for name in getattr(module, 'PREPARED_QUERIES', {}):
+                if args.only and name not in args.only:
+                    continue
+                params = tuple(fill(dict(enumerate(SAMPLE_PARAMS.get((function, name), ()))), values).values())
+                if module.PREPARED_QUERIES[name].count('%s') != len(params):
+                    print(f'{function}:{name}: no SAMPLE_PARAMS entry, skipped')
+                    continue
+                result = bench_statement(conn, module, name, params, args.calls, args.rounds)
+                saved = 1 - result['prepared_us'] / result['plain_us']
+                savings.append(saved)
+                print(f"{function + ':' + name:<48} {result['plain_us']:>7.0f}us {result['prepared_us']:>7.0f}us "
+                      f"{saved:>6.0%}  {result['plain_plan_ms']:>6.3f} -> {result['prepared_plan_ms']:<6.3f}  {result['plan']}"
+                      f"{'  SLOWER: keep this statement plain' if saved < 0 else ''}")
+    finally:
+        conn.close()
+    if savings:
+        print(f'median saving per call: {statistics.median(savings):.0%} over {len(savings)} statements')
+
+if __name__ == '__main__':
+    main()
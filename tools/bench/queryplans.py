@@ -0,0 +1,572 @@
+"""
+Query plan checker: EXPLAIN (ANALYZE, BUFFERS) for every SQL statement the handlers run
+Drives each backend/*/index.py handler through PLAN_REQUESTS (and its JOBS through PLAN_JOBS) against a seeded database
+and, right before every cursor.execute(), explains the exact statement (parameters
+bound) inside a savepoint that is rolled back; the request's own transaction is
+rolled back as well, so the database is left untouched. For each statement it reports:
+
+- sequential scans on tables above --large-rows, with the filter that forced them
+- row-estimate misses (actual vs planned rows off by more than --estimate-factor)
+- sorts that spill to disk
+- a plan fingerprint (node types, relations and indexes, not costs) so plan changes
+  are detected against the saved baseline with --check
+- CREATE INDEX suggestions for filters no existing index covers
+- execute() call sites in the handlers that no request reached
+
+Usage:
+    DATABASE_URL=... python tools/bench/queryplans.py [--save-baseline] [--check]
+    python tools/bench/queryplans.py --ephemeral --scale 1000000 [--pg-bin ...]
+
+Seed the database with tools/bench/datagen.py first (or pass --scale).
+"""
+
+import argparse
+import ast
+import contextlib
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from loadtest import FUNCTIONS, ROOT, create_database, load_functions, start_ephemeral_postgres
+
+DEFAULT_BASELINE = ROOT / 'tools' / 'bench' / 'queryplans-baseline.json'
+
+# (function, method, query string or body). Placeholders are filled from sample_values():
+# mostly the busiest client and the newest exchange, so plans are checked against the worst
+# case; quiet_client_id covers the opposite end for filters that walk an ordered index.
+PLAN_REQUESTS: List[Tuple[str, str, Dict[str, Any]]] = [
+    ('exchange-api', 'GET', {'action': 'list_exchanges', 'limit': '50'}),
+    ('exchange-api', 'GET', {'action': 'list_exchanges', 'status': 'pending', 'limit': '50'}),
+    ('exchange-api', 'GET', {'action': 'list_exchanges', 'client_id': '{client_id}', 'limit': '50'}),
+    ('exchange-api', 'GET', {'action': 'list_exchanges', 'client_id': '{quiet_client_id}', 'limit': '50'}),
+    ('exchange-api', 'GET', {'action': 'list_exchanges', 'client_email': '{client_email}', 'limit': '50'}),
+    ('exchange-api', 'GET', {'action': 'get_exchange', 'id': '{exchange_id}'}),
+    ('exchange-api', 'GET', {'action': 'list_clients'}),
+    ('exchange-api', 'GET', {'action': 'get_rates'}),
+    ('exchange-api', 'GET', {'action': 'get_candles', 'from_currency': 'BTC', 'to_currency': 'USDT', 'resolution': '1h'}),
+    ('exchange-api', 'GET', {'action': 'get_candles', 'from_currency': 'BTC', 'to_currency': 'USDT', 'resolution': '15m'}),
+    ('exchange-api', 'GET', {'action': 'list_currencies'}),
+    ('exchange-api', 'GET', {'action': 'get_quote', 'from_currency': 'BTC', 'to_currency': 'USDT', 'from_amount': '0.01'}),
+    ('exchange-api', 'GET', {'action': 'get_quote', 'from_currency': 'ETH', 'to_currency': 'USDT', 'from_amount': '0.5',
+                             'referral_code': 'WELCOME1'}),
+    ('exchange-api', 'POST', {'action': 'calculate_fees', 'items': [
+        {'from_currency': 'BTC', 'to_currency': 'USDT', 'amount': 0.01},
+        {'from_currency': 'ETH', 'to_currency': 'BTC', 'amount': 2, 'referral_code': 'TEST1234'}
+    ]}),
+    ('exchange-api', 'POST', {'action': 'create_exchange', 'from_currency': 'BTC', 'to_currency': 'USDT', 'from_amount': 0.002,
+                              'to_amount': 130.0, 'exchange_rate': 65000, 'email': '{client_email}'}),
+    ('exchange-api', 'POST', {'action': 'create_exchange', 'from_currency': 'ETH', 'to_currency': 'USDT', 'from_amount': 0.05,
+                              'to_amount': 160.0, 'exchange_rate': 3200, 'email': 'plan-check@example.com'}),
+    ('exchange-api', 'POST', {'action': 'update_rate', 'from_currency': 'BTC', 'to_currency': 'USDT', 'rate': 65000}),
+    ('exchange-api', 'PUT', {'id': '{processing_exchange_id}', 'status': 'completed'}),
+    ('exchange-api', 'PUT', {'action': 'bulk_update_status', 'ids': ['{exchange_id}', '{processing_exchange_id}'],
+                             'status': 'failed'}),
+    ('admin-api', 'GET', {'resource': 'dashboard'}),
+    ('admin-api', 'GET', {'resource': 'rate_sources'}),
+    ('admin-api', 'GET', {'resource': 'sponsors'}),
+    ('admin-api', 'GET', {'resource': 'settings'}),
+    ('admin-api', 'GET', {'resource': 'currencies'}),
+    ('admin-api', 'GET', {'resource': 'commissions'}),
+    ('admin-api', 'GET', {'resource': 'site_content', 'category': 'hero'}),
+    ('admin-api', 'GET', {'resource': 'payment_providers'}),
+    ('admin-api', 'GET', {'resource': 'system_settings'}),
+    ('admin-api', 'GET', {'resource': 'payment_transaction', 'id': '{payment_id}'}),
+    ('admin-api', 'GET', {'resource': 'reconciliation'}),
+    ('admin-api', 'GET', {'resource': 'reconciliation', 'kind': 'amount_drift', 'limit': '20'}),
+    ('admin-api', 'GET', {'resource': 'ledger'}),
+    ('admin-api', 'GET', {'resource': 'ledger', 'account': 'hot_wallet:ETH', 'limit': '20'}),
+    ('admin-api', 'GET', {'resource': 'site_content'}),
+    ('admin-api', 'POST', {'resource': 'sponsor', 'name': 'Plan check'}),
+    ('admin-api', 'PUT', {'resource': 'sponsor', 'id': 1, 'name': 'Plan check', 'is_active': True, 'display_order': 1}),
+    ('admin-api', 'DELETE', {'resource': 'sponsor', 'id': '1'}),
+    ('admin-api', 'POST', {'resource': 'rate_source', 'name': 'Plan check', 'api_url': 'https://example.com'}),
+    ('admin-api', 'PUT', {'resource': 'rate_source', 'id': 1, 'name': 'Plan check', 'api_url': 'https://example.com',
+                          'api_key_required': False, 'is_active': True, 'priority': 1}),
+    ('admin-api', 'DELETE', {'resource': 'rate_source', 'id': '1'}),
+    ('admin-api', 'POST', {'resource': 'setting', 'setting_key': 'plan_check', 'setting_value': '1'}),
+    ('admin-api', 'POST', {'resource': 'currency', 'symbol': 'PLN', 'name': 'Zloty', 'type': 'fiat'}),
+    ('admin-api', 'PUT', {'resource': 'currency', 'symbol': 'BTC', 'name': 'Bitcoin', 'type': 'crypto', 'decimals': 8,
+                          'is_active': True}),
+    ('admin-api', 'POST', {'resource': 'commission', 'from_currency': 'TON', 'to_currency': 'XMR', 'commission_percent': 1.5}),
+    ('admin-api', 'PUT', {'resource': 'commission', 'id': 1, 'commission_percent': 1.5}),
+    ('admin-api', 'POST', {'resource': 'site_content', 'key': 'plan_check', 'value': 'x'}),
+    ('admin-api', 'PUT', {'resource': 'site_content', 'id': 1, 'value': 'x'}),
+    ('admin-api', 'PUT', {'resource': 'system_setting', 'key': 'maintenance_mode', 'value': 'false'}),
+    ('blockchain-api', 'GET', {'action': 'check_transaction', 'tx_hash': '{tx_hash}'}),
+    ('blockchain-api', 'GET', {'action': 'get_transaction_history', 'exchange_id': '{exchange_id}'}),
+    ('blockchain-api', 'GET', {'action': 'get_wallet_balance'}),
+    ('blockchain-api', 'POST', {'action': 'track_deposit', 'exchange_id': '{exchange_id}', 'tx_hash': '0xplancheck',
+                                'blockchain': 'ethereum', 'amount': 1.0, 'currency': 'ETH'}),
+    ('blockchain-api', 'POST', {'action': 'verify_transaction', 'tx_hash': '{tx_hash}', 'confirmations': 20}),
+    ('blockchain-api', 'POST', {'action': 'initiate_withdrawal', 'exchange_id': '{processing_exchange_id}',
+                                'to_address': '0xplancheck', 'amount': 1.0, 'currency': 'USDT', 'blockchain': 'ethereum'}),
+    ('kyc-aml-api', 'GET', {'action': 'check_limits', 'client_id': '{client_id}', 'amount_usd': '500'}),
+    ('kyc-aml-api', 'GET', {'action': 'get_kyc_status', 'client_id': '{client_id}'}),
+    ('kyc-aml-api', 'GET', {'action': 'get_aml_status', 'client_id': '{client_id}'}),
+    ('kyc-aml-api', 'POST', {'action': 'perform_aml_check', 'client_id': '{client_id}', 'exchange_id': '{exchange_id}'}),
+    ('kyc-aml-api', 'POST', {'action': 'verify_exchange', 'exchange_id': '{exchange_id}', 'client_id': '{client_id}',
+                             'amount_usd': 2500}),
+    ('kyc-aml-api', 'POST', {'action': 'submit_kyc', 'client_id': '{quiet_client_id}', 'verification_level': 'basic',
+                             'document_type': 'passport', 'document_number': '123456789'}),
+    ('kyc-aml-api', 'POST', {'action': 'request_wallet_verification', 'client_id': '{client_id}',
+                             'wallet_address': '0xplancheck', 'currency': 'ETH'}),
+    ('kyc-aml-api', 'PUT', {'action': 'approve_kyc', 'kyc_id': '{kyc_id}'}),
+    ('kyc-aml-api', 'PUT', {'action': 'reject_kyc', 'kyc_id': '{kyc_id}', 'reason': 'Plan check'}),
+    ('trading-features-api', 'GET', {'action': 'get_referral_code', 'client_id': '{referrer_id}'}),
+    ('trading-features-api', 'GET', {'action': 'check_referral_code', 'code': 'WELCOME1'}),
+    ('trading-features-api', 'GET', {'action': 'get_referral_stats', 'client_id': '{referrer_id}'}),
+    ('trading-features-api', 'GET', {'action': 'list_limit_orders', 'client_id': '{client_id}'}),
+    ('trading-features-api', 'GET', {'action': 'get_price_alerts', 'client_id': '{client_id}'}),
+    ('trading-features-api', 'GET', {'action': 'get_trading_analytics', 'currency_pair': 'BTC-USDT', 'days': '30'}),
+    ('trading-features-api', 'POST', {'action': 'create_referral_code', 'client_id': '{quiet_client_id}'}),
+    ('trading-features-api', 'POST', {'action': 'create_price_alert', 'client_id': '{client_id}', 'currency': 'BTC',
+                                      'target_price': 80000, 'condition': 'above'}),
+    ('trading-features-api', 'POST', {'action': 'use_referral_code', 'code': 'WELCOME1', 'exchange_id': '{exchange_id}'}),
+    ('trading-features-api', 'POST', {'action': 'create_limit_order', 'client_id': '{client_id}', 'from_currency': 'BTC',
+                                      'to_currency': 'USDT', 'from_amount': 0.01, 'target_rate': 70000}),
+    ('trading-features-api', 'PUT', {'action': 'cancel_limit_order', 'order_id': '{order_id}'})
+]
+
+# Background jobs (each module's JOBS table) run outside any request; driven directly here.
+PLAN_JOBS = [
+    ('kyc-aml-api', 'aml_check', {'client_id': '{client_id}', 'exchange_id': '{exchange_id}'}),
+    ('kyc-aml-api', 'kyc_review_handoff', {'kyc_id': '{kyc_id}'}),
+    ('blockchain-api', 'withdrawal', {'exchange_id': '{processing_exchange_id}', 'to_address': '0xplancheck',
+                                      'amount': 1.0, 'currency': 'USDT', 'blockchain': 'ethereum'}),
+    ('trading-features-api', 'referral_commission', {'referral_code_id': '{referral_code_id}', 'commission_usd': 1.5,
+                                                     'referral_usage_id': '{referral_usage_id}', 'exchange_id': '{exchange_id}'}),
+    ('trading-features-api', 'referral_settlement', {}),
+    ('exchange-api', 'rate_rollup', {}),
+    ('exchange-api', 'rate_retention', {}),
+    ('exchange-api', 'expiry_sweep', {}),
+    ('admin-api', 'reconcile', {}),
+    ('admin-api', 'ledger_checkpoint', {})
+]
+
+SAMPLE_QUERIES = {
+    'client_id': 'SELECT client_id FROM exchanges WHERE client_id IS NOT NULL GROUP BY client_id ORDER BY COUNT(*) DESC LIMIT 1',
+    'exchange_id': 'SELECT MAX(id) FROM exchanges',
+    'tx_hash': 'SELECT tx_hash FROM blockchain_transactions ORDER BY id DESC LIMIT 1',
+    'kyc_id': "SELECT MAX(id) FROM kyc_verifications WHERE status = 'pending'",
+    'order_id': "SELECT MAX(id) FROM limit_orders WHERE status = 'active'",
+    'payment_id': 'SELECT MAX(id) FROM payment_provider_transactions',
+    'quiet_client_id': 'SELECT client_id FROM exchanges GROUP BY client_id HAVING COUNT(*) = 1 LIMIT 1',
+    'referrer_id': 'SELECT client_id FROM referral_codes ORDER BY total_referrals DESC LIMIT 1',
+    'referral_code_id': 'SELECT id FROM referral_codes ORDER BY total_referrals DESC LIMIT 1',
+    'referral_usage_id': 'SELECT MAX(id) FROM referral_usage',
+    'processing_exchange_id': "SELECT MAX(id) FROM exchanges WHERE status = 'processing' AND withdrawal_tx_hash IS NULL"
+}
+
+COMPARISON = re.compile(r'([\w.]+)\)*(?:::[\w ]+)?\s+(=|>=|<=|>|<|~~\*?)\s+\(*([^\s)]+)')
+SORT_KEY = re.compile(r'^(?:\w+\.)?(\w+)(?:\s+DESC)?')
+
+# -- Capture ----------------------------------------------------------------------------
+
+class ExplainingCursor:
+    """Explains each statement in a savepoint before running it on the wrapped cursor."""
+
+    def __init__(self, cursor, recorder: 'PlanRecorder', conn):
+        self._cursor = cursor
+        self._recorder = recorder
+        self._conn = conn
+
+    def execute(self, query, params=None):
+        self._recorder.explain(self._conn, query, params)
+        return self._cursor.execute(query, params)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+class ExplainingConnection:
+    """Keeps every handler write uncommitted; close() rolls the request back."""
+
+    def __init__(self, conn, recorder: 'PlanRecorder'):
+        self._conn = conn
+        self._recorder = recorder
+
+    def cursor(self, *args, **kwargs):
+        return ExplainingCursor(self._conn.cursor(*args, **kwargs), self._recorder, self._conn)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        self._conn.rollback()
+        self._conn.close()
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+class PlanRecorder:
+    def __init__(self, module, function: str, analyze: bool):
+        self.module = module
+        self.function = function
+        self.analyze = analyze
+        self.statements: Dict[str, Dict[str, Any]] = {}
+        self.sites: Set[str] = set()
+        self.label = ''
+
+    def explain(self, conn, query: str, params) -> None:
+        query_id, text = self.module.query_fingerprint(query if isinstance(query, str) else query.decode())
+        # Helpers copied between modules (enqueue_job) share a fingerprint but are separate sites.
+        site = call_site()
+        self.sites.add(site)
+        if query_id in self.statements:
+            return
+        cursor = conn.cursor()
+        sql = cursor.mogrify(query, params).decode()
+        options = 'ANALYZE, BUFFERS, FORMAT JSON' if self.analyze else 'FORMAT JSON'
+        entry = {'function': self.function, 'site': site, 'request': self.label, 'query': text}
+        cursor.execute('SAVEPOINT plan_check')
+        try:
+            started = time.perf_counter()
+            cursor.execute(f'EXPLAIN ({options}) {sql}')
+            entry['plan'] = cursor.fetchone()[0][0]
+            entry['ms'] = round((time.perf_counter() - started) * 1000, 3)
+        except Exception as error:
+            entry['error'] = str(error).strip().splitlines()[0]
+        cursor.execute('ROLLBACK TO SAVEPOINT plan_check')
+        self.statements[query_id] = entry
+
+PREPARED_HELPERS = ('execute_prepared', 'prepared_session')
+
+def call_site() -> str:
+    frame = sys._getframe(2)
+    while frame is not None:
+        path = Path(frame.f_code.co_filename)
+        if path.name == 'index.py' and path.parent.parent.name == 'backend' and frame.f_code.co_name not in PREPARED_HELPERS:
+            return f'{path.parent.name}:{frame.f_lineno}'
+        frame = frame.f_back
+    return '?'
+
+def execute_sites() -> Dict[str, str]:
+    sites = {}
+    for name in FUNCTIONS:
+        tree = ast.parse((ROOT / 'backend' / name / 'index.py').read_text())
+        for node in ast.walk(tree):
+            # The prepared-statement helpers run their callers' statements; the callers are the sites.
+            if isinstance(node, ast.FunctionDef) and node.name not in PREPARED_HELPERS:
+                for call in ast.walk(node):
+                    if (isinstance(call, ast.Call) and isinstance(call.func, ast.Attribute) and call.func.attr == 'execute'
+                            and isinstance(call.func.value, ast.Name) and call.func.value.id == 'cursor'):
+                        sites[f'{name}:{call.lineno}'] = node.name
+                    elif isinstance(call, ast.Call) and isinstance(call.func, ast.Name) and call.func.id == 'execute_prepared':
+                        sites[f'{name}:{call.lineno}'] = node.name
+    return sites
+
+# -- Requests ---------------------------------------------------------------------------
+
+def sample_values(database_url: str) -> Dict[str, str]:
+    import psycopg2
+    conn = psycopg2.connect(database_url)
+    try:
+        cursor = conn.cursor()
+        values = {}
+        for key, query in SAMPLE_QUERIES.items():
+            cursor.execute(query)
+            row = cursor.fetchone()
+            values[key] = str(row[0]) if row and row[0] is not None else '1'
+        cursor.execute('SELECT email FROM clients WHERE id = %s', (int(values['client_id']),))
+        row = cursor.fetchone()
+        values['client_email'] = row[0] if row else 'nobody@example.com'
+    finally:
+        conn.close()
+    return values
+
+def fill_value(value: Any, values: Dict[str, str]) -> Any:
+    if isinstance(value, list):
+        return [fill_value(item, values) for item in value]
+    if isinstance(value, str) and value.startswith('{') and value.endswith('}'):
+        return values[value[1:-1]]
+    return value
+
+def fill(payload: Dict[str, Any], values: Dict[str, str]) -> Dict[str, Any]:
+    return {key: fill_value(value, values) for key, value in payload.items()}
+
+def run_requests(modules: Dict[str, Any], values: Dict[str, str],
+                 analyze: bool) -> Tuple[Dict[str, Dict], Set[str], List[str]]:
+    recorders = {}
+    failures = []
+    for name, module in modules.items():
+        recorder = recorders[name] = PlanRecorder(module, name, analyze)
+        connect = module.get_db_connection
+        module.get_db_connection = lambda connect=connect, recorder=recorder: ExplainingConnection(connect(), recorder)
+
+    for function, method, payload in PLAN_REQUESTS:
+        payload = fill(payload, values)
+        schema = SCHEMA_CASTS.get((function, method))
+        if schema:
+            payload = {key: schema[key](value) if key in schema else value for key, value in payload.items()}
+        target = payload.get('action') or payload.get('resource') or 'default'
+        recorders[function].label = f'{method} {target}'
+        event = {'httpMethod': method, 'headers': {}, 'isBase64Encoded': False}
+        if method in ('GET', 'DELETE'):
+            event['queryStringParameters'] = payload
+        else:
+            event['queryStringParameters'] = {}
+            event['body'] = json.dumps(payload)
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            response = modules[function].handler(event, SimpleNamespace(request_id='plan-check'))
+        if response['statusCode'] >= 400:
+            failures.append(f"{function} {method} {target}: HTTP {response['statusCode']}")
+
+    for function, kind, payload in PLAN_JOBS:
+        payload = {key: JOB_CASTS[key](value) if key in JOB_CASTS else value for key, value in fill(payload, values).items()}
+        recorders[function].label = f'JOB {kind}'
+        conn = modules[function].get_db_connection()
+        try:
+            modules[function].JOBS[kind](conn, payload)
+        except Exception as error:
+            failures.append(f'{function} job {kind}: {type(error).__name__}: {error}')
+        finally:
+            conn.close()
+
+    statements = {}
+    reached: Set[str] = set()
+    for recorder in recorders.values():
+        statements.update(recorder.statements)
+        reached |= recorder.sites
+    return statements, reached, failures
+
+# Placeholders are strings; bodies need the ids as integers to pass the handlers' schemas.
+SCHEMA_CASTS = {
+    (function, method): {key: int for key in ('id', 'exchange_id', 'client_id', 'kyc_id', 'order_id')}
+    for function in FUNCTIONS for method in ('POST', 'PUT')
+}
+
+JOB_CASTS = {key: int for key in ('client_id', 'exchange_id', 'kyc_id', 'referral_code_id')}
+
+# -- Analysis ---------------------------------------------------------------------------
+
+def table_sizes_and_indexes(database_url: str) -> Tuple[Dict[str, float], Dict[str, Dict[str, List[str]]]]:
+    import psycopg2
+    conn = psycopg2.connect(database_url)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT c.relname, c.reltuples FROM pg_class c
+            WHERE c.relnamespace = current_schema()::regnamespace AND c.relkind = 'r'
+        """)
+        sizes = dict(cursor.fetchall())
+        cursor.execute("""
+            SELECT t.relname, i.indexrelid::regclass::text, ARRAY(SELECT a.attname FROM unnest(i.indkey) WITH ORDINALITY k(attnum, n)
+                                    JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = k.attnum ORDER BY k.n)
+            FROM pg_index i JOIN pg_class t ON t.oid = i.indrelid
+            WHERE t.relnamespace = current_schema()::regnamespace
+        """)
+        indexes: Dict[str, Dict[str, List[str]]] = {}
+        for table, name, columns in cursor.fetchall():
+            indexes.setdefault(table, {})[name] = list(columns)
+    finally:
+        conn.close()
+    return sizes, indexes
+
+def walk(node: Dict[str, Any], parents: Tuple[Dict[str, Any], ...] = ()):
+    yield node, parents
+    for child in node.get('Plans', []):
+        yield from walk(child, parents + (node,))
+
+def plan_shape(node: Dict[str, Any]) -> str:
+    parts = [node['Node Type']]
+    for key in ('Join Type', 'Strategy', 'Relation Name', 'Index Name'):
+        if key in node:
+            parts.append(str(node[key]))
+    children = ', '.join(plan_shape(child) for child in node.get('Plans', []))
+    return ' '.join(parts) + (f' [{children}]' if children else '')
+
+def plan_fingerprint(plan: Dict[str, Any]) -> str:
+    return hashlib.blake2b(plan_shape(plan['Plan']).encode(), digest_size=6).hexdigest()
+
+def filter_columns(condition: str, alias: Optional[str]) -> Tuple[List[str], List[str], List[str]]:
+    equality, ranges, unindexable = [], [], []
+    for left, operator, right in COMPARISON.findall(condition):
+        # Join conditions may name this relation on either side: "(c.id = client_id)".
+        if '.' in left and alias and not left.startswith(f'{alias}.'):
+            if '.' in right and not right.startswith(f'{alias}.') or right.startswith("'"):
+                continue
+            left, right = right, left
+        column = left.rsplit('.', 1)[-1]
+        if operator.startswith('~~'):
+            (unindexable if right.startswith("'%") else ranges).append(column)
+        elif operator == '=':
+            equality.append(column)
+        else:
+            ranges.append(column)
+    return equality, ranges, unindexable
+
+def covered(equality: List[str], ordered: List[str], existing: Dict[str, List[str]]) -> bool:
+    # Equality columns may come in any order, but must lead; the range/sort column follows them.
+    width = len(equality)
+    return any(sorted(index[:width]) == sorted(equality) and index[width:width + len(ordered)] == ordered
+               for index in existing.values())
+
+def suggest(relation: str, equality: List[str], ordered: List[str], indexes: Dict[str, Dict[str, List[str]]]) -> Optional[str]:
+    columns = equality + [column for column in ordered if column not in equality]
+    if not columns or covered(equality, ordered, indexes.get(relation, {})):
+        return None
+    return (f"CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_{relation}_{'_'.join(columns)} "
+            f"ON {relation}({', '.join(columns)});")
+
+def sort_column(sort: Dict[str, Any]) -> List[str]:
+    keys = sort.get('Sort Key') or []
+    match = SORT_KEY.match(keys[0]) if keys else None
+    return [match.group(1)] if match else []
+
+def analyze_plan(entry: Dict[str, Any], sizes: Dict[str, float], indexes: Dict[str, Dict[str, List[str]]],
+                 large_rows: int, estimate_factor: float) -> Tuple[List[str], List[str]]:
+    issues, suggestions = [], []
+    for node, parents in walk(entry['plan']['Plan']):
+        relation = node.get('Relation Name')
+        large = sizes.get(relation, 0) >= large_rows
+        limited = any(parent['Node Type'] == 'Limit' for parent in parents)
+        # A Sort feeding a Limit means the top-N is computed from every matching row.
+        sort = next((parent for parent in reversed(parents) if parent['Node Type'] in ('Sort', 'Incremental Sort')), None)
+        top_n = sort_column(sort) if sort is not None and limited else []
+
+        if node['Node Type'] == 'Seq Scan' and large:
+            condition = node.get('Filter', '')
+            issues.append(f"seq scan on {relation} (~{int(sizes[relation])} rows)" + (f' filter {condition}' if condition else ''))
+            equality, ranges, unindexable = filter_columns(condition, node.get('Alias'))
+            if unindexable:
+                issues.append(f"{relation}.{', '.join(unindexable)}: LIKE with a leading wildcard cannot use a btree index")
+            kept, removed = node.get('Actual Rows', 0), node.get('Rows Removed by Filter', 0)
+            if (equality or ranges) and kept <= (kept + removed) * 0.2:
+                suggestions.append(suggest(relation, equality, ranges[:1] or top_n, indexes))
+        elif large and top_n and node['Node Type'] in ('Index Scan', 'Index Only Scan', 'Bitmap Heap Scan'):
+            equality, _, _ = filter_columns(node.get('Index Cond') or node.get('Recheck Cond') or '', node.get('Alias'))
+            if equality and node.get('Actual Rows', 0) * node.get('Actual Loops', 1) > 100:
+                issues.append(f"top-N sort over {node.get('Actual Rows')} {relation} rows matched by {', '.join(equality)}")
+                suggestions.append(suggest(relation, equality, top_n, indexes))
+        elif large and limited and node['Node Type'] in ('Index Scan', 'Index Only Scan'):
+            # An ordered index walked for a LIMIT that throws most entries away on a filter.
+            kept, removed = node.get('Actual Rows', 0), node.get('Rows Removed by Filter', 0)
+            if removed >= max(kept * 10, large_rows // 10):
+                equality, _, _ = filter_columns(node.get('Filter', ''), node.get('Alias'))
+                order = indexes.get(relation, {}).get(node.get('Index Name'), [])[:1]
+                issues.append(f"index scan {node.get('Index Name')} discarded {removed} {relation} rows by filter "
+                              f"{node.get('Filter')}")
+                if equality:
+                    suggestions.append(suggest(relation, equality, order, indexes))
+
+        planned, actual = node.get('Plan Rows', 0), node.get('Actual Rows')
+        if (actual is not None and node.get('Actual Loops', 0) > 0 and not limited
+                and not node['Node Type'].startswith('Bitmap') and max(planned, actual) >= 1000):
+            ratio = max(planned, 1) / max(actual, 1)
+            if ratio >= estimate_factor or ratio <= 1 / estimate_factor:
+                issues.append(f"row estimate off on {node['Node Type']}{' ' + relation if relation else ''}: "
+                              f"planned {planned}, actual {actual}")
+        if node.get('Sort Space Type') == 'Disk':
+            issues.append(f"sort spilled to disk ({node.get('Sort Space Used')} kB) on {node.get('Sort Key')}")
+    return issues, [suggestion for suggestion in suggestions if suggestion]
+
+# -- Report -----------------------------------------------------------------------------
+
+def report(statements: Dict[str, Dict], sizes, indexes, args) -> Tuple[Dict[str, Dict], List[str]]:
+    results, all_suggestions = {}, []
+    ordered = sorted(statements.items(), key=lambda item: -item[1].get('ms', 0))
+    for query_id, entry in ordered:
+        result = {key: entry[key] for key in ('function', 'site', 'request', 'query')}
+        if 'error' in entry:
+            result['error'] = entry['error']
+            print(f"\n{query_id} {entry['site']} ({entry['request']}) FAILED: {entry['error']}\n  {entry['query'][:160]}")
+            results[query_id] = result
+            continue
+        issues, suggestions = analyze_plan(entry, sizes, indexes, args.large_rows, args.estimate_factor)
+        plan = entry['plan']
+        root = plan['Plan']
+        buffers = root.get('Shared Hit Blocks', 0) + root.get('Shared Read Blocks', 0)
+        result.update({'fingerprint': plan_fingerprint(plan), 'shape': plan_shape(root), 'issues': issues,
+                       'ms': plan.get('Execution Time', entry['ms']), 'buffers': buffers})
+        results[query_id] = result
+        all_suggestions += [s for s in suggestions if s not in all_suggestions]
+        if issues or args.verbose:
+            print(f"\n{query_id} {entry['site']} ({entry['request']}) {result['ms']:.2f} ms, {buffers} buffers")
+            print(f"  {entry['query'][:160]}")
+            print(f"  plan {result['fingerprint']}: {result['shape'][:200]}")
+            for issue in issues:
+                print(f'  ! {issue}')
+    return results, all_suggestions
+
+def compare_baseline(results: Dict[str, Dict], baseline: Dict[str, Any]) -> List[str]:
+    changes = []
+    for query_id, result in results.items():
+        previous = baseline.get('statements', {}).get(query_id, {})
+        if 'fingerprint' not in result:
+            continue
+        if previous and previous.get('fingerprint') != result['fingerprint']:
+            changes.append(f"{query_id} {result['site']}: plan changed\n      was {previous['shape'][:180]}\n      now {result['shape'][:180]}")
+        for issue in result['issues']:
+            if issue not in previous.get('issues', []) and not issue.startswith('row estimate'):
+                changes.append(f"{query_id} {result['site']}: new issue: {issue}")
+    return changes
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--large-rows', type=int, default=10000, help='tables at least this big must not be seq-scanned')
+    parser.add_argument('--estimate-factor', type=float, default=10.0, help='flag planned/actual row ratios beyond this')
+    parser.add_argument('--no-analyze', action='store_true', help='plain EXPLAIN, statements are not executed')
+    parser.add_argument('--verbose', action='store_true', help='print every statement, not only flagged ones')
+    parser.add_argument('--ephemeral', action='store_true', help='create a throwaway Postgres cluster')
+    parser.add_argument('--pg-bin', help='directory with initdb/pg_ctl')
+    parser.add_argument('--scale', type=int, help='seed N synthetic exchanges with datagen.py first')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--baseline', type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--check', action='store_true', help='exit 1 if a plan fingerprint changed or a new issue appeared')
+    args = parser.parse_args()
+
+    stop_postgres = None
+    if args.ephemeral:
+        server_url, stop_postgres = start_ephemeral_postgres(args.pg_bin)
+        os.environ['DATABASE_URL'] = create_database(server_url, 'queryplans')
+    elif not os.environ.get('DATABASE_URL'):
+        sys.exit('Set DATABASE_URL or pass --ephemeral')
+    database_url = os.environ['DATABASE_URL']
+    os.environ['METRICS_SAMPLE_RATE'] = '0'
+
+    try:
+        if args.scale:
+            subprocess.run([sys.executable, str(ROOT / 'tools' / 'bench' / 'datagen.py'), '--exchanges', str(args.scale),
+                            '--seed', str(args.seed)], check=True)
+        sizes, indexes = table_sizes_and_indexes(database_url)
+        statements, reached, failures = run_requests(load_functions(), sample_values(database_url), not args.no_analyze)
+        print(f"{len(statements)} statements from {len(PLAN_REQUESTS)} requests and {len(PLAN_JOBS)} jobs, exchanges ~{int(sizes.get('exchanges', 0))} rows")
+        results, suggestions = report(statements, sizes, indexes, args)
+
+        missed = {site: name for site, name in execute_sites().items() if site not in reached}
+        print(f'\nexecute() sites not reached by PLAN_REQUESTS or PLAN_JOBS: {len(missed)}')
+        for site, name in sorted(missed.items()):
+            print(f'  {site} {name}')
+        for failure in failures:
+            print(f'  request failed: {failure}')
+
+        print('\nsuggested indexes:' if suggestions else '\nno missing indexes found')
+        for suggestion in suggestions:
+            print(f'  {suggestion}')
+
+        if args.save_baseline:
+            args.baseline.write_text(json.dumps({
+                'meta': {'exchanges': int(sizes.get('exchanges', 0)), 'large_rows': args.large_rows},
+                'statements': results
+            }, indent=2, sort_keys=True) + '\n')
+            print(f'\nbaseline written to {args.baseline}')
+        if args.check and args.baseline.exists():
+            changes = compare_baseline(results, json.loads(args.baseline.read_text()))
+            print('\nplan changes:' if changes else '\nno plan changes against baseline')
+            for line in changes:
+                print(f'  {line}')
+            if changes:
+                sys.exit(1)
+    finally:
+        if stop_postgres is not None:
+            stop_postgres()
+
+if __name__ == '__main__':
+    main()
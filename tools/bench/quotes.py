@@ -0,0 +1,74 @@
+"""
+Quote throughput benchmark (exchange-api get_quote / verify_quote)
+Loads the quote book once from DATABASE_URL, then on one core measures:
+
+- issue: get_quote(), pricing from the in-process book and signing the quote id
+- handler: the same through handler(), with routing, validation and instrumentation
+- verify: verify_quote(), the check create_exchange does instead of looking rates up
+
+and compares each with --target quotes/s. Nothing is written to the database.
+
+Usage:
+    DATABASE_URL=... python tools/bench/quotes.py [--seconds 3] [--target 20000] [--pair BTC/USDT] [--amount 0.01]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Callable
+
+from loadtest import load_functions
+
+class Context:
+    request_id = ''
+
+def rate(run: Callable[[], object], seconds: float) -> float:
+    calls = 0
+    started = time.perf_counter()
+    deadline = started + seconds
+    while True:
+        for _ in range(1000):
+            run()
+        calls += 1000
+        now = time.perf_counter()
+        if now >= deadline:
+            return calls / (now - started)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seconds', type=float, default=3.0, help='duration of each phase')
+    parser.add_argument('--target', type=float, default=20000.0, help='quotes/s per core each phase is compared with')
+    parser.add_argument('--pair', default='BTC/USDT')
+    parser.add_argument('--amount', default='0.01')
+    args = parser.parse_args()
+    if not os.environ.get('DATABASE_URL'):
+        sys.exit('DATABASE_URL is not set')
+    os.environ['METRICS_SAMPLE_RATE'] = '0'
+
+    module = load_functions()['exchange-api']
+    # Keep the book and fee table loaded for the whole run: the point is the in-process path, not the reload.
+    module.QUOTE_BOOK_TTL_SECONDS = float('inf')
+    module.FEE_CHECK_SECONDS = float('inf')
+    from_currency, to_currency = args.pair.split('/')
+    params = {'from_currency': from_currency, 'to_currency': to_currency, 'from_amount': args.amount}
+    response = module.get_quote(params)
+    if response['statusCode'] != 200:
+        sys.exit(f"get_quote failed: {response['body']}")
+    quote_id = json.loads(response['body'])['quote_id']
+    event = {'httpMethod': 'GET', 'queryStringParameters': {'action': 'get_quote', **params}, 'headers': {}}
+
+    phases = [
+        ('issue', lambda: module.get_quote(params)),
+        ('handler', lambda: module.handler(event, Context())),
+        ('verify', lambda: module.verify_quote(quote_id))
+    ]
+    print(f'{args.pair} {args.amount}, {args.seconds:.0f}s per phase on one core')
+    for name, run in phases:
+        per_second = rate(run, args.seconds)
+        verdict = 'ok  ' if per_second >= args.target else 'SLOW'
+        print(f'  {verdict} {name:<8} {per_second:>10,.0f} quotes/s  {1e6 / per_second:>6.1f}us each')
+
+if __name__ == '__main__':
+    main()
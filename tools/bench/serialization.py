@@ -0,0 +1,122 @@
+"""
+Benchmark: response serialization of large row sets (list_exchanges-shaped rows)
+Compares the legacy RealDictCursor + dict() + json.dumps(default=str) path with
+fetch_rows() + dump_json() from backend/exchange-api/index.py, where rows stay tuples
+and the handlers' queries cast numeric columns to text.
+
+Usage:
+    python tools/bench/serialization.py [--rows 100000] [--repeat 3]
+
+With DATABASE_URL set, rows are fetched from Postgres via generate_series so the
+cursor side is measured too; otherwise synthetic tuples are serialized.
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import secrets
+import time
+from datetime import datetime
+from decimal import Decimal
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[2]
+
+COLUMNS = (
+    'id', 'client_id', 'from_currency', 'to_currency', 'from_amount', 'to_amount',
+    'exchange_rate', 'status', 'from_wallet', 'to_wallet', 'created_at', 'completed_at',
+    'notes', 'email', 'full_name'
+)
+
+# {cast} is empty for the legacy path and ::text for the current one.
+ROWS_QUERY = """
+    SELECT g AS id, g %% 5000 AS client_id, 'BTC'::varchar AS from_currency, 'USDT'::varchar AS to_currency,
+           (g / 1000.0)::numeric(20, 8){cast} AS from_amount, (g * 60.0)::numeric(20, 8){cast} AS to_amount,
+           60000.12345678::numeric(20, 8){cast} AS exchange_rate, 'pending'::varchar AS status,
+           'bc1qwallet' AS from_wallet, '0xwallet' AS to_wallet,
+           NOW()::timestamp - g * INTERVAL '1 second' AS created_at, NULL::timestamp AS completed_at,
+           '' AS notes, 'client' || (g %% 5000) || '@mail.com' AS email, 'Client ' || (g %% 5000) AS full_name
+    FROM generate_series(1, %s) g
+"""
+
+def load_handler_module(name: str):
+    # Quotes signed here are only ever checked by this process.
+    os.environ.setdefault('QUOTE_SECRET', secrets.token_hex(32))
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), ROOT / 'backend' / name / 'index.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def synthetic_rows(count: int):
+    now = datetime.now()
+    return [
+        (i, i % 5000, 'BTC', 'USDT', Decimal(i) / 1000, Decimal(i) * 60, Decimal('60000.12345678'),
+         'pending', 'bc1qwallet', '0xwallet', now, None, '', f'client{i % 5000}@mail.com', f'Client {i % 5000}')
+        for i in range(count)
+    ]
+
+def timed(fn, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+def bench_synthetic(module, count: int, repeat: int) -> None:
+    from psycopg2.extras import RealDictRow
+    rows = synthetic_rows(count)
+
+    def legacy():
+        records = [RealDictRow(zip(COLUMNS, row)) for row in rows]
+        return json.dumps({'exchanges': [dict(r) for r in records]}, default=str)
+
+    # What the driver hands fetch_rows once the amounts are cast to text.
+    text_rows = [(*row[:4], str(row[4]), str(row[5]), str(row[6]), *row[7:]) for row in rows]
+
+    def current():
+        return module.dump_json({'exchanges': module.Rows(COLUMNS, text_rows)})
+
+    report('synthetic', count, timed(legacy, repeat), timed(current, repeat), module)
+
+def bench_database(module, count: int, repeat: int) -> None:
+    import psycopg2
+    from psycopg2.extras import RealDictCursor
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+
+    def legacy():
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        cursor.execute(ROWS_QUERY.format(cast=''), (count,))
+        return json.dumps({'exchanges': [dict(r) for r in cursor.fetchall()]}, default=str)
+
+    def current():
+        cursor = conn.cursor()
+        cursor.execute(ROWS_QUERY.format(cast='::text'), (count,))
+        return module.dump_json({'exchanges': module.fetch_rows(cursor)})
+
+    try:
+        report('postgres', count, timed(legacy, repeat), timed(current, repeat), module)
+    finally:
+        conn.close()
+
+def report(source: str, count: int, legacy: float, current: float, module) -> None:
+    encoder = 'orjson' if module.orjson is not None else 'stdlib json'
+    print(f'[{source}] {count} rows, encoder={encoder}')
+    print(f'  legacy  RealDictRow + json.dumps(default=str): {legacy * 1000:9.1f} ms')
+    print(f'  current fetch_rows + dump_json:               {current * 1000:9.1f} ms')
+    print(f'  speedup: {legacy / current:.2f}x')
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    module = load_handler_module('exchange-api')
+    bench_synthetic(module, args.rows, args.repeat)
+    if os.environ.get('DATABASE_URL'):
+        bench_database(module, args.rows, args.repeat)
+
+if __name__ == '__main__':
+    main()